@@ -0,0 +1,93 @@
+"""
+Bytes sent over loopback against CPU time for GETs and PUTs of a file,
+compressed with each codec and level the client supports, and with none.
+
+    python bench/codecs.py [--size MB] [--random] [server options]
+
+The file is made up of log lines by default, or random bytes with
+--random, which the server should find not worth compressing.
+"""
+import os
+import random
+import argparse
+
+from common import *
+
+import iotftp
+from iotftp.compress import CODECS
+
+# the levels tried of each codec, from fastest to smallest
+LEVELS = {
+    "zlib": (1, 6, 9),
+    "lzma": (0, 6),
+    "bz2": (1, 9),
+}
+
+def log_lines(size):
+    """
+    Returns size bytes of made up syscall trace lines, the same each run.
+    """
+    rng = random.Random(0)
+    calls = ("read", "write", "openat", "close", "mmap", "futex", "recvfrom")
+    lines = []
+    n = 0
+    while n < size:
+        line = (
+            f"{n:012d} pid={rng.randrange(1, 4096)} {rng.choice(calls)}"
+            f"(fd={rng.randrange(64)}, len={rng.randrange(1 << 16)}) = "
+            f"{rng.randrange(-1, 1 << 16)}\n"
+        )
+        lines.append(line)
+        n += len(line)
+    return "".join(lines).encode()[:size]
+
+def specs():
+    yield None
+    for name, levels in LEVELS.items():
+        if name in CODECS:
+            for level in levels:
+                yield f"{name}:{level}"
+
+def run(srv, name, spec):
+    """
+    Gets the file and puts it back compressed with spec, returning the
+    measurements of each.
+    """
+    client = iotftp.IoTFTPClient("127.0.0.1", srv.port, "ascii", compress=spec, digest=None)
+    with client.session() as s:
+        with quiet(), Measure(srv) as get:
+            s.get(name)
+        os.rename(name, "up")
+        with quiet(), Measure(srv) as put:
+            s.put("up")
+        s.delete("up")
+    os.remove("up")
+    return get, put
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=32,
+        help="size of the file, in MB")
+    parser.add_argument("--random", action="store_true",
+        help="transfer random bytes instead of log lines")
+    args, server_args = parser.parse_known_args()
+
+    size = args.size << 20
+    with tempdir() as srvroot, tempdir() as cliroot:
+        os.chdir(cliroot)
+        name, = make_files(srvroot, [size], data=os.urandom if args.random else log_lines)
+        with Server(srvroot, *server_args) as srv:
+            print(
+                f"{'codec':>7} {'dir':>3} {'wire MB':>8} {'ratio':>6} {'MB/s':>6} "
+                f"{'server CPU s':>12} {'client CPU s':>12}"
+            )
+            for spec in specs():
+                for direction, m in zip(("GET", "PUT"), run(srv, name, spec)):
+                    print(
+                        f"{spec or 'none':>7} {direction:>3} {m.wire / (1 << 20):>8.1f} "
+                        f"{m.wire / size:>6.3f} {size / m.wall / (1 << 20):>6.0f} "
+                        f"{m.server_cpu:>12.2f} {m.cpu:>12.2f}"
+                    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import io
+import os
+import sys
+import time
+import socket
+import tempfile
+import subprocess
+import contextlib
+
+# the benchmarks run from a checkout, against the library in it
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# runs server.py, after turning sendfile off if asked to
+RUNNER = """
+import sys, runpy
+sys.path.insert(0, {root!r})
+if not {sendfile!r}:
+    import iotftp.transfer
+    iotftp.transfer.HAS_SENDFILE = False
+sys.argv[0] = {script!r}
+runpy.run_path({script!r}, run_name="__main__")
+"""
+
+TICKS = os.sysconf("SC_CLK_TCK")
+
+class Server:
+    """
+    Runs the server on loopback in a process of its own, serving root,
+    so the CPU time it uses can be told apart from the client's.
+
+        with Server(root) as srv:
+            client = iotftp.IoTFTPClient("127.0.0.1", srv.port, "ascii")
+    """
+    def __init__(self, root, *args, sendfile=True):
+        self.root = root
+        self.args = args
+        self.sendfile = sendfile
+        self.port = None
+        self.proc = None
+
+    def __enter__(self):
+        self.port = free_port()
+        script = os.path.join(ROOT, "server.py")
+        code = RUNNER.format(root=ROOT, sendfile=self.sendfile, script=script)
+        self.proc = subprocess.Popen(
+            [sys.executable, "-c", code, "127.0.0.1", str(self.port),
+             "--workers", "1", *self.args],
+            cwd=self.root,
+        )
+        self.wait_listening()
+        return self
+
+    def __exit__(self, *exc):
+        self.proc.terminate()
+        self.proc.wait()
+
+    def wait_listening(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"server exited with {self.proc.returncode}")
+            if self.port in listening_ports():
+                return
+            time.sleep(0.05)
+        raise TimeoutError("server did not start listening")
+
+    def cpu(self):
+        """
+        Returns the CPU time the server has used so far, in seconds.
+        """
+        with open(f"/proc/{self.proc.pid}/stat") as f:
+            # the command name may hold spaces, so split after it
+            fields = f.read().rpartition(")")[2].split()
+        # utime and stime, the 14th and 15th fields
+        return (int(fields[11]) + int(fields[12])) / TICKS
+
+    def sockets(self):
+        """
+        Returns the inodes of the sockets the server has open.
+        """
+        inodes = set()
+        fds = f"/proc/{self.proc.pid}/fd"
+        for fd in os.listdir(fds):
+            try:
+                target = os.readlink(os.path.join(fds, fd))
+            except OSError:
+                continue
+            if target.startswith("socket:["):
+                inodes.add(target[8:-1])
+        return inodes
+
+class Measure:
+    """
+    Measures the wall time and CPU time of the client and server over a
+    block, and the bytes sent over loopback, which take in everything on
+    the loopback interface, TCP and IP headers included.
+    """
+    def __init__(self, server):
+        self.server = server
+
+    def __enter__(self):
+        self.wire = loopback_bytes()
+        self.cpu = time.process_time()
+        self.server_cpu = self.server.cpu()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self.start
+        self.server_cpu = self.server.cpu() - self.server_cpu
+        self.cpu = time.process_time() - self.cpu
+        self.wire = loopback_bytes() - self.wire
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def tcp_sockets():
+    """
+    Yields the local port, remote port, state and inode of every TCP
+    socket on the host, states given as in /proc/net/tcp.
+    """
+    for path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            f = open(path)
+        except FileNotFoundError:
+            continue
+        with f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                local = int(fields[1].rpartition(":")[2], 16)
+                remote = int(fields[2].rpartition(":")[2], 16)
+                yield local, remote, fields[3], fields[9]
+
+TCP_LISTEN = "0A"
+TCP_TIME_WAIT = "06"
+
+def listening_ports():
+    return {port for port, _, state, _ in tcp_sockets() if state == TCP_LISTEN}
+
+def loopback_bytes():
+    with open("/proc/net/dev") as f:
+        for line in f:
+            name, _, counters = line.partition(":")
+            if name.strip() == "lo":
+                # the bytes transmitted, after the eight receive counters
+                return int(counters.split()[8])
+    return 0
+
+def make_files(root, sizes, count=1, data=os.urandom):
+    """
+    Creates count files of each size in root, returning their names.
+    """
+    names = []
+    for size in sizes:
+        for i in range(count):
+            name = f"f{size}-{i}"
+            with open(os.path.join(root, name), "wb") as f:
+                f.write(data(size))
+            names.append(name)
+    return names
+
+def tempdir():
+    return tempfile.TemporaryDirectory(prefix="iotftp-bench-")
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Keeps the progress the client prints out of the results.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+def remove(names):
+    for name in names:
+        os.remove(name)
@@ -0,0 +1,98 @@
+"""
+Connection rate and bulk throughput of the selectors and asyncio engines.
+
+    python bench/engines.py [--conns N] [--clients N] [--size MB] [server options]
+
+The connection rate is of clients that connect, read the welcome, ask to
+delete a file that is not there and hang up, from one thread and from
+several at once. Throughput is of a GET and a PUT of a large file,
+digests off.
+"""
+import os
+import time
+import socket
+import argparse
+import threading
+
+from common import *
+
+import iotftp
+
+ENGINES = ("selectors", "asyncio")
+
+def connect_loop(port, count):
+    for _ in range(count):
+        with socket.create_connection(("127.0.0.1", port)) as s:
+            s.recv(512)
+            s.sendall(b"DEL\nmissing")
+            if not s.recv(512):
+                raise ConnectionError("server hung up")
+
+def conn_rate(srv, count, clients):
+    """
+    Returns the connections per second made over clients threads.
+    """
+    threads = [
+        threading.Thread(target=connect_loop, args=(srv.port, count // clients))
+        for _ in range(clients)
+    ]
+    with Measure(srv) as m:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    return count // clients * clients / m.wall, m
+
+def bulk(srv, name, runs):
+    """
+    Gets the file and puts it back runs times, returning the fastest of
+    each.
+    """
+    client = iotftp.IoTFTPClient("127.0.0.1", srv.port, "ascii", digest=None)
+    best_get = best_put = None
+    with client.session() as s:
+        for _ in range(runs):
+            with quiet(), Measure(srv) as get:
+                s.get(name)
+            os.rename(name, "up")
+            with quiet(), Measure(srv) as put:
+                s.put("up")
+            s.delete("up")
+            os.remove("up")
+            if best_get is None or get.wall < best_get.wall:
+                best_get = get
+            if best_put is None or put.wall < best_put.wall:
+                best_put = put
+    return best_get, best_put
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--conns", type=int, default=2000,
+        help="connections to make for the connection rate")
+    parser.add_argument("--clients", type=int, default=8,
+        help="threads making connections at once")
+    parser.add_argument("--size", type=int, default=256,
+        help="size of the file to get and put, in MB")
+    parser.add_argument("--runs", type=int, default=3,
+        help="times to get and put the file, keeping the fastest")
+    args, server_args = parser.parse_known_args()
+
+    size = args.size << 20
+    with tempdir() as srvroot, tempdir() as cliroot:
+        os.chdir(cliroot)
+        name, = make_files(srvroot, [size])
+
+        print(f"{'engine':>9} {'test':>12} {'rate':>12} {'server CPU s':>13}")
+        for engine in ENGINES:
+            with Server(srvroot, "--engine", engine, *server_args) as srv:
+                for clients in (1, args.clients):
+                    rate, m = conn_rate(srv, args.conns, clients)
+                    test = f"conns x{clients}"
+                    print(f"{engine:>9} {test:>12} {rate:>8.0f}/s   {m.server_cpu:>13.2f}")
+                get, put = bulk(srv, name, args.runs)
+                for test, m in (("GET", get), ("PUT", put)):
+                    mbs = size / m.wall / (1 << 20)
+                    print(f"{engine:>9} {test:>12} {mbs:>6.0f} MB/s   {m.server_cpu:>13.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""
+Files per second getting and putting small files through one session, over
+a data connection per file, multiplexed onto the main connection, and
+inline with the command or reply.
+
+    python bench/inline.py [--count N] [--sizes BYTES ...] [server options]
+"""
+import os
+import argparse
+
+from common import *
+
+import iotftp
+
+WAYS = {
+    "data conn": dict(mux=False, inline=0),
+    "mux": dict(mux=True, inline=0),
+    "inline": dict(mux=True),
+}
+
+def get(session, names):
+    for name in names:
+        session.get(name)
+
+def put(session, names):
+    for name in names:
+        session.put(name)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=500,
+        help="files of each size to transfer each way")
+    parser.add_argument("--sizes", type=int, nargs="+",
+        default=[1 << 10, 4 << 10, 16 << 10, 64 << 10],
+        help="sizes of the files, in bytes")
+    args, server_args = parser.parse_known_args()
+
+    with tempdir() as srvroot, tempdir() as cliroot:
+        os.chdir(cliroot)
+        print(f"{'size':>6} {'way':>9} {'GET files/s':>12} {'PUT files/s':>12} {'server CPU ms/file':>19}")
+        for size in args.sizes:
+            names = make_files(srvroot, [size], args.count)
+            with Server(srvroot, *server_args) as srv:
+                for way, opts in WAYS.items():
+                    client = iotftp.IoTFTPClient("127.0.0.1", srv.port, "ascii", **opts)
+                    with client.session() as s:
+                        with quiet(), Measure(srv) as g:
+                            get(s, names)
+                        # put back the files just got, under the same names
+                        remove(os.path.join(srvroot, name) for name in names)
+                        with quiet(), Measure(srv) as p:
+                            put(s, names)
+                    remove(names)
+                    print(
+                        f"{size:>6} {way:>9} "
+                        f"{args.count / g.wall:>12.0f} {args.count / p.wall:>12.0f} "
+                        f"{(g.server_cpu + p.server_cpu) / (2 * args.count) * 1000:>19.3f}"
+                    )
+            remove(os.path.join(srvroot, name) for name in names)
+
+if __name__ == "__main__":
+    main()
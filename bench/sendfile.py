@@ -0,0 +1,57 @@
+"""
+Loopback throughput and server CPU time of GETs of a large file, sent with
+sendfile and with the read/send loop it falls back to.
+
+    python bench/sendfile.py [--size MB] [--runs N] [server options]
+
+Digests are off, since a hashed GET never goes through sendfile. Only the
+selectors engine falls back to read/send when told to: data threads and
+the asyncio engine go through socket.sendfile and loop.sock_sendfile,
+which pick for themselves.
+"""
+import os
+import argparse
+
+from common import *
+
+import iotftp
+
+def run(srv, name, runs):
+    """
+    Gets the file runs times, returning the best wall time and the server
+    and client CPU time of that run.
+    """
+    client = iotftp.IoTFTPClient("127.0.0.1", srv.port, "ascii", digest=None)
+    best = None
+    with client.session() as s:
+        for _ in range(runs):
+            with quiet(), Measure(srv) as m:
+                s.get(name)
+            os.remove(name)
+            if best is None or m.wall < best.wall:
+                best = m
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=256,
+        help="size of the file to get, in MB")
+    parser.add_argument("--runs", type=int, default=5,
+        help="times to get the file with each, keeping the fastest")
+    args, server_args = parser.parse_known_args()
+
+    size = args.size << 20
+    with tempdir() as srvroot, tempdir() as cliroot:
+        os.chdir(cliroot)
+        name, = make_files(srvroot, [size])
+        print(f"{'path':>9} {'MB/s':>8} {'server CPU s':>13} {'CPU s/GB':>9} {'client CPU s':>13}")
+        for path, sendfile in (("sendfile", True), ("read/send", False)):
+            with Server(srvroot, *server_args, sendfile=sendfile) as srv:
+                m = run(srv, name, args.runs)
+            print(
+                f"{path:>9} {size / m.wall / (1 << 20):>8.0f} {m.server_cpu:>13.2f} "
+                f"{m.server_cpu / (size / (1 << 30)):>9.2f} {m.cpu:>13.2f}"
+            )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""
+Per-file overhead of getting small files with a connection per file, as
+the client did before sessions, through one session, and through a pool
+of sessions from several threads.
+
+    python bench/session.py [--count N] [--size BYTES] [server options]
+"""
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from common import *
+
+import iotftp
+
+def oneshot(client, names):
+    for name in names:
+        client.get(name)
+
+def session(client, names):
+    with client.session() as s:
+        for name in names:
+            s.get(name)
+
+def pool(client, names, size=4):
+    with client.pool(size) as p, ThreadPoolExecutor(size) as ex:
+        list(ex.map(p.get, names))
+
+WAYS = {
+    "one-shot": oneshot,
+    "session": session,
+    "pool x4": pool,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=500,
+        help="files to get each way")
+    parser.add_argument("--size", type=int, default=1 << 10,
+        help="size of the files, in bytes")
+    args, server_args = parser.parse_known_args()
+
+    with tempdir() as srvroot, tempdir() as cliroot:
+        os.chdir(cliroot)
+        names = make_files(srvroot, [args.size], args.count)
+        with Server(srvroot, *server_args) as srv:
+            print(f"{'way':>9} {'ms/file':>8} {'files/s':>8} {'server CPU ms/file':>19}")
+            client = iotftp.IoTFTPClient("127.0.0.1", srv.port, "ascii")
+            for way, fn in WAYS.items():
+                with quiet(), Measure(srv) as m:
+                    fn(client, names)
+                remove(names)
+                print(
+                    f"{way:>9} "
+                    f"{m.wall / args.count * 1000:>8.3f} {args.count / m.wall:>8.0f} "
+                    f"{m.server_cpu / args.count * 1000:>19.3f}"
+                )
+
+if __name__ == "__main__":
+    main()
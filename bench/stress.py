@@ -0,0 +1,107 @@
+"""
+Runs rounds of GETs and PUTs over data connections from several clients at
+once, and checks that the server's port usage stays flat: the sockets it
+listens on, the sockets it has open, and the TIME_WAIT sockets left on its
+ports.
+
+    python bench/stress.py [--rounds N] [--transfers N] [--clients N] [server options]
+
+Exits with 1 if any of them grew.
+"""
+import os
+import sys
+import argparse
+import threading
+
+from common import *
+
+import iotftp
+
+def usage(srv, ports):
+    """
+    Samples the server's port usage, adding the ports it listens on to
+    ports. Returns the number of listening sockets, open sockets and
+    TIME_WAIT sockets on its ports, and TIME_WAIT sockets on the host.
+    """
+    inodes = srv.sockets()
+    sockets = list(tcp_sockets())
+    listening = {
+        local for local, _, state, inode in sockets
+        if state == TCP_LISTEN and inode in inodes
+    }
+    ports |= listening
+    # sockets in TIME_WAIT belong to no process, so the server's are told
+    # apart by their local port
+    waiting = [(local, remote) for local, remote, state, _ in sockets if state == TCP_TIME_WAIT]
+    server_waiting = sum(1 for local, _ in waiting if local in ports)
+    return len(listening), len(inodes), server_waiting, len(waiting)
+
+def transfer(client, names, errors):
+    try:
+        for name in names:
+            upload = "up-" + name
+            client.get(name)
+            os.rename(name, upload)
+            client.put(upload)
+            client.delete(upload)
+            os.remove(upload)
+    except Exception as e:
+        errors.append(e)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--transfers", type=int, default=400,
+        help="GETs, and as many PUTs, in each round")
+    parser.add_argument("--clients", type=int, default=8,
+        help="clients transferring at once")
+    parser.add_argument("--size", type=int, default=16 << 10,
+        help="size of the files transferred, in bytes")
+    args, server_args = parser.parse_known_args()
+
+    with tempdir() as srvroot, tempdir() as cliroot:
+        os.chdir(cliroot)
+        names = make_files(srvroot, [args.size], args.clients)
+        per_client = args.transfers // args.clients
+
+        with Server(srvroot, *server_args) as srv:
+            client = iotftp.IoTFTPClient("127.0.0.1", srv.port, "ascii")
+            ports = set()
+            samples = [usage(srv, ports)]
+            print(f"{'round':>5} {'listening':>9} {'sockets':>7} {'server TIME_WAIT':>16} {'host TIME_WAIT':>14}")
+            print(f"{'idle':>5} {samples[0][0]:>9} {samples[0][1]:>7} {samples[0][2]:>16} {samples[0][3]:>14}")
+
+            for n in range(1, args.rounds + 1):
+                errors = []
+                # each client transfers a file of its own, so none clash
+                threads = [
+                    threading.Thread(target=transfer, args=(client, [name] * per_client, errors))
+                    for name in names
+                ]
+                with quiet():
+                    for t in threads:
+                        t.start()
+                    for t in threads:
+                        t.join()
+                if errors:
+                    raise errors[0]
+                samples.append(usage(srv, ports))
+                listening, sockets, server_waiting, waiting = samples[-1]
+                print(f"{n:>5} {listening:>9} {sockets:>7} {server_waiting:>16} {waiting:>14}")
+
+        steady = samples[1:]
+        failed = []
+        if len({s[0] for s in samples}) > 1:
+            failed.append("listening sockets changed")
+        # main connections the server has yet to see hang up may come on
+        # top of those idle
+        if max(s[1] for s in steady) > samples[0][1] + args.clients:
+            failed.append("sockets leaked")
+        if steady[-1][2] > max(steady[0][2], 1) * 2:
+            failed.append("TIME_WAIT sockets on the server's ports kept growing")
+        for f in failed:
+            print("FAIL:", f)
+        sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
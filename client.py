@@ -37,18 +37,51 @@ def run(client, args):
             client.put(args[1])
         case "del":
             client.delete(args[1])
+        case "size":
+            print(client.size(args[1]))
+        case "reget":
+            client.get(args[1], resume=True)
+        case "reput":
+            client.put(args[1], resume=True)
+        case "dput":
+            client.dput(args[1])
+        case "mget":
+            print(client.mget(*args[1:]))
+        case "mput":
+            print(client.mput(*args[1:]))
+        case "tget":
+            print(client.tget(args[1]))
+        case "pwd":
+            print(client.pwd())
+        case "lsd":
+            for entry in client.lsd(*args[1:2]):
+                print(*entry)
+        case "cwd":
+            client.cwd(args[1])
+        case "pull":
+            # pull DIR [TOKEN], printing the token for the next pull
+            token, results = client.pull(args[1], token=args[2] if len(args) > 2 else None)
+            print(token, results)
         case "bye":
             client.bye()
 
 
 def main():
     ipaddr, port, encoding = sys.argv[1], int(sys.argv[2]), "ascii"
-    client = iotftp.IoTFTPClient(ipaddr, port, encoding)
+    # optional compression spec for GET and PUT, e.g. zlib:6, or - for none
+    compress = sys.argv[3] if len(sys.argv) > 3 and sys.argv[3] != "-" else None
+    # optional number of data connections to split GET and PUT across
+    streams = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    client = iotftp.IoTFTPClient(ipaddr, port, encoding, compress, streams)
+    # one session for every command, so the working directory is kept
+    session = client.session()
     
     while True:
         try:
+            if session.closed:
+                session = client.session()
             args = parse_command(input(PROMPT))
-            run(client, args)
+            run(session, args)
         except OSError as e:
             print(repr(e))
         except Exception as e:
@@ -1,2 +1,7 @@
 from iotftp.server import *
+from iotftp.asyncserver import *
+from iotftp.workers import *
+from iotftp.store import *
+from iotftp.index import *
+from iotftp.trace import *
 from iotftp.client import *
\ No newline at end of file
@@ -0,0 +1,1327 @@
+import os
+import logging
+import socket
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from iotftp.utils import *
+from iotftp.transfer import (
+    BufferPool, FileSender, FileReceiver, CompressedSender, RangeSender,
+    RangeReceiver, split_ranges, received_prefix, pack_range, reopen, preallocate,
+    write_at,
+)
+from iotftp.compress import parse_spec, format_spec, probe
+from iotftp.digest import DIGESTS, new_hasher, format_digest
+from iotftp.ports import DataPortPool
+from iotftp.cmds.size import file_size
+from iotftp.cmds.put import open_partial
+from iotftp.cmds.mget import expand, open_entry, pack_header, send_entries
+from iotftp.cmds.tget import (
+    open_tree, next_member, block_padding, end_of_archive, send_tree,
+)
+from iotftp.cmds.mput import (
+    open_upload, upload_error, take_header, parse_header, recv_entries,
+)
+from iotftp.cmds.dput import exchange
+from iotftp.cmds.lsd import ListingCache, listing_error
+from iotftp.cmds.sync import list_changes
+from iotftp.cmds.cwd import check_dir
+from iotftp.index import parse_token
+from iotftp.trace import tracer
+from iotftp.framing import FRAME_START, FramedStream, MuxChannel
+from iotftp.delta import open_delta
+
+logger = logging.getLogger()
+
+class CommandFailed(Exception):
+    """
+    Raised by a command coroutine when the command cannot be completed.
+    The error is sent to the client, which must then acknowledge it.
+    """
+    def __init__(self, err: CommandError):
+        self.err = err
+
+    def __repr__(self):
+        return f"CommandFailed({self.err})"
+
+class IoTFTPAsyncServer:
+    """
+    An asyncio implementation of the server, speaking the same protocol
+    as IoTFTPServer.
+
+    Each client is served by its own coroutine, and each command is a
+    coroutine that runs the whole exchange for that command, including
+    its data connection.
+    """
+
+    # class attributes
+    host = "127.0.0.1"
+    delimiter = b"\n"
+    startmsg = b"HI"
+
+    def __init__(self, ipaddr, port, encoding, dataports=DEF_DATAPORTS,
+                 reuseport=False, clients=None, fsworkers=DEF_FS_WORKERS,
+                 datathreads=0, maxstreams=DEF_MAX_STREAMS, store=None, index=None,
+                 inlinesize=DEF_INLINE_SIZE, muxsize=DEF_MUX_SIZE):
+        if not validate_ip(ipaddr):
+            raise InvalidIPException()
+        # the port listening on
+        self.port = port
+        # all information needed for the user
+        self.cwd = os.getcwd()
+        self.user = login_name()
+        self.euid = os.geteuid()
+        # number of active connections, which may be shared with other
+        # worker processes serving the same port
+        self.clients = clients if clients is not None else ClientTracker()
+        # the encoding to use for protocol commands
+        self.encoding = encoding
+        # receive buffers shared by all transfers
+        self.bufpool = BufferPool()
+        # data ports leased out to transfers
+        self.ports = DataPortPool(ipaddr, dataports)
+        # threads running blocking filesystem work
+        self.fs = ThreadPoolExecutor(
+            max_workers=fsworkers, thread_name_prefix="iotftp-fs"
+        )
+        # threads running whole transfer bodies, if data-plane mode is on
+        self.dataplane = None
+        if datathreads > 0:
+            self.dataplane = ThreadPoolExecutor(
+                max_workers=datathreads, thread_name_prefix="iotftp-data"
+            )
+        # most data connections a transfer can be split across
+        self.maxstreams = maxstreams
+        # the content store uploads are deduplicated against, if any
+        self.store = store
+        # listings of the directories listed lately, shared by every client
+        self.listings = ListingCache()
+        # the index of the files under cwd that SYNC answers from, if any
+        self.index = index
+        # largest file sent inline with a GET reply or a PUT command
+        self.inlinesize = inlinesize
+        # largest transfer multiplexed onto the main connection of a client
+        self.muxsize = muxsize
+        # track whether the server should be running
+        self.running = False
+        # the listening socket
+        self.listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuseport:
+            # let other worker processes listen on the same port
+            self.listensock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # the asyncio server, created once the loop is running
+        self.server = None
+
+        IoTFTPAsyncServer.host = ipaddr
+
+    def start(self):
+        self.listensock.bind((IoTFTPAsyncServer.host, self.port))
+        self.listensock.setblocking(False)
+        self.listensock.listen()
+        self.ports.open()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+
+        self.listensock.close()
+        self.ports.close()
+        self.fs.shutdown(wait=True, cancel_futures=True)
+        if self.dataplane is not None:
+            self.dataplane.shutdown(wait=True, cancel_futures=True)
+
+    def run(self):
+        logger.debug("[*] Running async server")
+        asyncio.run(self.serve())
+        self.stop()
+
+    async def serve(self):
+        self.running = True
+        self.server = await asyncio.start_server(
+            self.handle_client, sock=self.listensock
+        )
+        async with self.server:
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                # server closed by BYE
+                pass
+
+    def shutdown(self):
+        """
+        Stops accepting clients and ends serve().
+        """
+        self.running = False
+        if self.server is not None:
+            self.server.close()
+
+    def welcome(self):
+        """
+        Returns the welcome message and relevant information.
+        """
+        send = [
+            IoTFTPAsyncServer.startmsg,
+            bytes(",".join((VERSION, FRAMED_VERSION)), self.encoding),
+            bytes(self.cwd, self.encoding),
+            bytes(self.user, self.encoding),
+            bytes(str(self.euid), self.encoding),
+            bytes(" ".join(format_opts(server_features(self.maxstreams, self.store, self.index, self.inlinesize))), self.encoding),
+        ]
+        return IoTFTPAsyncServer.delimiter.join(send)
+
+    async def handle_client(self, reader, writer):
+        """
+        Serves a main connection until the client closes it.
+        """
+        if tracer.on:
+            start = tracer.clock()
+        addr = writer.get_extra_info("peername")
+        logger.debug("[*] Got connection from %s", addr)
+        self.clients.connect()
+        # every connection starts out in the server's directory
+        data = ConnData(ConnType.COMMAND, addr, ConnState.NON, None)
+        data.cwd = self.cwd
+
+        try:
+            writer.write(self.welcome())
+            await writer.drain()
+            if tracer.on:
+                # the phases of a connection are tracked by its task
+                tracer.label(asyncio.current_task(), addr)
+                tracer.record(asyncio.current_task(), "accept", start)
+
+            stream = None
+            while self.running:
+                if stream is not None:
+                    cmd = await stream.read_command()
+                else:
+                    cmd = await reader.read(MAX_COMMAND)
+                    if cmd[:1] == bytes([FRAME_START]):
+                        # the client frames every message from here on
+                        logger.debug("Client frames its commands")
+                        stream = FramedStream(reader, writer, cmd)
+                        reader = writer = stream
+                        cmd = await stream.read_command()
+                if not cmd:
+                    raise ConnClosedErr()
+
+                try:
+                    await self.evalcmd(cmd, data, reader, writer)
+                    if tracer.on:
+                        tracer.finish(asyncio.current_task())
+                except CommandFailed as e:
+                    if tracer.on:
+                        tracer.abandon(asyncio.current_task())
+                    logger.debug("[*] Sending error message for error %s", e.err)
+                    writer.write(e.err.value)
+                    await writer.drain()
+                    await self.expect_ack(reader)
+        except ConnectionResetError:
+            logger.debug("[%s] Connection reset by peer", addr)
+        except ConnClosedErr:
+            logger.debug("[%s] Connection closed by peer", addr)
+        except BrokenPipeError:
+            logger.debug("[%s] Connection closed on write", addr)
+        except TimeoutError:
+            logger.debug("[%s] Connection timed out, closing", addr)
+        except Exception:
+            # a bug serving one client must not take the others down
+            logger.exception("[%s] Error serving client, closing", addr)
+        finally:
+            logger.debug("[*] Closing connection %s", addr)
+            writer.close()
+            if tracer.on:
+                tracer.forget(asyncio.current_task())
+            # exit if a client asked us to once everyone has left
+            if self.clients.disconnect() == 0 and self.clients.close_requested():
+                logger.debug("[*] Last client left, exiting")
+                self.shutdown()
+
+    async def evalcmd(self, cmd, data, reader, writer):
+        """
+        Parses a command sent by a client and runs its coroutine.
+        """
+        if tracer.on:
+            start = tracer.clock()
+        # a PUT may carry the file it uploads inline, after an empty field
+        cmd, body = split_inline(cmd, IoTFTPAsyncServer.delimiter)
+        cmd = cmd.decode(self.encoding).split(
+            IoTFTPAsyncServer.delimiter.decode(self.encoding)
+        )
+        command, args = cmd[0], cmd[1:]
+        if body is not None and command != "PUT":
+            raise CommandFailed(CommandError.ERR_ARGS)
+        if tracer.on:
+            task = asyncio.current_task()
+            tracer.label(task, data.addr, command)
+            tracer.record(task, "parse", start)
+            tracer.begin(task, "command", start)
+
+        match command:
+            case "GET":
+                logger.debug("Got GET command")
+                if len(args) < 1 or not args[0]:
+                    raise CommandFailed(CommandError.ERR_ARGS)
+                path = resolve(data.cwd, args[0])
+                await self.get(path, self.options(args[1:]), reader, writer)
+            case "PUT":
+                logger.debug("Got PUT command")
+                if len(args) < 2 or not args[0]:
+                    raise CommandFailed(CommandError.ERR_ARGS)
+                path = resolve(data.cwd, args[0])
+                await self.put(path, args[1], self.options(args[2:]), reader, writer, body)
+            case "DPUT":
+                logger.debug("Got DPUT command")
+                if len(args) < 2 or not args[0]:
+                    raise CommandFailed(CommandError.ERR_ARGS)
+                path = resolve(data.cwd, args[0])
+                await self.dput(path, args[1], self.options(args[2:]), reader, writer)
+            case "DEL":
+                logger.debug("Got DEL command")
+                if len(args) != 1:
+                    raise CommandFailed(CommandError.ERR_ARGS)
+                if not args[0]:
+                    # an empty path would resolve to the working directory
+                    raise CommandFailed(CommandError.ERR_NONE)
+                await self.delete(resolve(data.cwd, args[0]), writer)
+            case "SIZE":
+                logger.debug("Got SIZE command")
+                if len(args) != 1 or not args[0]:
+                    raise CommandFailed(CommandError.ERR_ARGS)
+                await self.size(resolve(data.cwd, args[0]), writer)
+            case "MGET":
+                logger.debug("Got MGET command")
+                if len(args) < 1:
+                    raise CommandFailed(CommandError.ERR_ARGS)
+                await self.mget(args, data.cwd, reader, writer)
+            case "MPUT":
+                logger.debug("Got MPUT command")
+                if len(args) != 1:
+                    raise CommandFailed(CommandError.ERR_ARGS)
+                await self.mput(args[0], data.cwd, reader, writer)
+            case "TGET":
+                logger.debug("Got TGET command")
+                if len(args) != 1:
+                    raise CommandFailed(CommandError.ERR_ARGS)
+                await self.tget(resolve(data.cwd, args[0]), reader, writer)
+            case "PWD":
+                logger.debug("Got PWD command")
+                writer.write(IoTFTPAsyncServer.delimiter.join([
+                    RES_OK,
+                    bytes(data.cwd, self.encoding),
+                ]))
+                await writer.drain()
+            case "LSD":
+                logger.debug("Got LSD command")
+                if len(args) > 1:
+                    raise CommandFailed(CommandError.ERR_ARGS)
+                # the working directory, unless given another
+                path = resolve(data.cwd, args[0]) if args else data.cwd
+                await self.lsd(path, reader, writer)
+            case "CWD":
+                logger.debug("Got CWD command")
+                if len(args) != 1:
+                    raise CommandFailed(CommandError.ERR_ARGS)
+                data.cwd = await self.cwd_to(resolve(data.cwd, args[0]), writer)
+            case "SYNC":
+                logger.debug("Got SYNC command")
+                if self.index is None:
+                    raise CommandFailed(CommandError.ERR_UNSP)
+                if len(args) < 1:
+                    raise CommandFailed(CommandError.ERR_ARGS)
+                path = resolve(data.cwd, args[0])
+                await self.sync(path, self.options(args[1:]), reader, writer)
+            case "BYE":
+                logger.debug("Got BYE command")
+                writer.write(RES_OK)
+                await writer.drain()
+
+                # only exit once this is the last client connected
+                self.clients.request_close()
+                if self.clients.count() <= 1:
+                    self.shutdown()
+            case _:
+                logger.debug("Got %s", command)
+
+    def options(self, fields):
+        """
+        Parses the options following the arguments of a command.
+        """
+        try:
+            return parse_opts(fields)
+        except ValueError:
+            raise CommandFailed(CommandError.ERR_ARGS)
+
+    def codec(self, opts):
+        """
+        Returns the compression codec and level asked for in opts, if any.
+        """
+        if "Z" not in opts:
+            return None, None
+        try:
+            return parse_spec(opts["Z"])
+        except KeyError:
+            raise CommandFailed(CommandError.ERR_UNSP)
+        except ValueError:
+            raise CommandFailed(CommandError.ERR_ARGS)
+
+    async def run_fs(self, fn, *args):
+        """
+        Runs blocking filesystem work on the filesystem threads.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.fs, fn, *args)
+
+    def offset(self, opts):
+        """
+        Returns the offset a transfer resumes from, if any.
+        """
+        try:
+            return parse_offset(opts)
+        except ValueError:
+            raise CommandFailed(CommandError.ERR_ARGS)
+
+    def streams(self, opts):
+        """
+        Returns the most data connections a transfer can be split across,
+        given the number asked for.
+        """
+        try:
+            return min(parse_streams(opts), self.maxstreams)
+        except ValueError:
+            raise CommandFailed(CommandError.ERR_ARGS)
+
+    def window(self, opts, writer):
+        """
+        Returns the window to multiplex a transfer onto the main connection
+        with, if asked for in opts.
+        """
+        try:
+            window = parse_mux(opts)
+        except ValueError:
+            raise CommandFailed(CommandError.ERR_ARGS)
+        if window is not None and not isinstance(writer, FramedStream):
+            # there is nothing to tell the data from the replies
+            raise CommandFailed(CommandError.ERR_UNSP)
+        return window
+
+    def inline(self, opts):
+        """
+        Returns the largest file to send inline with the reply to a GET,
+        if the client takes files inline.
+        """
+        try:
+            inline = parse_inline(opts)
+        except ValueError:
+            raise CommandFailed(CommandError.ERR_ARGS)
+        return min(inline, self.inlinesize) if inline is not None else None
+
+    def digest(self, opts):
+        """
+        Returns the digest algorithm asked for in opts, if any.
+        """
+        if "H" not in opts:
+            return None
+        if opts["H"] not in DIGESTS:
+            raise CommandFailed(CommandError.ERR_UNSP)
+        return opts["H"]
+
+    def hashers(self, digest, count):
+        """
+        Returns a new hash object for each of count ranges, or Nones if
+        no digest was asked for.
+        """
+        return [ new_hasher(digest) if digest is not None else None for _ in range(count) ]
+
+    def offer(self, opts):
+        """
+        Returns the digest of the contents offered for the content store
+        in opts, if any.
+        """
+        if "CAS" not in opts:
+            return None
+        if self.store is None:
+            raise CommandFailed(CommandError.ERR_UNSP)
+        try:
+            return self.store.parse_offer(opts["CAS"])
+        except KeyError:
+            raise CommandFailed(CommandError.ERR_UNSP)
+        except ValueError:
+            raise CommandFailed(CommandError.ERR_ARGS)
+
+    def store_later(self, offer, path):
+        """
+        Adds an uploaded file to the content store in the background, if
+        its contents were offered and the store did not have them. Called
+        before the upload is acknowledged, so the client cannot put it
+        again before the store knows to expect it.
+        """
+        if offer is not None:
+            self.store.expect(offer)
+            loop = asyncio.get_running_loop()
+            loop.run_in_executor(self.fs, self.store.add, offer, os.path.abspath(path))
+
+    async def send_done(self, writer, digest, hashers):
+        """
+        Sends the final reply to a transfer, with its digests if asked for.
+        """
+        reply = [ RES_OK ]
+        if digest is not None:
+            reply.append(bytes(f"H={format_digest(digest, hashers)}", self.encoding))
+        writer.write(IoTFTPAsyncServer.delimiter.join(reply))
+        await writer.drain()
+
+    async def get(self, path, opts, reader, writer):
+        codec, level = self.codec(opts)
+        offset = self.offset(opts) or 0
+        streams = self.streams(opts)
+        window = self.window(opts, writer)
+        inline = self.inline(opts)
+        digest = self.digest(opts)
+        try:
+            f = await self.run_fs(open, path, "rb")
+        except FileNotFoundError:
+            raise CommandFailed(CommandError.ERR_NONE)
+        except PermissionError:
+            raise CommandFailed(CommandError.ERR_PERM)
+        except IsADirectoryError:
+            raise CommandFailed(CommandError.ERR_ISDR)
+        except OSError as e:
+            logger.debug("got err: %s", e)
+            raise CommandFailed(CommandError.ERR_NONE)
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            logger.debug("Got size %s", size)
+            if offset > size:
+                # resuming past the end of the file
+                raise CommandFailed(CommandError.ERR_ARGS)
+
+            if inline is not None and size - offset <= inline:
+                # the file follows the reply, and that is the whole transfer
+                try:
+                    content = await self.run_fs(os.pread, f.fileno(), size - offset, offset)
+                except OSError as e:
+                    logger.error(f"[ERR] {e}")
+                    raise CommandFailed(CommandError.ERR_UNKW)
+                reply = [ RES_OK, bytes(f"INLINE={len(content)}", self.encoding) ]
+                if digest is not None:
+                    hashers = self.hashers(digest, 1)
+                    hashers[0].update(content)
+                    reply.append(bytes(f"H={format_digest(digest, hashers)}", self.encoding))
+                writer.write(pack_inline(reply, content, IoTFTPAsyncServer.delimiter))
+                await writer.drain()
+                return
+
+            if window is not None and size - offset <= self.muxsize:
+                hashers = self.hashers(digest, 1)
+                await self.send_mux(writer, f, offset, size, window, hashers[0])
+                await self.send_done(writer, digest, hashers)
+                return
+
+            extra = [ bytes(str(size), self.encoding) ]
+            compress = codec is not None and await self.run_fs(probe, f.fileno())
+            if compress:
+                extra.append(bytes(f"Z={format_spec(codec, level)}", self.encoding))
+            else:
+                # a compressed stream cannot be split
+                ranges = split_ranges(offset, size, streams)
+                if len(ranges) > 1:
+                    extra.append(bytes(f"STREAMS={len(ranges)}", self.encoding))
+                    hashers = self.hashers(digest, len(ranges))
+                    await self.run_streams(
+                        writer, reader, extra, len(ranges),
+                        lambda conn, i: self.send_range(conn, f, *ranges[i], hashers[i]),
+                    )
+                    if tracer.on:
+                        tracer.switch(asyncio.current_task(), "transfer", "ack")
+                    await self.expect_ack(reader)
+                    await self.send_done(writer, digest, hashers)
+                    return
+
+            conn = await self.open_data(writer, reader, extra)
+            hashers = self.hashers(digest, 1)
+
+            with conn:
+                if compress:
+                    sender = CompressedSender(
+                        f, size, codec.encoder(level), offset, hashers[0]
+                    )
+                    loop = asyncio.get_running_loop()
+                    if self.dataplane is not None:
+                        conn.settimeout(DATA_TIMEOUT)
+                        await loop.run_in_executor(self.dataplane, sender.send_all, conn)
+                    else:
+                        while (out := await self.run_fs(sender.produce)):
+                            await loop.sock_sendall(conn, out)
+                    # the compressed stream ends where the data does
+                    conn.shutdown(socket.SHUT_WR)
+                elif self.dataplane is not None:
+                    conn.settimeout(DATA_TIMEOUT)
+                    loop = asyncio.get_running_loop()
+                    sender = FileSender(f, size, offset, hashers[0])
+                    await loop.run_in_executor(self.dataplane, sender.send_all, conn)
+                elif digest is not None:
+                    await self.send_hashed(conn, f, offset, size, hashers[0])
+                elif size > offset:
+                    # sock_sendfile rejects a count of 0
+                    loop = asyncio.get_running_loop()
+                    await loop.sock_sendfile(conn, f, offset, size - offset)
+
+                if tracer.on:
+                    tracer.switch(asyncio.current_task(), "transfer", "ack")
+                # wait for the client to confirm it has the whole file, which
+                # it does once it has hung up, so closing the data connection
+                # after leaves the TIME_WAIT with the client
+                await self.expect_ack(reader)
+        await self.send_done(writer, digest, hashers)
+
+    async def put(self, path, size, opts, reader, writer, body=None):
+        try:
+            size = int(size)
+        except ValueError:
+            raise CommandFailed(CommandError.ERR_ARGS)
+        codec, level = self.codec(opts)
+        offset = self.offset(opts)
+        streams = self.streams(opts)
+        window = self.window(opts, writer)
+        digest = self.digest(opts)
+        if offset is not None and offset > size:
+            raise CommandFailed(CommandError.ERR_ARGS)
+        if body is not None:
+            if len(body) > self.inlinesize:
+                raise CommandFailed(CommandError.ERR_UNSP)
+            if len(body) != size - (offset or 0):
+                raise CommandFailed(CommandError.ERR_ARGS)
+        # nothing is saved offering a file that is already here
+        offer = self.offer(opts) if offset is None and body is None else None
+
+        decoder = codec.decoder() if codec is not None else None
+        if offset is not None:
+            # resume a partial file, which is kept if this fails
+            try:
+                f = await self.run_fs(open_partial, path, offset, size)
+            except FileNotFoundError:
+                raise CommandFailed(CommandError.ERR_NONE)
+            except ValueError as e:
+                logger.debug("Cannot resume: %s", e)
+                raise CommandFailed(CommandError.ERR_ARGS)
+            except Exception as e:
+                logger.error(f"[ERR] {e}")
+                raise CommandFailed(CommandError.ERR_UNKW)
+        else:
+            try:
+                f = await self.run_fs(open, path, "xb", 0)
+            except FileExistsError:
+                raise CommandFailed(CommandError.ERR_EXST)
+            except Exception as e:
+                logger.error(f"[ERR] {e}")
+                raise CommandFailed(CommandError.ERR_UNKW)
+
+            adding = self.store.pending(offer) if offer is not None else None
+            if adding is not None:
+                # the same contents are still being added from an earlier
+                # upload; wait here rather than on the executor the add is
+                # queued on
+                await asyncio.wrap_future(adding)
+            try:
+                hit = offer is not None and await self.run_fs(
+                    self.store.fetch, offer, path, f, size
+                )
+                if hit:
+                    # made from the content store, nothing to send
+                    f.close()
+                    writer.write(IoTFTPAsyncServer.delimiter.join([ RES_OK, b"CAS=HIT" ]))
+                    await writer.drain()
+                    return
+                await self.run_fs(preallocate, f.fileno(), size)
+            except Exception as e:
+                logger.error(f"[ERR] {e}")
+                f.close()
+                await self.run_fs(os.remove, path)
+                raise CommandFailed(CommandError.ERR_UNKW)
+
+        if body is not None:
+            # written out with the file, and that is the whole transfer
+            try:
+                await self.run_fs(write_at, f.fileno(), body, offset or 0)
+            except Exception as e:
+                logger.error(f"[ERR] {e}")
+                if offset is None:
+                    await self.run_fs(os.remove, path)
+                raise CommandFailed(CommandError.ERR_UNKW)
+            finally:
+                f.close()
+            hashers = self.hashers(digest, 1)
+            if digest is not None:
+                hashers[0].update(body)
+            await self.send_done(writer, digest, hashers)
+            return
+
+        extra = []
+        if offer is not None:
+            extra.append(b"CAS=MISS")
+        if window is not None and codec is None and size - (offset or 0) <= self.muxsize:
+            hashers = self.hashers(digest, 1)
+            receiver = FileReceiver(
+                f, size, self.bufpool, None, offset or 0, hasher=hashers[0]
+            )
+            try:
+                await self.recv_mux(writer, receiver, window, extra)
+            finally:
+                receiver.close()
+            self.store_later(offer, path)
+            await self.send_done(writer, digest, hashers)
+            return
+        if codec is not None:
+            # confirm the compressed stream is expected
+            extra.append(bytes(f"Z={format_spec(codec, level)}", self.encoding))
+        else:
+            # a compressed stream cannot be split
+            ranges = split_ranges(offset or 0, size, streams)
+            if len(ranges) > 1:
+                extra.append(bytes(f"STREAMS={len(ranges)}", self.encoding))
+                hashers = await self.recv_ranges(f, ranges, digest, extra, reader, writer)
+                if tracer.on:
+                    tracer.switch(asyncio.current_task(), "transfer", "ack")
+                self.store_later(offer, path)
+                await self.send_done(writer, digest, hashers)
+                return
+
+        hashers = self.hashers(digest, 1)
+        receiver = FileReceiver(
+            f, size, self.bufpool, decoder, offset or 0, hasher=hashers[0]
+        )
+
+        try:
+            conn = await self.open_data(writer, reader, extra)
+
+            with conn:
+                loop = asyncio.get_running_loop()
+                if self.dataplane is not None:
+                    conn.settimeout(DATA_TIMEOUT)
+                    await loop.run_in_executor(self.dataplane, receiver.recv_all, conn)
+                while not receiver.done():
+                    n = await loop.sock_recv_into(conn, receiver.window())
+                    if not n:
+                        receiver.end()
+                        continue
+                    receiver.commit(n)
+            receiver.verify()
+            if tracer.on:
+                tracer.switch(asyncio.current_task(), "transfer", "ack")
+        except (ConnectionError, TimeoutError):
+            raise
+        except OSError as e:
+            # writing the file, or decompressing it, failed
+            logger.error(f"[ERR] {e}")
+            raise CommandFailed(CommandError.ERR_UNKW)
+        finally:
+            receiver.close()
+
+        self.store_later(offer, path)
+        await self.send_done(writer, digest, hashers)
+
+    async def dput(self, path, size, opts, reader, writer):
+        try:
+            size = int(size)
+        except ValueError:
+            raise CommandFailed(CommandError.ERR_ARGS)
+        if size < 0:
+            raise CommandFailed(CommandError.ERR_ARGS)
+        digest = self.digest(opts)
+        hashers = self.hashers(digest, 1)
+
+        try:
+            receiver, sigs = await self.run_fs(open_delta, path, size, hashers[0])
+        except FileNotFoundError:
+            # nothing to update, the client can fall back to a PUT
+            raise CommandFailed(CommandError.ERR_NONE)
+        except PermissionError:
+            raise CommandFailed(CommandError.ERR_PERM)
+        except IsADirectoryError:
+            raise CommandFailed(CommandError.ERR_ISDR)
+        except NotADirectoryError:
+            raise CommandFailed(CommandError.ERR_NDIR)
+        except Exception as e:
+            logger.error(f"[ERR] {e}")
+            raise CommandFailed(CommandError.ERR_UNKW)
+
+        try:
+            conn = await self.open_data(writer, reader, [
+                bytes(str(receiver.blocksize), self.encoding),
+                bytes(str(receiver.basesize), self.encoding),
+            ])
+
+            with conn:
+                loop = asyncio.get_running_loop()
+                if self.dataplane is not None:
+                    conn.settimeout(DATA_TIMEOUT)
+                    await loop.run_in_executor(
+                        self.dataplane, exchange, conn, sigs, receiver
+                    )
+                else:
+                    await loop.sock_sendall(conn, sigs)
+                    while not receiver.done():
+                        b = await self.recv_some(conn, RECV_BUFSIZE)
+                        await self.run_fs(receiver.feed, b)
+                    await self.run_fs(receiver.install)
+        except (ConnectionError, TimeoutError):
+            raise
+        except ValueError as e:
+            # malformed delta
+            logger.debug("Bad delta: %s", e)
+            raise CommandFailed(CommandError.ERR_ARGS)
+        except OSError as e:
+            logger.error(f"[ERR] {e}")
+            raise CommandFailed(CommandError.ERR_UNKW)
+        finally:
+            receiver.close()
+
+        await self.send_done(writer, digest, hashers)
+
+    async def send_mux(self, stream, f, offset, size, window, hasher):
+        """
+        Sends the bytes of f from offset to size multiplexed onto the main
+        connection, once the client acknowledges the reply.
+        """
+        with MuxChannel(stream, window) as channel:
+            stream.write(IoTFTPAsyncServer.delimiter.join([
+                RES_OK,
+                bytes(f"MUX={window}", self.encoding),
+                bytes(str(size), self.encoding),
+            ]))
+            await stream.drain()
+            await self.expect_ack(stream)
+            if tracer.on:
+                tracer.begin(asyncio.current_task(), "transfer")
+
+            while offset < size:
+                while not channel.credit:
+                    if not await stream.fill():
+                        raise ConnClosedErr()
+                count = min(MUX_CHUNK, channel.credit, size - offset)
+                b = await self.run_fs(os.pread, f.fileno(), count, offset)
+                if not b:
+                    # file was truncated underneath us, nothing more to send
+                    break
+                if hasher is not None:
+                    hasher.update(b)
+                channel.send(b)
+                await stream.drain()
+                offset += len(b)
+
+        if tracer.on:
+            tracer.switch(asyncio.current_task(), "transfer", "ack")
+        # wait for the client to confirm it has the whole file
+        await self.expect_ack(stream)
+
+    async def recv_mux(self, stream, receiver, window, extra):
+        """
+        Receives a PUT multiplexed onto the main connection into receiver,
+        sending the reply along with any extra reply fields first.
+        """
+        with MuxChannel(stream, window) as channel:
+            stream.write(IoTFTPAsyncServer.delimiter.join([
+                RES_OK,
+                bytes(f"MUX={window}", self.encoding),
+                *extra,
+            ]))
+            await stream.drain()
+            await self.expect_ack(stream)
+            if tracer.on:
+                tracer.begin(asyncio.current_task(), "transfer")
+
+            try:
+                while not receiver.done():
+                    try:
+                        n = channel.recv_into(receiver.window())
+                    except BlockingIOError:
+                        if not await stream.fill():
+                            raise ConnClosedErr()
+                        continue
+                    receiver.commit(n)
+                receiver.verify()
+                if tracer.on:
+                    tracer.switch(asyncio.current_task(), "transfer", "ack")
+            except (ConnectionError, TimeoutError):
+                raise
+            except OSError as e:
+                # writing the file failed
+                logger.error(f"[ERR] {e}")
+                raise CommandFailed(CommandError.ERR_UNKW)
+
+    async def send_hashed(self, conn, f, offset, end, hasher):
+        """
+        Sends the bytes of f from offset to end, hashing them on the way,
+        which sendfile would keep out of reach.
+        """
+        loop = asyncio.get_running_loop()
+        bs = get_blocksize(end - offset)
+        while offset < end:
+            b = await self.run_fs(os.pread, f.fileno(), min(bs, end - offset), offset)
+            if not b:
+                # file was truncated underneath us, nothing more to send
+                break
+            hasher.update(b)
+            await loop.sock_sendall(conn, b)
+            offset += len(b)
+
+    async def send_range(self, conn, f, offset, length, hasher=None):
+        """
+        Sends one range of a split GET, preceded by its header.
+        """
+        loop = asyncio.get_running_loop()
+        if self.dataplane is not None:
+            conn.settimeout(DATA_TIMEOUT)
+            sender = RangeSender(
+                f, offset, length, IoTFTPAsyncServer.delimiter, self.encoding, hasher
+            )
+            await loop.run_in_executor(self.dataplane, sender.send_all, conn)
+            return
+
+        await loop.sock_sendall(conn, pack_range(
+            offset, length, IoTFTPAsyncServer.delimiter, self.encoding
+        ))
+        if hasher is not None:
+            await self.send_hashed(conn, f, offset, offset + length, hasher)
+        elif length:
+            await loop.sock_sendfile(conn, f, offset, length)
+
+    async def recv_ranges(self, f, ranges, digest, extra, reader, writer):
+        """
+        Receives a PUT split into ranges, each over its own data connection,
+        into f and closes it. If the transfer is incomplete, the file is
+        truncated to the data written out with no gaps before it.
+
+        Returns the hash object of each range, in order.
+        """
+        expected = {rng: i for i, rng in enumerate(ranges)}
+        stored, hashers = {}, [ None ] * len(ranges)
+        try:
+            await self.run_streams(
+                writer, reader, extra, len(ranges),
+                lambda conn, i: self.recv_range(conn, f, expected, digest, stored, hashers),
+            )
+        except BaseException:
+            try:
+                os.ftruncate(f.fileno(), received_prefix(ranges, stored))
+            except OSError as e:
+                logger.debug("Could not truncate incomplete file: %s", e)
+            raise
+        finally:
+            f.close()
+        return hashers
+
+    async def recv_range(self, conn, f, expected, digest, stored, hashers):
+        """
+        Receives whichever range of a split PUT the client sends on conn,
+        recording the end of the data written out in it in stored, and
+        its hash object in hashers.
+        """
+        loop = asyncio.get_running_loop()
+        part = RangeReceiver(
+            reopen(f, "r+b"), self.bufpool, expected, IoTFTPAsyncServer.delimiter,
+            digest,
+        )
+        try:
+            if self.dataplane is not None:
+                conn.settimeout(DATA_TIMEOUT)
+                await loop.run_in_executor(self.dataplane, part.recv_all, conn)
+                return
+
+            while part.receiver is None:
+                part.feed_header(await self.recv_some(conn, MAX_RANGE_HEADER))
+            receiver = part.receiver
+            while not receiver.done():
+                n = await loop.sock_recv_into(conn, receiver.window())
+                if not n:
+                    receiver.end()
+                    continue
+                receiver.commit(n)
+        except ValueError as e:
+            # malformed header, or a range that was not asked for
+            logger.debug("Bad range: %s", e)
+            raise CommandFailed(CommandError.ERR_ARGS)
+        except (ConnectionError, TimeoutError):
+            raise
+        except OSError as e:
+            logger.error(f"[ERR] {e}")
+            raise CommandFailed(CommandError.ERR_UNKW)
+        finally:
+            part.close()
+            if part.stored() is not None:
+                index, end = part.stored()
+                stored[index] = end
+                hashers[index] = part.hasher
+
+    async def run_streams(self, writer, reader, extra, count, fn):
+        """
+        Like open_data, but for a transfer split across count data
+        connections. Each connection is handed to fn, along with the order
+        it was accepted in, as soon as it is accepted, and the coroutines
+        fn returns run together.
+
+        If any fails, the others are stopped by shutting their connections
+        down, and its error is raised once they have all returned.
+        """
+        if tracer.on:
+            tracer.begin(asyncio.current_task(), "connect")
+        loop = asyncio.get_running_loop()
+        sock = self.ports.lease()
+        conns, tasks, accept, running = [], [], None, set()
+        try:
+            reply = [
+                RES_OK,
+                bytes(str(sock.getsockname()[1]), self.encoding),
+                *extra,
+            ]
+            writer.write(IoTFTPAsyncServer.delimiter.join(reply))
+            await writer.drain()
+
+            await self.expect_ack(reader)
+
+            peer = writer.get_extra_info("peername")
+            deadline = loop.time() + DATA_ACCEPT_TIMEOUT
+            accept = asyncio.ensure_future(self.accept_data(sock, peer))
+            running.add(accept)
+
+            while running:
+                # the client only has so long to make every connection
+                timeout = deadline - loop.time() if accept in running else None
+                done, running = await asyncio.wait(
+                    running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise TimeoutError("data connections not made in time")
+
+                for task in done:
+                    # raises the error of a failed transfer
+                    res = task.result()
+                    if task is not accept:
+                        continue
+                    conns.append(res)
+                    tasks.append(asyncio.ensure_future(fn(res, len(conns) - 1)))
+                    running.add(tasks[-1])
+                    if len(conns) < count:
+                        accept = asyncio.ensure_future(self.accept_data(sock, peer))
+                        running.add(accept)
+                    elif tracer.on:
+                        # every data connection has been made
+                        tracer.switch(asyncio.current_task(), "connect", "transfer")
+        except BaseException:
+            for conn in conns:
+                shutdown(conn)
+            if accept is not None:
+                accept.cancel()
+                tasks.append(accept)
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            self.ports.release(sock)
+            for conn in conns:
+                conn.close()
+
+    async def mget(self, patterns, cwd, reader, writer):
+        paths = await self.run_fs(expand, patterns, cwd)
+
+        conn = await self.open_data(writer, reader, [
+            bytes(str(len(paths)), self.encoding),
+        ])
+
+        with conn:
+            loop = asyncio.get_running_loop()
+            if self.dataplane is not None:
+                conn.settimeout(DATA_TIMEOUT)
+                await loop.run_in_executor(
+                    self.dataplane, send_entries, conn, paths,
+                    IoTFTPAsyncServer.delimiter, self.encoding, cwd,
+                )
+            else:
+                for path in paths:
+                    status, f, size = await self.run_fs(open_entry, resolve(cwd, path))
+                    await loop.sock_sendall(conn, pack_header(
+                        status, size, path, IoTFTPAsyncServer.delimiter, self.encoding
+                    ))
+                    if f is None:
+                        continue
+                    with f:
+                        if size:
+                            await loop.sock_sendfile(conn, f, 0, size)
+
+        # wait for the client to confirm it has every file
+        await self.expect_ack(reader)
+        writer.write(RES_OK)
+        await writer.drain()
+
+    async def mput(self, count, cwd, reader, writer):
+        try:
+            count = int(count)
+        except ValueError:
+            raise CommandFailed(CommandError.ERR_ARGS)
+
+        conn = await self.open_data(writer, reader, [])
+
+        with conn:
+            if self.dataplane is not None:
+                conn.settimeout(DATA_TIMEOUT)
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(
+                    self.dataplane, recv_entries, conn, count, self.bufpool,
+                    IoTFTPAsyncServer.delimiter, self.encoding, cwd,
+                )
+            else:
+                await self.recv_entries(conn, count, cwd)
+
+        writer.write(RES_OK)
+        await writer.drain()
+
+    async def tget(self, path, reader, writer):
+        try:
+            members = await self.run_fs(open_tree, path)
+        except FileNotFoundError:
+            raise CommandFailed(CommandError.ERR_NONE)
+        except PermissionError:
+            raise CommandFailed(CommandError.ERR_PERM)
+        except NotADirectoryError:
+            raise CommandFailed(CommandError.ERR_NDIR)
+        except OSError as e:
+            logger.debug("got err: %s", e)
+            raise CommandFailed(CommandError.ERR_NONE)
+
+        conn = await self.open_data(writer, reader, [])
+
+        with conn:
+            loop = asyncio.get_running_loop()
+            if self.dataplane is not None:
+                conn.settimeout(DATA_TIMEOUT)
+                await loop.run_in_executor(self.dataplane, send_tree, conn, members)
+            else:
+                sent = 0
+                while (member := await self.run_fs(next_member, members)) is not None:
+                    header, f, size = member
+                    await loop.sock_sendall(conn, header)
+                    sent += len(header)
+                    if f is None:
+                        continue
+                    with f:
+                        done = 0
+                        if size:
+                            done = await loop.sock_sendfile(conn, f, 0, size)
+                    # pad out a file that shrank while being sent
+                    await loop.sock_sendall(conn, bytes(size - done + block_padding(size)))
+                    sent += size + block_padding(size)
+                await loop.sock_sendall(conn, end_of_archive(sent))
+
+        # wait for the client to confirm it has the whole tree
+        await self.expect_ack(reader)
+        writer.write(RES_OK)
+        await writer.drain()
+
+    async def recv_entries(self, conn, count, cwd):
+        """
+        Receives the files of an MPUT, then sends back their results.
+        """
+        loop = asyncio.get_running_loop()
+        delim = IoTFTPAsyncServer.delimiter
+        inbuf, results = bytearray(), bytearray()
+
+        for _ in range(count):
+            while (header := take_header(inbuf, delim)) is None:
+                if len(inbuf) > MAX_HEADER:
+                    raise CommandFailed(CommandError.ERR_ARGS)
+                inbuf += await self.recv_some(conn, MAX_HEADER)
+
+            try:
+                size, path = parse_header(header, delim, self.encoding)
+            except ValueError:
+                raise CommandFailed(CommandError.ERR_ARGS)
+
+            receiver = None
+            status = RES_OK
+            try:
+                f = await self.run_fs(open_upload, resolve(cwd, path), size)
+                receiver = FileReceiver(f, size, self.bufpool)
+            except OSError as e:
+                logger.debug("Could not create %s: %s", path, e)
+                status = upload_error(e)
+
+            try:
+                left = size
+                while left:
+                    if not inbuf:
+                        inbuf += await self.recv_some(conn, min(left, RECV_BUFSIZE))
+                    n = min(left, len(inbuf))
+                    if receiver is not None:
+                        with memoryview(inbuf) as view, view[:n] as chunk:
+                            receiver.feed(chunk)
+                    del inbuf[:n]
+                    left -= n
+            finally:
+                if receiver is not None:
+                    receiver.close()
+            results += status
+
+        await loop.sock_sendall(conn, results)
+
+    async def lsd(self, path, reader, writer):
+        try:
+            listing = await self.run_fs(self.listings.list, path)
+        except OSError as e:
+            raise CommandFailed(listing_error(e)[1])
+
+        await self.send_listing(listing, [
+            bytes(str(listing.size), self.encoding),
+        ], reader, writer)
+
+    async def sync(self, path, opts, reader, writer):
+        try:
+            since = parse_token(opts["SINCE"]) if "SINCE" in opts else None
+        except ValueError:
+            raise CommandFailed(CommandError.ERR_ARGS)
+        if opts.get("H", DIGESTS[0]) not in DIGESTS:
+            raise CommandFailed(CommandError.ERR_UNSP)
+
+        try:
+            changes = await self.run_fs(list_changes, self.index, path, since, opts.get("H"))
+        except OSError as e:
+            raise CommandFailed(listing_error(e)[1])
+
+        await self.send_listing(changes, [
+            bytes(str(changes.size), self.encoding),
+            bytes(changes.token, self.encoding),
+            b"F" if changes.full else b"D",
+        ], reader, writer)
+
+    async def send_listing(self, listing, extra, reader, writer):
+        """
+        Sends the size of a listing along with any extra reply fields,
+        then the listing itself once the client acknowledges.
+        """
+        writer.write(IoTFTPAsyncServer.delimiter.join([ RES_OK, *extra ]))
+        await writer.drain()
+        await self.expect_ack(reader)
+
+        # the final reply goes out with the end of the listing
+        start = 0
+        while start <= len(listing.lines):
+            chunk, start = listing.chunk(start)
+            writer.write(chunk + RES_OK if start > len(listing.lines) else chunk)
+            await writer.drain()
+
+    async def cwd_to(self, path, writer):
+        """
+        Checks that path is a directory a client can change to, and
+        returns it.
+        """
+        try:
+            await self.run_fs(check_dir, path)
+        except OSError as e:
+            raise CommandFailed(listing_error(e)[1])
+
+        writer.write(RES_OK)
+        await writer.drain()
+        return path
+
+    async def recv_some(self, conn, n):
+        """
+        Receives up to n bytes from a data connection.
+        """
+        loop = asyncio.get_running_loop()
+        b = await loop.sock_recv(conn, n)
+        if not b:
+            raise ConnClosedErr()
+        return b
+
+    async def delete(self, path, writer):
+        try:
+            await self.run_fs(os.remove, os.path.abspath(path))
+        except FileNotFoundError:
+            raise CommandFailed(CommandError.ERR_NONE)
+        except PermissionError:
+            raise CommandFailed(CommandError.ERR_PERM)
+        except IsADirectoryError:
+            raise CommandFailed(CommandError.ERR_ISDR)
+        except OSError as e:
+            logger.error(f"[ERR] {e}")
+            raise CommandFailed(CommandError.ERR_UNKW)
+
+        writer.write(RES_OK)
+        await writer.drain()
+
+    async def size(self, path, writer):
+        try:
+            size = await self.run_fs(file_size, path)
+        except FileNotFoundError:
+            raise CommandFailed(CommandError.ERR_NONE)
+        except PermissionError:
+            raise CommandFailed(CommandError.ERR_PERM)
+        except IsADirectoryError:
+            raise CommandFailed(CommandError.ERR_ISDR)
+        except OSError as e:
+            logger.debug("got err: %s", e)
+            raise CommandFailed(CommandError.ERR_NONE)
+
+        writer.write(IoTFTPAsyncServer.delimiter.join([
+            RES_OK,
+            bytes(str(size), self.encoding),
+        ]))
+        await writer.drain()
+
+    async def open_data(self, writer, reader, extra):
+        """
+        Leases a data port, sends it to the client along with any extra
+        reply fields, and returns the data connection the client makes.
+        """
+        if tracer.on:
+            tracer.begin(asyncio.current_task(), "connect")
+        sock = self.ports.lease()
+        try:
+            reply = [
+                RES_OK,
+                bytes(str(sock.getsockname()[1]), self.encoding),
+                *extra,
+            ]
+            writer.write(IoTFTPAsyncServer.delimiter.join(reply))
+            await writer.drain()
+
+            await self.expect_ack(reader)
+
+            peer = writer.get_extra_info("peername")
+            conn = await asyncio.wait_for(
+                self.accept_data(sock, peer), DATA_ACCEPT_TIMEOUT
+            )
+            if tracer.on:
+                tracer.switch(asyncio.current_task(), "connect", "transfer")
+            return conn
+        finally:
+            self.ports.release(sock)
+
+    async def accept_data(self, sock, peer):
+        """
+        Accepts the data connection from the client at peer on sock.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            conn, addr = await loop.sock_accept(sock)
+            if addr[0] == peer[0]:
+                logger.debug("Got new connection %s", addr)
+                conn.setblocking(False)
+                return conn
+
+            # not the client this port was leased for
+            logger.debug("Dropping data connection from unexpected %s", addr)
+            conn.close()
+
+    async def expect_ack(self, reader):
+        """
+        Reads an acknowledgement from the client.
+        """
+        try:
+            b = await reader.readexactly(len(ACKNOW))
+        except asyncio.IncompleteReadError:
+            raise ConnClosedErr()
+
+        if b != ACKNOW:
+            # instead of sending an error back to the client, just close it
+            raise ConnClosedErr()
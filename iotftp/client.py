@@ -1,11 +1,28 @@
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import socket, AF_INET, SOCK_STREAM, IPPROTO_TCP, TCP_NODELAY
 import os
 import logging
 import time
+import threading
+import contextlib
+import tarfile
+import mmap
+import glob
 
 logger = logging.getLogger()
 
 from iotftp.utils import *
+from iotftp.compress import COMPRESS_BLOCKSIZE, CODECS, CorruptStream, parse_spec, probe
+from iotftp.digest import DEF_DIGEST, DigestMismatch, new_hasher, verify
+from iotftp.transfer import (
+    split_ranges, received_prefix, pack_range, parse_range, take_header, write_at,
+)
+from iotftp.delta import SIGNATURE, block_count, parse_signatures, delta_ops
+from iotftp.framing import MAX_FRAME, FramedSocket, MuxChannel
+
+# whether tarfile has the data filter, which refuses members that would
+# land outside the destination; without it, members are checked by
+# check_member instead
+HAS_DATA_FILTER = hasattr(tarfile, "data_filter")
 
 class TimeoutErr(TimeoutError):
     def __init__(self, b):
@@ -29,11 +46,51 @@ class UnknownWelcome(Exception):
     Raised when the welcome message received is not as expected.
     """
 
+class UnsafePath(ValueError):
+    """
+    Raised for a path sent by the server that is absolute, or leads
+    outside the directory it is to be written in.
+    """
+
+# errors refusing a member of a tree, from the data filter or check_member
+if HAS_DATA_FILTER:
+    MEMBER_REFUSED = (tarfile.FilterError, UnsafePath)
+else:
+    MEMBER_REFUSED = UnsafePath
+
 class IoTFTPClient:
-    def __init__(self, ipaddr, port, encoding):
+    def __init__(self, ipaddr, port, encoding, compress=None, streams=1,
+                 digest=DEF_DIGEST, dedup=True, framing=True, mux=True,
+                 inline=DEF_INLINE_SIZE):
         self.ipaddr = ipaddr
         self.port = port
         self.encoding = encoding
+        # the most data connections to split GET and PUT across,
+        # used only with servers that support splitting transfers
+        self.streams = streams
+        # the digest algorithm to verify GET and PUT with, or None not to,
+        # used only with servers that support the algorithm
+        self.digest = digest
+        if digest is not None:
+            # raises on an algorithm this side does not support
+            new_hasher(digest)
+        # whether to offer the digest of a file before putting it, so a
+        # server with a content store can skip the transfer
+        self.dedup = dedup
+        # whether to frame commands, with servers that support framing
+        self.framing = framing
+        # whether to offer to send GET and PUT data on the main connection
+        # of a framed session, which the server does for small transfers
+        self.mux = mux
+        # the largest file to take inline with a GET reply or send inline
+        # with a PUT command, 0 not to, used only with servers that do
+        self.inline = inline
+        # the compression spec (codec[:level]) to ask for on GET and PUT,
+        # used only with servers that support the codec
+        self.compress = compress
+        if compress is not None:
+            # raises on a codec or level this side does not support
+            parse_spec(compress)
 
     def parse_welcome_msg(self, s):
         """
@@ -54,7 +111,12 @@ class IoTFTPClient:
         user = welcome[3].decode(self.encoding)
         euid = int(welcome[4].decode(self.encoding))
 
-        return (ver, pwd, user, euid)
+        # optional features, not sent by older servers
+        features = {}
+        if len(welcome) > 5 and welcome[5]:
+            features = parse_opts(welcome[5].decode(self.encoding).split(" "))
+
+        return (ver, pwd, user, euid, features)
 
     def determine_err(self, errb):
         match errb[0:3]:
@@ -86,209 +148,1612 @@ class IoTFTPClient:
         """
         if resb == RES_OK:
             logger.debug(success_msg)
-        elif len(resb) > 0 and resb[0] == b"3":
+        elif resb[:1] == b"3":
                 raise self.determine_err(resb.decode(self.encoding))
         else:
             logger.error(f"[ERR] Unknown server response: {resb}")
 
 
 
-    def get(self, filename):
+    def session(self):
+        """
+        Opens a session, which keeps one connection to the server
+        open for any number of commands. Use as a context manager:
+
+            with client.session() as s:
+                s.get("trace1")
+                s.get("trace2")
+        """
+        return ClientSession(self)
 
-        abspath = os.path.abspath(filename)
-        if os.path.exists(abspath):
-            raise FileExistsError(abspath)
-        
-        with socket(AF_INET, SOCK_STREAM) as s:
+    def pool(self, size):
+        """
+        Returns a pool of up to size sessions, for sending commands
+        from several threads at once.
+        """
+        return SessionPool(self, size)
+
+    def get(self, filename, resume=False):
+        with self.session() as s:
+            s.get(filename, resume)
+
+    def put(self, filename, resume=False):
+        with self.session() as s:
+            return s.put(filename, resume)
+
+    def dput(self, filename):
+        with self.session() as s:
+            s.dput(filename)
+
+    def delete(self, filename):
+        with self.session() as s:
+            s.delete(filename)
+
+    def size(self, filename):
+        with self.session() as s:
+            return s.size(filename)
+
+    def sizes(self, *filenames):
+        with self.session() as s:
+            return s.sizes(*filenames)
+
+    def mget(self, *patterns):
+        with self.session() as s:
+            return s.mget(*patterns)
+
+    def mput(self, *filenames):
+        with self.session() as s:
+            return s.mput(*filenames)
+
+    def tget(self, dirname, dest="."):
+        with self.session() as s:
+            return s.tget(dirname, dest)
+
+    def pwd(self):
+        with self.session() as s:
+            return s.pwd()
+
+    def lsd(self, dirname=None):
+        with self.session() as s:
+            return s.lsd(dirname)
+
+    def sync(self, dirname=".", token=None, digest=None):
+        with self.session() as s:
+            return s.sync(dirname, token, digest)
+
+    def pull(self, dirname=".", dest=".", token=None, delete=False):
+        with self.session() as s:
+            return s.pull(dirname, dest, token, delete)
+
+    def bye(self):
+        with self.session() as s:
+            s.bye()
+
+    def connect(self):
+        """
+        Opens a connection to the server and reads its welcome message.
+
+        Returns the connection and the welcome info.
+        """
+        s = socket(AF_INET, SOCK_STREAM)
+        try:
             s.settimeout(120)
             s = self._attempt_connection(s, (self.ipaddr, self.port), tries=5)
+            # commands and acknowledgements are tiny, and some are sent back
+            # to back, so don't let them wait on delayed acks
+            s.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
 
             logger.debug(s.getsockname())
 
-            _ = self.parse_welcome_msg(s)
+            welcome = self.parse_welcome_msg(s)
+        except BaseException:
+            s.close()
+            raise
 
-            # construct and send command
-            args = [ b"GET", bytes(filename, self.encoding) ]
-            s.send(DELIMITER.join(args))
+        if self.framing and FRAMED_VERSION in welcome[0].split(","):
+            # frame every message, so commands can be of any length
+            # and sent without waiting for the replies to others
+            s = FramedSocket(s)
 
-            # receive command parameters
-            params = s.recv(32)
-            if not params:
-                raise ConnectionResetError(s)
-            
-            params = params.decode(self.encoding)
+        return s, welcome
+
+    def _attempt_connection(self, sock, params, tries=1, wait=5):
+        """
+        Attempt a connection on a socket with given params (ipaddr, port).
 
-            if not params.startswith("200 AIGT"):
-                s.send(ACKNOW)
-                raise self.determine_err(params)
+        Tries - number of times to attempt making the connection.
+        Wait - Waiting time between tries.
+        """
 
-            params = params.split(DELIMITER.decode(self.encoding))
-            port, size = int(params[1]), int(params[2])
+        for i in range(tries):
+            try:
+                sock.connect(params)
+            except OSError as e:
+                time.sleep(wait)
+                if i == tries - 1:
+                    raise e
+            else:
+                return sock
 
-            print(f"[*] Reading {size} bytes from port {port}")
+class ClientSession:
+    """
+    A single connection to the server, over which commands are sent
+    one after another.
 
+    A server error leaves the session usable. Any other error leaves the
+    connection in an unknown state, so the session is closed.
+    """
+    def __init__(self, client):
+        # the client this session belongs to
+        self.client = client
+        # the connection to the server, opened on first use
+        self.conn = None
+        # the welcome info sent by the server
+        self.welcome = None
+        # whether the session can no longer be used
+        self.closed = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        if self.conn is None:
+            self.conn, self.welcome = self.client.connect()
+
+    def close(self):
+        self.closed = True
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def run(self, cmd, *args):
+        """
+        Runs a command on the session's connection.
+        """
+        if self.closed:
+            raise ConnectionError("session is closed")
+        self.open()
+        if self.framed():
+            self.conn.new_request()
+
+        try:
+            return cmd(self.conn, *args)
+        except ServerError:
+            # the error has been acknowledged, so the server
+            # is waiting for the next command
+            raise
+        except BaseException:
+            self.close()
+            raise
+
+    def framed(self):
+        return isinstance(self.conn, FramedSocket)
+
+    def result(self, s, resb, success_msg):
+        """
+        Evaluates the final response to a command, acknowledging it
+        if it is an error so the server awaits the next command.
+        """
+        if resb[:1] == b"3":
             s.send(ACKNOW)
+        self.client.eval_result(resb, success_msg)
 
-            s2 = socket(AF_INET, SOCK_STREAM)
+    def dial(self, port):
+        """
+        Makes a data connection to port on the server. Servers that send
+        no features predate listening on a data port before handing it
+        out, so for those the connection is retried a few times.
+        """
+        tries = 1 if self.welcome[4] else DATA_CONNECT_TRIES
+        sock = socket(AF_INET, SOCK_STREAM)
+        for i in range(tries):
+            try:
+                sock.connect((self.client.ipaddr, port))
+            except OSError:
+                if i == tries - 1:
+                    sock.close()
+                    raise
+                time.sleep(DATA_CONNECT_WAIT)
+            else:
+                return sock
 
-            # attempt to connect 5 times; if not, return error
-            i = 0
-            while True:
-                try:
-                    s2.connect((self.ipaddr, port))
-                except OSError as e:
-                    i += 1
-                    if i < 5:
-                        time.sleep(0.5)
-                        continue
-                    else:
-                        raise e
-                else:
-                    break
+    def get(self, filename, resume=False):
+        """
+        Gets a file. With resume, a partial local copy left by an
+        interrupted transfer is continued rather than refused.
+        """
+        abspath = os.path.abspath(filename)
+        offset = 0
+        if os.path.exists(abspath):
+            if not resume:
+                raise FileExistsError(abspath)
+            offset = os.path.getsize(abspath)
+
+        self.run(self._get, filename, offset)
+
+    def put(self, filename, resume=False):
+        """
+        Puts a file. With resume, a partial copy left on the server by
+        an interrupted transfer is continued, and only the rest is sent.
+
+        Returns whether the server's content store already had the file,
+        so it was not sent, or None if the file was not offered to it.
+        """
+        abspath = os.path.abspath(filename)
+        if not os.path.exists(abspath):
+            raise FileNotFoundError(abspath)
+
+        offset = self.size(filename) if resume else None
+        return self.run(self._put, filename, os.path.getsize(abspath), offset)
+
+    def dput(self, filename):
+        """
+        Puts a file the server has an older copy of, sending only the parts
+        of it that changed. Falls back to a plain put if the server has no
+        copy, or does not support delta uploads.
+        """
+        abspath = os.path.abspath(filename)
+        if not os.path.exists(abspath):
+            raise FileNotFoundError(abspath)
+
+        size = os.path.getsize(abspath)
+        self.open()
+        if "DELTA" not in self.welcome[4] or not self.run(self._dput, filename, size):
+            self.run(self._put, filename, size, None)
+
+    def delete(self, filename):
+        self.run(self._delete, filename)
+
+    def size(self, filename):
+        """
+        Returns the size of a file on the server, or None if it does not exist.
+        """
+        return self.run(self._size, filename)
+
+    def sizes(self, *filenames):
+        """
+        Returns the sizes of several files on the server, with None for any
+        that do not exist. With a framing server, every command is sent
+        before the first reply is read, so this takes one round trip.
+        """
+        if not self.framed():
+            return [ self.size(filename) for filename in filenames ]
+        return self.run(self._sizes, filenames)
+
+    def codec(self):
+        """
+        Returns the compression spec to ask the server for, if the client
+        has one set and the server supports its codec.
+        """
+        spec = self.client.compress
+        if spec is None:
+            return None
+        self.open()
+        offered = self.welcome[4].get("Z", "").split(",")
+        return spec if spec.partition(":")[0] in offered else None
+
+    def digest(self):
+        """
+        Returns the digest algorithm to ask the server for, if the client
+        has one set and the server supports it.
+        """
+        name = self.client.digest
+        if name is None:
+            return None
+        self.open()
+        offered = self.welcome[4].get("H", "").split(",")
+        return name if name in offered else None
+
+    def finish(self, s, resb, success_msg, digest, hashers):
+        """
+        Evaluates the final response to a transfer, checking the digests
+        it carries against those of the bytes transferred if asked for.
+        """
+        fields = resb.split(DELIMITER)
+        if fields[0] == RES_OK and digest is not None:
+            opts = parse_opts(field.decode(self.client.encoding) for field in fields[1:])
+            if "H" not in opts:
+                raise DigestMismatch("no digest sent by the server")
+            verify(opts["H"], digest, hashers)
+        self.result(s, fields[0], success_msg)
+
+    def offer(self, filename):
+        """
+        Returns the digest of a file to offer the server's content store,
+        as algorithm:digest, if the client offers uploads and the server
+        has a store using an algorithm this side supports.
+        """
+        if not self.client.dedup:
+            return None
+        self.open()
+        name = self.welcome[4].get("CAS")
+        if name is None:
+            return None
+        try:
+            hasher = new_hasher(name)
+        except KeyError:
+            return None
+
+        with open(filename, "rb") as f:
+            while (b := f.read(RECV_BUFSIZE)):
+                hasher.update(b)
+        return f"{name}:{hasher.hexdigest()}"
+
+    def window(self):
+        """
+        Returns the window to ask the server for to send a transfer on the
+        main connection, if the client offers to and the session is framed.
+        """
+        if not self.client.mux:
+            return None
+        self.open()
+        if not self.framed() or "MUX" not in self.welcome[4]:
+            return None
+        return MUX_WINDOW
 
-            with s2:
-                s2.settimeout(120)
+    def inline(self):
+        """
+        Returns the largest file to take inline with a GET reply or send
+        inline with a PUT command, if both the client and server do.
+        """
+        if not self.client.inline:
+            return None
+        self.open()
+        offered = int(self.welcome[4].get("INLINE", 0))
+        return min(self.client.inline, offered) or None
+
+    def inline_body(self, filename, offset, size, args):
+        """
+        Returns the part of a file to send inline with the PUT command args,
+        if it is small enough for the server to take inline and for the
+        command to stay within what the server reads of one.
+        """
+        inline = self.inline()
+        if inline is None or size - offset > inline:
+            return None
+        limit = MAX_FRAME if self.framed() else MAX_COMMAND
+        if len(DELIMITER.join(args)) + 2 * len(DELIMITER) + size - offset > limit:
+            return None
+
+        with open(filename, "rb") as f:
+            f.seek(offset)
+            body = f.read(size - offset)
+        if len(body) != size - offset:
+            raise ValueError(f"{filename} shrank while being sent")
+        return body
+
+    def streams(self):
+        """
+        Returns the number of data connections to ask the server to split
+        a transfer across.
+        """
+        self.open()
+        offered = int(self.welcome[4].get("STREAMS", 1))
+        return max(1, min(self.client.streams, offered))
+
+    def mget(self, *patterns):
+        """
+        Gets several files over one data connection. The server expands
+        glob patterns in its working directory.
+
+        Returns a list of (path, error) for each file, where error is
+        None if the file was received. A file the server sends under an
+        absolute path, or one outside the working directory, is not
+        written, and has an UnsafePath error.
+        """
+        return self.run(self._mget, patterns)
+
+    def mput(self, *filenames):
+        """
+        Puts several files over one data connection.
+
+        Returns a list of (filename, error) for each file, where error
+        is None if the file was stored.
+        """
+        results, entries = [], []
+        for filename in filenames:
+            abspath = os.path.abspath(filename)
+            if not os.path.exists(abspath):
+                results.append((filename, FileNotFoundError(abspath)))
+                continue
+            entries.append((filename, os.path.getsize(abspath)))
+            results.append((filename, None))
+
+        statuses = iter(self.run(self._mput, entries))
+        return [
+            (name, err if err is not None else next(statuses))
+            for name, err in results
+        ]
+
+    def bye(self):
+        try:
+            self.run(self._bye)
+        finally:
+            # the server may be going away
+            self.close()
+
+    def _get(self, s, filename, offset):
+        client = self.client
+
+        # construct and send command
+        args = [ b"GET", bytes(filename, client.encoding) ]
+        if offset:
+            args.append(bytes(f"OFF={offset}", client.encoding))
+        spec = self.codec()
+        if spec is not None:
+            args.append(bytes(f"Z={spec}", client.encoding))
+        streams = self.streams()
+        if streams > 1:
+            args.append(bytes(f"STREAMS={streams}", client.encoding))
+        digest = self.digest()
+        if digest is not None:
+            args.append(bytes(f"H={digest}", client.encoding))
+        window = self.window()
+        if window is not None:
+            args.append(bytes(f"MUX={window}", client.encoding))
+        inline = self.inline()
+        if inline is not None:
+            args.append(bytes(f"INLINE={inline}", client.encoding))
+        s.send(DELIMITER.join(args))
+
+        # receive command parameters
+        params = s.recv(64)
+        if not params:
+            raise ConnectionResetError(s)
+
+        if params.startswith(RES_OK + DELIMITER + b"INLINE="):
+            # the file follows the reply
+            self._get_inline(s, filename, params, offset, digest)
+            return
+        
+        params = params.decode(client.encoding)
+
+        if not params.startswith("200 AIGT"):
+            s.send(ACKNOW)
+            raise client.determine_err(params)
+
+        params = params.split(DELIMITER.decode(client.encoding))
+        if params[1].startswith("MUX="):
+            # the server sends the file on this connection
+            window = int(parse_opts(params[1:2])["MUX"])
+            self._get_mux(s, filename, int(params[2]), offset, window, digest)
+            return
+
+        port, size = int(params[1]), int(params[2])
+        # the server only compresses files worth compressing
+        opts = parse_opts(params[3:])
+        decoder = parse_spec(opts["Z"])[0].decoder() if "Z" in opts else None
+        # the server only splits transfers large enough to be worth it
+        streams = int(opts.get("STREAMS", 1))
+
+        print(f"[*] Reading {size - offset} bytes from port {port}")
+
+        s.send(ACKNOW)
+
+        if streams > 1:
+            hashers = [ new_hasher(digest) if digest else None for _ in range(streams) ]
+            recved = self._recv_ranges(filename, port, size, offset, hashers)
+            s.send(ACKNOW)
+            d = s.recv(MAX_REPLY)
+            self.finish(
+                s, d, f"[*] File transfer successful: {recved} bytes received",
+                digest, hashers,
+            )
+            return
+
+        hasher = new_hasher(digest) if digest is not None else None
+
+        s2 = self.dial(port)
+
+        with s2:
+            s2.settimeout(120)
+            if offset:
+                # continue the partial file where it left off
+                f = open(filename, "r+b")
+                f.seek(offset)
+                f.truncate()
+            else:
                 f = open(filename, "wb")
-                inb, recved = bytes(), 0
-                bs = get_blocksize(size)
+            inb, recved = bytes(), offset
+            bs = get_blocksize(size)
+
+            if decoder is not None:
+                # the compressed stream runs until the server closes it
+                while (inb := s2.recv(RECV_BUFSIZE)):
+                    outb = decoder.decompress(inb)
+                    if hasher is not None:
+                        hasher.update(outb)
+                    recved += len(outb)
+                    f.write(outb)
+                if not decoder.eof or recved != size:
+                    f.close()
+                    raise CorruptStream(f"got {recved} of {size} bytes")
+
+            while recved < size:
+                inb = s2.recv(bs)
+                if not inb:
+                    f.close()
+                    raise ConnectionResetError(s2)
+                if hasher is not None:
+                    hasher.update(inb)
+                recved += len(inb)
+                f.write(inb)
 
+            f.close()
+
+        s.send(ACKNOW)
+        d = s.recv(MAX_REPLY)
+
+        self.finish(
+            s, d, f"[*] File transfer successful: {recved} bytes received",
+            digest, [ hasher ],
+        )
+
+    def _get_inline(self, s, filename, resb, offset, digest):
+        """
+        Takes a file sent inline with the reply to a GET, given the start
+        of the reply.
+        """
+        while True:
+            header, content = split_inline(resb, DELIMITER)
+            if content is not None:
+                break
+            if len(resb) > MAX_REPLY:
+                raise ValueError("no end to the fields of the reply")
+            b = s.recv(MAX_REPLY)
+            if not b:
+                raise ConnectionResetError(s)
+            resb += b
+
+        fields = header.split(DELIMITER)
+        size = int(parse_opts(field.decode(self.client.encoding) for field in fields[1:])["INLINE"])
+
+        print(f"[*] Reading {size} bytes inline")
+
+        chunks, recved = [ content ], len(content)
+        while recved < size:
+            b = s.recv(min(RECV_BUFSIZE, size - recved))
+            if not b:
+                raise ConnectionResetError(s)
+            chunks.append(b)
+            recved += len(b)
+        content = b"".join(chunks)
+
+        if offset:
+            # continue the partial file where it left off
+            f = open(filename, "r+b")
+            f.seek(offset)
+            f.truncate()
+        else:
+            f = open(filename, "wb")
+        with f:
+            f.write(content)
+
+        hasher = new_hasher(digest) if digest is not None else None
+        if hasher is not None:
+            hasher.update(content)
+        self.finish(
+            s, header, f"[*] File transfer successful: {offset + size} bytes received",
+            digest, [ hasher ],
+        )
+
+    def _get_mux(self, s, filename, size, offset, window, digest):
+        hasher = new_hasher(digest) if digest is not None else None
+
+        print(f"[*] Reading {size - offset} bytes on the main connection")
+
+        with MuxChannel(s, window) as channel:
+            s.send(ACKNOW)
+
+            if offset:
+                # continue the partial file where it left off
+                f = open(filename, "r+b")
+                f.seek(offset)
+                f.truncate()
+            else:
+                f = open(filename, "wb")
+
+            with f:
+                recved = offset
                 while recved < size:
-                    inb = s2.recv(bs)
+                    inb = channel.recv(RECV_BUFSIZE)
+                    if not inb:
+                        # the server ended the transfer with an error
+                        break
+                    if hasher is not None:
+                        hasher.update(inb)
                     recved += len(inb)
                     f.write(inb)
 
-                f.close()
+        if recved == size:
+            s.send(ACKNOW)
+        d = s.recv(MAX_REPLY)
+
+        self.finish(
+            s, d, f"[*] File transfer successful: {recved} bytes received",
+            digest, [ hasher ],
+        )
+
+    def _put(self, s, filename, size, offset):
+        client = self.client
+
+        args = [
+            b"PUT",
+            bytes(filename, client.encoding),
+            bytes(str(size), client.encoding),
+        ]
+        if offset is not None:
+            # the server continues its partial copy from here
+            args.append(bytes(f"OFF={offset}", client.encoding))
+        digest = self.digest()
+        if digest is not None:
+            args.append(bytes(f"H={digest}", client.encoding))
+        body = self.inline_body(filename, offset or 0, size, args)
+        if body is not None:
+            # nothing is worth compressing, splitting or offering
+            return self._put_inline(s, args, body, offset or 0, digest)
+
+        spec = self.codec()
+        if spec is not None:
+            # only compress files worth compressing
+            with open(filename, "rb") as f:
+                if not probe(f.fileno()):
+                    spec = None
+        if spec is not None:
+            args.append(bytes(f"Z={spec}", client.encoding))
+        else:
+            # a compressed stream cannot be split
+            streams = self.streams()
+            if streams > 1:
+                args.append(bytes(f"STREAMS={streams}", client.encoding))
+        offer = self.offer(filename) if offset is None else None
+        if offer is not None:
+            args.append(bytes(f"CAS={offer}", client.encoding))
+        window = self.window()
+        if window is not None:
+            args.append(bytes(f"MUX={window}", client.encoding))
+
+        s.send(DELIMITER.join(args))
+
+        params = s.recv(64)
+        if not params:
+            raise ConnectionResetError(s)
+        
+        params = params.decode(client.encoding)
 
+        if not params.startswith("200 AIGT"):
             s.send(ACKNOW)
-            d = s.recv(8)
+            raise client.determine_err(params)
 
-        self.eval_result(d, f"[*] File transfer successful: {recved} bytes received")
+        params = params.split(DELIMITER.decode(client.encoding))
+        if params[1] == "CAS=HIT":
+            # the server made the file from its content store
+            self.result(s, RES_OK, "[*] File found in the server's content store: 0 bytes sent")
+            return True
 
-    def put(self, filename):
-        abspath = os.path.abspath(filename)
-        if not os.path.exists(abspath):
-            raise FileNotFoundError(abspath)
+        opts = parse_opts(params[2:])
+        stored = False if opts.get("CAS") == "MISS" else None
+        if params[1].startswith("MUX="):
+            # the server takes the file on this connection
+            window = int(parse_opts(params[1:2])["MUX"])
+            hasher = new_hasher(digest) if digest is not None else None
+            sent = self._send_mux(s, filename, size, offset or 0, window, hasher)
+            d = s.recv(MAX_REPLY)
+            self.finish(
+                s, d, f"[*] File transfer successful: {sent} bytes sent",
+                digest, [ hasher ],
+            )
+            return stored
 
-        with socket(AF_INET, SOCK_STREAM) as s:
-            s.settimeout(120)
-            s = self._attempt_connection(s, (self.ipaddr, self.port), tries=5)
-            
-            logger.debug(s.getsockname())
+        port = int(params[1])
+        streams = int(opts.get("STREAMS", 1))
 
-            _ = self.parse_welcome_msg(s)
+        s.send(ACKNOW)
 
-            size = os.path.getsize(abspath)
-            
-            args = [
-                b"PUT",
-                bytes(filename, self.encoding),
-                bytes(str(size), self.encoding),
-            ]
+        if streams > 1:
+            hashers = [ new_hasher(digest) if digest else None for _ in range(streams) ]
+            sent = self._send_ranges(filename, port, size, offset or 0, hashers)
+            d = s.recv(MAX_REPLY)
+            self.finish(
+                s, d, f"[*] File transfer successful: {sent} bytes sent",
+                digest, hashers,
+            )
+            return stored
 
-            s.send(DELIMITER.join(args))
+        hasher = new_hasher(digest) if digest is not None else None
 
-            params = s.recv(32)
-            if not params:
-                raise ConnectionResetError(s)
+        s2 = self.dial(port)
+
+        newport = s2.getsockname()[1]
+        logger.debug("[*] Sending %s bytes on port %s", size, newport)
+        
+        with s2:
+            s2.settimeout(120)
+            f = open(filename, "rb")
+            sent = offset or 0
+            f.seek(sent)
+            bs = get_blocksize(size)
+
+            if spec is not None:
+                # the compressed stream ends when the connection is closed
+                codec, level = parse_spec(spec)
+                encoder = codec.encoder(level)
+                while (outb := f.read(COMPRESS_BLOCKSIZE)):
+                    if hasher is not None:
+                        hasher.update(outb)
+                    s2.sendall(encoder.compress(outb))
+                    sent += len(outb)
+                s2.sendall(encoder.flush())
+            else:
+                while sent < size:
+                    outb = f.read(bs)
+                    if hasher is not None:
+                        hasher.update(outb)
+                    s2.sendall(outb)
+                    sent += len(outb)
             
-            params = params.decode(self.encoding)
+            f.close()
 
-            if not params.startswith("200 AIGT"):
-                s.send(ACKNOW)
-                raise self.determine_err(params)
+        d = s.recv(MAX_REPLY)
 
-            params = params.split(DELIMITER.decode(self.encoding))
-            port = int(params[1])
+        self.finish(
+            s, d, f"[*] File transfer successful: {sent} bytes sent",
+            digest, [ hasher ],
+        )
+        return stored
 
+    def _put_inline(self, s, args, body, offset, digest):
+        """
+        Sends a PUT with the file inline after the command.
+        """
+        s.send(pack_inline(args, body, DELIMITER))
+
+        hasher = new_hasher(digest) if digest is not None else None
+        if hasher is not None:
+            hasher.update(body)
+        d = s.recv(MAX_REPLY)
+        if not d:
+            raise ConnectionResetError(s)
+
+        self.finish(
+            s, d, f"[*] File transfer successful: {offset + len(body)} bytes sent",
+            digest, [ hasher ],
+        )
+        return None
+
+    def _send_mux(self, s, filename, size, offset, window, hasher):
+        """
+        Sends a PUT on the main connection, updating hasher, if any.
+        Returns the number of bytes sent, which is short of the whole file
+        if the server ended the transfer with an error.
+        """
+        with MuxChannel(s, window) as channel, open(filename, "rb") as f:
             s.send(ACKNOW)
 
-            s2 = socket(AF_INET, SOCK_STREAM)
+            f.seek(offset)
+            sent = offset
+            while sent < size:
+                outb = f.read(min(MUX_CHUNK, size - sent))
+                if not outb:
+                    raise ValueError(f"{filename} shrank while being sent")
+                if hasher is not None:
+                    hasher.update(outb)
+                if not channel.sendall(outb):
+                    break
+                sent += len(outb)
+        return sent
+
+    def _dput(self, s, filename, size):
+        client = self.client
+
+        args = [
+            b"DPUT",
+            bytes(filename, client.encoding),
+            bytes(str(size), client.encoding),
+        ]
+        digest = self.digest()
+        if digest is not None:
+            args.append(bytes(f"H={digest}", client.encoding))
+
+        s.send(DELIMITER.join(args))
+
+        params = s.recv(64)
+        if not params:
+            raise ConnectionResetError(s)
+
+        params = params.decode(client.encoding)
+
+        if not params.startswith("200 AIGT"):
+            s.send(ACKNOW)
+            if params.startswith("302"):
+                # nothing to update, so the whole file has to be sent
+                return False
+            raise client.determine_err(params)
+
+        params = params.split(DELIMITER.decode(client.encoding))
+        port, blocksize, basesize = int(params[1]), int(params[2]), int(params[3])
+
+        s.send(ACKNOW)
+
+        s2 = self.dial(port)
 
-            i = 0
+        with s2, open(filename, "rb") as f:
+            s2.settimeout(120)
+
+            # the signature of each block of the server's copy
+            want = block_count(basesize, blocksize) * SIGNATURE.size
+            sigs = bytearray()
+            while len(sigs) < want:
+                b = s2.recv(min(want - len(sigs), RECV_BUFSIZE))
+                if not b:
+                    raise ConnectionResetError(s2)
+                sigs += b
+            table = parse_signatures(sigs)
+
+            # an empty file cannot be mapped
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+            hasher = new_hasher(digest) if digest is not None else None
+            try:
+                if hasher is not None:
+                    hasher.update(data)
+                # batch the ops up so small ones do not go out one by one
+                sent, outbuf = 0, bytearray()
+                for op in delta_ops(data, table, blocksize, basesize):
+                    outbuf += op
+                    if len(outbuf) >= RECV_BUFSIZE:
+                        s2.sendall(outbuf)
+                        sent += len(outbuf)
+                        outbuf.clear()
+                s2.sendall(outbuf)
+                sent += len(outbuf)
+            finally:
+                if size:
+                    data.close()
+
+        d = s.recv(MAX_REPLY)
+
+        self.finish(
+            s, d, f"[*] Delta transfer successful: {sent} bytes sent for {size}",
+            digest, [ hasher ],
+        )
+        return True
+
+    def _recv_ranges(self, filename, port, size, offset, hashers):
+        """
+        Receives a GET split into a range for each of hashers, each over its
+        own data connection, writing each range where it belongs in the file
+        and updating its hash object, if any.
+        If the transfer fails, the file is truncated to the data received
+        with no gaps before it, so it can be resumed from there.
+
+        Returns the number of bytes received.
+        """
+        client = self.client
+        ranges = split_ranges(offset, size, len(hashers))
+        expected = {rng: i for i, rng in enumerate(ranges)}
+        stored = {}
+        lock = threading.Lock()
+
+        if offset:
+            # continue the partial file where it left off
+            f = open(filename, "r+b")
+            f.truncate(offset)
+        else:
+            f = open(filename, "wb")
+
+        def recv_range(sock):
+            inbuf = bytearray()
+            while (header := take_header(inbuf, DELIMITER)) is None:
+                if len(inbuf) >= MAX_RANGE_HEADER:
+                    raise ValueError("range header too long")
+                b = sock.recv(MAX_RANGE_HEADER)
+                if not b:
+                    raise ConnectionResetError(sock)
+                inbuf += b
+
+            start, length = parse_range(header, DELIMITER)
+            with lock:
+                index = expected.pop((start, length), None)
+            if index is None or len(inbuf) > length:
+                raise ValueError(f"unexpected range {start}+{length}")
+
+            pos, end = start, start + length
+            b, bs = bytes(inbuf), get_blocksize(length)
+            hasher = hashers[index]
             while True:
-                try:
-                    s2.connect((self.ipaddr, port))
-                except OSError as e:
-                    i += 1
-                    if i < 5:
-                        time.sleep(0.5)
-                        continue
-                    else:
-                        raise e
-                else:
+                if hasher is not None:
+                    hasher.update(b)
+                write_at(f.fileno(), b, pos)
+                pos += len(b)
+                stored[index] = pos
+                if pos >= end:
                     break
+                b = sock.recv(min(bs, end - pos))
+                if not b:
+                    raise ConnectionResetError(sock)
 
-            newport = s2.getsockname()[1]
-            logger.debug(f"[*] Sending {size} bytes on port {newport}")
-            
-            with s2:
-                s2.settimeout(120)
-                f = open(filename, "rb")
-                sent = 0
-                bs = get_blocksize(size)
+        with f, contextlib.ExitStack() as stack:
+            socks = [ stack.enter_context(self.dial(port)) for _ in ranges ]
+            for sock in socks:
+                sock.settimeout(120)
 
-                while sent < size:
-                    outb = f.read(bs)
-                    out = s2.send(outb)
-                    sent += out
-                
-                f.close()
+            try:
+                run_streams(socks, recv_range)
+            except BaseException:
+                f.truncate(received_prefix(ranges, stored))
+                raise
 
-            d = s.recv(8)
+        return size - offset
 
-        self.eval_result(d, f"[*] File transfer successful: {sent} bytes sent")
+    def _send_ranges(self, filename, port, size, offset, hashers):
+        """
+        Sends a PUT split into a range for each of hashers, each over its
+        own data connection, updating its hash object, if any.
+        Returns the number of bytes sent.
+        """
+        client = self.client
+        count = len(hashers)
 
-    def delete(self, filename):
-        with socket(AF_INET, SOCK_STREAM) as s:
-            s.settimeout(120)
-            s = self._attempt_connection(s, (self.ipaddr, self.port), tries=5)
+        def send_range(sock, index):
+            start, length = ranges[index]
+            sock.sendall(pack_range(start, length, DELIMITER, client.encoding))
+            if not length:
+                return
+            with open(filename, "rb") as f:
+                hasher = hashers[index]
+                if hasher is None:
+                    sock.sendfile(f, start, length)
+                    return
+                # read through Python so the bytes can be hashed
+                f.seek(start)
+                bs = get_blocksize(length)
+                while length > 0:
+                    b = f.read(min(bs, length))
+                    if not b:
+                        raise ValueError(f"{filename} shrank while being sent")
+                    hasher.update(b)
+                    sock.sendall(b)
+                    length -= len(b)
 
-            _ = self.parse_welcome_msg(s)
+        with contextlib.ExitStack() as stack:
+            socks = [ stack.enter_context(self.dial(port)) for _ in range(count) ]
+            for sock in socks:
+                sock.settimeout(120)
 
-            # construct and send command
-            args = [ b"DEL", bytes(filename, self.encoding) ]
-            s.send(DELIMITER.join(args))
+            ranges = split_ranges(offset, size, count)
+            index = { sock: i for i, sock in enumerate(socks) }
+            run_streams(socks, lambda sock: send_range(sock, index[sock]))
 
-            res = s.recv(8)
-            
-        self.eval_result(res, "[*] Command successful")
+        return size - offset
+
+    def _delete(self, s, filename):
+        client = self.client
+
+        # construct and send command
+        args = [ b"DEL", bytes(filename, client.encoding) ]
+        s.send(DELIMITER.join(args))
+
+        res = s.recv(8)
+
+        self.result(s, res, "[*] Command successful")
+
+    def _size(self, s, filename):
+        client = self.client
+
+        args = [ b"SIZE", bytes(filename, client.encoding) ]
+        s.send(DELIMITER.join(args))
+
+        return self._size_reply(s)
+
+    def _sizes(self, s, filenames):
+        client = self.client
+
+        reqids = []
+        for filename in filenames:
+            reqids.append(s.new_request())
+            s.send(DELIMITER.join([ b"SIZE", bytes(filename, client.encoding) ]))
+
+        sizes, error = [], None
+        for reqid in reqids:
+            s.switch(reqid)
+            try:
+                sizes.append(self._size_reply(s))
+            except ServerError as e:
+                # the rest are still read and acknowledged, so the server
+                # goes on to the next command
+                error = error or e
+        if error is not None:
+            raise error
+        return sizes
+
+    def _size_reply(self, s):
+        res = s.recv(32)
+        if not res:
+            raise ConnectionResetError(s)
+
+        if res == CommandError.ERR_NONE.value:
+            s.send(ACKNOW)
+            return None
+
+        if not res.startswith(RES_OK):
+            self.result(s, res, "")
+
+        return int(res.split(DELIMITER)[1])
+
+    def _mget(self, s, patterns, local=None):
+        """
+        With local, each file is written to the path local returns for the
+        path the server sent, replacing any file already there once the new
+        one is whole. Otherwise, files are written at the paths sent, and
+        any already there are left alone; a path that is absolute, or leads
+        outside the working directory, is refused with UnsafePath.
+        """
+        client = self.client
+
+        args = [ b"MGET", *(bytes(p, client.encoding) for p in patterns) ]
+        s.send(DELIMITER.join(args))
+
+        params = s.recv(64)
+        if not params:
+            raise ConnectionResetError(s)
+
+        params = params.decode(client.encoding)
+
+        if not params.startswith("200 AIGT"):
+            s.send(ACKNOW)
+            raise client.determine_err(params)
+
+        params = params.split(DELIMITER.decode(client.encoding))
+        port, count = int(params[1]), int(params[2])
+
+        logger.debug("[*] Reading %s files from port %s", count, port)
+
+        s.send(ACKNOW)
+
+        results = []
+
+        s2 = self.dial(port)
+
+        with s2, s2.makefile("rb") as rfile:
+            s2.settimeout(120)
+            for _ in range(count):
+                status = rfile.readline(MAX_HEADER).rstrip(DELIMITER)
+                size = int(rfile.readline(MAX_HEADER))
+                path = rfile.readline(MAX_HEADER).rstrip(DELIMITER).decode(client.encoding)
+
+                if status != RES_OK:
+                    results.append((path, client.determine_err(status.decode(client.encoding))))
+                    continue
+
+                try:
+                    target = contained(os.curdir, path) if local is None else local(path)
+                    if os.path.dirname(target):
+                        os.makedirs(os.path.dirname(target), exist_ok=True)
+                    f = open(target, "xb") if local is None else open(target + ".part", "wb")
+                except (OSError, UnsafePath) as e:
+                    # still have to read the file off the connection
+                    results.append((path, e))
+                    f = None
+
+                left = size
+                while left:
+                    b = rfile.read(min(left, RECV_BUFSIZE))
+                    if not b:
+                        raise ConnectionResetError(s2)
+                    if f is not None:
+                        f.write(b)
+                    left -= len(b)
+
+                if f is not None:
+                    f.close()
+                    if local is not None:
+                        os.replace(f.name, target)
+                    results.append((path, None))
+
+        s.send(ACKNOW)
+        d = s.recv(8)
+
+        self.result(s, d, f"[*] Multi-file transfer successful: {count} files")
+        return results
+
+    def _mput(self, s, entries):
+        client = self.client
+
+        args = [ b"MPUT", bytes(str(len(entries)), client.encoding) ]
+        s.send(DELIMITER.join(args))
+
+        params = s.recv(32)
+        if not params:
+            raise ConnectionResetError(s)
+
+        params = params.decode(client.encoding)
+
+        if not params.startswith("200 AIGT"):
+            s.send(ACKNOW)
+            raise client.determine_err(params)
+
+        params = params.split(DELIMITER.decode(client.encoding))
+        port = int(params[1])
+
+        s.send(ACKNOW)
+
+        s2 = self.dial(port)
+
+        with s2:
+            s2.settimeout(120)
+            for filename, size in entries:
+                header = [
+                    bytes(str(size), client.encoding),
+                    bytes(filename, client.encoding),
+                ]
+                s2.sendall(DELIMITER.join(header) + DELIMITER)
+                with open(filename, "rb") as f:
+                    if size:
+                        s2.sendfile(f, 0, size)
+
+            # the server sends back the status of every file once it has them all
+            statuses = bytearray()
+            want = len(entries) * len(RES_OK)
+            while len(statuses) < want:
+                b = s2.recv(want - len(statuses))
+                if not b:
+                    raise ConnectionResetError(s2)
+                statuses += b
+
+        d = s.recv(8)
+
+        self.result(s, d, f"[*] Multi-file transfer successful: {len(entries)} files")
+
+        results = []
+        for i in range(len(entries)):
+            status = bytes(statuses[i * len(RES_OK):(i + 1) * len(RES_OK)])
+            if status == RES_OK:
+                results.append(None)
+            else:
+                results.append(client.determine_err(status.decode(client.encoding)))
+        return results
+
+    def tget(self, dirname, dest="."):
+        """
+        Gets a directory tree, extracting it under dest as it arrives.
+
+        Returns the number of members extracted.
+        """
+        target = os.path.join(dest, os.path.basename(os.path.normpath(dirname)))
+        if os.path.exists(target):
+            raise FileExistsError(os.path.abspath(target))
+
+        return self.run(self._tget, dirname, dest)
+
+    def _tget(self, s, dirname, dest):
+        client = self.client
+
+        args = [ b"TGET", bytes(dirname, client.encoding) ]
+        s.send(DELIMITER.join(args))
+
+        params = s.recv(32)
+        if not params:
+            raise ConnectionResetError(s)
+
+        params = params.decode(client.encoding)
+
+        if not params.startswith("200 AIGT"):
+            s.send(ACKNOW)
+            raise client.determine_err(params)
+
+        params = params.split(DELIMITER.decode(client.encoding))
+        port = int(params[1])
+
+        logger.debug("[*] Reading tree %s from port %s", dirname, port)
+
+        s.send(ACKNOW)
+
+        count = 0
+
+        s2 = self.dial(port)
+
+        with s2, s2.makefile("rb") as rfile:
+            s2.settimeout(120)
+            with tarfile.open(fileobj=rfile, mode="r|") as tar:
+                for member in tar:
+                    try:
+                        if HAS_DATA_FILTER:
+                            tar.extract(member, dest, filter="data")
+                        else:
+                            check_member(dest, member)
+                            tar.extract(member, dest)
+                        count += 1
+                    except MEMBER_REFUSED as e:
+                        logger.error(f"[ERR] Not extracting {member.name}: {e}")
+                    # a stream is read once, so don't keep every member around
+                    tar.members = []
+
+            # read the rest of the last record before closing
+            while rfile.read(RECV_BUFSIZE):
+                pass
+
+        s.send(ACKNOW)
+        d = s.recv(8)
+
+        self.result(s, d, f"[*] Tree transfer successful: {count} members extracted")
+        return count
 
     def pwd(self):
-        pass
+        """
+        Returns the working directory of the session on the server.
+        """
+        return self.run(self._pwd)
 
-    def lsd(self):
-        pass
+    def lsd(self, dirname=None):
+        """
+        Lists a directory on the server, the session's working directory
+        if none is given.
+
+        Returns a (kind, size, mtime_ns, name) tuple for each entry, where
+        kind is d for a directory, f for a file, l for a symlink or o for
+        anything else.
+        """
+        return self.run(self._lsd, dirname)
 
     def cwd(self, dirname):
-        pass
+        """
+        Changes the working directory of the session on the server, which
+        the paths of its later commands are relative to.
+        """
+        self.run(self._cwd, dirname)
 
-    def bye(self):
-        with socket(AF_INET, SOCK_STREAM) as s:
-            s.connect((self.ipaddr, self.port))
+    def sync(self, dirname=".", token=None, digest=None):
+        """
+        Lists the files under a directory on the server that changed since
+        token, the one returned by the last sync, or every file without one.
 
-            _ = self.parse_welcome_msg(s)
+        Returns the token to pass next time, whether every file is listed
+        rather than the changes, because there was no token or the server
+        could not use it, and a (kind, size, mtime_ns, digest, name) tuple
+        for each file, where kind is f for a file added or changed and x
+        for one removed, and digest is None unless an algorithm was given.
+        """
+        return self.run(self._sync, dirname, token, digest)
 
-            s.send(b"BYE")
+    def pull(self, dirname=".", dest=".", token=None, delete=False):
+        """
+        Brings the copy of a directory at dest up to date with the server,
+        getting only the files changed since token, the one returned by the
+        last pull, or every file without one. With delete, files removed on
+        the server are removed from dest too.
 
-            s.settimeout(5)
-            res = s.recv(8)
-        
-        self.eval_result(res, "[*] Command successful")
-    
-    def _attempt_connection(self, sock, params, tries=1, wait=5):
+        Returns the token to pass to the next pull, and the (path, error)
+        of each file got, as mget does. A name the server sends that is
+        absolute, or leads outside dest, is neither got nor removed, and
+        has an UnsafePath error.
         """
-        Attempt a connection on a socket with given params (ipaddr, port).
+        token, _, entries = self.sync(dirname, token)
 
-        Tries - number of times to attempt making the connection.
-        Wait - Waiting time between tries.
+        names, results = [], []
+        for kind, _, _, _, name in entries:
+            try:
+                target = contained(dest, name)
+            except UnsafePath as e:
+                logger.error(f"[ERR] Not syncing {name}: {e}")
+                results.append((name, e))
+                continue
+            if kind == "f":
+                names.append(name)
+            elif delete:
+                try:
+                    os.remove(target)
+                except FileNotFoundError:
+                    pass
+
+        top = "" if os.path.normpath(dirname) == "." else dirname
+        def local(path):
+            return contained(dest, os.path.relpath(path, top or "."))
+
+        # the server expands glob patterns, so the names are escaped, and
+        # split across as many commands as it takes to fit them
+        patterns = [ glob.escape(os.path.join(top, name)) for name in names ]
+        limit = MAX_FRAME if self.framed() else MAX_COMMAND
+        for batch in split_commands(b"MGET", patterns, self.client.encoding, limit):
+            results += self.run(self._mget, batch, local)
+        return token, results
+
+    def _pwd(self, s):
+        client = self.client
+
+        s.send(b"PWD")
+
+        res = s.recv(MAX_REPLY)
+        if not res:
+            raise ConnectionResetError(s)
+
+        if not res.startswith(RES_OK):
+            self.result(s, res, "")
+
+        return res.split(DELIMITER, 1)[1].decode(client.encoding)
+
+    def _lsd(self, s, dirname):
+        client = self.client
+
+        args = [ b"LSD" ]
+        if dirname is not None:
+            args.append(bytes(dirname, client.encoding))
+        _, listing = self._recv_listing(s, args)
+
+        entries = []
+        for line in listing:
+            kind, size, mtime, name = line.split(b" ", 3)
+            entries.append((
+                kind.decode(client.encoding), int(size), int(mtime), os.fsdecode(name),
+            ))
+        return entries
+
+    def _sync(self, s, dirname, token, digest):
+        client = self.client
+
+        args = [ b"SYNC", bytes(dirname, client.encoding) ]
+        if token is not None:
+            args.append(bytes(f"SINCE={token}", client.encoding))
+        if digest is not None:
+            args.append(bytes(f"H={digest}", client.encoding))
+        params, listing = self._recv_listing(s, args)
+
+        entries = []
+        for line in listing:
+            kind, size, mtime, fdigest, name = line.split(b" ", 4)
+            entries.append((
+                kind.decode(client.encoding), int(size), int(mtime),
+                fdigest.decode(client.encoding) if fdigest != b"-" else None,
+                os.fsdecode(name),
+            ))
+        return params[0], params[1] == "F", entries
+
+    def _recv_listing(self, s, args):
         """
+        Sends a command answered with a listing on the main connection,
+        returning the fields of the reply after the size of the listing,
+        and the lines of the listing.
+        """
+        client = self.client
+
+        s.send(DELIMITER.join(args))
+
+        params = s.recv(MAX_REPLY)
+        if not params:
+            raise ConnectionResetError(s)
+
+        params = params.decode(client.encoding)
+
+        if not params.startswith("200 AIGT"):
+            s.send(ACKNOW)
+            raise client.determine_err(params)
+
+        params = params.split(DELIMITER.decode(client.encoding))
+        size = int(params[1])
+
+        s.send(ACKNOW)
+
+        # the listing, followed by the final reply
+        listing = bytearray()
+        while len(listing) < size + len(RES_OK):
+            b = s.recv(min(RECV_BUFSIZE, size + len(RES_OK) - len(listing)))
+            if not b:
+                raise ConnectionResetError(s)
+            listing += b
+
+        self.result(s, bytes(listing[size:]), f"[*] Listing successful: {size} bytes")
+
+        return params[2:], [ bytes(line) for line in listing[:size].split(DELIMITER)[:-1] ]
+
+    def _cwd(self, s, dirname):
+        client = self.client
+
+        args = [ b"CWD", bytes(dirname, client.encoding) ]
+        s.send(DELIMITER.join(args))
+
+        res = s.recv(8)
+
+        self.result(s, res, f"[*] Changed directory to {dirname}")
+
+    def _bye(self, s):
+        s.send(b"BYE")
+
+        s.settimeout(5)
+        res = s.recv(8)
+        
+        self.client.eval_result(res, "[*] Command successful")
+
+def contained(root, path):
+    """
+    Returns path joined onto root, for a path sent by the server. Raises
+    UnsafePath if it is absolute, or leads outside root once normalised.
+    """
+    if os.path.isabs(path):
+        raise UnsafePath(f"{path} is absolute")
+    target = os.path.normpath(os.path.join(root, path))
+    base = os.path.abspath(root)
+    full = os.path.abspath(target)
+    if full == base or os.path.commonpath([ base, full ]) != base:
+        raise UnsafePath(f"{path} is not inside {root}")
+    return target
+
+def check_member(dest, member):
+    """
+    Checks a member of a tree sent by the server before it is extracted
+    under dest, for when tarfile has no data filter. Raises UnsafePath for
+    anything but a file, directory or symbolic link, for a member that
+    would be written through a link or outside dest, and for a link that
+    could lead outside dest. Also drops the ownership and special mode
+    bits of the member, as the data filter does.
+    """
+    if not (member.isfile() or member.isdir() or member.issym()):
+        raise UnsafePath(f"{member.name} is not a file, directory or link")
+    target = contained(dest, member.name)
+
+    # the directories leading to the member are real ones, not links
+    # extracted earlier, so it lands where its name says
+    parent = os.path.dirname(os.path.abspath(target))
+    real = os.path.join(os.path.realpath(dest), os.path.relpath(parent, os.path.abspath(dest)))
+    if os.path.realpath(parent) != os.path.normpath(real):
+        raise UnsafePath(f"{member.name} is inside a link")
+    if os.path.islink(target):
+        raise UnsafePath(f"{member.name} would be written through a link")
+
+    if member.issym():
+        # going up only before going down, so links met on the way down,
+        # each checked the same way, cannot lead back above dest
+        parts = [part for part in member.linkname.split("/") if part not in ("", ".")]
+        ups = 0
+        while ups < len(parts) and parts[ups] == "..":
+            ups += 1
+        if os.path.isabs(member.linkname) or ".." in parts[ups:]:
+            raise UnsafePath(f"{member.name} links to {member.linkname}")
+        contained(dest, os.path.join(os.path.dirname(member.name), member.linkname))
+    else:
+        member.mode &= 0o755
+        member.uid, member.gid = os.geteuid(), os.getegid()
+        member.uname = member.gname = ""
+
+def split_commands(command, args, encoding, limit=MAX_COMMAND):
+    """
+    Splits the arguments of a command into runs that each fit in a single
+    command of up to limit bytes, with at least one argument in each.
+    """
+    batch, size = [], len(command)
+    for arg in args:
+        n = len(DELIMITER) + len(bytes(arg, encoding))
+        if batch and size + n > limit:
+            yield batch
+            batch, size = [], len(command)
+        batch.append(arg)
+        size += n
+    if batch:
+        yield batch
+
+def run_streams(socks, fn):
+    """
+    Runs fn on each of socks on a thread of its own. If any of them raises,
+    the other sockets are shut down so their threads stop, and the first
+    error is raised once every thread has returned.
+    """
+    errors = []
+
+    def run(sock):
+        try:
+            fn(sock)
+        except BaseException as e:
+            errors.append(e)
+            for other in socks:
+                shutdown(other)
+
+    threads = [ threading.Thread(target=run, args=(sock,)) for sock in socks ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+class SessionPool:
+    """
+    A pool of sessions to the same server, for sending commands from
+    several threads at once. Each thread borrows an idle session, and
+    at most size sessions are open at a time.
+    """
+    def __init__(self, client, size):
+        # the client the sessions belong to
+        self.client = client
+        # limits the number of sessions in use
+        self.slots = threading.BoundedSemaphore(size)
+        # sessions not currently in use
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @contextlib.contextmanager
+    def session(self):
+        """
+        Borrows a session from the pool for the duration of a with block.
+        """
+        with self.slots:
+            with self.lock:
+                s = self.idle.pop() if self.idle else None
+            if s is None:
+                s = self.client.session()
+                s.open()
 
-        for i in range(tries):
             try:
-                sock.connect(params)
-            except OSError as e:
-                time.sleep(wait)
-                if i == tries - 1:
-                    raise e
-            else:
-                return sock
\ No newline at end of file
+                yield s
+            finally:
+                if not s.closed:
+                    with self.lock:
+                        self.idle.append(s)
+
+    def get(self, filename, resume=False):
+        with self.session() as s:
+            s.get(filename, resume)
+
+    def put(self, filename, resume=False):
+        with self.session() as s:
+            return s.put(filename, resume)
+
+    def dput(self, filename):
+        with self.session() as s:
+            s.dput(filename)
+
+    def delete(self, filename):
+        with self.session() as s:
+            s.delete(filename)
+
+    def size(self, filename):
+        with self.session() as s:
+            return s.size(filename)
+
+    def sizes(self, *filenames):
+        with self.session() as s:
+            return s.sizes(*filenames)
+
+    def mget(self, *patterns):
+        with self.session() as s:
+            return s.mget(*patterns)
+
+    def mput(self, *filenames):
+        with self.session() as s:
+            return s.mput(*filenames)
+
+    def tget(self, dirname, dest="."):
+        with self.session() as s:
+            return s.tget(dirname, dest)
+
+    def pwd(self):
+        with self.session() as s:
+            return s.pwd()
+
+    def lsd(self, dirname=None):
+        with self.session() as s:
+            return s.lsd(dirname)
+
+    def sync(self, dirname=".", token=None, digest=None):
+        with self.session() as s:
+            return s.sync(dirname, token, digest)
+
+    def pull(self, dirname=".", dest=".", token=None, delete=False):
+        with self.session() as s:
+            return s.pull(dirname, dest, token, delete)
+
+    def close(self):
+        """
+        Closes all idle sessions.
+        """
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for s in idle:
+            s.close()
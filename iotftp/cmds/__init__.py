@@ -15,13 +15,14 @@ class BaseCommandHandler(ABC):
         commtype: whether the connection is open for reading or writing.
 
         A handler function should return two items:
-        restype: the result type. This can be OK, DONE, NEWCONN, REPLACE, or ERR.
+        restype: the result type. This can be OK, DONE, NEWCONN, REPLACE, ATTACH, or ERR.
         res: the data associated with the result type. This differs according
         with the result type:
         - OK: None.
         - DONE: None.
         - NEWCONN: The socket to be registered as a subconnection.
         - REPLACE, a tuple (old_conn, (new_conn, new_data)).
+        - ATTACH, a tuple (new_conn, new_data).
         - ERR: A CommandError.
         """
         pass
@@ -34,3 +35,27 @@ class BaseCommandHandler(ABC):
         All conventions on handle() apply to this function.
         """
         pass
+
+    @abstractmethod
+    def interest(self, data):
+        """
+        Return the selector events the connection is waiting on.
+
+        data: the data associated with the connection, which may be
+            the main connection or a subconnection.
+
+        The server only wakes a connection up for the events it is
+        waiting on, so this should only include EVENT_WRITE when the
+        handler actually has something to send. Returning 0 takes the
+        connection out of the selector until the handler's state changes.
+        """
+        pass
+
+    def close(self):
+        """
+        Release any resources (files, buffers) held by the handler.
+
+        Called by the server when the command finishes, is abandoned
+        after an error, or its connection is closed.
+        """
+        pass
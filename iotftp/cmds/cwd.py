@@ -0,0 +1,87 @@
+import socket
+import os
+import stat
+import logging
+import selectors
+
+from enum import Enum
+
+from iotftp.cmds import BaseCommandHandler
+from iotftp.utils import *
+
+logger = logging.getLogger()
+
+class CwdCmdState(Enum):
+    # raw connection, unhandled
+    UNHANDLED = 0
+    # checking the directory on the filesystem executor
+    CHECKING = 1
+    # completed, acknowledgement sent
+    COMPLETE = 2
+
+class CwdCmdHandler(BaseCommandHandler):
+    """
+    Changes the working directory of the connection, which the paths of
+    its later commands are relative to. Other connections are unaffected.
+    """
+    def __init__(self, args):
+        self.state = CwdCmdState.UNHANDLED
+        # the directory to change to, already made absolute
+        self.args = args
+        # the filesystem job in progress, if any
+        self.pending = None
+
+    def handle(self, conn: socket.socket, params, data, commtype):
+        if commtype == RW.READ:
+            return HandlerResult.OK, None
+
+        elif commtype == RW.WRITE:
+            match self.state:
+                case CwdCmdState.UNHANDLED:
+                    # check the directory off the event loop
+                    self.pending = params.fs.submit(conn, check_dir, self.args)
+                    self.state = CwdCmdState.CHECKING
+
+                    return HandlerResult.OK, None
+
+                case CwdCmdState.CHECKING:
+                    try:
+                        self.pending.result()
+                    except FileNotFoundError:
+                        return HandlerResult.E302, CommandError.ERR_NONE
+                    except PermissionError:
+                        return HandlerResult.E301, CommandError.ERR_PERM
+                    except NotADirectoryError:
+                        return HandlerResult.E303, CommandError.ERR_NDIR
+                    except OSError as e:
+                        logger.debug("got err: %s", e)
+                        return HandlerResult.E302, CommandError.ERR_NONE
+                    finally:
+                        self.pending = None
+
+                    logger.debug("[%s] Changed directory to %s", data.addr, self.args)
+                    data.cwd = self.args
+                    conn.send(RES_OK)
+                    self.state = CwdCmdState.COMPLETE
+
+                    return HandlerResult.DONE, None
+
+        return HandlerResult.OK, None
+
+    def handle_subconn(self, conn: socket.socket, params, data, commtype):
+        pass
+
+    def interest(self, data):
+        if self.state == CwdCmdState.CHECKING and not self.pending.done():
+            return 0
+        return selectors.EVENT_WRITE
+
+def check_dir(path):
+    """
+    Checks path is a directory that can be worked in.
+    """
+    st = os.stat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        raise NotADirectoryError(path)
+    if not os.access(path, os.X_OK):
+        raise PermissionError(path)
@@ -1,6 +1,7 @@
 import socket
 import os
 import logging
+import selectors
 
 from enum import Enum
 
@@ -13,33 +14,57 @@ logger = logging.getLogger()
 class DelCmdState(Enum):
     # raw connection, unhandled
     UNHANDLED = 0
+    # removing the file on the filesystem executor
+    REMOVING = 1
     # completed, acknowledgement sent
-    COMPLETE = 1
+    COMPLETE = 2
 
 class DelCmdHandler(BaseCommandHandler):
     def __init__(self, args):
         self.state = DelCmdState.UNHANDLED
         self.args = args
+        # the filesystem job in progress, if any
+        self.pending = None
 
     def handle(self, conn: socket.socket, params, data, commtype):
-        start_fn("del_handler")
-
         if commtype == RW.READ:
             return HandlerResult.OK, None
             
         elif commtype == RW.WRITE:
-            f = os.path.abspath(self.args)
-            
-            try:
-                os.remove(f)
-            except FileNotFoundError:
-                return HandlerResult.E302, CommandError.ERR_NONE
-            except PermissionError:
-                return HandlerResult.E301, CommandError.ERR_PERM
-            
-            conn.send(RES_OK)
+            match self.state:
+                case DelCmdState.UNHANDLED:
+                    f = os.path.abspath(self.args)
+
+                    # remove the file off the event loop
+                    self.pending = params.fs.submit(conn, os.remove, f)
+                    self.state = DelCmdState.REMOVING
+
+                    return HandlerResult.OK, None
 
-            return HandlerResult.DONE, None
+                case DelCmdState.REMOVING:
+                    try:
+                        self.pending.result()
+                    except FileNotFoundError:
+                        return HandlerResult.E302, CommandError.ERR_NONE
+                    except PermissionError:
+                        return HandlerResult.E301, CommandError.ERR_PERM
+                    except IsADirectoryError:
+                        return HandlerResult.E309, CommandError.ERR_ISDR
+                    except OSError as e:
+                        logger.error(f"[ERR] {e}")
+                        return HandlerResult.E308, CommandError.ERR_UNKW
+
+                    conn.send(RES_OK)
+                    self.state = DelCmdState.COMPLETE
+
+                    return HandlerResult.DONE, None
+
+        return HandlerResult.OK, None
 
     def handle_subconn(self, conn: socket.socket, params, data, commtype):
         pass
+
+    def interest(self, data):
+        if self.state == DelCmdState.REMOVING and not self.pending.done():
+            return 0
+        return selectors.EVENT_WRITE
\ No newline at end of file
@@ -0,0 +1,298 @@
+import socket
+import logging
+import selectors
+
+from enum import Enum
+
+from iotftp.cmds import BaseCommandHandler
+from iotftp.utils import *
+from iotftp.delta import open_delta
+from iotftp.digest import DIGESTS, new_hasher, format_digest
+
+logger = logging.getLogger()
+
+class DPutCmdState(Enum):
+    # raw connection, unhandled
+    UNHANDLED = 0
+    # opening the base file and computing its signatures
+    OPENING = 1
+    # sent new port number and block size, awaiting acknowledgement
+    SENTPORT = 2
+    # received ack, awaiting connection on subconn
+    CONNECT = 3
+    # sending the signatures of the base file on the subconn
+    SENDSIGS = 4
+    # receiving and applying the delta
+    RECEIVING = 5
+    # moving the rebuilt file into place
+    INSTALLING = 6
+    # file rebuilt, send ack
+    COMPLETE = 7
+    # in a current state of error, tracked by main server class
+    ERROR = 8
+
+class DPutCmdHandler(BaseCommandHandler):
+    """
+    Updates a file the server already has by receiving only what changed.
+
+    The server splits its copy, the base file, into blocks and sends the
+    signature of each on the data connection. The client answers with a
+    delta: literal data for what it could not match, and references to
+    the blocks it could. The new file is rebuilt next to the base file and
+    only replaces it once it is complete.
+    """
+    def __init__(self, args, opts=None):
+        self.state = DPutCmdState.UNHANDLED
+        self.mainconn = None
+        self.subconn = None
+        # command arguments and options
+        self.args = args
+        self.opts = opts or {}
+        # the digest algorithm asked for, if any
+        self.digest = None
+        # total size of the file once rebuilt
+        self.totalsize = 0
+        # rebuilds the file from the delta
+        self.receiver = None
+        # the signatures of the base file, and the part not yet sent
+        self.outbuf = None
+        # the filesystem job in progress, if any
+        self.pending = None
+
+    def handle(self, conn: socket.socket, params, data, commtype):
+        if commtype == RW.READ:
+            match self.state:
+                case DPutCmdState.SENTPORT:
+                    b = conn.recv(len(ACKNOW))
+                    if not b:
+                        raise ConnClosedErr()
+
+                    if b == ACKNOW:
+                        logger.debug("Got acknowledgement")
+                        self.state = DPutCmdState.CONNECT
+                    else:
+                        raise ConnClosedErr()
+
+        elif commtype == RW.WRITE:
+            match self.state:
+                case DPutCmdState.UNHANDLED:
+                    self.mainconn = conn
+
+                    try:
+                        self.totalsize = int(self.args[1])
+                    except ValueError:
+                        return HandlerResult.E306, CommandError.ERR_ARGS
+                    if self.totalsize < 0:
+                        return HandlerResult.E306, CommandError.ERR_ARGS
+
+                    hasher = None
+                    if "H" in self.opts:
+                        if self.opts["H"] not in DIGESTS:
+                            return HandlerResult.E305, CommandError.ERR_UNSP
+                        self.digest = self.opts["H"]
+                        hasher = new_hasher(self.digest)
+
+                    # reading the base file can take a while, so it is
+                    # done off the event loop
+                    self.pending = params.fs.submit(
+                        conn, open_delta, self.args[0], self.totalsize, hasher
+                    )
+                    self.state = DPutCmdState.OPENING
+                    return HandlerResult.OK, None
+
+                case DPutCmdState.OPENING:
+                    try:
+                        self.receiver, self.outbuf = self.pending.result()
+                    except Exception as e:
+                        return delta_error(e)
+                    finally:
+                        self.pending = None
+
+                    sock = params.ports.lease()
+
+                    reply = [
+                        RES_OK,
+                        bytes(str(sock.getsockname()[1]), params.encoding),
+                        bytes(str(self.receiver.blocksize), params.encoding),
+                        bytes(str(self.receiver.basesize), params.encoding),
+                    ]
+
+                    conn.send(params.delim.join(reply))
+                    self.subconn = sock
+                    self.state = DPutCmdState.SENTPORT
+                    return HandlerResult.NEWCONN, sock
+
+                case DPutCmdState.COMPLETE:
+                    logger.debug("[%s] Transfer complete, sending ack", data.addr)
+                    reply = [ RES_OK ]
+                    if self.digest is not None:
+                        reply.append(bytes(
+                            f"H={format_digest(self.digest, [self.receiver.hasher])}",
+                            params.encoding,
+                        ))
+                    conn.send(params.delim.join(reply))
+                    return HandlerResult.DONE, None
+        return HandlerResult.OK, None
+
+    def handle_subconn(self, conn: socket.socket, params, data, commtype):
+        if self.state == DPutCmdState.CONNECT and commtype == RW.READ:
+            try:
+                newconn, addr = self.subconn.accept()
+            except BlockingIOError:
+                # connection went away before we got to it
+                return HandlerResult.OK, None
+
+            if addr[0] != data.addr[0]:
+                # not the client this port was leased for
+                logger.debug("Dropping data connection from unexpected %s", addr)
+                newconn.close()
+                return HandlerResult.OK, None
+
+            logger.debug("Got new connection %s", addr)
+
+            if params.dataplane is None:
+                newconn.setblocking(False)
+                self.state = DPutCmdState.SENDSIGS
+            else:
+                # run the whole exchange on a data-plane thread, the
+                # data socket is woken up once it is done
+                newconn.settimeout(DATA_TIMEOUT)
+                self.pending = params.dataplane.submit(
+                    self.mainconn, exchange, newconn, self.outbuf, self.receiver
+                )
+                self.state = DPutCmdState.INSTALLING
+            self.outbuf = memoryview(self.outbuf)
+
+            newdata = ConnData(ConnType.TRANSFER, addr, None, self)
+
+            oldconn = self.subconn
+            self.subconn = newconn
+            return HandlerResult.REPLACE, (oldconn, (newconn, newdata))
+
+        try:
+            match self.state:
+                case DPutCmdState.SENDSIGS if commtype == RW.WRITE:
+                    try:
+                        n = conn.send(self.outbuf)
+                    except BlockingIOError:
+                        n = 0
+                    self.outbuf = self.outbuf[n:]
+
+                    if not self.outbuf:
+                        self.state = DPutCmdState.RECEIVING
+
+                case DPutCmdState.RECEIVING if self.pending is not None:
+                    if commtype == RW.WRITE and self.pending.done():
+                        try:
+                            self.pending.result()
+                        finally:
+                            self.pending = None
+                        if self.receiver.done():
+                            self.pending = params.fs.submit(
+                                self.mainconn, self.receiver.install
+                            )
+                            self.state = DPutCmdState.INSTALLING
+
+                case DPutCmdState.RECEIVING if commtype == RW.READ:
+                    try:
+                        b = conn.recv(RECV_BUFSIZE)
+                    except BlockingIOError:
+                        return HandlerResult.OK, None
+                    if not b:
+                        raise ConnClosedErr()
+                    # ops are applied one batch at a time, in order
+                    self.pending = params.fs.submit(self.mainconn, self.receiver.feed, b)
+
+                case DPutCmdState.INSTALLING if commtype == RW.WRITE:
+                    try:
+                        self.pending.result()
+                    finally:
+                        self.pending = None
+                    self.state = DPutCmdState.COMPLETE
+                    return HandlerResult.DONE, None
+        except (ConnectionError, TimeoutError):
+            # handled by the server like any other connection error
+            raise
+        except ValueError as e:
+            # malformed delta
+            logger.debug("Bad delta: %s", e)
+            return HandlerResult.E306, CommandError.ERR_ARGS
+        except OSError as e:
+            logger.error(f"[ERR] {e}")
+            return HandlerResult.E308, CommandError.ERR_UNKW
+        return HandlerResult.OK, None
+
+    def interest(self, data):
+        if data.is_subconn():
+            match self.state:
+                case DPutCmdState.CONNECT:
+                    return selectors.EVENT_READ
+                case DPutCmdState.SENDSIGS:
+                    return selectors.EVENT_WRITE
+                case DPutCmdState.RECEIVING | DPutCmdState.INSTALLING:
+                    if self.pending is not None:
+                        return selectors.EVENT_WRITE if self.pending.done() else 0
+                    return selectors.EVENT_READ
+                case _:
+                    return 0
+
+        match self.state:
+            case DPutCmdState.UNHANDLED | DPutCmdState.COMPLETE:
+                return selectors.EVENT_WRITE
+            case DPutCmdState.OPENING:
+                return selectors.EVENT_WRITE if self.pending.done() else 0
+            case DPutCmdState.SENTPORT:
+                return selectors.EVENT_READ
+            case _:
+                # nothing is read from the client while transferring, so
+                # anything it sends out of turn waits until it is expected
+                return 0
+
+    def close(self):
+        if self.pending is not None:
+            if self.state == DPutCmdState.OPENING:
+                # base file still being opened, close it once it is
+                self.pending.add_done_callback(close_delta)
+                return
+            # unblock a data-plane thread, and remove the new file
+            # once the job stops
+            shutdown(self.subconn)
+            self.pending.add_done_callback(lambda _: self.receiver.close())
+        elif self.receiver is not None:
+            self.receiver.close()
+
+def close_delta(fut):
+    """
+    Done callback that closes the receiver an open_delta job created, for
+    when the command was abandoned while it was running.
+    """
+    if fut.exception() is None:
+        fut.result()[0].close()
+
+def delta_error(e):
+    """
+    Returns the handler result for a base file that could not be opened.
+    """
+    match e:
+        case FileNotFoundError():
+            # nothing to update, the client can fall back to a PUT
+            return HandlerResult.E302, CommandError.ERR_NONE
+        case PermissionError():
+            return HandlerResult.E301, CommandError.ERR_PERM
+        case IsADirectoryError():
+            return HandlerResult.E309, CommandError.ERR_ISDR
+        case NotADirectoryError():
+            return HandlerResult.E303, CommandError.ERR_NDIR
+        case _:
+            logger.error(f"[ERR] {e}")
+            return HandlerResult.E308, CommandError.ERR_UNKW
+
+def exchange(conn, sigs, receiver):
+    """
+    Sends the signatures of the base file, then receives and applies the
+    delta and moves the new file into place, over a blocking socket.
+    Runs on a data-plane thread.
+    """
+    conn.sendall(sigs)
+    receiver.recv_all(conn)
+    receiver.install()
@@ -1,11 +1,20 @@
 import socket
 import os
 import logging
+import selectors
 
 from enum import Enum
 
 from iotftp.cmds import BaseCommandHandler
 from iotftp.utils import *
+from iotftp.transfer import (
+    FileSender, CompressedSender, RangeSender, split_ranges, reopen,
+)
+from iotftp.compress import parse_spec, format_spec, probe
+from iotftp.digest import DIGESTS, new_hasher, format_digest
+from iotftp.executor import close_result
+from iotftp.framing import MuxChannel, is_framed
+from iotftp.trace import tracer
 import iotftp
 
 logger = logging.getLogger()
@@ -13,48 +22,91 @@ logger = logging.getLogger()
 class GetCmdState(Enum):
     # raw connection, unhandled
     UNHANDLED = 0
+    # opening the file on the filesystem executor
+    OPENING = 1
     # sent new port number and details, awaiting acknowledgement
-    SENTPORT = 1
+    SENTPORT = 2
     # received ack, awaiting connection on subconn
-    CONNECT = 2
+    CONNECT = 3
     # currently sending file
-    SENDING = 3
+    SENDING = 4
     # sending complete, awaiting ack
-    COMPLETE = 4
+    COMPLETE = 5
     # received ack, respond with ack
-    SENDACK = 5
+    SENDACK = 6
     # in a current state of error, tracked by main server class
-    ERROR = 6
+    ERROR = 7
 
 
 class GetCmdHandler(BaseCommandHandler):
-    def __init__(self, args):
+    def __init__(self, args, opts=None):
         self.state = GetCmdState.UNHANDLED
         self.mainconn = None
         self.subconn = None
         # the file to be sent
         self.file = None
-        # command arguments
+        # command arguments and options
         self.args = args
+        self.opts = opts or {}
+        # the codec and level asked for, and whether the file is worth compressing
+        self.codec = None
+        self.level = None
+        self.compress = False
+        # the offset to start sending from, for resuming a transfer
+        self.offset = 0
+        # the number of data connections asked for
+        self.streams = 1
+        # the window asked for to multiplex the transfer onto the main
+        # connection, whether it is small enough to be, and the channel
+        # it is sent on if so
+        self.window = None
+        self.mux = False
+        self.channel = None
+        # the largest file the client takes inline with the reply, capped
+        # by the server's own, and the part of the file sent inline if the
+        # file is small enough
+        self.inline = None
+        self.content = None
+        # the digest algorithm asked for, if any, and the hash object
+        # the file is hashed with as it is sent
+        self.digest = None
+        self.hasher = None
+        # for a transfer split across several data connections, the ranges
+        # still to be given a connection, the connections and senders of
+        # those that have one, and the number of ranges not yet sent
+        self.ranges = None
+        self.senders = []
+        self.active = 0
         # total size of the file
         self.totalsize = 0
-        self.blocksize = get_blocksize(self.totalsize)
-        # number of bytes sent
-        self.sent = 0
+        # the transfer engine sending the file over the subconn
+        self.sender = None
+        # the filesystem job in progress, if any
+        self.pending = None
 
     def handle(self, conn: socket.socket, params, data, commtype):
-        start_fn("get_handler")
         if commtype == iotftp.RW.READ:
             logger.debug("Reading from connection")
             match self.state:
                 case GetCmdState.SENTPORT:
                     # receive acknowledgement
                     logger.debug("Sent port, awaiting acknowledgement")
-                    b = conn.recv(8)
+                    b = conn.recv(len(ACKNOW))
                     if not b:
                         raise ConnClosedErr()
 
-                    if b == ACKNOW:
+                    if b == ACKNOW and self.channel is not None:
+                        logger.debug("Got acknowledgement, sending on the main connection")
+                        if self.digest is not None:
+                            self.hasher = new_hasher(self.digest)
+                        self.sender = FileSender(
+                            self.file, self.totalsize, self.offset, self.hasher,
+                            sendfile=False, blocksize=MUX_CHUNK,
+                        )
+                        self.state = GetCmdState.SENDING
+                        if tracer.on:
+                            tracer.begin(conn, "transfer")
+                    elif b == ACKNOW:
                         logger.debug("Got acknowledgement")
                         self.state = GetCmdState.CONNECT
                     else:
@@ -62,7 +114,7 @@ class GetCmdHandler(BaseCommandHandler):
                         raise ConnClosedErr()
                 case GetCmdState.COMPLETE:
                     logger.debug("Transfer complete, awaiting acknowledgement")
-                    b = conn.recv(8)
+                    b = conn.recv(len(ACKNOW))
 
                     if b == ACKNOW:
                         logger.debug("Got acknowledgement")
@@ -70,8 +122,6 @@ class GetCmdHandler(BaseCommandHandler):
                         raise ConnClosedErr()
 
                     self.state = GetCmdState.SENDACK
-                    
-                    end_fn("get_handler")
                     return HandlerResult.OK, None
 
         elif commtype == iotftp.RW.WRITE:
@@ -79,86 +129,201 @@ class GetCmdHandler(BaseCommandHandler):
             match self.state:
                 case GetCmdState.UNHANDLED:
                     self.mainconn = conn
-                    logger.debug(f"[{data.addr}] Connection unhandled, setting up now")
-                    logger.debug(f"args: {self.args}")
+                    logger.debug("[%s] Connection unhandled, setting up now", data.addr)
+                    logger.debug("args: %s", self.args)
                     f = os.path.abspath(self.args)
 
-                    logger.debug(f"Got fully qualified path {f}")
-                    # create a new socket and bind to it
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.bind((params.host, 0))
+                    logger.debug("Got fully qualified path %s", f)
+
+                    if "Z" in self.opts:
+                        try:
+                            self.codec, self.level = parse_spec(self.opts["Z"])
+                        except KeyError:
+                            return HandlerResult.E305, CommandError.ERR_UNSP
+                        except ValueError:
+                            return HandlerResult.E306, CommandError.ERR_ARGS
+
                     try:
-                        self.file = open(self.args, "rb")
-                        self.totalsize = os.path.getsize(f)
-                        logger.debug(f"Got size {self.totalsize}")
+                        self.offset = parse_offset(self.opts) or 0
+                        self.streams = parse_streams(self.opts)
+                        self.window = parse_mux(self.opts)
+                        self.inline = parse_inline(self.opts)
+                    except ValueError:
+                        return HandlerResult.E306, CommandError.ERR_ARGS
+                    if self.window is not None and not is_framed(conn):
+                        # there is nothing to tell the data from the replies
+                        return HandlerResult.E305, CommandError.ERR_UNSP
+                    if self.inline is not None:
+                        self.inline = min(self.inline, params.inlinesize)
+
+                    if "H" in self.opts:
+                        if self.opts["H"] not in DIGESTS:
+                            return HandlerResult.E305, CommandError.ERR_UNSP
+                        self.digest = self.opts["H"]
+
+                    # open the file off the event loop
+                    self.pending = params.fs.submit(conn, self.open_file, params.muxsize)
+                    self.state = GetCmdState.OPENING
+                    return HandlerResult.OK, None
+
+                case GetCmdState.OPENING:
+                    try:
+                        self.file = self.pending.result()
+                        logger.debug("Got size %s", self.totalsize)
                     except FileNotFoundError:
-                        end_fn("get_handler")
                         return HandlerResult.E302, CommandError.ERR_NONE
                     except PermissionError:
-                        end_fn("get_handler")
                         return HandlerResult.E301, CommandError.ERR_PERM
                     except IsADirectoryError:
-                        end_fn("get_handler")
                         return HandlerResult.E309, CommandError.ERR_ISDR
                     except OSError as e:
-                        logger.debug(f"got err: {e}")
-
-                        end_fn("get_handler")
+                        logger.debug("got err: %s", e)
                         return HandlerResult.E302, CommandError.ERR_NONE
-
+                    finally:
+                        self.pending = None
+
+                    if self.offset > self.totalsize:
+                        # resuming past the end of the file
+                        return HandlerResult.E306, CommandError.ERR_ARGS
+
+                    if self.content is not None:
+                        # the file follows the reply, and that is the whole transfer
+                        reply = [
+                            RES_OK,
+                            bytes(f"INLINE={len(self.content)}", params.encoding),
+                        ]
+                        if self.digest is not None:
+                            hasher = new_hasher(self.digest)
+                            hasher.update(self.content)
+                            reply.append(bytes(
+                                f"H={format_digest(self.digest, [hasher])}", params.encoding
+                            ))
+                        conn.send_whole(pack_inline(reply, self.content, params.delim))
+                        return HandlerResult.DONE, None
+
+                    if self.mux:
+                        # open before replying, so no credit is dropped
+                        self.channel = MuxChannel(conn, self.window)
+                        reply = [
+                            RES_OK,
+                            bytes(f"MUX={self.window}", params.encoding),
+                            bytes(str(self.totalsize), params.encoding),
+                        ]
+                        conn.send(params.delim.join(reply))
+                        self.state = GetCmdState.SENTPORT
+                        return HandlerResult.OK, None
+
+                    # a compressed stream cannot be split
+                    streams = min(self.streams, params.maxstreams)
+                    if streams > 1 and not self.compress:
+                        ranges = split_ranges(self.offset, self.totalsize, streams)
+                        if len(ranges) > 1:
+                            self.ranges = ranges
+                            self.active = len(ranges)
+
+                    # lease a data port, which is already listening so the
+                    # client can connect as soon as it has the port
+                    sock = params.ports.lease()
                     port = sock.getsockname()[1]
 
-                    logger.debug(f"Got port {port}")
+                    logger.debug("Got port %s", port)
                     
                     reply = [
                         RES_OK,
                         bytes(str(sock.getsockname()[1]), params.encoding),
                         bytes(str(self.totalsize), params.encoding),
                     ]
-                    
+                    if self.compress:
+                        # tell the client the data will arrive compressed
+                        spec = format_spec(self.codec, self.level)
+                        reply.append(bytes(f"Z={spec}", params.encoding))
+                    if self.ranges is not None:
+                        # tell the client how many data connections to make
+                        reply.append(bytes(f"STREAMS={self.active}", params.encoding))
+
                     conn.send(params.delim.join(reply))
                     self.subconn = sock
                     self.state = GetCmdState.SENTPORT
-
-                    end_fn("get_handler")
                     return HandlerResult.NEWCONN, sock
 
+                case GetCmdState.SENDING if self.channel is not None:
+                    logger.debug("[%s] Sending on the main connection", data.addr)
+                    while self.channel.credit and not self.sender.done():
+                        if not self.sender.send(self.channel):
+                            break
+
+                    if self.sender.done():
+                        self.state = GetCmdState.COMPLETE
+                        self.sender.close()
+                        self.channel.close()
+                        if tracer.on:
+                            tracer.switch(conn, "transfer", "ack")
                 case GetCmdState.SENDING:
-                    logger.debug(f"{data.addr}] Connection sending")
+                    logger.debug("%s] Connection sending", data.addr)
                     pass
                 case GetCmdState.SENDACK:
-                    logger.debug(f"Sending acknowledgement to client")
-                    conn.send(RES_OK)
-
-                    end_fn("get_handler")
+                    logger.debug("Sending acknowledgement to client")
+                    reply = [ RES_OK ]
+                    if self.digest is not None:
+                        # a split transfer has a digest for each range
+                        hashers = [ stream.hasher for _, stream in self.senders ] or [ self.hasher ]
+                        reply.append(bytes(
+                            f"H={format_digest(self.digest, hashers)}", params.encoding
+                        ))
+                    conn.send(params.delim.join(reply))
                     return HandlerResult.DONE, None
 
         logger.debug(self.state)
-
-        end_fn("get_handler")
         return HandlerResult.OK, None
 
     def handle_subconn(self, conn: socket.socket, params, data, commtype):
-        start_fn("get_handler_subconn")
-
         #! ALWAYS ASSUME conn IS THE SUBCONN
 
         if commtype == RW.READ:
             # only read from sending socket if waiting for connection (SENTPORT)
             match self.state:
                 case GetCmdState.CONNECT:
-                    # listen for connection
+                    # accept the connection
                     # assume self.subconn is the listening socket
-
-                    # set subconn to blocking and listen
-                    self.subconn.settimeout(5)
-
-                    logger.debug("Listening for connection")
-                    self.subconn.listen()
-
-                    newconn, addr = self.subconn.accept()
-
-                    logger.debug(f"Got new connection {addr}")
+                    try:
+                        newconn, addr = self.subconn.accept()
+                    except BlockingIOError:
+                        # connection went away before we got to it
+                        return HandlerResult.OK, None
+
+                    if addr[0] != data.addr[0]:
+                        # not the client this port was leased for
+                        logger.debug("Dropping data connection from unexpected %s", addr)
+                        newconn.close()
+                        return HandlerResult.OK, None
+
+                    logger.debug("Got new connection %s", addr)
+                    if self.ranges is not None:
+                        return self.accept_range(newconn, addr, params)
+
+                    if self.digest is not None:
+                        self.hasher = new_hasher(self.digest)
+                    if self.compress:
+                        self.sender = CompressedSender(
+                            self.file, self.totalsize, self.codec.encoder(self.level),
+                            self.offset, self.hasher,
+                        )
+                    else:
+                        self.sender = FileSender(
+                            self.file, self.totalsize, self.offset, self.hasher
+                        )
+
+                    if params.dataplane is None:
+                        newconn.setblocking(False)
+                        if self.compress:
+                            self.sender.offload(params.fs, newconn)
+                    else:
+                        # send the whole file on a data-plane thread, the
+                        # data socket is woken up once it is done
+                        newconn.settimeout(DATA_TIMEOUT)
+                        self.pending = params.dataplane.submit(
+                            self.mainconn, self.sender.send_all, newconn
+                        )
 
                     newdata = ConnData(ConnType.TRANSFER, addr, None, self)
 
@@ -169,20 +334,183 @@ class GetCmdHandler(BaseCommandHandler):
 
                     # once connection received, change state
                     self.state = GetCmdState.SENDING
-
-                    end_fn("get_handler_subconn")
                     return HandlerResult.REPLACE, (oldconn, (newconn, newdata))
         
+        elif commtype == RW.WRITE and data.stream is not None:
+            return self.send_range(conn, data.stream)
+
         elif commtype == RW.WRITE:
             match self.state:
                 case GetCmdState.SENDING:
-                    b = self.file.read(self.blocksize)
-
-                    self.sent += conn.send(b)
+                    if self.pending is not None:
+                        try:
+                            self.pending.result()
+                        except (ConnectionError, TimeoutError):
+                            # handled by the server like any other connection error
+                            raise
+                        except OSError as e:
+                            logger.error(f"[ERR] {e}")
+                            return HandlerResult.E308, CommandError.ERR_UNKW
+                        finally:
+                            self.pending = None
+                    else:
+                        self.sender.send(conn)
 
-                    if self.sent >= self.totalsize:
+                    if self.sender.done():
                         self.state = GetCmdState.COMPLETE
-                        self.file.close()
-
-        end_fn("get_handler_subconn")
+                        self.sender.close()
+                        if tracer.on:
+                            tracer.switch(self.mainconn, "transfer", "ack")
+                        if self.compress:
+                            # the compressed stream ends where the data does
+                            conn.shutdown(socket.SHUT_WR)
+                        # left open until the command is done, by when the
+                        # client has hung up, so the TIME_WAIT stays with it
+                        # rather than on the pooled port
         return HandlerResult.OK, None
+
+    def accept_range(self, newconn, addr, params):
+        """
+        Starts sending the next range of a split transfer on a newly accepted
+        data connection. The listening socket is kept until every range has
+        a connection.
+        """
+        offset, length = self.ranges.pop(0)
+        hasher = new_hasher(self.digest) if self.digest is not None else None
+        stream = RangeSender(
+            reopen(self.file, "rb"), offset, length, params.delim, params.encoding,
+            hasher,
+        )
+        self.senders.append((newconn, stream))
+
+        if params.dataplane is None:
+            newconn.setblocking(False)
+        else:
+            newconn.settimeout(DATA_TIMEOUT)
+            stream.pending = params.dataplane.submit(
+                self.mainconn, stream.send_all, newconn
+            )
+
+        newdata = ConnData(ConnType.TRANSFER, addr, None, self)
+        newdata.stream = stream
+
+        if self.ranges:
+            return HandlerResult.ATTACH, (newconn, newdata)
+
+        oldconn = self.subconn
+        self.subconn = newconn
+        self.state = GetCmdState.SENDING
+        return HandlerResult.REPLACE, (oldconn, (newconn, newdata))
+
+    def send_range(self, conn, stream):
+        """
+        Sends the range of a split transfer carried by conn.
+        """
+        if stream.pending is not None:
+            try:
+                stream.pending.result()
+            except (ConnectionError, TimeoutError):
+                # handled by the server like any other connection error
+                raise
+            except OSError as e:
+                logger.error(f"[ERR] {e}")
+                return HandlerResult.E308, CommandError.ERR_UNKW
+            finally:
+                stream.pending = None
+        else:
+            stream.send(conn)
+
+        if not stream.done():
+            return HandlerResult.OK, None
+
+        stream.close()
+        self.active -= 1
+        if self.active == 0:
+            self.state = GetCmdState.COMPLETE
+            if tracer.on:
+                tracer.switch(self.mainconn, "transfer", "ack")
+        return HandlerResult.DONE, None
+
+    def interest(self, data):
+        if data.stream is not None:
+            return selectors.EVENT_WRITE if data.stream.ready() else 0
+
+        if data.is_subconn():
+            # the listening socket waits to accept once the client has
+            # acknowledged, the data socket waits to send
+            match self.state:
+                case GetCmdState.CONNECT:
+                    return selectors.EVENT_READ
+                case GetCmdState.SENDING:
+                    if self.pending is not None and not self.pending.done():
+                        return 0
+                    if self.pending is None and not self.sender.ready():
+                        return 0
+                    return selectors.EVENT_WRITE
+                case _:
+                    return 0
+
+        match self.state:
+            case GetCmdState.UNHANDLED | GetCmdState.SENDACK:
+                return selectors.EVENT_WRITE
+            case GetCmdState.OPENING:
+                return selectors.EVENT_WRITE if self.pending.done() else 0
+            case GetCmdState.SENTPORT | GetCmdState.COMPLETE:
+                return selectors.EVENT_READ
+            case GetCmdState.SENDING if self.channel is not None:
+                # out of credit, until the client grants more
+                return selectors.EVENT_WRITE if self.channel.credit else selectors.EVENT_READ
+            case _:
+                # nothing is read from the client while transferring, so
+                # anything it sends out of turn waits until it is expected
+                return 0
+
+    def open_file(self, muxsize):
+        """
+        Opens the file to send and gets its size, reads it whole if it is
+        to be sent inline, multiplexes it if it is no bigger than muxsize
+        and that was asked for, and if compression was asked for, checks the
+        start of the file is worth compressing. Runs on the filesystem
+        executor.
+        """
+        f = open(self.args, "rb")
+        self.totalsize = os.fstat(f.fileno()).st_size
+        if self.inline is not None and 0 <= self.totalsize - self.offset <= self.inline:
+            # small enough to read whole and send inline, uncompressed
+            try:
+                self.content = os.pread(f.fileno(), self.totalsize - self.offset, self.offset)
+            except Exception:
+                f.close()
+                raise
+            return f
+        # multiplexed transfers are not worth compressing
+        self.mux = self.window is not None and self.totalsize - self.offset <= muxsize
+        if self.codec is not None and not self.mux:
+            try:
+                self.compress = probe(f.fileno())
+            except Exception:
+                f.close()
+                raise
+        return f
+
+    def close(self):
+        if self.channel is not None:
+            self.channel.close()
+
+        for conn, stream in self.senders:
+            if stream.pending is not None:
+                # unblock the data-plane thread
+                shutdown(conn)
+            stream.close()
+
+        if self.sender is not None and self.pending is not None:
+            # unblock the data-plane thread, and close the file once it stops
+            shutdown(self.subconn)
+            self.pending.add_done_callback(lambda _: self.sender.close())
+        elif self.sender is not None:
+            self.sender.close()
+        elif self.file is not None:
+            self.file.close()
+        elif self.pending is not None:
+            # file still being opened, close it once it is
+            self.pending.add_done_callback(close_result)
@@ -0,0 +1,305 @@
+import socket
+import os
+import stat
+import time
+import logging
+import selectors
+import threading
+import collections
+from concurrent.futures import Future
+
+from enum import Enum
+
+from iotftp.cmds import BaseCommandHandler
+from iotftp.utils import *
+
+logger = logging.getLogger()
+
+# most directories whose listings are cached
+LISTING_CACHE_DIRS = 64
+# most entries kept across every cached listing
+LISTING_CACHE_ENTRIES = 1 << 20
+# a directory changed this recently may change again without its mtime
+# moving on, so its listing is not cached until it has settled
+LISTING_SETTLE_NS = 1_000_000_000
+# bytes of a listing sent at a time
+LISTING_CHUNK = 1 << 16
+
+class LsdCmdState(Enum):
+    # raw connection, unhandled
+    UNHANDLED = 0
+    # listing the directory on the filesystem executor
+    LISTING = 1
+    # sent the size of the listing, awaiting acknowledgement
+    SENTSIZE = 2
+    # sending the listing
+    SENDING = 3
+    # listing sent
+    COMPLETE = 4
+    # in a current state of error, tracked by main server class
+    ERROR = 5
+
+class LsdCmdHandler(BaseCommandHandler):
+    """
+    Lists a directory, one entry per line, with the kind, size and
+    modification time of each.
+
+    Listings come from the server's listing cache, and are sent on the
+    main connection a chunk at a time, so a large directory is never
+    formatted into a single buffer.
+    """
+    def __init__(self, args):
+        self.state = LsdCmdState.UNHANDLED
+        # command arguments
+        self.args = args
+        # the listing being sent, and the index of the next line to send
+        self.listing = None
+        self.next = 0
+        # the part of the current chunk not yet sent
+        self.outbuf = None
+        # the filesystem job in progress, if any
+        self.pending = None
+
+    def handle(self, conn: socket.socket, params, data, commtype):
+        if commtype == RW.READ:
+            match self.state:
+                case LsdCmdState.SENTSIZE:
+                    b = conn.recv(len(ACKNOW))
+                    if not b:
+                        raise ConnClosedErr()
+
+                    if b == ACKNOW:
+                        logger.debug("Got acknowledgement")
+                        self.state = LsdCmdState.SENDING
+                    else:
+                        raise ConnClosedErr()
+
+        elif commtype == RW.WRITE:
+            match self.state:
+                case LsdCmdState.UNHANDLED:
+                    logger.debug("[%s] Listing %s", data.addr, self.args)
+
+                    self.pending = self.submit(conn, params)
+                    self.state = LsdCmdState.LISTING
+
+                case LsdCmdState.LISTING:
+                    try:
+                        self.listing = self.pending.result()
+                    except Exception as e:
+                        return listing_error(e)
+                    finally:
+                        self.pending = None
+
+                    reply = [ RES_OK, *self.header(params) ]
+                    conn.send(params.delim.join(reply))
+                    self.state = LsdCmdState.SENTSIZE
+
+                case LsdCmdState.SENDING:
+                    if self.pump(conn):
+                        self.state = LsdCmdState.COMPLETE
+                        return HandlerResult.DONE, None
+        return HandlerResult.OK, None
+
+    def submit(self, conn, params):
+        """
+        Starts making the listing on the filesystem executor.
+        """
+        return params.fs.submit(conn, params.listings.list, self.args)
+
+    def header(self, params):
+        """
+        Returns the fields sent along with 200 AIGT, before the listing.
+        """
+        return [ bytes(str(self.listing.size), params.encoding) ]
+
+    def pump(self, conn):
+        """
+        Sends the listing, then the final reply, until the socket would
+        block. Returns whether everything has been sent.
+        """
+        while True:
+            if self.outbuf:
+                try:
+                    n = conn.send_chunk(self.outbuf)
+                except BlockingIOError:
+                    return False
+                self.outbuf = self.outbuf[n:]
+            elif self.next <= len(self.listing.lines):
+                chunk, self.next = self.listing.chunk(self.next)
+                if self.next > len(self.listing.lines):
+                    # the final reply goes out with the end of the listing
+                    chunk += RES_OK
+                self.outbuf = memoryview(chunk)
+            else:
+                return True
+
+    def handle_subconn(self, conn: socket.socket, params, data, commtype):
+        pass
+
+    def interest(self, data):
+        match self.state:
+            case LsdCmdState.UNHANDLED | LsdCmdState.SENDING:
+                return selectors.EVENT_WRITE
+            case LsdCmdState.LISTING:
+                return selectors.EVENT_WRITE if self.pending.done() else 0
+            case LsdCmdState.SENTSIZE:
+                return selectors.EVENT_READ
+            case _:
+                return 0
+
+class Listing:
+    """
+    The listing of a directory, as the lines sent for its entries.
+    """
+    def __init__(self, mtime, lines):
+        # the mtime of the directory when it was listed
+        self.mtime = mtime
+        self.lines = lines
+        # number of bytes in the whole listing
+        self.size = sum(len(line) for line in lines)
+
+    def chunk(self, start):
+        """
+        Returns a chunk of about LISTING_CHUNK bytes of the listing from
+        line start, and the line after it. Past the last line, the line
+        returned is one more than the number of lines.
+        """
+        end, n = start, 0
+        while end < len(self.lines) and n < LISTING_CHUNK:
+            n += len(self.lines[end])
+            end += 1
+        if end == len(self.lines):
+            end += 1
+        return b"".join(self.lines[start:end]), end
+
+class ListingCache:
+    """
+    Caches the listings of directories, for as long as the mtime of each
+    directory stays the same. Directories are keyed by device and inode, so
+    every path to a directory shares its listing.
+
+    Adding, removing or renaming an entry moves the mtime of a directory on,
+    but writing to a file in it does not, so a cached listing can have stale
+    sizes for files still being written to. The traces this server exists to
+    hand out are complete by the time it is started.
+
+    The size of a listing is sent before it, and its lines are sorted, so a
+    directory that is not cached is read whole before any of it is sent.
+    Clients listing it at the same time share that scan and its listing.
+    """
+    def __init__(self, maxdirs=LISTING_CACHE_DIRS, maxentries=LISTING_CACHE_ENTRIES):
+        self.maxdirs = maxdirs
+        self.maxentries = maxentries
+        # listings by (device, inode), least recently used first,
+        # and the number of entries in them
+        self.listings = collections.OrderedDict()
+        self.entries = 0
+        # the scans in progress by (device, inode, mtime), so clients
+        # listing a directory that is not cached share a single scan of it,
+        # and a single copy of its listing
+        self.scans = {}
+        # the cache is used from every filesystem thread
+        self.lock = threading.Lock()
+
+    def list(self, path):
+        """
+        Returns the listing of the directory at path.
+        Runs on the filesystem executor.
+        """
+        st = os.stat(path)
+        if not stat.S_ISDIR(st.st_mode):
+            raise NotADirectoryError(path)
+        key = (st.st_dev, st.st_ino)
+
+        with self.lock:
+            listing = self.listings.get(key)
+            if listing is not None and listing.mtime == st.st_mtime_ns:
+                self.listings.move_to_end(key)
+                return listing
+            version = key + (st.st_mtime_ns,)
+            # a scan already in progress for another client is waited on
+            scan = self.scans.get(version)
+            waiting = scan is not None
+            if not waiting:
+                scan = self.scans[version] = Future()
+        if waiting:
+            return scan.result()
+
+        try:
+            listing = Listing(st.st_mtime_ns, scan_dir(path))
+        except BaseException as e:
+            scan.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.scans[version]
+        scan.set_result(listing)
+
+        if time.time_ns() - st.st_mtime_ns >= LISTING_SETTLE_NS:
+            self.add(key, listing)
+        return listing
+
+    def add(self, key, listing):
+        if len(listing.lines) > self.maxentries:
+            return
+        with self.lock:
+            old = self.listings.pop(key, None)
+            if old is not None:
+                self.entries -= len(old.lines)
+            self.listings[key] = listing
+            self.entries += len(listing.lines)
+
+            while len(self.listings) > self.maxdirs or self.entries > self.maxentries:
+                _, old = self.listings.popitem(last=False)
+                self.entries -= len(old.lines)
+
+def scan_dir(path):
+    """
+    Lists the directory at path with os.scandir, returning the line for
+    each entry, sorted by name: its kind (d, f, l or o for anything else),
+    size, mtime in nanoseconds and name, separated by spaces. Names are
+    sent as the filesystem has them, and any with the delimiter in them
+    are left out.
+    """
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            name = os.fsencode(entry.name)
+            if DELIMITER in name:
+                logger.debug("Leaving %r out of the listing", entry.name)
+                continue
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                # removed since it was read
+                continue
+            entries.append((name, b"%s %d %d %s%s" % (
+                entry_kind(st.st_mode), st.st_size, st.st_mtime_ns, name, DELIMITER,
+            )))
+
+    entries.sort()
+    return [ line for _, line in entries ]
+
+def entry_kind(mode):
+    if stat.S_ISDIR(mode):
+        return b"d"
+    elif stat.S_ISREG(mode):
+        return b"f"
+    elif stat.S_ISLNK(mode):
+        return b"l"
+    return b"o"
+
+def listing_error(e):
+    """
+    Returns the handler result for a directory that could not be listed.
+    """
+    match e:
+        case FileNotFoundError():
+            return HandlerResult.E302, CommandError.ERR_NONE
+        case PermissionError():
+            return HandlerResult.E301, CommandError.ERR_PERM
+        case NotADirectoryError():
+            return HandlerResult.E303, CommandError.ERR_NDIR
+        case _:
+            logger.debug("got err: %s", e)
+            return HandlerResult.E302, CommandError.ERR_NONE
@@ -0,0 +1,323 @@
+import socket
+import os
+import glob
+import logging
+import selectors
+
+from enum import Enum
+
+from iotftp.cmds import BaseCommandHandler
+from iotftp.utils import *
+from iotftp.transfer import FileSender
+
+logger = logging.getLogger()
+
+class MGetCmdState(Enum):
+    # raw connection, unhandled
+    UNHANDLED = 0
+    # expanding the requested paths on the filesystem executor
+    LISTING = 1
+    # sent new port number and file count, awaiting acknowledgement
+    SENTPORT = 2
+    # received ack, awaiting connection on subconn
+    CONNECT = 3
+    # currently sending files
+    SENDING = 4
+    # sending complete, awaiting ack
+    COMPLETE = 5
+    # received ack, respond with ack
+    SENDACK = 6
+    # in a current state of error, tracked by main server class
+    ERROR = 7
+
+
+class MGetCmdHandler(BaseCommandHandler):
+    """
+    Sends several files back to back over a single data connection.
+
+    Each file is preceded by a header of its status, size and path. A file
+    that cannot be opened is sent with its error code and a size of 0, and
+    the rest of the files are still sent.
+    """
+    def __init__(self, args, cwd):
+        self.state = MGetCmdState.UNHANDLED
+        self.mainconn = None
+        self.subconn = None
+        # command arguments, paths or glob patterns
+        self.args = args
+        # the working directory they are relative to
+        self.cwd = cwd
+        # the paths of the files to send, once expanded
+        self.paths = None
+        # index of the next file to open
+        self.next = 0
+        # the part of the current header not yet sent
+        self.header = None
+        # the transfer engine sending the current file
+        self.sender = None
+        # the filesystem job in progress, if any
+        self.pending = None
+
+    def handle(self, conn: socket.socket, params, data, commtype):
+        if commtype == RW.READ:
+            match self.state:
+                case MGetCmdState.SENTPORT:
+                    b = conn.recv(len(ACKNOW))
+                    if not b:
+                        raise ConnClosedErr()
+
+                    if b == ACKNOW:
+                        logger.debug("Got acknowledgement")
+                        self.state = MGetCmdState.CONNECT
+                    else:
+                        raise ConnClosedErr()
+                case MGetCmdState.COMPLETE:
+                    b = conn.recv(len(ACKNOW))
+
+                    if b == ACKNOW:
+                        logger.debug("Got acknowledgement")
+                    else:
+                        raise ConnClosedErr()
+
+                    self.state = MGetCmdState.SENDACK
+
+        elif commtype == RW.WRITE:
+            match self.state:
+                case MGetCmdState.UNHANDLED:
+                    self.mainconn = conn
+                    logger.debug("[%s] Expanding %s", data.addr, self.args)
+
+                    self.pending = params.fs.submit(conn, expand, self.args, self.cwd)
+                    self.state = MGetCmdState.LISTING
+
+                case MGetCmdState.LISTING:
+                    try:
+                        self.paths = self.pending.result()
+                    except OSError as e:
+                        logger.debug("got err: %s", e)
+                        return HandlerResult.E308, CommandError.ERR_UNKW
+                    finally:
+                        self.pending = None
+
+                    sock = params.ports.lease()
+
+                    reply = [
+                        RES_OK,
+                        bytes(str(sock.getsockname()[1]), params.encoding),
+                        bytes(str(len(self.paths)), params.encoding),
+                    ]
+
+                    conn.send(params.delim.join(reply))
+                    self.subconn = sock
+                    self.state = MGetCmdState.SENTPORT
+                    return HandlerResult.NEWCONN, sock
+
+                case MGetCmdState.SENDACK:
+                    conn.send(RES_OK)
+                    return HandlerResult.DONE, None
+        return HandlerResult.OK, None
+
+    def handle_subconn(self, conn: socket.socket, params, data, commtype):
+        if commtype == RW.READ:
+            match self.state:
+                case MGetCmdState.CONNECT:
+                    try:
+                        newconn, addr = self.subconn.accept()
+                    except BlockingIOError:
+                        # connection went away before we got to it
+                        return HandlerResult.OK, None
+
+                    if addr[0] != data.addr[0]:
+                        # not the client this port was leased for
+                        logger.debug("Dropping data connection from unexpected %s", addr)
+                        newconn.close()
+                        return HandlerResult.OK, None
+
+                    logger.debug("Got new connection %s", addr)
+
+                    if params.dataplane is None:
+                        newconn.setblocking(False)
+                    else:
+                        # send every file on a data-plane thread, the
+                        # data socket is woken up once it is done
+                        newconn.settimeout(DATA_TIMEOUT)
+                        self.pending = params.dataplane.submit(
+                            self.mainconn, send_entries, newconn, self.paths,
+                            params.delim, params.encoding, self.cwd,
+                        )
+
+                    newdata = ConnData(ConnType.TRANSFER, addr, None, self)
+
+                    oldconn = self.subconn
+                    self.subconn = newconn
+
+                    self.state = MGetCmdState.SENDING
+                    return HandlerResult.REPLACE, (oldconn, (newconn, newdata))
+
+        elif commtype == RW.WRITE:
+            match self.state:
+                case MGetCmdState.SENDING:
+                    try:
+                        if params.dataplane is not None:
+                            # raises whatever stopped the data-plane thread
+                            try:
+                                self.pending.result()
+                            finally:
+                                self.pending = None
+                            sent = True
+                        else:
+                            sent = self.pump(conn, params)
+                    except (ConnectionError, TimeoutError):
+                        # handled by the server like any other connection error
+                        raise
+                    except OSError as e:
+                        logger.error(f"[ERR] {e}")
+                        return HandlerResult.E308, CommandError.ERR_UNKW
+
+                    if sent:
+                        self.state = MGetCmdState.COMPLETE
+                        return HandlerResult.DONE, None
+        return HandlerResult.OK, None
+
+    def pump(self, conn, params):
+        """
+        Sends headers and files until the socket would block or a file
+        is being opened. Returns whether every file has been sent.
+        """
+        while True:
+            if self.header:
+                try:
+                    n = conn.send(self.header)
+                except BlockingIOError:
+                    return False
+                self.header = self.header[n:]
+
+            elif self.sender is not None:
+                self.sender.send(conn)
+                if not self.sender.done():
+                    return False
+                self.sender.close()
+                self.sender = None
+
+            elif self.pending is not None:
+                if not self.pending.done():
+                    return False
+                try:
+                    status, f, size = self.pending.result()
+                finally:
+                    self.pending = None
+
+                path = self.paths[self.next - 1]
+                self.header = memoryview(
+                    pack_header(status, size, path, params.delim, params.encoding)
+                )
+                if f is not None:
+                    self.sender = FileSender(f, size)
+
+            elif self.next < len(self.paths):
+                # open the next file off the event loop
+                self.pending = params.fs.submit(
+                    self.mainconn, open_entry, resolve(self.cwd, self.paths[self.next])
+                )
+                self.next += 1
+
+            else:
+                return True
+
+    def interest(self, data):
+        if data.is_subconn():
+            match self.state:
+                case MGetCmdState.CONNECT:
+                    return selectors.EVENT_READ
+                case MGetCmdState.SENDING:
+                    if self.pending is not None and not self.pending.done():
+                        return 0
+                    return selectors.EVENT_WRITE
+                case _:
+                    return 0
+
+        match self.state:
+            case MGetCmdState.UNHANDLED | MGetCmdState.SENDACK:
+                return selectors.EVENT_WRITE
+            case MGetCmdState.LISTING:
+                return selectors.EVENT_WRITE if self.pending.done() else 0
+            case MGetCmdState.SENTPORT | MGetCmdState.COMPLETE:
+                return selectors.EVENT_READ
+            case _:
+                # nothing is read from the client while transferring, so
+                # anything it sends out of turn waits until it is expected
+                return 0
+
+    def close(self):
+        if self.sender is not None:
+            self.sender.close()
+        if self.pending is not None:
+            if self.state == MGetCmdState.SENDING:
+                # unblock a data-plane thread
+                shutdown(self.subconn)
+            self.pending.add_done_callback(close_entry)
+
+def expand(patterns, cwd):
+    """
+    Expands the paths and glob patterns of an MGET, relative to cwd, into
+    the paths to send. A pattern matching nothing is kept as is, so it is
+    reported as missing.
+    """
+    paths = []
+    for pattern in patterns:
+        paths.extend(sorted(glob.glob(pattern, root_dir=cwd)) or [pattern])
+    return paths
+
+def open_entry(path):
+    """
+    Opens a file to send, returning its status, the file and its size.
+    The file is None if it could not be opened, and the status is the error.
+    """
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return CommandError.ERR_NONE.value, None, 0
+    except PermissionError:
+        return CommandError.ERR_PERM.value, None, 0
+    except IsADirectoryError:
+        return CommandError.ERR_ISDR.value, None, 0
+    except OSError as e:
+        logger.debug("got err: %s", e)
+        return CommandError.ERR_NONE.value, None, 0
+
+    return RES_OK, f, os.fstat(f.fileno()).st_size
+
+def close_entry(fut):
+    """
+    Done callback that closes the file an open_entry job opened, for when
+    the command was abandoned while it was running.
+    """
+    if fut.exception() is None and isinstance(fut.result(), tuple):
+        f = fut.result()[1]
+        if f is not None:
+            f.close()
+
+def pack_header(status, size, path, delim, encoding):
+    """
+    Builds the header sent before each file of an MGET.
+    """
+    return delim.join([
+        status,
+        bytes(str(size), encoding),
+        bytes(path, encoding),
+    ]) + delim
+
+def send_entries(conn, paths, delim, encoding, cwd):
+    """
+    Sends every file over a blocking socket.
+    Runs on a data-plane thread.
+    """
+    for path in paths:
+        status, f, size = open_entry(resolve(cwd, path))
+        conn.sendall(pack_header(status, size, path, delim, encoding))
+        if f is not None:
+            sender = FileSender(f, size)
+            try:
+                sender.send_all(conn)
+            finally:
+                sender.close()
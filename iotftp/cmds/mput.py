@@ -0,0 +1,415 @@
+import socket
+import os
+import logging
+import selectors
+
+from enum import Enum
+
+from iotftp.cmds import BaseCommandHandler
+from iotftp.utils import *
+from iotftp.transfer import FileReceiver, preallocate, take_header
+
+logger = logging.getLogger()
+
+class MPutCmdState(Enum):
+    # raw connection, unhandled
+    UNHANDLED = 0
+    # sent new port number, awaiting acknowledgement
+    SENTPORT = 1
+    # received ack, awaiting connection on subconn
+    CONNECT = 2
+    # currently receiving files
+    RECEIVING = 3
+    # all files received, sending their results on the subconn
+    RESULTS = 4
+    # results sent, send ack
+    COMPLETE = 5
+    # in a current state of error, tracked by main server class
+    ERROR = 6
+
+class MPutCmdHandler(BaseCommandHandler):
+    """
+    Receives several files back to back over a single data connection.
+
+    Each file is preceded by a header of its size and path. Once every file
+    has been received, the status of each is sent back on the data connection.
+    A file that cannot be created is read and discarded, and the rest of the
+    files are still received.
+    """
+    def __init__(self, args, cwd):
+        self.state = MPutCmdState.UNHANDLED
+        self.mainconn = None
+        self.subconn = None
+        # command arguments
+        self.args = args
+        # the working directory the paths of the files are relative to
+        self.cwd = cwd
+        # number of files to receive
+        self.count = 0
+        # number of files received
+        self.received = 0
+        # data read off the subconn but not yet consumed
+        self.inbuf = bytearray()
+        # the path and size of the current file
+        self.path = None
+        self.size = 0
+        # the transfer engine receiving the current file
+        self.receiver = None
+        # number of bytes of the current file left to discard,
+        # and the error it is being discarded for
+        self.skip = 0
+        self.status = None
+        # the status of each file received, and the part not yet sent
+        self.results = bytearray()
+        self.outbuf = None
+        # the selector events the subconn is waiting on
+        self.want = selectors.EVENT_READ
+        # the filesystem job in progress, if any
+        self.pending = None
+
+    def handle(self, conn: socket.socket, params, data, commtype):
+        if commtype == RW.READ:
+            match self.state:
+                case MPutCmdState.SENTPORT:
+                    b = conn.recv(len(ACKNOW))
+                    if not b:
+                        raise ConnClosedErr()
+
+                    if b == ACKNOW:
+                        logger.debug("Got acknowledgement")
+                        self.state = MPutCmdState.CONNECT
+                    else:
+                        raise ConnClosedErr()
+
+        elif commtype == RW.WRITE:
+            match self.state:
+                case MPutCmdState.UNHANDLED:
+                    self.mainconn = conn
+
+                    try:
+                        self.count = int(self.args)
+                    except ValueError:
+                        return HandlerResult.E306, CommandError.ERR_ARGS
+
+                    sock = params.ports.lease()
+
+                    reply = [
+                        RES_OK,
+                        bytes(str(sock.getsockname()[1]), params.encoding),
+                    ]
+
+                    conn.send(params.delim.join(reply))
+                    self.subconn = sock
+                    self.state = MPutCmdState.SENTPORT
+                    return HandlerResult.NEWCONN, sock
+
+                case MPutCmdState.COMPLETE:
+                    logger.debug("[%s] Transfer complete, sending ack", data.addr)
+                    conn.send(RES_OK)
+                    return HandlerResult.DONE, None
+        return HandlerResult.OK, None
+
+    def handle_subconn(self, conn: socket.socket, params, data, commtype):
+        if self.state == MPutCmdState.CONNECT and commtype == RW.READ:
+            try:
+                newconn, addr = self.subconn.accept()
+            except BlockingIOError:
+                # connection went away before we got to it
+                return HandlerResult.OK, None
+
+            if addr[0] != data.addr[0]:
+                # not the client this port was leased for
+                logger.debug("Dropping data connection from unexpected %s", addr)
+                newconn.close()
+                return HandlerResult.OK, None
+
+            logger.debug("Got new connection %s", addr)
+
+            if params.dataplane is None:
+                newconn.setblocking(False)
+            else:
+                # receive every file on a data-plane thread, the
+                # data socket is woken up once it is done
+                newconn.settimeout(DATA_TIMEOUT)
+                self.pending = params.dataplane.submit(
+                    self.mainconn, recv_entries, newconn, self.count,
+                    params.bufpool, params.delim, params.encoding, self.cwd,
+                )
+
+            newdata = ConnData(ConnType.TRANSFER, addr, None, self)
+
+            oldconn = self.subconn
+            self.subconn = newconn
+
+            self.state = MPutCmdState.RECEIVING
+            return HandlerResult.REPLACE, (oldconn, (newconn, newdata))
+
+        try:
+            match self.state:
+                case MPutCmdState.RECEIVING if params.dataplane is not None:
+                    try:
+                        self.pending.result()
+                    finally:
+                        self.pending = None
+                    self.state = MPutCmdState.COMPLETE
+                    return HandlerResult.DONE, None
+
+                case MPutCmdState.RECEIVING:
+                    if self.pump(conn, params):
+                        self.outbuf = bytes(self.results)
+                        self.state = MPutCmdState.RESULTS
+
+                case MPutCmdState.RESULTS if commtype == RW.WRITE:
+                    try:
+                        n = conn.send(self.outbuf)
+                    except BlockingIOError:
+                        n = 0
+                    self.outbuf = self.outbuf[n:]
+
+                    if not self.outbuf:
+                        self.state = MPutCmdState.COMPLETE
+                        return HandlerResult.DONE, None
+        except (ConnectionError, TimeoutError):
+            # handled by the server like any other connection error
+            raise
+        except ValueError:
+            # malformed header
+            return HandlerResult.E306, CommandError.ERR_ARGS
+        except OSError as e:
+            logger.error(f"[ERR] {e}")
+            return HandlerResult.E308, CommandError.ERR_UNKW
+        return HandlerResult.OK, None
+
+    def pump(self, conn, params):
+        """
+        Receives headers and files until the socket has nothing more to read
+        or a filesystem job is in progress. Returns whether every file has
+        been received.
+        """
+        while self.received < self.count:
+            if self.pending is not None:
+                if not self.pending.done():
+                    self.want = 0
+                    return False
+                self.start_file(params)
+
+            elif self.receiver is not None:
+                if not self.receiver.done():
+                    if self.inbuf:
+                        n = self.receiver.feed(self.inbuf)
+                        del self.inbuf[:n]
+                    elif not self.receiver.ready():
+                        self.want = 0
+                        return False
+                    elif not self.receiver.recv(conn):
+                        self.want = selectors.EVENT_READ
+                        return False
+                    continue
+
+                if not self.receiver.finished():
+                    # waiting on the last flushes
+                    self.want = 0
+                    return False
+
+                status = RES_OK
+                if self.receiver.error is not None:
+                    logger.error(f"[ERR] {self.receiver.error}")
+                    status = CommandError.ERR_UNKW.value
+                self.receiver.close()
+                self.receiver = None
+                self.finish_file(status)
+
+            elif self.skip:
+                if not self.inbuf and not self.fill(conn, min(self.skip, RECV_BUFSIZE)):
+                    return False
+                n = min(self.skip, len(self.inbuf))
+                del self.inbuf[:n]
+                self.skip -= n
+                if not self.skip:
+                    self.finish_file(self.status)
+
+            else:
+                header = take_header(self.inbuf, params.delim)
+                if header is None:
+                    if len(self.inbuf) > MAX_HEADER:
+                        raise ValueError("header too long")
+                    if not self.fill(conn, MAX_HEADER):
+                        return False
+                    continue
+
+                size, path = parse_header(header, params.delim, params.encoding)
+                logger.debug("Receiving %s bytes into %s", size, path)
+                self.path, self.size = path, size
+                # create the file off the event loop
+                self.pending = params.fs.submit(
+                    self.mainconn, open_upload, resolve(self.cwd, path), size
+                )
+
+        return True
+
+    def fill(self, conn, n):
+        """
+        Reads up to n bytes from the subconn into the input buffer.
+        Returns whether anything was read.
+        """
+        try:
+            b = conn.recv(n)
+        except BlockingIOError:
+            self.want = selectors.EVENT_READ
+            return False
+        if not b:
+            raise ConnClosedErr()
+        self.inbuf += b
+        return True
+
+    def start_file(self, params):
+        """
+        Starts receiving the current file once it has been created,
+        or discarding it if it could not be.
+        """
+        try:
+            f = self.pending.result()
+        except OSError as e:
+            logger.debug("Could not create %s: %s", self.path, e)
+            self.status = upload_error(e)
+            self.skip = self.size
+            if not self.skip:
+                self.finish_file(self.status)
+            return
+        finally:
+            self.pending = None
+
+        self.receiver = FileReceiver(f, self.size, params.bufpool)
+        self.receiver.offload(params.fs, self.mainconn)
+
+    def finish_file(self, status):
+        self.results += status
+        self.received += 1
+        self.path = None
+
+    def interest(self, data):
+        if data.is_subconn():
+            match self.state:
+                case MPutCmdState.CONNECT:
+                    return selectors.EVENT_READ
+                case MPutCmdState.RECEIVING:
+                    if self.pending is not None:
+                        return selectors.EVENT_WRITE if self.pending.done() else 0
+                    if self.want:
+                        return self.want
+                    # waiting on flushes, which may have completed
+                    if self.receiver.ready() or self.receiver.finished():
+                        return selectors.EVENT_WRITE
+                    return 0
+                case MPutCmdState.RESULTS:
+                    return selectors.EVENT_WRITE
+                case _:
+                    return 0
+
+        match self.state:
+            case MPutCmdState.UNHANDLED | MPutCmdState.COMPLETE:
+                return selectors.EVENT_WRITE
+            case MPutCmdState.SENTPORT:
+                return selectors.EVENT_READ
+            case _:
+                # nothing is read from the client while transferring, so
+                # anything it sends out of turn waits until it is expected
+                return 0
+
+    def close(self):
+        if self.pending is not None:
+            if self.state == MPutCmdState.RECEIVING:
+                # unblock a data-plane thread
+                shutdown(self.subconn)
+            self.pending.add_done_callback(close_upload)
+        if self.receiver is not None:
+            self.receiver.close()
+
+def open_upload(path, size):
+    """
+    Creates a file to upload into and reserves space for it.
+    """
+    f = open(path, "xb", buffering=0)
+    try:
+        preallocate(f.fileno(), size)
+    except Exception:
+        f.close()
+        os.remove(path)
+        raise
+    return f
+
+def close_upload(fut):
+    """
+    Done callback that closes the file an open_upload job created, for when
+    the command was abandoned while it was running.
+    """
+    if fut.exception() is None and fut.result() is not None:
+        fut.result().close()
+
+def upload_error(e):
+    """
+    Returns the status of a file that could not be created.
+    """
+    match e:
+        case FileExistsError():
+            return CommandError.ERR_EXST.value
+        case PermissionError():
+            return CommandError.ERR_PERM.value
+        case FileNotFoundError():
+            return CommandError.ERR_NONE.value
+        case IsADirectoryError():
+            return CommandError.ERR_ISDR.value
+        case NotADirectoryError():
+            return CommandError.ERR_NDIR.value
+        case _:
+            return CommandError.ERR_UNKW.value
+
+def parse_header(header, delim, encoding):
+    """
+    Parses the size and path out of the header of a file of an MPUT.
+    Raises ValueError if it is malformed.
+    """
+    size, path = header.split(delim, 1)
+    size = int(size)
+    if size < 0 or not path:
+        raise ValueError("invalid header")
+    return size, path.decode(encoding)
+
+def recv_entries(conn, count, pool, delim, encoding, cwd):
+    """
+    Receives every file from a blocking socket, then sends back their results.
+    Runs on a data-plane thread.
+    """
+    results = bytearray()
+    with conn.makefile("rb") as rfile:
+        for _ in range(count):
+            size = rfile.readline(MAX_HEADER)
+            path = rfile.readline(MAX_HEADER)
+            if not path.endswith(delim):
+                raise ConnClosedErr()
+            size, path = parse_header(size + path[:-len(delim)], delim, encoding)
+
+            try:
+                f = open_upload(resolve(cwd, path), size)
+            except OSError as e:
+                logger.debug("Could not create %s: %s", path, e)
+                results += upload_error(e)
+                while size:
+                    b = rfile.read(min(size, RECV_BUFSIZE))
+                    if not b:
+                        raise ConnClosedErr()
+                    size -= len(b)
+                continue
+
+            receiver = FileReceiver(f, size, pool)
+            try:
+                while not receiver.done():
+                    n = rfile.readinto(receiver.window())
+                    if not n:
+                        raise ConnClosedErr()
+                    receiver.commit(n)
+            finally:
+                receiver.close()
+            results += RES_OK
+
+    conn.sendall(results)
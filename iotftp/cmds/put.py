@@ -1,11 +1,23 @@
 import socket
 import os
+import stat
 import logging
+import selectors
 
 from enum import Enum
 
 from iotftp.cmds import BaseCommandHandler
 from iotftp.utils import *
+from iotftp.transfer import (
+    FileReceiver, RangeReceiver, preallocate, split_ranges, received_prefix, reopen,
+    write_at,
+)
+from iotftp.compress import parse_spec, format_spec
+from iotftp.digest import DIGESTS, new_hasher, format_digest
+from iotftp.executor import close_result, when_all
+from iotftp.store import copy_out
+from iotftp.framing import MuxChannel, is_framed
+from iotftp.trace import tracer
 import iotftp
 
 logger = logging.getLogger()
@@ -13,19 +25,24 @@ logger = logging.getLogger()
 class PutCmdState(Enum):
     # raw connection, unhandled
     UNHANDLED = 0
+    # creating the file on the filesystem executor
+    OPENING = 1
     # sent new port number and details, awaiting acknowledgement
-    SENTPORT = 1
+    SENTPORT = 2
     # receiving ack, awaiting connection on subconn
-    CONNECT = 2
+    CONNECT = 3
     # currently receiving file
-    RECEIVING = 3
+    RECEIVING = 4
     # complete file received, send ack
-    COMPLETE = 4
+    COMPLETE = 5
     # in a current state of error, tracked by main server class
-    ERROR = 5
+    ERROR = 6
+    # waiting for the content store to take in the contents offered,
+    # before creating the file
+    STORING = 7
 
 class PutCmdHandler(BaseCommandHandler):
-    def __init__(self, args):
+    def __init__(self, args, opts=None, body=None):
         # the current state of the connection
         self.state = PutCmdState.UNHANDLED
         # the main connection where commands are sent
@@ -34,100 +51,364 @@ class PutCmdHandler(BaseCommandHandler):
         self.subconn = None
         # the file to be transferred
         self.file = None
-        # command arguments
+        # command arguments and options
         self.args = args
+        self.opts = opts or {}
+        # the file carried inline with the command, if it is small enough
+        # to need no data connection
+        self.body = body
+        # the codec the file is compressed with on the wire, if any
+        self.codec = None
+        self.level = None
+        # the offset to resume receiving from, if resuming a partial file
+        self.offset = None
+        # the number of data connections asked for
+        self.streams = 1
+        # the window asked for to multiplex the transfer onto the main
+        # connection, and the channel it is received on if it is
+        self.window = None
+        self.channel = None
+        # the digest algorithm asked for, if any, and the hash object
+        # the file is hashed with as it is written
+        self.digest = None
+        self.hasher = None
+        # the content store, and the digest of the contents offered
+        # for it, and whether the store had them
+        self.store = None
+        self.offer = None
+        self.hit = False
+        # for a transfer split across several data connections, the ranges
+        # it is split into, those not yet claimed by a connection mapped to
+        # their index, the connections and receivers of the ranges, the
+        # number of connections still to accept and of ranges not yet written
+        self.ranges = None
+        self.expected = None
+        self.parts = []
+        self.accepting = 0
+        self.active = 0
         # total size of the file to receive
         self.totalsize = 0
-        # number of bytes received
-        self.received = 0
-        self.blocksize = 0
-
+        # the transfer engine receiving the file from the subconn
+        self.receiver = None
+        # the filesystem job in progress, if any
+        self.pending = None
 
     def handle(self, conn: socket.socket, params, data, commtype):
-        start_fn("put_handler")
-
         if commtype == RW.READ:
             logger.debug("Reading from connection")
             match self.state:
                 case PutCmdState.SENTPORT:
                     logger.debug("Sent port, awaiting acknowledgement")
-                    b = conn.recv(8)
+                    b = conn.recv(len(ACKNOW))
                     if not b:
                         raise ConnClosedErr()
 
-                    if b == ACKNOW:
+                    if b == ACKNOW and self.channel is not None:
+                        logger.debug("Got acknowledgement, receiving on the main connection")
+                        self.receiver.offload(params.fs, conn)
+                        self.state = PutCmdState.RECEIVING
+                        if tracer.on:
+                            tracer.begin(conn, "transfer")
+                    elif b == ACKNOW:
                         logger.debug("Got acknowledgement")
                         self.state = PutCmdState.CONNECT
                     else:
                         raise ConnClosedErr()
 
+                case PutCmdState.RECEIVING if self.channel is not None:
+                    return self.recv_mux()
+
         elif commtype == RW.WRITE:
             logger.debug("Writing to connection")
             match self.state:
                 case PutCmdState.UNHANDLED:
-                    logger.debug(f"[{data.addr}] Connection unhandled, setting up now")
-                    logger.debug(f"args: {self.args}")
+                    self.mainconn = conn
+                    logger.debug("[%s] Connection unhandled, setting up now", data.addr)
+                    logger.debug("args: %s", self.args)
                     f = os.path.abspath(self.args[0])
 
-                    logger.debug(f"Got fully qualified path {f}")
+                    logger.debug("Got fully qualified path %s", f)
+
+                    try:
+                        self.totalsize = int(self.args[1])
+                    except ValueError:
+                        return HandlerResult.E306, CommandError.ERR_ARGS
 
-                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    sock.bind((params.host, 0))
+                    if "Z" in self.opts:
+                        try:
+                            self.codec, self.level = parse_spec(self.opts["Z"])
+                        except KeyError:
+                            return HandlerResult.E305, CommandError.ERR_UNSP
+                        except ValueError:
+                            return HandlerResult.E306, CommandError.ERR_ARGS
 
                     try:
-                        if os.path.exists(f):
-                            end_fn("put_handler")
-                            return HandlerResult.E307, CommandError.ERR_EXST
-                        
-                        f = open(self.args[0], "wb")
-                    
+                        self.offset = parse_offset(self.opts)
+                        self.streams = parse_streams(self.opts)
+                        self.window = parse_mux(self.opts)
+                    except ValueError:
+                        return HandlerResult.E306, CommandError.ERR_ARGS
+                    if self.window is not None and not is_framed(conn):
+                        # there is nothing to tell the data from the replies
+                        return HandlerResult.E305, CommandError.ERR_UNSP
+                    if self.offset is not None and self.offset > self.totalsize:
+                        return HandlerResult.E306, CommandError.ERR_ARGS
+                    if self.body is not None:
+                        if len(self.body) > params.inlinesize:
+                            return HandlerResult.E305, CommandError.ERR_UNSP
+                        if len(self.body) != self.totalsize - (self.offset or 0):
+                            return HandlerResult.E306, CommandError.ERR_ARGS
+
+                    if "H" in self.opts:
+                        if self.opts["H"] not in DIGESTS:
+                            return HandlerResult.E305, CommandError.ERR_UNSP
+                        self.digest = self.opts["H"]
+
+                    # nothing is saved offering a file that is already here
+                    if "CAS" in self.opts and self.offset is None and self.body is None:
+                        if params.store is None:
+                            return HandlerResult.E305, CommandError.ERR_UNSP
+                        try:
+                            self.offer = params.store.parse_offer(self.opts["CAS"])
+                        except KeyError:
+                            return HandlerResult.E305, CommandError.ERR_UNSP
+                        except ValueError:
+                            return HandlerResult.E306, CommandError.ERR_ARGS
+                        self.store = params.store
+                        # the same contents may still be being added from
+                        # an earlier upload; wait here rather than on the
+                        # executor the add is queued on
+                        adding = self.store.pending(self.offer)
+                        if adding is not None:
+                            self.pending = params.fs.watch(conn, adding)
+                            self.state = PutCmdState.STORING
+                            return HandlerResult.OK, None
+
+                    return self.start_open(conn, params)
+
+                case PutCmdState.STORING:
+                    self.pending = None
+                    return self.start_open(conn, params)
+
+                case PutCmdState.OPENING:
+                    try:
+                        f = self.pending.result()
+                    except FileExistsError:
+                        return HandlerResult.E307, CommandError.ERR_EXST
+                    except FileNotFoundError:
+                        # nothing to resume
+                        return HandlerResult.E302, CommandError.ERR_NONE
+                    except ValueError as e:
+                        logger.debug("Cannot resume: %s", e)
+                        return HandlerResult.E306, CommandError.ERR_ARGS
                     except Exception as e:
                         logger.error(f"[ERR] {e}")
-                        end_fn("put_handler")
-                        self.cleanup_err()
                         return HandlerResult.E308, CommandError.ERR_UNKW
-                    
+                    finally:
+                        self.pending = None
+
+                    if self.hit:
+                        # made from the content store, nothing to send
+                        f.close()
+                        reply = [ RES_OK, b"CAS=HIT" ]
+                        conn.send(params.delim.join(reply))
+                        return HandlerResult.DONE, None
+
+                    if self.body is not None:
+                        # written out with the file, and that is the whole transfer
+                        f.close()
+                        reply = [ RES_OK ]
+                        if self.digest is not None:
+                            hasher = new_hasher(self.digest)
+                            hasher.update(self.body)
+                            reply.append(bytes(
+                                f"H={format_digest(self.digest, [hasher])}", params.encoding
+                            ))
+                        conn.send(params.delim.join(reply))
+                        return HandlerResult.DONE, None
+
+                    if self.window is not None and self.codec is None and \
+                            self.totalsize - (self.offset or 0) <= params.muxsize:
+                        return self.start_mux(conn, f, params)
+
+                    # a compressed stream cannot be split
+                    streams = min(self.streams, params.maxstreams)
+                    ranges = split_ranges(self.offset or 0, self.totalsize, streams)
+                    if self.codec is None and len(ranges) > 1:
+                        self.ranges = ranges
+                        self.expected = {rng: i for i, rng in enumerate(ranges)}
+                        self.accepting = self.active = len(ranges)
+                    else:
+                        decoder = self.codec.decoder() if self.codec is not None else None
+                        if self.digest is not None:
+                            self.hasher = new_hasher(self.digest)
+                        self.receiver = FileReceiver(
+                            f, self.totalsize, params.bufpool, decoder, self.offset or 0,
+                            hasher=self.hasher,
+                        )
+
+                    # lease a data port, which is already listening so the
+                    # client can connect as soon as it has the port
+                    sock = params.ports.lease()
                     port = sock.getsockname()[1]
 
-                    logger.debug(f"Got port {port}")
+                    logger.debug("Got port %s", port)
 
                     reply = [
                         RES_OK,
                         bytes(str(port), params.encoding)
                     ]
-                    
+                    if self.codec is not None:
+                        # confirm the compressed stream is expected
+                        spec = format_spec(self.codec, self.level)
+                        reply.append(bytes(f"Z={spec}", params.encoding))
+                    if self.ranges is not None:
+                        # tell the client how many data connections to make
+                        reply.append(bytes(f"STREAMS={self.active}", params.encoding))
+                    if self.offer is not None:
+                        reply.append(b"CAS=MISS")
+
                     conn.send(params.delim.join(reply))
                     self.subconn = sock
                     self.state = PutCmdState.SENTPORT
                     self.file = f
-                    self.totalsize = int(self.args[1])
-                    self.blocksize = get_blocksize(self.totalsize)
-
-                    end_fn("put_handler")
                     return HandlerResult.NEWCONN, sock
 
                 case PutCmdState.COMPLETE:
-                    logger.debug(f"[{data.addr}] Transfer complete, sending ack")
-                    conn.send(RES_OK)
-
-                    end_fn("put_handler")
+                    logger.debug("[%s] Transfer complete, sending ack", data.addr)
+                    reply = [ RES_OK ]
+                    if self.digest is not None:
+                        # a split transfer has a digest for each range
+                        hashers = [ self.hasher ]
+                        if self.ranges is not None:
+                            hashers = [ None ] * len(self.ranges)
+                            for _, part in self.parts:
+                                hashers[part.index] = part.hasher
+                        reply.append(bytes(
+                            f"H={format_digest(self.digest, hashers)}", params.encoding
+                        ))
+                    if self.offer is not None:
+                        # store the file for next time, in the background,
+                        # but before the reply, so the client cannot put it
+                        # again before the store knows to expect it
+                        self.store.expect(self.offer)
+                        params.fs.submit(
+                            conn, self.store.add, self.offer, os.path.abspath(self.args[0])
+                        )
+                    conn.send(params.delim.join(reply))
                     return HandlerResult.DONE, None
 
+                case PutCmdState.RECEIVING if self.channel is not None:
+                    return self.recv_mux()
+
         return HandlerResult.OK, None
 
+    def start_open(self, conn, params):
+        """
+        Creates the file off the event loop.
+        """
+        if self.body is not None:
+            self.pending = params.fs.submit(conn, self.write_inline, self.totalsize)
+        else:
+            self.pending = params.fs.submit(conn, self.open_file, self.totalsize)
+        self.state = PutCmdState.OPENING
+        return HandlerResult.OK, None
+
+    def start_mux(self, conn, f, params):
+        """
+        Replies to a transfer multiplexed onto the main connection, which
+        the client starts sending as soon as it has acknowledged.
+        """
+        if self.digest is not None:
+            self.hasher = new_hasher(self.digest)
+        self.receiver = FileReceiver(
+            f, self.totalsize, params.bufpool, None, self.offset or 0,
+            hasher=self.hasher,
+        )
+        # open before replying, so none of the data is dropped
+        self.channel = MuxChannel(conn, self.window)
+
+        reply = [
+            RES_OK,
+            bytes(f"MUX={self.window}", params.encoding),
+        ]
+        if self.offer is not None:
+            reply.append(b"CAS=MISS")
+
+        conn.send(params.delim.join(reply))
+        self.state = PutCmdState.SENTPORT
+        self.file = f
+        return HandlerResult.OK, None
+
+    def recv_mux(self):
+        """
+        Takes in the data of a multiplexed transfer received so far,
+        and checks on the file once all of it has been.
+        """
+        while self.receiver.ready() and not self.receiver.done():
+            if not self.receiver.recv(self.channel):
+                break
+
+        res = self.check_received()
+        if res is not None or self.state == PutCmdState.COMPLETE:
+            # anything more the client sends is dropped
+            self.channel.close()
+        return res or (HandlerResult.OK, None)
+
+    def check_received(self):
+        """
+        Moves on to COMPLETE once the whole file has been received and
+        written out, or returns the error if writing it out failed.
+        """
+        if self.receiver.error is not None:
+            logger.error(f"[ERR] {self.receiver.error}")
+            return HandlerResult.E308, CommandError.ERR_UNKW
+
+        if self.receiver.finished():
+            try:
+                self.receiver.verify()
+            except OSError as e:
+                logger.error(f"[ERR] {e}")
+                return HandlerResult.E308, CommandError.ERR_UNKW
+
+            self.state = PutCmdState.COMPLETE
+            self.receiver.close()
+            if tracer.on:
+                tracer.switch(self.mainconn, "transfer", "ack")
+        return None
+
     def handle_subconn(self, conn: socket.socket, params, data, commtype):
-        start_fn("put_handler_subconn")
+        if data.stream is not None:
+            return self.recv_range(conn, data.stream, commtype)
 
         if commtype == RW.READ:
             match self.state:
                 case PutCmdState.CONNECT:
-                    self.subconn.settimeout(5)
+                    try:
+                        newconn, addr = self.subconn.accept()
+                    except BlockingIOError:
+                        # connection went away before we got to it
+                        return HandlerResult.OK, None
 
-                    logger.debug("Listening for connection")
-                    self.subconn.listen()
+                    if addr[0] != data.addr[0]:
+                        # not the client this port was leased for
+                        logger.debug("Dropping data connection from unexpected %s", addr)
+                        newconn.close()
+                        return HandlerResult.OK, None
+                    logger.debug("Got new connection %s", addr)
+                    if self.ranges is not None:
+                        return self.accept_range(newconn, addr, params)
 
-                    newconn, addr = self.subconn.accept()
-                    logger.debug(f"Got new connection {addr}")
+                    if params.dataplane is None:
+                        newconn.setblocking(False)
+                        self.receiver.offload(params.fs, newconn)
+                    else:
+                        # receive the whole file on a data-plane thread, the
+                        # data socket is woken up once it is done
+                        newconn.settimeout(DATA_TIMEOUT)
+                        self.pending = params.dataplane.submit(
+                            self.mainconn, self.receiver.recv_all, newconn
+                        )
 
                     newdata = ConnData(ConnType.TRANSFER, addr, None, self)
 
@@ -135,24 +416,253 @@ class PutCmdHandler(BaseCommandHandler):
                     self.subconn = newconn
 
                     self.state = PutCmdState.RECEIVING
-                    end_fn("put_handler_subconn")
                     return HandlerResult.REPLACE, (oldconn, (newconn, newdata))
 
                 case PutCmdState.RECEIVING:
-                    b = conn.recv(self.blocksize)
-                    self.received += len(b)
+                    if self.receiver.ready() and not self.receiver.done():
+                        self.receiver.recv(conn)
 
-                    self.file.write(b)
+        elif commtype == RW.WRITE and self.pending is not None:
+            try:
+                self.pending.result()
+            except (ConnectionError, TimeoutError):
+                # handled by the server like any other connection error
+                raise
+            except OSError as e:
+                self.receiver.error = e
+            finally:
+                self.pending = None
 
-                    if self.received >= self.totalsize:
-                        self.state = PutCmdState.COMPLETE
-                        self.file.close()
+        # once everything is received, the data socket is only woken up
+        # for writing when the last flush has completed
+        if self.state == PutCmdState.RECEIVING:
+            res = self.check_received()
+            if res is not None:
+                return res
 
-        elif commtype == RW.WRITE:
-            pass
+            if self.state == PutCmdState.COMPLETE:
+                return HandlerResult.DONE, None
 
         return HandlerResult.OK, None
     
+    def accept_range(self, newconn, addr, params):
+        """
+        Starts receiving a range of a split transfer on a newly accepted data
+        connection. Which range it carries is only known once its header is
+        read. The listening socket is kept until every range has a connection.
+        """
+        part = RangeReceiver(
+            reopen(self.file, "r+b"), params.bufpool, self.expected, params.delim,
+            self.digest,
+        )
+        self.parts.append((newconn, part))
+
+        if params.dataplane is None:
+            newconn.setblocking(False)
+            part.offload(params.fs, newconn)
+        else:
+            newconn.settimeout(DATA_TIMEOUT)
+            part.pending = params.dataplane.submit(
+                self.mainconn, part.recv_all, newconn
+            )
+
+        newdata = ConnData(ConnType.TRANSFER, addr, None, self)
+        newdata.stream = part
+
+        self.accepting -= 1
+        if self.accepting:
+            return HandlerResult.ATTACH, (newconn, newdata)
+
+        oldconn = self.subconn
+        self.subconn = newconn
+        self.state = PutCmdState.RECEIVING
+        return HandlerResult.REPLACE, (oldconn, (newconn, newdata))
+
+    def recv_range(self, conn, part, commtype):
+        """
+        Receives the range of a split transfer carried by conn.
+        """
+        try:
+            if commtype == RW.READ:
+                if part.ready() and not part.done():
+                    part.recv(conn)
+            elif part.pending is not None:
+                try:
+                    part.pending.result()
+                finally:
+                    part.pending = None
+        except ValueError as e:
+            # malformed header, or a range that was not asked for
+            logger.debug("Bad range: %s", e)
+            return HandlerResult.E306, CommandError.ERR_ARGS
+        except (ConnectionError, TimeoutError):
+            # handled by the server like any other connection error
+            raise
+        except OSError as e:
+            logger.error(f"[ERR] {e}")
+            return HandlerResult.E308, CommandError.ERR_UNKW
+
+        if part.error() is not None:
+            logger.error(f"[ERR] {part.error()}")
+            return HandlerResult.E308, CommandError.ERR_UNKW
+
+        if not part.finished():
+            return HandlerResult.OK, None
+
+        part.close()
+        self.active -= 1
+        if self.active == 0:
+            self.state = PutCmdState.COMPLETE
+            if tracer.on:
+                tracer.switch(self.mainconn, "transfer", "ack")
+        return HandlerResult.DONE, None
+
+    def interest(self, data):
+        if data.stream is not None:
+            part = data.stream
+            if part.pending is not None:
+                return selectors.EVENT_WRITE if part.pending.done() else 0
+            if not part.done():
+                return selectors.EVENT_READ if part.ready() else 0
+            return selectors.EVENT_WRITE if part.finished() else 0
+
+        if data.is_subconn():
+            # the listening socket waits to accept once the client has
+            # acknowledged, the data socket waits to receive as long as
+            # not too many flushes are in progress
+            match self.state:
+                case PutCmdState.CONNECT:
+                    return selectors.EVENT_READ
+                case PutCmdState.RECEIVING:
+                    if self.pending is not None:
+                        return 0 if not self.pending.done() else selectors.EVENT_WRITE
+                    if not self.receiver.done():
+                        return selectors.EVENT_READ if self.receiver.ready() else 0
+                    return selectors.EVENT_WRITE if self.receiver.finished() else 0
+                case _:
+                    return 0
+
+        match self.state:
+            case PutCmdState.UNHANDLED | PutCmdState.COMPLETE:
+                return selectors.EVENT_WRITE
+            case PutCmdState.OPENING | PutCmdState.STORING:
+                return selectors.EVENT_WRITE if self.pending.done() else 0
+            case PutCmdState.SENTPORT:
+                return selectors.EVENT_READ
+            case PutCmdState.RECEIVING if self.channel is not None:
+                if self.receiver.done():
+                    return selectors.EVENT_WRITE if self.receiver.finished() else 0
+                return selectors.EVENT_READ if self.receiver.ready() else 0
+            case _:
+                # nothing is read from the client while transferring, so
+                # anything it sends out of turn waits until it is expected
+                return 0
+
+    def open_file(self, size):
+        """
+        Creates the file to upload into and reserves space for it, or fills
+        it from the content store if it has the contents offered.
+        When resuming, opens the partial file instead, which must hold
+        at least the bytes before the offset, and drops anything after it.
+        Runs on the filesystem executor.
+        """
+        if self.offset is not None:
+            return open_partial(self.args[0], self.offset, size)
+
+        f = open(self.args[0], "xb", buffering=0)
+        try:
+            if self.offer is not None:
+                self.hit = self.store.fetch(self.offer, self.args[0], f, size)
+            if not self.hit:
+                preallocate(f.fileno(), size)
+        except Exception:
+            f.close()
+            self.cleanup_err()
+            raise
+        return f
+
+    def write_inline(self, size):
+        """
+        Creates or resumes the file as open_file does and writes the body
+        carried with the command into it. Runs on the filesystem executor.
+        """
+        f = self.open_file(size)
+        try:
+            write_at(f.fileno(), self.body, self.offset or 0)
+        except Exception:
+            f.close()
+            if self.offset is None:
+                self.cleanup_err()
+            raise
+        return f
+
+    def close(self):
+        if self.channel is not None:
+            self.channel.close()
+
+        if self.ranges is not None:
+            # unblock the data-plane threads, and close the ranges once they stop
+            pending = []
+            for conn, part in self.parts:
+                if part.pending is not None:
+                    shutdown(conn)
+                    pending.append(part.pending)
+            when_all(pending, self.close_ranges)
+        elif self.receiver is not None and self.pending is not None:
+            # unblock the data-plane thread, and close the file once it stops
+            shutdown(self.subconn)
+            self.pending.add_done_callback(lambda _: self.receiver.close())
+        elif self.receiver is not None:
+            self.receiver.close()
+        elif self.pending is not None and self.state == PutCmdState.OPENING:
+            # file still being opened, close it once it is
+            self.pending.add_done_callback(close_result)
+
+    def close_ranges(self):
+        """
+        Closes the ranges of a split transfer and the file. If the transfer
+        is incomplete, the file is truncated to the data written out with
+        no gaps before it, so it can be resumed from there.
+        """
+        stored = {}
+        for _, part in self.parts:
+            part.close()
+            if part.stored() is not None:
+                index, end = part.stored()
+                stored[index] = end
+
+        if self.state != PutCmdState.COMPLETE:
+            try:
+                os.ftruncate(self.file.fileno(), received_prefix(self.ranges, stored))
+            except OSError as e:
+                logger.debug("Could not truncate incomplete file: %s", e)
+        self.file.close()
+
     def cleanup_err(self):
         if os.path.exists(self.args[0]):
-            os.remove(self.args[0])
\ No newline at end of file
+            os.remove(self.args[0])
+
+def open_partial(path, offset, size):
+    """
+    Opens a partially uploaded file to resume writing it at offset.
+    Raises ValueError if the file is shorter than offset.
+    """
+    st = os.stat(path)
+    if st.st_nlink > 1 and stat.S_ISREG(st.st_mode):
+        # hard linked, to a content store object or elsewhere, and writing
+        # to it in place would change every file linked to it
+        if st.st_size < offset:
+            raise ValueError(f"{path} has {st.st_size} bytes, cannot resume at {offset}")
+        copy_out(path, offset)
+    f = open(path, "r+b", buffering=0)
+    try:
+        have = os.fstat(f.fileno()).st_size
+        if have < offset:
+            raise ValueError(f"{path} has {have} bytes, cannot resume at {offset}")
+        os.ftruncate(f.fileno(), offset)
+        preallocate(f.fileno(), size)
+    except Exception:
+        # the partial file is kept for another attempt
+        f.close()
+        raise
+    return f
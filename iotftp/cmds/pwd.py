@@ -0,0 +1,42 @@
+import socket
+import logging
+import selectors
+
+from enum import Enum
+
+from iotftp.cmds import BaseCommandHandler
+from iotftp.utils import *
+
+logger = logging.getLogger()
+
+class PwdCmdState(Enum):
+    # raw connection, unhandled
+    UNHANDLED = 0
+    # completed, working directory sent
+    COMPLETE = 1
+
+class PwdCmdHandler(BaseCommandHandler):
+    """
+    Sends the working directory of the connection.
+    """
+    def __init__(self):
+        self.state = PwdCmdState.UNHANDLED
+
+    def handle(self, conn: socket.socket, params, data, commtype):
+        if commtype == RW.WRITE and self.state == PwdCmdState.UNHANDLED:
+            reply = [
+                RES_OK,
+                bytes(data.cwd, params.encoding),
+            ]
+            conn.send(params.delim.join(reply))
+            self.state = PwdCmdState.COMPLETE
+
+            return HandlerResult.DONE, None
+
+        return HandlerResult.OK, None
+
+    def handle_subconn(self, conn: socket.socket, params, data, commtype):
+        pass
+
+    def interest(self, data):
+        return selectors.EVENT_WRITE
@@ -0,0 +1,87 @@
+import socket
+import os
+import stat
+import logging
+import selectors
+
+from enum import Enum
+
+from iotftp.cmds import BaseCommandHandler
+from iotftp.utils import *
+
+logger = logging.getLogger()
+
+class SizeCmdState(Enum):
+    # raw connection, unhandled
+    UNHANDLED = 0
+    # getting the size of the file on the filesystem executor
+    STATTING = 1
+    # completed, size sent
+    COMPLETE = 2
+
+class SizeCmdHandler(BaseCommandHandler):
+    """
+    Sends the size of a file, so a client can tell how much of an
+    interrupted upload the server already has.
+    """
+    def __init__(self, args):
+        self.state = SizeCmdState.UNHANDLED
+        self.args = args
+        # the filesystem job in progress, if any
+        self.pending = None
+
+    def handle(self, conn: socket.socket, params, data, commtype):
+        if commtype == RW.READ:
+            return HandlerResult.OK, None
+
+        elif commtype == RW.WRITE:
+            match self.state:
+                case SizeCmdState.UNHANDLED:
+                    # stat the file off the event loop
+                    self.pending = params.fs.submit(conn, file_size, self.args)
+                    self.state = SizeCmdState.STATTING
+
+                    return HandlerResult.OK, None
+
+                case SizeCmdState.STATTING:
+                    try:
+                        size = self.pending.result()
+                    except FileNotFoundError:
+                        return HandlerResult.E302, CommandError.ERR_NONE
+                    except PermissionError:
+                        return HandlerResult.E301, CommandError.ERR_PERM
+                    except IsADirectoryError:
+                        return HandlerResult.E309, CommandError.ERR_ISDR
+                    except OSError as e:
+                        logger.debug("got err: %s", e)
+                        return HandlerResult.E302, CommandError.ERR_NONE
+                    finally:
+                        self.pending = None
+
+                    reply = [
+                        RES_OK,
+                        bytes(str(size), params.encoding),
+                    ]
+                    conn.send(params.delim.join(reply))
+                    self.state = SizeCmdState.COMPLETE
+
+                    return HandlerResult.DONE, None
+
+        return HandlerResult.OK, None
+
+    def handle_subconn(self, conn: socket.socket, params, data, commtype):
+        pass
+
+    def interest(self, data):
+        if self.state == SizeCmdState.STATTING and not self.pending.done():
+            return 0
+        return selectors.EVENT_WRITE
+
+def file_size(path):
+    """
+    Returns the size of the regular file at path.
+    """
+    st = os.stat(path)
+    if stat.S_ISDIR(st.st_mode):
+        raise IsADirectoryError(path)
+    return st.st_size
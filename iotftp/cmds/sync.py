@@ -0,0 +1,50 @@
+import logging
+
+from iotftp.cmds.lsd import LsdCmdHandler, Listing
+
+logger = logging.getLogger()
+
+class SyncCmdHandler(LsdCmdHandler):
+    """
+    Lists the files under a directory that changed since a client's token,
+    from the server's file index, along with the token to send next time.
+
+    The changes are sent the same way as a directory listing, on the main
+    connection a chunk at a time.
+    """
+    def __init__(self, args, since=None, digest=None):
+        super().__init__(args)
+        # the token the client sent, as (epoch, change number), if any
+        self.since = since
+        # the digest algorithm to send the digests of the files in, if any
+        self.digest = digest
+
+    def submit(self, conn, params):
+        return params.fs.submit(
+            conn, list_changes, params.index, self.args, self.since, self.digest
+        )
+
+    def header(self, params):
+        return [
+            bytes(str(self.listing.size), params.encoding),
+            bytes(self.listing.token, params.encoding),
+            b"F" if self.listing.full else b"D",
+        ]
+
+class Changes(Listing):
+    """
+    The files changed since a token, as the lines sent for them.
+    """
+    def __init__(self, token, full, lines):
+        super().__init__(None, lines)
+        # the token to send next time
+        self.token = token
+        # whether every file is listed, rather than the changes
+        self.full = full
+
+def list_changes(index, path, since, digest):
+    """
+    Returns the changes to the files under path since the token since.
+    Runs on the filesystem executor.
+    """
+    return Changes(*index.changes(path, since, digest))
@@ -0,0 +1,405 @@
+import socket
+import os
+import stat
+import tarfile
+import logging
+import selectors
+
+from enum import Enum
+
+from iotftp.cmds import BaseCommandHandler
+from iotftp.utils import *
+from iotftp.transfer import FileSender
+
+logger = logging.getLogger()
+
+# the blocks marking the end of a tar archive
+TAR_END = bytes(2 * tarfile.BLOCKSIZE)
+
+class TGetCmdState(Enum):
+    # raw connection, unhandled
+    UNHANDLED = 0
+    # checking the directory on the filesystem executor
+    OPENING = 1
+    # sent new port number, awaiting acknowledgement
+    SENTPORT = 2
+    # received ack, awaiting connection on subconn
+    CONNECT = 3
+    # currently sending the archive
+    SENDING = 4
+    # sending complete, awaiting ack
+    COMPLETE = 5
+    # received ack, respond with ack
+    SENDACK = 6
+    # in a current state of error, tracked by main server class
+    ERROR = 7
+
+
+class TGetCmdHandler(BaseCommandHandler):
+    """
+    Sends a directory tree as a tar stream, built while it is sent.
+
+    The tree is walked with os.scandir one member at a time, and each
+    file is sent straight from disk after its tar header, so the archive
+    is never staged on disk or held in memory.
+    """
+    def __init__(self, args):
+        self.state = TGetCmdState.UNHANDLED
+        self.mainconn = None
+        self.subconn = None
+        # command arguments
+        self.args = args
+        # the members of the archive still to be sent
+        self.members = None
+        # the part of the archive not yet sent: the current header or
+        # padding, and the current file
+        self.header = None
+        self.sender = None
+        # the size of the current file given in its header
+        self.size = 0
+        # number of bytes of the archive sent
+        self.sent = 0
+        # whether the end of the archive has been queued
+        self.ended = False
+        # the filesystem job in progress, if any
+        self.pending = None
+
+    def handle(self, conn: socket.socket, params, data, commtype):
+        if commtype == RW.READ:
+            match self.state:
+                case TGetCmdState.SENTPORT:
+                    b = conn.recv(len(ACKNOW))
+                    if not b:
+                        raise ConnClosedErr()
+
+                    if b == ACKNOW:
+                        logger.debug("Got acknowledgement")
+                        self.state = TGetCmdState.CONNECT
+                    else:
+                        raise ConnClosedErr()
+                case TGetCmdState.COMPLETE:
+                    b = conn.recv(len(ACKNOW))
+
+                    if b == ACKNOW:
+                        logger.debug("Got acknowledgement")
+                    else:
+                        raise ConnClosedErr()
+
+                    self.state = TGetCmdState.SENDACK
+
+        elif commtype == RW.WRITE:
+            match self.state:
+                case TGetCmdState.UNHANDLED:
+                    self.mainconn = conn
+                    logger.debug("[%s] Sending tree %s", data.addr, self.args)
+
+                    self.pending = params.fs.submit(conn, open_tree, self.args)
+                    self.state = TGetCmdState.OPENING
+
+                case TGetCmdState.OPENING:
+                    try:
+                        self.members = self.pending.result()
+                    except FileNotFoundError:
+                        return HandlerResult.E302, CommandError.ERR_NONE
+                    except PermissionError:
+                        return HandlerResult.E301, CommandError.ERR_PERM
+                    except NotADirectoryError:
+                        return HandlerResult.E303, CommandError.ERR_NDIR
+                    except OSError as e:
+                        logger.debug("got err: %s", e)
+                        return HandlerResult.E302, CommandError.ERR_NONE
+                    finally:
+                        self.pending = None
+
+                    sock = params.ports.lease()
+
+                    reply = [
+                        RES_OK,
+                        bytes(str(sock.getsockname()[1]), params.encoding),
+                    ]
+
+                    conn.send(params.delim.join(reply))
+                    self.subconn = sock
+                    self.state = TGetCmdState.SENTPORT
+                    return HandlerResult.NEWCONN, sock
+
+                case TGetCmdState.SENDACK:
+                    conn.send(RES_OK)
+                    return HandlerResult.DONE, None
+        return HandlerResult.OK, None
+
+    def handle_subconn(self, conn: socket.socket, params, data, commtype):
+        if commtype == RW.READ:
+            match self.state:
+                case TGetCmdState.CONNECT:
+                    try:
+                        newconn, addr = self.subconn.accept()
+                    except BlockingIOError:
+                        # connection went away before we got to it
+                        return HandlerResult.OK, None
+
+                    if addr[0] != data.addr[0]:
+                        # not the client this port was leased for
+                        logger.debug("Dropping data connection from unexpected %s", addr)
+                        newconn.close()
+                        return HandlerResult.OK, None
+
+                    logger.debug("Got new connection %s", addr)
+
+                    if params.dataplane is None:
+                        newconn.setblocking(False)
+                    else:
+                        # send the whole tree on a data-plane thread, the
+                        # data socket is woken up once it is done
+                        newconn.settimeout(DATA_TIMEOUT)
+                        self.pending = params.dataplane.submit(
+                            self.mainconn, send_tree, newconn, self.members
+                        )
+
+                    newdata = ConnData(ConnType.TRANSFER, addr, None, self)
+
+                    oldconn = self.subconn
+                    self.subconn = newconn
+
+                    self.state = TGetCmdState.SENDING
+                    return HandlerResult.REPLACE, (oldconn, (newconn, newdata))
+
+        elif commtype == RW.WRITE:
+            match self.state:
+                case TGetCmdState.SENDING:
+                    try:
+                        if params.dataplane is not None:
+                            # raises whatever stopped the data-plane thread
+                            try:
+                                self.pending.result()
+                            finally:
+                                self.pending = None
+                            sent = True
+                        else:
+                            sent = self.pump(conn, params)
+                    except (ConnectionError, TimeoutError):
+                        # handled by the server like any other connection error
+                        raise
+                    except OSError as e:
+                        logger.error(f"[ERR] {e}")
+                        return HandlerResult.E308, CommandError.ERR_UNKW
+
+                    if sent:
+                        self.state = TGetCmdState.COMPLETE
+                        return HandlerResult.DONE, None
+        return HandlerResult.OK, None
+
+    def pump(self, conn, params):
+        """
+        Sends the archive until the socket would block or the next member
+        is being read. Returns whether the whole archive has been sent.
+        """
+        while True:
+            if self.header:
+                try:
+                    n = conn.send(self.header)
+                except BlockingIOError:
+                    return False
+                self.header = self.header[n:]
+                self.sent += n
+
+            elif self.sender is not None:
+                self.sent += self.sender.send(conn)
+                if not self.sender.done():
+                    return False
+
+                # a file that shrank while being sent is padded out to
+                # the size in its header, keeping the stream in step
+                self.header = memoryview(bytes(
+                    self.size - self.sender.offset + block_padding(self.size)
+                ))
+                self.sender.close()
+                self.sender = None
+
+            elif self.pending is not None:
+                if not self.pending.done():
+                    return False
+                try:
+                    member = self.pending.result()
+                finally:
+                    self.pending = None
+
+                if member is None:
+                    self.header = memoryview(end_of_archive(self.sent))
+                    self.ended = True
+                    continue
+
+                header, f, size = member
+                self.header = memoryview(header)
+                if f is not None:
+                    self.sender = FileSender(f, size)
+                    self.size = size
+
+            elif not self.ended:
+                # read the next member off the event loop
+                self.pending = params.fs.submit(self.mainconn, next_member, self.members)
+
+            else:
+                return True
+
+    def interest(self, data):
+        if data.is_subconn():
+            match self.state:
+                case TGetCmdState.CONNECT:
+                    return selectors.EVENT_READ
+                case TGetCmdState.SENDING:
+                    if self.pending is not None and not self.pending.done():
+                        return 0
+                    return selectors.EVENT_WRITE
+                case _:
+                    return 0
+
+        match self.state:
+            case TGetCmdState.UNHANDLED | TGetCmdState.SENDACK:
+                return selectors.EVENT_WRITE
+            case TGetCmdState.OPENING:
+                return selectors.EVENT_WRITE if self.pending.done() else 0
+            case TGetCmdState.SENTPORT | TGetCmdState.COMPLETE:
+                return selectors.EVENT_READ
+            case _:
+                # nothing is read from the client while transferring, so
+                # anything it sends out of turn waits until it is expected
+                return 0
+
+    def close(self):
+        if self.sender is not None:
+            self.sender.close()
+        if self.pending is not None:
+            if self.state == TGetCmdState.SENDING:
+                # unblock a data-plane thread
+                shutdown(self.subconn)
+            self.pending.add_done_callback(close_member)
+
+def open_tree(path):
+    """
+    Checks path is a directory and returns the members of its archive.
+    """
+    st = os.stat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        raise NotADirectoryError(path)
+    os.scandir(path).close()
+
+    return walk_tree(path)
+
+def walk_tree(root):
+    """
+    Walks the tree under root with os.scandir, yielding the path, archive
+    name and lstat result of each directory, file and symlink in it.
+
+    Only the entries of the directories still to be walked are kept,
+    so memory use does not grow with the size of the tree.
+    """
+    root = os.path.normpath(root)
+    base = os.path.basename(root) or "."
+    stack = [(root, base, os.lstat(root))]
+
+    while stack:
+        path, arcname, st = stack.pop()
+        yield path, arcname, st
+
+        if not stat.S_ISDIR(st.st_mode):
+            continue
+        try:
+            with os.scandir(path) as it:
+                entries = sorted(it, key=lambda e: e.name, reverse=True)
+        except OSError as e:
+            logger.debug("Skipping unreadable directory %s: %s", path, e)
+            continue
+
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            # other file types, such as sockets and fifos, are left out
+            if stat.S_ISDIR(st.st_mode) or stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+                stack.append((entry.path, arcname + "/" + entry.name, st))
+
+def next_member(members):
+    """
+    Reads the next member of an archive, returning its tar header, its
+    file and its size, or None once there are no more members.
+
+    The file is None for directories and symlinks. Files that cannot be
+    read are left out of the archive.
+    """
+    for path, arcname, st in members:
+        info = tarfile.TarInfo(arcname)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.mtime = int(st.st_mtime)
+        info.uid, info.gid = st.st_uid, st.st_gid
+
+        f = None
+        if stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            try:
+                info.linkname = os.readlink(path)
+            except OSError:
+                continue
+        else:
+            try:
+                f = open(path, "rb")
+            except OSError as e:
+                logger.debug("Skipping unreadable file %s: %s", path, e)
+                continue
+            info.size = os.fstat(f.fileno()).st_size
+
+        header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        return header, f, info.size
+
+    return None
+
+def close_member(fut):
+    """
+    Done callback that closes the file a next_member job opened, for when
+    the command was abandoned while it was running.
+    """
+    if fut.exception() is None and isinstance(fut.result(), tuple):
+        f = fut.result()[1]
+        if f is not None:
+            f.close()
+
+def block_padding(size):
+    """
+    Returns the number of bytes padding a member of size bytes
+    out to a whole number of tar blocks.
+    """
+    return -size % tarfile.BLOCKSIZE
+
+def end_of_archive(sent):
+    """
+    Returns the blocks ending an archive of sent bytes, padded
+    out to a whole number of tar records.
+    """
+    return TAR_END + bytes(-(sent + len(TAR_END)) % tarfile.RECORDSIZE)
+
+def send_tree(conn, members):
+    """
+    Sends a whole archive over a blocking socket.
+    Runs on a data-plane thread.
+    """
+    sent = 0
+    while (member := next_member(members)) is not None:
+        header, f, size = member
+        conn.sendall(header)
+        sent += len(header)
+        if f is None:
+            continue
+
+        sender = FileSender(f, size)
+        try:
+            sender.send_all(conn)
+        finally:
+            sender.close()
+        padding = size - sender.offset + block_padding(size)
+        conn.sendall(bytes(padding))
+        sent += size + block_padding(size)
+
+    conn.sendall(end_of_archive(sent))
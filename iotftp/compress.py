@@ -0,0 +1,114 @@
+import os
+import zlib
+
+# lzma and bz2 are optional parts of the standard library,
+# and may be missing from minimal Python builds
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+# number of bytes compressed at a time
+COMPRESS_BLOCKSIZE = 1 << 18
+# number of bytes at the start of a file looked at to decide
+# whether compressing it is worthwhile
+PROBE_SIZE = 1 << 16
+# a probe that compresses to more than this fraction of its size
+# is considered incompressible
+PROBE_RATIO = 0.9
+
+class CorruptStream(OSError):
+    """
+    A compressed stream that could not be decoded, or did not decode
+    to the size it was declared to be.
+    """
+
+class Codec:
+    """
+    A streaming compression codec, and the range of levels it takes.
+    """
+    def __init__(self, name, compressor, decompressor, errors, levels, default):
+        self.name = name
+        self.compressor = compressor
+        self.decompressor = decompressor
+        # exceptions raised by the decompressor on bad input
+        self.errors = errors
+        self.levels = levels
+        self.default = default
+
+    def encoder(self, level):
+        return self.compressor(level)
+
+    def decoder(self):
+        return Decoder(self)
+
+class Decoder:
+    """
+    Decompresses a stream, raising CorruptStream on bad input.
+    """
+    def __init__(self, codec):
+        self.codec = codec
+        self.obj = codec.decompressor()
+
+    @property
+    def eof(self):
+        return self.obj.eof
+
+    def decompress(self, data):
+        if self.obj.eof:
+            raise CorruptStream("data after the end of the compressed stream")
+        try:
+            return self.obj.decompress(data)
+        except self.codec.errors as e:
+            raise CorruptStream(str(e))
+
+# the codecs available, by name, in order of preference
+CODECS = {
+    "zlib": Codec("zlib", zlib.compressobj, zlib.decompressobj, (zlib.error,), range(0, 10), 6),
+}
+if lzma is not None:
+    CODECS["lzma"] = Codec(
+        "lzma", lambda level: lzma.LZMACompressor(preset=level),
+        lzma.LZMADecompressor, (lzma.LZMAError,), range(0, 10), 6,
+    )
+if bz2 is not None:
+    CODECS["bz2"] = Codec(
+        "bz2", bz2.BZ2Compressor, bz2.BZ2Decompressor, (OSError,), range(1, 10), 9,
+    )
+
+def parse_spec(spec):
+    """
+    Parses a compression spec of the form codec[:level] into the codec
+    and level. Raises KeyError for an unknown codec, and ValueError for
+    a level the codec does not take.
+    """
+    name, _, level = spec.partition(":")
+    codec = CODECS[name]
+    level = int(level) if level else codec.default
+    if level not in codec.levels:
+        raise ValueError(f"invalid level {level} for {name}")
+    return codec, level
+
+def format_spec(codec, level):
+    return f"{codec.name}:{level}"
+
+def compressible(block):
+    """
+    Whether a block from the start of a file compresses well enough for
+    compressing the file to be worthwhile. Uses the fastest zlib level,
+    whatever codec is in use.
+    """
+    if not block:
+        return False
+    return len(zlib.compress(block, 1)) < len(block) * PROBE_RATIO
+
+def probe(fd):
+    """
+    Whether the file open at fd is worth compressing, judging by its start.
+    """
+    return compressible(os.pread(fd, PROBE_SIZE, 0))
@@ -0,0 +1,368 @@
+import os
+import stat
+import zlib
+import errno
+import struct
+import hashlib
+import logging
+import tempfile
+
+from iotftp.utils import *
+from iotftp.transfer import preallocate, write_at
+
+logger = logging.getLogger()
+
+# bounds on the size of the blocks a base file is split into
+DELTA_MIN_BLOCK = 1 << 10
+DELTA_MAX_BLOCK = 1 << 17
+# number of bytes in the strong checksum of a block
+STRONG_SIZE = 16
+# the signature of a block: its weak checksum, then its strong checksum
+SIGNATURE = struct.Struct(f"!I{STRONG_SIZE}s")
+# modulus of the adler32 weak checksum
+ADLER_MOD = 65521
+
+# the ops a delta is made of, each a single byte followed by its fields:
+# literal data, preceded by its length
+OP_LITERAL = b"L"
+LITERAL = struct.Struct("!I")
+# a run of blocks of the base file, as the index of the first and the count
+OP_COPY = b"C"
+COPY = struct.Struct("!II")
+# the end of the delta
+OP_END = b"E"
+# most bytes of literal data in one op
+MAX_LITERAL = 1 << 18
+
+# errors from os.copy_file_range that mean it cannot be used for this
+# pair of files, and reading and writing should be used instead
+COPY_RANGE_UNSUPPORTED = (
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+)
+
+def block_size(size):
+    """
+    Picks the block size for a base file of size bytes, growing with the
+    square root of the size as rsync does, so larger files do not have
+    too many signatures.
+    """
+    bs = int(size ** 0.5) & ~(DELTA_MIN_BLOCK - 1)
+    return max(DELTA_MIN_BLOCK, min(DELTA_MAX_BLOCK, bs))
+
+def block_count(size, blocksize):
+    return -(-size // blocksize)
+
+def strong_sum(block):
+    return hashlib.blake2b(block, digest_size=STRONG_SIZE).digest()
+
+def signatures(fd, size, blocksize):
+    """
+    Computes the signature of each block of the file open at fd.
+    """
+    sigs = bytearray()
+    for offset in range(0, size, blocksize):
+        block = os.pread(fd, blocksize, offset)
+        if not block:
+            # file was truncated underneath us
+            break
+        sigs += SIGNATURE.pack(zlib.adler32(block), strong_sum(block))
+    return bytes(sigs)
+
+def parse_signatures(sigs):
+    """
+    Builds the lookup table the client matches blocks against, mapping
+    each weak checksum to the strong checksums and indexes of the blocks
+    with it.
+    """
+    table = {}
+    for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(sigs)):
+        table.setdefault(weak, []).append((strong, index))
+    return table
+
+def find_block(table, weak, block, expect):
+    """
+    Returns the index of a block of the base file matching block, preferring
+    expect, the block after the last one matched, or None if there is none.
+    """
+    candidates = table.get(weak)
+    if not candidates:
+        return None
+    strong = strong_sum(block)
+    found = None
+    for other, index in candidates:
+        if other == strong:
+            if index == expect:
+                return index
+            if found is None:
+                found = index
+    return found
+
+def delta_ops(data, table, blocksize, basesize):
+    """
+    Yields the ops of a delta that rebuilds data from the base file the
+    table of signatures was computed from.
+
+    Blocks are matched at every offset of data using a rolling weak checksum,
+    and confirmed with the strong checksum, so data inserted or removed only
+    costs the literal data around it.
+    """
+    size, count = len(data), block_count(basesize, blocksize)
+    # the base file's last block, if shorter than the rest, can only
+    # match right at the end of data
+    lastlen = basesize - (count - 1) * blocksize if count else 0
+
+    # the end of the data already covered by ops, and the run of
+    # consecutive blocks matched since then, not yet yielded
+    literal, run, runcount = 0, None, 0
+
+    def match(index, start, length):
+        # yields the ops for everything before a block matched at start
+        nonlocal literal, run, runcount
+        if literal < start:
+            if run is not None:
+                yield OP_COPY + COPY.pack(run, runcount)
+                run = None
+            yield from literal_ops(data, literal, start)
+        if run is not None and index == run + runcount:
+            runcount += 1
+        else:
+            if run is not None:
+                yield OP_COPY + COPY.pack(run, runcount)
+            run, runcount = index, 1
+        literal = start + length
+
+    pos, weak = 0, None
+    while pos + blocksize <= size:
+        if weak is None:
+            weak = zlib.adler32(data[pos:pos + blocksize])
+            a, b = weak & 0xffff, weak >> 16
+
+        expect = run + runcount if run is not None else None
+        index = find_block(table, weak, data[pos:pos + blocksize], expect)
+        if index is not None:
+            yield from match(index, pos, blocksize)
+            pos += blocksize
+            weak = None
+            continue
+
+        if pos + blocksize == size:
+            break
+        # roll the window on by a byte
+        out, new = data[pos], data[pos + blocksize]
+        a = (a - out + new) % ADLER_MOD
+        b = (b - blocksize * out + a - 1) % ADLER_MOD
+        weak = (b << 16) | a
+        pos += 1
+
+    if 0 < lastlen < blocksize and size - lastlen >= literal:
+        tail = data[size - lastlen:]
+        if find_block(table, zlib.adler32(tail), tail, count - 1) == count - 1:
+            yield from match(count - 1, size - lastlen, lastlen)
+
+    if run is not None:
+        yield OP_COPY + COPY.pack(run, runcount)
+    yield from literal_ops(data, literal, size)
+    yield OP_END
+
+def literal_ops(data, start, end):
+    """
+    Yields the ops carrying the bytes of data from start to end.
+    """
+    for offset in range(start, end, MAX_LITERAL):
+        chunk = data[offset:min(end, offset + MAX_LITERAL)]
+        yield OP_LITERAL + LITERAL.pack(len(chunk)) + chunk
+
+class DeltaReceiver:
+    """
+    Rebuilds a file from a delta against the base file it replaces, into
+    a new file next to it. The new file only takes the place of the base
+    file once it is complete, so a failed transfer leaves the base intact.
+    """
+    def __init__(self, path, base, file, tmppath, blocksize, totalsize, hasher=None):
+        # the path of the base file, and the base file itself
+        self.path = path
+        self.base = base
+        self.basesize = os.fstat(base.fileno()).st_size
+        # the new file, and its path until it is moved into place
+        self.file = file
+        self.tmppath = tmppath
+        self.blocksize = blocksize
+        self.count = block_count(self.basesize, blocksize)
+        # total size of the new file, and the number of bytes written to it
+        self.totalsize = totalsize
+        self.written = 0
+        # the hash object updated with the new file as it is written, if any
+        self.hasher = hasher
+        # data received but not yet made into whole ops
+        self.inbuf = bytearray()
+        # whether the end of the delta has been received
+        self.ended = False
+        # whether to attempt copy_file_range, which keeps copied blocks
+        # out of Python and so out of reach of the hasher
+        self.use_copy_range = hasattr(os, "copy_file_range") and hasher is None
+        # whether the new file has been moved into place
+        self.installed = False
+
+    def feed(self, data):
+        """
+        Applies every whole op in data, along with whatever was left over
+        from before. Raises ValueError if the delta is malformed.
+        Runs on the filesystem executor, or a data-plane thread.
+        """
+        self.inbuf += data
+        buf, pos = self.inbuf, 0
+        with memoryview(buf) as view:
+            while not self.ended and pos < len(buf):
+                op = buf[pos:pos + 1]
+                if op == OP_LITERAL:
+                    if len(buf) - pos < 1 + LITERAL.size:
+                        break
+                    (n,) = LITERAL.unpack_from(buf, pos + 1)
+                    if n > MAX_LITERAL:
+                        raise ValueError(f"literal of {n} bytes too long")
+                    start = pos + 1 + LITERAL.size
+                    if len(buf) - start < n:
+                        break
+                    self.write(view[start:start + n])
+                    pos = start + n
+                elif op == OP_COPY:
+                    if len(buf) - pos < 1 + COPY.size:
+                        break
+                    self.copy(*COPY.unpack_from(buf, pos + 1))
+                    pos += 1 + COPY.size
+                elif op == OP_END:
+                    self.ended = True
+                    pos += 1
+                else:
+                    raise ValueError(f"unknown op {bytes(op)!r}")
+        del buf[:pos]
+
+        if self.ended and buf:
+            raise ValueError("data after the end of the delta")
+
+    def recv_all(self, conn):
+        """
+        Receives and applies the rest of the delta from a blocking socket.
+        Runs on a data-plane thread.
+        """
+        while not self.ended:
+            b = conn.recv(RECV_BUFSIZE)
+            if not b:
+                raise ConnClosedErr()
+            self.feed(b)
+
+    def write(self, data):
+        self.reserve(len(data))
+        if self.hasher is not None:
+            self.hasher.update(data)
+        write_at(self.file.fileno(), data, self.written)
+        self.written += len(data)
+
+    def copy(self, index, count):
+        """
+        Copies count blocks of the base file, starting at index.
+        """
+        if count < 1 or index + count > self.count:
+            raise ValueError(f"copy of blocks {index}+{count} out of range")
+        offset = index * self.blocksize
+        length = min(count * self.blocksize, self.basesize - offset)
+        self.reserve(length)
+
+        end = offset + length
+        while offset < end:
+            n = 0
+            if self.use_copy_range:
+                try:
+                    n = os.copy_file_range(
+                        self.base.fileno(), self.file.fileno(), end - offset,
+                        offset, self.written,
+                    )
+                except OSError as e:
+                    if e.errno not in COPY_RANGE_UNSUPPORTED:
+                        raise
+                    logger.debug("copy_file_range unavailable (%s), falling back to read/write", e)
+                    self.use_copy_range = False
+                    continue
+            else:
+                b = os.pread(self.base.fileno(), min(RECV_BUFSIZE, end - offset), offset)
+                if b:
+                    if self.hasher is not None:
+                        self.hasher.update(b)
+                    write_at(self.file.fileno(), b, self.written)
+                n = len(b)
+            if not n:
+                raise OSError(f"{self.path} was truncated during the transfer")
+            offset += n
+            self.written += n
+
+    def reserve(self, n):
+        if self.written + n > self.totalsize:
+            raise ValueError("delta rebuilds more than the declared size")
+
+    def done(self):
+        return self.ended
+
+    def install(self):
+        """
+        Moves the new file into the place of the base file, with its
+        permissions, once the whole delta has been applied.
+        Runs on the filesystem executor, or a data-plane thread.
+        """
+        if self.written != self.totalsize:
+            raise ValueError(
+                f"delta rebuilt {self.written} bytes, expected {self.totalsize}"
+            )
+        mode = stat.S_IMODE(os.fstat(self.base.fileno()).st_mode)
+        os.fchmod(self.file.fileno(), mode)
+        os.replace(self.tmppath, self.path)
+        self.installed = True
+
+    def close(self):
+        """
+        Closes both files, removing the new file if it was never moved
+        into place. Safe to call more than once.
+        """
+        self.base.close()
+        self.file.close()
+        if not self.installed:
+            try:
+                os.remove(self.tmppath)
+            except FileNotFoundError:
+                pass
+            self.installed = True
+
+def open_delta(path, totalsize, hasher=None):
+    """
+    Opens the base file at path for a delta upload, creates the new file
+    next to it, and computes the signatures the client matches against.
+
+    Returns the receiver to rebuild the new file with, and the signatures.
+    Runs on the filesystem executor.
+    """
+    path = os.path.abspath(path)
+    base = open(path, "rb")
+    try:
+        st = os.fstat(base.fileno())
+        if stat.S_ISDIR(st.st_mode):
+            raise IsADirectoryError(path)
+        blocksize = block_size(st.st_size)
+
+        fd, tmppath = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=f".{os.path.basename(path)}.", suffix=".delta"
+        )
+        file = os.fdopen(fd, "r+b", buffering=0)
+    except Exception:
+        base.close()
+        raise
+
+    receiver = DeltaReceiver(path, base, file, tmppath, blocksize, totalsize, hasher)
+    try:
+        preallocate(file.fileno(), totalsize)
+        sigs = signatures(base.fileno(), receiver.basesize, blocksize)
+    except Exception:
+        receiver.close()
+        raise
+    return receiver, sigs
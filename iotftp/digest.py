@@ -0,0 +1,56 @@
+import hashlib
+
+# the digest algorithms available, by name, in order of preference,
+# leaving out any the platform's hashlib does not provide
+DIGESTS = tuple(
+    name for name in ("blake2b", "blake2s", "sha256", "sha512", "sha1")
+    if name in hashlib.algorithms_available
+)
+# the algorithm clients ask for unless told otherwise
+DEF_DIGEST = "blake2b"
+
+class DigestMismatch(OSError):
+    """
+    A transfer whose digest at one end differs from the digest at the other.
+    """
+
+def new_hasher(name):
+    """
+    Returns a new hash object for an algorithm. Raises KeyError for an
+    algorithm that is not available.
+    """
+    if name not in DIGESTS:
+        raise KeyError(name)
+    return hashlib.new(name)
+
+def format_digest(name, hashers):
+    """
+    Formats the digests of a transfer as the value of its H option,
+    of the form algorithm:digest, with a comma-separated digest for
+    each range of a split transfer.
+    """
+    return f"{name}:" + ",".join(hasher.hexdigest() for hasher in hashers)
+
+def parse_digest(value):
+    """
+    Parses the value of an H option into the algorithm and the list
+    of digests. Raises ValueError if it is malformed.
+    """
+    name, sep, digests = value.partition(":")
+    if not sep or not digests:
+        raise ValueError(f"invalid digest {value!r}")
+    return name, digests.split(",")
+
+def verify(value, name, hashers):
+    """
+    Raises DigestMismatch if the digests in value, the H option sent by
+    the other end, are not those of hashers.
+    """
+    try:
+        theirs = parse_digest(value)
+    except ValueError as e:
+        raise DigestMismatch(str(e))
+
+    ours = (name, [hasher.hexdigest() for hasher in hashers])
+    if theirs != ours:
+        raise DigestMismatch(f"{name} digest mismatch: got {value}")
@@ -0,0 +1,108 @@
+import socket
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from iotftp.utils import *
+
+logger = logging.getLogger()
+
+class FsExecutor:
+    """
+    Runs blocking filesystem work on a bounded thread pool, so a slow
+    disk does not stall the event loop. Also used to run data-plane
+    transfers, under a different thread name.
+
+    The loop selects on wakesock, which becomes readable whenever a job
+    completes. completed() then returns the connections whose jobs are
+    done, so the server can re-evaluate what they are waiting on.
+    """
+    def __init__(self, workers=DEF_FS_WORKERS, name="iotftp-fs"):
+        # the threads running jobs
+        self.pool = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=name
+        )
+        # the loop selects on wakesock, the pool threads write to notifysock
+        self.wakesock, self.notifysock = socket.socketpair()
+        self.wakesock.setblocking(False)
+        self.notifysock.setblocking(False)
+        # connections whose jobs have completed since the last wakeup
+        self.finished = collections.deque()
+
+    def submit(self, conn, fn, *args):
+        """
+        Runs fn(*args) on the pool, waking the loop up for conn
+        once it is done. Returns the future of the job.
+        """
+        fut = self.pool.submit(fn, *args)
+        fut.add_done_callback(lambda _: self._notify(conn))
+        return fut
+
+    def watch(self, conn, fut):
+        """
+        Wakes the loop up for conn once fut, which was not submitted here,
+        is done. Returns fut.
+        """
+        fut.add_done_callback(lambda _: self._notify(conn))
+        return fut
+
+    def _notify(self, conn):
+        # runs on the pool thread
+        self.finished.append(conn)
+        try:
+            self.notifysock.send(b"\0")
+        except OSError:
+            # the loop already has a wakeup pending, or is shutting down
+            pass
+
+    def completed(self):
+        """
+        Clears the wakeup and returns the connections with completed jobs.
+        """
+        try:
+            while self.wakesock.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        conns = []
+        while self.finished:
+            conns.append(self.finished.popleft())
+        return conns
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self.wakesock.close()
+        self.notifysock.close()
+
+def close_result(fut):
+    """
+    Done callback that closes the file a job opened, for when the
+    command that submitted the job was abandoned while it was running.
+    """
+    if fut.exception() is None:
+        fut.result().close()
+
+def when_all(futs, fn):
+    """
+    Calls fn once every one of futs is done, on the thread that completes
+    the last of them, or right away if there are none.
+    """
+    futs = list(futs)
+    if not futs:
+        fn()
+        return
+
+    left = [len(futs)]
+    lock = threading.Lock()
+
+    def done(_):
+        with lock:
+            left[0] -= 1
+            last = left[0] == 0
+        if last:
+            fn()
+
+    for fut in futs:
+        fut.add_done_callback(done)
@@ -0,0 +1,586 @@
+import struct
+import asyncio
+import logging
+import collections
+from socket import MSG_PEEK
+
+from iotftp.utils import *
+
+logger = logging.getLogger()
+
+# header of a frame: its kind, the id of the request the frame belongs to
+# and the length of the payload after it
+FRAME = struct.Struct("!BII")
+# first byte of a message frame, which is never the first byte of a
+# plaintext command, so a server can tell which protocol a client speaks
+FRAME_START = 2
+# first byte of a data frame, carrying data of a multiplexed transfer
+FRAME_DATA = 3
+# first byte of a credit frame, letting the sender of a multiplexed
+# transfer send more data
+FRAME_CREDIT = 4
+# payload of a credit frame: the number of bytes of credit granted
+CREDIT = struct.Struct("!I")
+# longest frame payload accepted
+MAX_FRAME = 1 << 20
+# bytes of frames a main connection can have waiting to be sent before
+# sending on it would block
+FRAME_BACKLOG = 1 << 16
+
+def pack_frame(reqid, payload, kind=FRAME_START):
+    return FRAME.pack(kind, reqid, len(payload)) + payload
+
+def pack_credit(reqid, n):
+    return pack_frame(reqid, CREDIT.pack(n), FRAME_CREDIT)
+
+class FrameParser:
+    """
+    Splits the bytes received on a framed connection into frames, however
+    they were split or coalesced across reads, and keeps the payloads of
+    the whole frames until they are taken.
+
+    Payloads are taken either as the next command, whichever request it
+    belongs to, or as bytes of a given request, skipping over the frames
+    of any others. Data and credit frames go to the multiplexed transfer
+    of their request, and are dropped if it is not open.
+    """
+    def __init__(self):
+        # bytes received that do not yet make a whole frame
+        self.inbuf = bytearray()
+        # payloads of the whole message frames not yet taken, in the order
+        # they were received, as (request id, payload)
+        self.frames = collections.deque()
+        # the multiplexed transfers open, by request id
+        self.channels = {}
+
+    def feed(self, b):
+        """
+        Adds bytes received to the parser. Raises ConnClosedErr on a frame
+        that is malformed or too long, as the stream cannot be resynced.
+        """
+        self.inbuf += b
+        pos = 0
+        while len(self.inbuf) - pos >= FRAME.size:
+            kind, reqid, n = FRAME.unpack_from(self.inbuf, pos)
+            if kind not in (FRAME_START, FRAME_DATA, FRAME_CREDIT) or n > MAX_FRAME or \
+                    (kind == FRAME_CREDIT and n != CREDIT.size):
+                logger.debug("Bad frame header (kind %s, length %s)", kind, n)
+                raise ConnClosedErr()
+            end = pos + FRAME.size + n
+            if end > len(self.inbuf):
+                break
+            if n:
+                payload = bytes(self.inbuf[pos + FRAME.size:end])
+                channel = self.channels.get(reqid)
+                if kind == FRAME_START:
+                    self.frames.append((reqid, payload))
+                elif channel is None:
+                    # the transfer is over, or was abandoned
+                    logger.debug("Dropping frame of closed transfer %s", reqid)
+                elif kind == FRAME_DATA:
+                    channel.received(payload)
+                else:
+                    channel.granted(CREDIT.unpack(payload)[0])
+            pos = end
+        del self.inbuf[:pos]
+
+    def has_command(self):
+        return bool(self.frames)
+
+    def next_command(self):
+        """
+        Takes the next whole frame, as (request id, payload), or returns
+        None if there is none.
+        """
+        if not self.frames:
+            return None
+        return self.frames.popleft()
+
+    def has(self, reqid):
+        return any(rid == reqid for rid, _ in self.frames)
+
+    def has_data(self, reqid):
+        channel = self.channels.get(reqid)
+        return channel is not None and channel.buffered > 0
+
+    def take(self, reqid, n, peek=False):
+        """
+        Takes up to n bytes of the next payload of reqid, or returns None
+        if none has been received.
+        """
+        for i, (rid, payload) in enumerate(self.frames):
+            if rid != reqid:
+                continue
+            if peek:
+                return payload[:n]
+            if len(payload) > n:
+                self.frames[i] = (rid, payload[n:])
+                return payload[:n]
+            del self.frames[i]
+            return payload
+        return None
+
+class ControlConn:
+    """
+    A main connection, as the server sees it. It speaks the plaintext
+    protocol, unless the first command the client sends is framed, in which
+    case every message either way is framed from then on.
+
+    Stands in for the socket everywhere the server and its handlers use the
+    main connection, so they send and receive messages the same way with
+    either protocol. When framed, what is sent goes out in a frame of the
+    request being served, and what is received comes from the frames of
+    that request. Frames of later requests, which a client can send without
+    waiting for a reply, are kept until the request before them is done.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        # whether the client frames its messages, until its first command
+        # is received
+        self.framed = None
+        self.parser = FrameParser()
+        # id of the request being served
+        self.reqid = 0
+        # frames not yet sent, as the socket would have blocked
+        self.outbuf = bytearray()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
+
+    def detect(self):
+        """
+        Tells which protocol the client speaks from the first byte it sends.
+        """
+        if self.framed is None:
+            b = self.sock.recv(1, MSG_PEEK)
+            if not b:
+                raise ConnClosedErr()
+            self.framed = b[0] == FRAME_START
+            if self.framed:
+                logger.debug("Client frames its commands")
+
+    def poll(self, idle):
+        """
+        Reads whatever has arrived on the readable connection, and returns
+        whether it completes a message to handle: a command if idle, else a
+        message of the request being served. Always true for plaintext,
+        where messages are read straight off the socket.
+        """
+        self.detect()
+        if not self.framed:
+            return True
+
+        self.fill()
+        if idle:
+            return self.has_command()
+        return self.parser.has(self.reqid) or self.parser.has_data(self.reqid)
+
+    def fill(self):
+        """
+        Reads what has arrived into the parser. Raises ConnClosedErr once
+        the client has closed the connection.
+        """
+        try:
+            b = self.sock.recv(RECV_BUFSIZE)
+        except BlockingIOError:
+            return
+        if not b:
+            raise ConnClosedErr()
+        self.parser.feed(b)
+
+    def has_command(self):
+        """
+        Returns whether a framed command is waiting to be evaluated. Commands
+        are held back while replies are backed up, so a client that does not
+        read its replies cannot make the server buffer without bound.
+        """
+        return bool(self.framed) and len(self.outbuf) < FRAME_BACKLOG and \
+            self.parser.has_command()
+
+    def read_command(self):
+        """
+        Returns the next command, or None if a whole one has not arrived.
+        """
+        if not self.framed:
+            return self.sock.recv(MAX_COMMAND)
+
+        frame = self.parser.next_command()
+        if frame is None:
+            return None
+        self.reqid, cmd = frame
+        return cmd
+
+    def recv(self, n, flags=0):
+        if not self.framed:
+            return self.sock.recv(n, flags)
+
+        b = self.parser.take(self.reqid, n, peek=flags & MSG_PEEK)
+        if b is None:
+            # only serviced once the request has a message waiting
+            raise BlockingIOError()
+        return b
+
+    def send(self, b):
+        """
+        Sends a message. When framed, it is queued whole even if others are
+        still waiting to be sent, as replies are sent in one go and never
+        retried; commands are held back while the queue is backed up, so it
+        stays bounded.
+        """
+        if not self.framed:
+            return self.sock.send(b)
+
+        self.outbuf += pack_frame(self.reqid, b)
+        self.flush()
+        return len(b)
+
+    def send_chunk(self, b):
+        """
+        Sends part of a long message, such as a listing, like send() on a
+        nonblocking socket: when framed, raises BlockingIOError while too
+        much is already waiting, so the sender waits until it is writable.
+        """
+        if not self.framed:
+            return self.sock.send(b)
+
+        self.send_frame(pack_frame(self.reqid, b))
+        return len(b)
+
+    def send_whole(self, b):
+        """
+        Queues a whole message to be sent, however long, for a reply that
+        carries a file inline and so cannot stop wherever the socket blocks.
+        """
+        self.outbuf += pack_frame(self.reqid, b) if self.framed else b
+        self.flush()
+
+    def send_frame(self, frame):
+        """
+        Queues a whole frame to be sent, raising BlockingIOError instead if
+        too many are already waiting.
+        """
+        if len(self.outbuf) >= FRAME_BACKLOG:
+            self.flush()
+            if len(self.outbuf) >= FRAME_BACKLOG:
+                raise BlockingIOError()
+        self.outbuf += frame
+        self.flush()
+
+    def grant(self, reqid, n):
+        """
+        Gives the client n more bytes of credit for the transfer of reqid.
+        Always queued, as the data it is for has already been taken in.
+        """
+        self.outbuf += pack_credit(reqid, n)
+        self.flush()
+
+    def buffered(self):
+        """
+        Returns whether a message or data of the request being served has
+        already been read off the socket, so waiting on it would not tell.
+        """
+        return bool(self.framed) and (
+            self.parser.has(self.reqid) or self.parser.has_data(self.reqid)
+        )
+
+    def pending(self):
+        """
+        Returns whether there are frames or replies waiting to be sent.
+        """
+        return bool(self.outbuf)
+
+    def flush(self):
+        """
+        Sends as much of what is waiting as the socket takes.
+        """
+        while self.outbuf:
+            try:
+                n = self.sock.send(self.outbuf)
+            except BlockingIOError:
+                return
+            del self.outbuf[:n]
+
+class FramedStream:
+    """
+    The asyncio server's counterpart to ControlConn, standing in for both the
+    reader and the writer of a main connection once the client has sent a
+    framed command.
+    """
+    def __init__(self, reader, writer, received):
+        self.reader = reader
+        self.writer = writer
+        self.parser = FrameParser()
+        self.parser.feed(received)
+        # id of the request being served
+        self.reqid = 0
+
+    async def fill(self):
+        """
+        Waits for more bytes to arrive. Returns False once the client has
+        closed the connection.
+        """
+        b = await self.reader.read(RECV_BUFSIZE)
+        if not b:
+            return False
+        self.parser.feed(b)
+        return True
+
+    async def read_command(self):
+        """
+        Returns the next command, or b"" once the client has closed the
+        connection.
+        """
+        while (frame := self.parser.next_command()) is None:
+            if not await self.fill():
+                return b""
+        self.reqid, cmd = frame
+        return cmd
+
+    async def read(self, n):
+        while (b := self.parser.take(self.reqid, n)) is None:
+            if not await self.fill():
+                return b""
+        return b
+
+    async def readexactly(self, n):
+        b = b""
+        while len(b) < n:
+            more = await self.read(n - len(b))
+            if not more:
+                raise asyncio.IncompleteReadError(b, n)
+            b += more
+        return b
+
+    def write(self, b):
+        self.writer.write(pack_frame(self.reqid, bytes(b)))
+
+    def send_frame(self, frame):
+        self.writer.write(frame)
+
+    def grant(self, reqid, n):
+        self.writer.write(pack_credit(reqid, n))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    def get_extra_info(self, name, default=None):
+        return self.writer.get_extra_info(name, default)
+
+    def close(self):
+        self.writer.close()
+
+class FramedSocket:
+    """
+    The client's side of a framed main connection. Each command is sent as
+    a new request, and replies are received as the bytes of the request
+    they belong to, whatever else has arrived.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.parser = FrameParser()
+        # id of the request being sent or received on
+        self.reqid = 0
+        # id the last request was given
+        self.lastid = 0
+
+    def new_request(self):
+        """
+        Starts a new request, sending and receiving on it from now on, and
+        returns its id.
+        """
+        self.lastid = (self.lastid + 1) & 0xffffffff
+        self.reqid = self.lastid
+        return self.reqid
+
+    def switch(self, reqid):
+        """
+        Sends and receives on an earlier request, for reading the replies to
+        commands sent ahead of them.
+        """
+        self.reqid = reqid
+
+    def send(self, b):
+        self.sock.sendall(pack_frame(self.reqid, bytes(b)))
+        return len(b)
+
+    def send_frame(self, frame):
+        self.sock.sendall(frame)
+
+    def grant(self, reqid, n):
+        self.sock.sendall(pack_credit(reqid, n))
+
+    def recv(self, n):
+        while (b := self.parser.take(self.reqid, n)) is None:
+            b = self.sock.recv(RECV_BUFSIZE)
+            if not b:
+                return b""
+            self.parser.feed(b)
+        return b
+
+    def fill(self):
+        """
+        Waits for more bytes to arrive. Raises ConnectionResetError once
+        the server has closed the connection.
+        """
+        b = self.sock.recv(RECV_BUFSIZE)
+        if not b:
+            raise ConnectionResetError(self.sock)
+        self.parser.feed(b)
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def getsockname(self):
+        return self.sock.getsockname()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+class MuxChannel:
+    """
+    A transfer multiplexed onto a framed main connection, standing in for
+    the data connection it would otherwise have. Its data is sent in data
+    frames of the request it belongs to, between any other frames.
+
+    Flow control is per transfer. The sender never has more than a window
+    of data out that the receiver has not taken in, and the receiver grants
+    credit for what it takes in, half a window at a time.
+
+    Like a nonblocking socket, send() and recv_into() raise BlockingIOError
+    rather than wait, so the senders and receivers in transfer.py can drive
+    a channel. recv() and sendall() wait instead, for blocking connections.
+
+    The channel is open from when it is made until it is closed, so data
+    that arrives before the transfer starts is kept, and any arriving
+    after it is abandoned is dropped.
+    """
+    def __init__(self, conn, window):
+        # the connection, one of ControlConn, FramedStream or FramedSocket
+        self.conn = conn
+        # the request the transfer belongs to
+        self.reqid = conn.reqid
+        self.window = window
+        # bytes the sender can still send before it needs more credit
+        self.credit = window
+        # payloads of the data frames received and not yet taken, and
+        # their total length
+        self.inbuf = collections.deque()
+        self.buffered = 0
+        # bytes taken in that the sender has not been granted credit for
+        self.taken = 0
+        conn.parser.channels[self.reqid] = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def received(self, payload):
+        """
+        Keeps the payload of a data frame until it is taken. Raises
+        ConnClosedErr if the sender has overrun its window.
+        """
+        self.buffered += len(payload)
+        if self.buffered > self.window:
+            logger.debug("Transfer %s sent more than its window", self.reqid)
+            raise ConnClosedErr()
+        self.inbuf.append(payload)
+
+    def granted(self, n):
+        self.credit += n
+
+    def send(self, b):
+        """
+        Sends as much of b as there is credit for, in one data frame.
+        """
+        n = min(len(b), self.credit, MUX_CHUNK)
+        if not n:
+            raise BlockingIOError()
+        self.conn.send_frame(pack_frame(self.reqid, bytes(b[:n]), FRAME_DATA))
+        self.credit -= n
+        return n
+
+    def sendall(self, b):
+        """
+        Sends all of b, waiting for credit as needed. Returns False without
+        sending the rest if the other side replies to the request instead,
+        ending the transfer early.
+        """
+        with memoryview(b) as view:
+            while view:
+                if not self.credit:
+                    if self.replied():
+                        return False
+                    self.conn.fill()
+                    continue
+                n = self.send(view)
+                view = view[n:]
+        return True
+
+    def take(self, n):
+        """
+        Takes up to n bytes of the data received, or returns None if there
+        is none, granting the sender more credit once enough has been taken.
+        """
+        if not self.inbuf:
+            return None
+        b = self.inbuf.popleft()
+        if len(b) > n:
+            self.inbuf.appendleft(b[n:])
+            b = b[:n]
+        self.buffered -= len(b)
+
+        self.taken += len(b)
+        if self.taken >= self.window // 2:
+            self.conn.grant(self.reqid, self.taken)
+            self.taken = 0
+        return b
+
+    def recv_into(self, buf):
+        b = self.take(len(buf))
+        if b is None:
+            raise BlockingIOError()
+        buf[:len(b)] = b
+        return len(b)
+
+    def recv(self, n):
+        """
+        Waits for up to n bytes of data. Returns an empty bytes if the
+        other side replies to the request instead, as the frames of a
+        request arrive in order, so no more data is coming.
+        """
+        while (b := self.take(n)) is None:
+            if self.replied():
+                return b""
+            self.conn.fill()
+        return b
+
+    def replied(self):
+        """
+        Returns whether a message of the request has arrived.
+        """
+        return self.conn.parser.has(self.reqid)
+
+    def close(self):
+        self.conn.parser.channels.pop(self.reqid, None)
+
+def is_framed(conn):
+    """
+    Returns whether a main connection, as a server sees it, is framed.
+    """
+    return isinstance(conn, FramedStream) or (
+        isinstance(conn, ControlConn) and bool(conn.framed)
+    )
@@ -0,0 +1,620 @@
+import os
+import stat
+import time
+import errno
+import fcntl
+import ctypes
+import struct
+import logging
+import threading
+import contextlib
+import collections
+
+from iotftp.digest import new_hasher
+
+logger = logging.getLogger()
+
+# version of the format the index is saved in
+INDEX_VERSION = 1
+# most removed files remembered; tokens from before the last one forgotten
+# are too old, and the clients holding them are sent every file instead
+INDEX_REMOVALS = 1 << 16
+# bytes read at a time when hashing a file
+INDEX_BLOCKSIZE = 1 << 20
+
+# inotify(7) events watched for on every directory
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+# and flags on the events read
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+# and flags when adding a watch
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+    | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    | IN_ONLYDIR | IN_DONT_FOLLOW
+)
+# the fixed part of an inotify event: watch, mask, cookie and name length
+EVENT = struct.Struct("iIII")
+# bytes of events read at a time
+INOTIFY_BUFSIZE = 1 << 16
+
+class Entry:
+    """
+    A file in the index, or a file removed from under the root.
+    """
+    __slots__ = ("seq", "size", "mtime", "ino", "digest")
+
+    def __init__(self, seq, size, mtime, ino, digest=None):
+        # the number of the last change to the file
+        self.seq = seq
+        # size, mtime in nanoseconds and inode of the file,
+        # with a size of None once it is removed
+        self.size = size
+        self.mtime = mtime
+        self.ino = ino
+        # the digest of the file, as algorithm:digest, if it has been
+        # computed since the file last changed
+        self.digest = digest
+
+    def removed(self):
+        return self.size is None
+
+    def same(self, st):
+        return (self.size, self.mtime, self.ino) == (st.st_size, st.st_mtime_ns, st.st_ino)
+
+class FileIndex:
+    """
+    Keeps an index of the regular files under a directory, so clients can
+    ask for only the files that changed since they last asked.
+
+    Every change to a file, its removal included, is numbered in sequence,
+    and the token a client holds is the epoch of the index and the number
+    of the last change it was sent. inotify tells the index which paths to
+    look at again; without it, or once events have been lost, the whole
+    tree is rescanned instead. Either way, the tree is only looked at when
+    a client asks for changes.
+
+    Given a path, the index is saved there after every change, so tokens
+    stay valid across restarts. Worker processes share the saved index,
+    taking turns under a lock on it, and each reads it again if another
+    has changed it.
+    """
+    def __init__(self, root, path=None):
+        # the directory indexed
+        self.root = os.fsencode(os.path.abspath(root))
+        # the file the index is saved in, if any
+        self.path = os.path.abspath(path) if path is not None else None
+        # the paths of the index's own files, kept out of it
+        self.exclude = set()
+        if self.path is not None:
+            for p in (self.path, self.path + ".tmp", self.path + ".lock"):
+                rel = os.path.relpath(os.fsencode(p), self.root)
+                if not rel.startswith(b".."):
+                    self.exclude.add(rel)
+        # files by path relative to the root, including removed files,
+        # in the order they were last changed
+        self.files = collections.OrderedDict()
+        # names of the files in each directory holding any,
+        # by its path relative to the root
+        self.dirs = {}
+        # number of removed files remembered
+        self.removals = 0
+        # the epoch tokens are only valid within, the number of the last
+        # change, and the number of the last removal forgotten
+        self.epoch = os.urandom(4).hex()
+        self.seq = 0
+        self.horizon = 0
+        # when the last scan of the whole tree started, and when events
+        # were last lost, in nanoseconds; the tree is scanned again
+        # whenever events were lost since it last was
+        self.scanned = 0
+        self.missed = 0
+        # the status of the saved index when last read or written, to
+        # tell if another worker has saved it since
+        self.loaded = None
+        # the inotify instance, if any, with the directories watched
+        # by watch descriptor and the other way around
+        self.inotify = None
+        self.wds = {}
+        self.watches = {}
+        # paths relative to the root to look at again
+        self.dirty = set()
+        # the index is used from every filesystem thread
+        self.lock = threading.Lock()
+
+        self.watch_tree()
+        # anything that changed before the watches were in place is missed
+        self.missed = time.time_ns()
+        if self.path is not None:
+            with self.locked():
+                self.reload()
+
+    def changes(self, path, since=None, algorithm=None):
+        """
+        Returns the changes to the files under the directory at path since
+        the token since, a (epoch, number) pair, as the token to ask from
+        next time, whether every file is listed instead, and the lines to
+        send. Every file is listed without a token, or with one too old or
+        from another index. With an algorithm, the digests of the files
+        listed are sent too.
+        Runs on the filesystem executor.
+        """
+        st = os.stat(path)
+        if not stat.S_ISDIR(st.st_mode):
+            raise NotADirectoryError(path)
+        prefix = os.path.relpath(os.fsencode(path), self.root)
+        if prefix == b".":
+            prefix = b""
+        elif prefix.startswith(b".."):
+            # outside the tree indexed
+            raise FileNotFoundError(path)
+
+        with self.lock, self.locked():
+            self.reload()
+            changed = self.refresh()
+
+            full = since is None or since[0] != self.epoch or not self.horizon <= since[1] <= self.seq
+            if full:
+                entries = [
+                    (rel, entry) for rel, entry in self.files.items()
+                    if not entry.removed() and under(rel, prefix)
+                ]
+            else:
+                entries = []
+                for rel, entry in reversed(self.files.items()):
+                    if entry.seq <= since[1]:
+                        break
+                    if under(rel, prefix):
+                        entries.append((rel, entry))
+            entries.sort()
+
+            if algorithm is not None:
+                changed |= self.hash_files(entries, algorithm)
+            if changed and self.path is not None:
+                self.save()
+
+            lines = [
+                format_entry(rel[len(prefix) + 1:] if prefix else rel, entry, algorithm)
+                for rel, entry in entries
+            ]
+            return f"{self.epoch}.{self.seq}", full, lines
+
+    def refresh(self):
+        """
+        Brings the index up to date with the tree, looking again at the
+        paths inotify says changed, or at everything if events were lost.
+        Returns whether anything changed.
+        """
+        self.drain()
+        if self.inotify is None or self.scanned < self.missed:
+            self.scanned = time.time_ns()
+            self.dirty.clear()
+            return self.scan(b"")
+
+        changed = False
+        dirty, self.dirty = self.dirty, set()
+        for rel in sorted(dirty):
+            changed |= self.check(rel)
+        return changed
+
+    def check(self, rel):
+        """
+        Looks again at the path rel, a file or directory, and updates the
+        index to match.
+        """
+        try:
+            st = os.lstat(self.abspath(rel))
+        except OSError:
+            st = None
+
+        if st is not None and stat.S_ISDIR(st.st_mode):
+            # a new directory, or one moved in, may have files in it already
+            return self.scan(rel)
+
+        # not a directory, whether or not it was one before
+        changed = self.forget_tree(rel)
+        if st is not None and stat.S_ISREG(st.st_mode) and self.indexed(rel):
+            changed |= self.update(rel, st)
+        else:
+            changed |= self.remove(rel)
+        return changed
+
+    def scan(self, top):
+        """
+        Scans the directory top and everything under it, updating the index
+        to match, and watches every directory found.
+        """
+        changed = False
+        seen = set()
+        for dirpath, _, filenames in os.walk(self.abspath(top)):
+            reldir = os.path.relpath(dirpath, self.root)
+            if reldir == b".":
+                reldir = b""
+            seen.add(reldir)
+            self.watch(reldir)
+
+            names = set()
+            for name in filenames:
+                rel = join_rel(reldir, name)
+                if not self.indexed(rel):
+                    continue
+                try:
+                    st = os.lstat(os.path.join(dirpath, name))
+                except OSError:
+                    # removed since it was read
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    names.add(name)
+                    changed |= self.update(rel, st)
+
+            for name in self.dirs.get(reldir, set()) - names:
+                changed |= self.remove(join_rel(reldir, name))
+
+        # directories that are no longer there
+        for reldir in [d for d in self.dirs if under(d, top) and d not in seen]:
+            for name in list(self.dirs[reldir]):
+                changed |= self.remove(join_rel(reldir, name))
+        for reldir in [d for d in self.watches if under(d, top) and d not in seen]:
+            self.unwatch(reldir)
+        return changed
+
+    def forget_tree(self, top):
+        """
+        Removes every file under top, once it is no longer a directory.
+        """
+        changed = False
+        for reldir in [d for d in self.dirs if under(d, top)]:
+            for name in list(self.dirs.get(reldir, ())):
+                changed |= self.remove(join_rel(reldir, name))
+        for reldir in [d for d in self.watches if under(d, top)]:
+            self.unwatch(reldir)
+        return changed
+
+    def indexed(self, rel):
+        # names with a newline cannot be sent, and the index is not in itself
+        return b"\n" not in rel and rel not in self.exclude
+
+    def update(self, rel, st):
+        """
+        Records the file at rel, with status st, as changed if it has.
+        """
+        entry = self.files.get(rel)
+        if entry is not None and not entry.removed() and entry.same(st):
+            return False
+        if entry is not None and entry.removed():
+            self.removals -= 1
+
+        self.seq += 1
+        self.files[rel] = Entry(self.seq, st.st_size, st.st_mtime_ns, st.st_ino)
+        self.files.move_to_end(rel)
+        reldir, name = split_rel(rel)
+        self.dirs.setdefault(reldir, set()).add(name)
+        return True
+
+    def remove(self, rel):
+        """
+        Records the file at rel as removed, if it was in the index.
+        """
+        entry = self.files.get(rel)
+        if entry is None or entry.removed():
+            return False
+
+        self.seq += 1
+        self.files[rel] = Entry(self.seq, None, 0, 0)
+        self.files.move_to_end(rel)
+        reldir, name = split_rel(rel)
+        names = self.dirs[reldir]
+        names.discard(name)
+        if not names:
+            del self.dirs[reldir]
+
+        self.removals += 1
+        if self.removals > INDEX_REMOVALS:
+            self.trim()
+        return True
+
+    def trim(self):
+        """
+        Forgets the oldest half of the removed files, so the index does not
+        grow without bound as files come and go.
+        """
+        for rel, entry in list(self.files.items()):
+            if self.removals <= INDEX_REMOVALS // 2:
+                break
+            if entry.removed():
+                del self.files[rel]
+                self.removals -= 1
+                self.horizon = entry.seq
+
+    def hash_files(self, entries, algorithm):
+        """
+        Computes the digests of the files listed that do not have one
+        already. Returns whether any were computed.
+        """
+        changed = False
+        for rel, entry in entries:
+            if entry.removed():
+                continue
+            if entry.digest is not None and entry.digest.startswith(f"{algorithm}:"):
+                continue
+            try:
+                digest = hash_file(self.abspath(rel), entry, algorithm)
+            except OSError as e:
+                logger.debug("Cannot hash %r: %s", rel, e)
+                continue
+            if digest is not None:
+                entry.digest = digest
+                changed = True
+        return changed
+
+    def abspath(self, rel):
+        return os.path.join(self.root, rel) if rel else self.root
+
+    def watch_tree(self):
+        """
+        Watches every directory under the root, if inotify is available.
+        """
+        try:
+            self.inotify = Inotify()
+        except OSError as e:
+            logger.warning(f"Cannot watch {os.fsdecode(self.root)}, rescanning instead: {e}")
+            return
+
+        for dirpath, _, _ in os.walk(self.root):
+            reldir = os.path.relpath(dirpath, self.root)
+            self.watch(b"" if reldir == b"." else reldir)
+            if self.inotify is None:
+                break
+
+    def watch(self, reldir):
+        if self.inotify is None or reldir in self.watches:
+            return
+        try:
+            wd = self.inotify.add(self.abspath(reldir))
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                logger.warning(
+                    f"Out of inotify watches, rescanning {os.fsdecode(self.root)} instead"
+                )
+                self.inotify.close()
+                self.inotify = None
+                self.wds.clear()
+                self.watches.clear()
+            # otherwise the directory went away
+            return
+
+        old = self.wds.get(wd)
+        if old is not None:
+            # the same directory, moved
+            del self.watches[old]
+        self.wds[wd] = reldir
+        self.watches[reldir] = wd
+
+    def unwatch(self, reldir):
+        wd = self.watches.pop(reldir)
+        del self.wds[wd]
+        try:
+            self.inotify.remove(wd)
+        except OSError:
+            # removed along with the directory
+            pass
+
+    def drain(self):
+        """
+        Reads the events inotify has queued, marking the paths they name
+        to be looked at again.
+        """
+        if self.inotify is None:
+            return
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                logger.debug("inotify queue overflowed, rescanning")
+                self.missed = time.time_ns()
+                continue
+            reldir = self.wds.get(wd)
+            if reldir is None:
+                continue
+            if mask & IN_IGNORED:
+                # the directory was removed
+                del self.wds[wd]
+                if self.watches.get(reldir) == wd:
+                    del self.watches[reldir]
+            elif name:
+                self.dirty.add(join_rel(reldir, name))
+            elif mask & (IN_DELETE_SELF | IN_MOVE_SELF) and not reldir:
+                # the root itself is gone
+                self.missed = time.time_ns()
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Holds the lock on the saved index, keeping other worker processes
+        out until it is released.
+        """
+        if self.path is None:
+            yield
+            return
+        with open(self.path + ".lock", "ab") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            yield
+
+    def reload(self):
+        """
+        Reads the saved index, if another worker has saved it since this
+        one last read or wrote it. Called with the lock held.
+        """
+        if self.path is None:
+            return
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return
+        if (st.st_ino, st.st_mtime_ns, st.st_size) == self.loaded:
+            return
+
+        try:
+            with open(self.path, "rb") as f:
+                self.load(f)
+        except (ValueError, IndexError) as e:
+            logger.warning(f"Ignoring malformed index {self.path}: {e}")
+            return
+        self.loaded = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def load(self, f):
+        magic, version, epoch, seq, horizon, scanned = f.readline().split()
+        if magic != b"IOTFTPINDEX" or int(version) != INDEX_VERSION:
+            raise ValueError("not an index, or from another version")
+
+        files, dirs, removals = collections.OrderedDict(), {}, 0
+        for line in f:
+            fseq, size, mtime, ino, digest, rel = line.rstrip(b"\n").split(b" ", 5)
+            if size == b"-":
+                files[rel] = Entry(int(fseq), None, 0, 0)
+                removals += 1
+                continue
+            files[rel] = Entry(
+                int(fseq), int(size), int(mtime), int(ino),
+                digest.decode() if digest != b"-" else None,
+            )
+            reldir, name = split_rel(rel)
+            dirs.setdefault(reldir, set()).add(name)
+
+        self.files, self.dirs, self.removals = files, dirs, removals
+        self.epoch, self.seq, self.horizon = epoch.decode(), int(seq), int(horizon)
+        self.scanned = int(scanned)
+
+    def save(self):
+        """
+        Saves the index, replacing the saved index only once it is whole.
+        Called with the lock held.
+        """
+        tmppath = self.path + ".tmp"
+        with open(tmppath, "wb") as f:
+            f.write(b"IOTFTPINDEX %d %s %d %d %d\n" % (
+                INDEX_VERSION, self.epoch.encode(), self.seq, self.horizon, self.scanned,
+            ))
+            f.writelines(
+                b"%d - 0 0 - %s\n" % (entry.seq, rel) if entry.removed() else
+                b"%d %d %d %d %s %s\n" % (
+                    entry.seq, entry.size, entry.mtime, entry.ino,
+                    entry.digest.encode() if entry.digest is not None else b"-", rel,
+                )
+                for rel, entry in self.files.items()
+            )
+        os.replace(tmppath, self.path)
+
+        st = os.stat(self.path)
+        self.loaded = (st.st_ino, st.st_mtime_ns, st.st_size)
+
+class Inotify:
+    """
+    A non-blocking inotify instance, called through libc, as the standard
+    library has no binding for it. Raises OSError where it is unavailable.
+    """
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            self.add_watch = libc.inotify_add_watch
+            self.rm_watch = libc.inotify_rm_watch
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except AttributeError as e:
+            raise OSError(errno.ENOSYS, f"no inotify: {e}")
+        if fd < 0:
+            raise errno_error()
+        self.fd = fd
+
+    def add(self, path):
+        wd = self.add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            raise errno_error(path)
+        return wd
+
+    def remove(self, wd):
+        if self.rm_watch(self.fd, wd) < 0:
+            raise errno_error()
+
+    def read(self):
+        """
+        Returns the (watch, mask, name) of every event queued.
+        """
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, INOTIFY_BUFSIZE)
+            except BlockingIOError:
+                return events
+
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, n = EVENT.unpack_from(buf, pos)
+                pos += EVENT.size
+                events.append((wd, mask, buf[pos:pos + n].rstrip(b"\0")))
+                pos += n
+
+    def close(self):
+        os.close(self.fd)
+
+def errno_error(path=None):
+    e = ctypes.get_errno()
+    return OSError(e, os.strerror(e), path)
+
+def hash_file(path, entry, algorithm):
+    """
+    Returns the digest of the file at path, or None if it no longer is the
+    file entry describes.
+    """
+    hasher = new_hasher(algorithm)
+    with open(path, "rb", buffering=0) as f:
+        if not entry.same(os.fstat(f.fileno())):
+            return None
+        while (b := f.read(INDEX_BLOCKSIZE)):
+            hasher.update(b)
+        if not entry.same(os.fstat(f.fileno())):
+            # changed while being hashed
+            return None
+    return f"{algorithm}:{hasher.hexdigest()}"
+
+def format_entry(name, entry, algorithm):
+    """
+    Formats the line SYNC sends for a file: f if it changed or x if it was
+    removed, then its size, mtime in nanoseconds, digest and name.
+    """
+    if entry.removed():
+        return b"x 0 0 - %s\n" % name
+    digest = b"-"
+    if algorithm is not None and entry.digest is not None:
+        digest = entry.digest.encode()
+    return b"f %d %d %s %s\n" % (entry.size, entry.mtime, digest, name)
+
+def parse_token(token):
+    """
+    Parses a token SYNC sent into its epoch and change number.
+    Raises ValueError if it is malformed.
+    """
+    epoch, sep, seq = token.partition(".")
+    if not sep or not epoch:
+        raise ValueError(f"invalid token {token!r}")
+    return epoch, int(seq)
+
+def join_rel(reldir, name):
+    return reldir + b"/" + name if reldir else name
+
+def split_rel(rel):
+    reldir, _, name = rel.rpartition(b"/")
+    return reldir, name
+
+def under(rel, top):
+    """
+    Returns whether the path rel is top or anything under it.
+    """
+    return not top or rel == top or rel.startswith(top + b"/")
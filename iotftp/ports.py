@@ -0,0 +1,89 @@
+import socket
+import logging
+
+logger = logging.getLogger()
+
+class DataPortPool:
+    """
+    A pool of data ports that are bound and listening ahead of time.
+
+    Transfers lease a port for as long as they need it and release it
+    when done, instead of binding a fresh ephemeral port per transfer.
+    If every pooled port is leased out, a one-off port is created and
+    closed on release, as before.
+    """
+    def __init__(self, host, size):
+        # the address to bind data ports to
+        self.host = host
+        # number of ports kept in the pool
+        self.size = size
+        # pooled listening sockets not leased to a transfer
+        self.free = []
+        # every listening socket belonging to the pool
+        self.owned = set()
+
+    def open(self):
+        """
+        Binds and starts listening on all the pooled ports.
+        """
+        for _ in range(self.size):
+            sock = self._listener()
+            self.owned.add(sock)
+            self.free.append(sock)
+        logger.debug("Opened %s pooled data ports", self.size)
+
+    def close(self):
+        """
+        Closes all the pooled ports.
+        """
+        for sock in self.owned:
+            sock.close()
+        self.owned.clear()
+        self.free.clear()
+
+    def lease(self):
+        """
+        Takes a listening socket to use as a data port.
+        """
+        if self.free:
+            sock = self.free.pop()
+            # anything queued from an earlier transfer is stale
+            self._drain(sock)
+            return sock
+
+        logger.debug("Data port pool exhausted, binding a new port")
+        return self._listener()
+
+    def release(self, sock):
+        """
+        Returns a leased socket to the pool, or closes it
+        if it did not come from the pool.
+        """
+        if sock in self.owned:
+            self._drain(sock)
+            self.free.append(sock)
+        else:
+            sock.close()
+
+    def owns(self, sock):
+        return sock in self.owned
+
+    def _listener(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((self.host, 0))
+        sock.listen()
+        sock.setblocking(False)
+        return sock
+
+    def _drain(self, sock):
+        """
+        Accepts and closes any connections waiting on a socket.
+        """
+        while True:
+            try:
+                conn, addr = sock.accept()
+            except OSError:
+                # nothing left to accept
+                return
+            logger.debug("Dropping stale data connection from %s", addr)
+            conn.close()
@@ -0,0 +1,87 @@
+import logging
+
+logger = logging.getLogger()
+
+class ConnRegistry:
+    """
+    Tracks every connection open on the server, along with its metadata
+    and the main connection each subconnection belongs to.
+
+    All lookups, insertions and removals are constant time, apart from
+    tearing down a main connection, which is linear in its subconnections.
+    """
+    def __init__(self):
+        # metadata (ConnData) of every connection, main or sub
+        self.data = dict()
+        # main connection -> its subconnections, a dict used as an ordered set
+        self.subconns = dict()
+        # subconnection -> the main connection it belongs to
+        self.mainconns = dict()
+
+    def __contains__(self, conn):
+        return conn in self.data
+
+    def __len__(self):
+        # number of main connections
+        return len(self.subconns)
+
+    def add(self, conn, data):
+        """
+        Registers a new main connection.
+        """
+        self.data[conn] = data
+        self.subconns[conn] = dict()
+
+    def attach(self, mainconn, subconn, data):
+        """
+        Registers a subconnection as belonging to a main connection.
+        """
+        self.data[subconn] = data
+        self.subconns[mainconn][subconn] = None
+        self.mainconns[subconn] = mainconn
+
+    def detach(self, subconn):
+        """
+        Removes a subconnection, returning its main connection.
+        """
+        mainconn = self.mainconns.pop(subconn)
+        del self.subconns[mainconn][subconn]
+        del self.data[subconn]
+        return mainconn
+
+    def remove(self, mainconn):
+        """
+        Removes a main connection and all its subconnections,
+        returning the subconnections removed.
+        """
+        subconns = list(self.subconns.pop(mainconn, ()))
+        for subconn in subconns:
+            del self.mainconns[subconn]
+            del self.data[subconn]
+        self.data.pop(mainconn, None)
+        return subconns
+
+    def data_of(self, conn):
+        """
+        Returns the metadata associated with a connection.
+        """
+        return self.data[conn]
+
+    def mainconn_of(self, conn):
+        """
+        Returns the main connection of a connection, which is
+        the connection itself if it is not a subconnection.
+        """
+        return self.mainconns.get(conn, conn)
+
+    def subconns_of(self, mainconn):
+        """
+        Returns the subconnections of a main connection.
+        """
+        return list(self.subconns[mainconn])
+
+    def group(self, mainconn):
+        """
+        Returns a main connection followed by all its subconnections.
+        """
+        return [mainconn, *self.subconns[mainconn]]
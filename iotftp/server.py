@@ -3,12 +3,30 @@ import sys
 import logging
 import socket
 import selectors
+import heapq
+import time
 
 from iotftp.cmds import *
 from iotftp.cmds.get import GetCmdHandler
 from iotftp.cmds.delete import DelCmdHandler
+from iotftp.cmds.size import SizeCmdHandler
 from iotftp.cmds.put import PutCmdHandler
+from iotftp.cmds.mget import MGetCmdHandler
+from iotftp.cmds.mput import MPutCmdHandler
+from iotftp.cmds.dput import DPutCmdHandler
+from iotftp.cmds.tget import TGetCmdHandler
+from iotftp.cmds.lsd import LsdCmdHandler, ListingCache
+from iotftp.cmds.pwd import PwdCmdHandler
+from iotftp.cmds.cwd import CwdCmdHandler
+from iotftp.cmds.sync import SyncCmdHandler
+from iotftp.index import parse_token
+from iotftp.framing import ControlConn
 from iotftp.utils import *
+from iotftp.transfer import BufferPool
+from iotftp.registry import ConnRegistry
+from iotftp.ports import DataPortPool
+from iotftp.executor import FsExecutor
+from iotftp.trace import tracer
 
 logger = logging.getLogger()
 
@@ -22,27 +40,64 @@ class IoTFTPServer:
     delimiter = b"\n"
     startmsg = b"HI"
 
-    def __init__(self, ipaddr, port, encoding):
+    def __init__(self, ipaddr, port, encoding, dataports=DEF_DATAPORTS,
+                 reuseport=False, clients=None, fsworkers=DEF_FS_WORKERS,
+                 datathreads=0, maxstreams=DEF_MAX_STREAMS, store=None, index=None,
+                 inlinesize=DEF_INLINE_SIZE, muxsize=DEF_MUX_SIZE):
         if not validate_ip(ipaddr):
             raise InvalidIPException()
         # the port listening on
         self.port = port
         # all information needed for the user
         self.cwd = os.getcwd()
-        self.user = os.getlogin()
+        self.user = login_name()
         self.euid = os.geteuid()
         # the selector to manage incoming connections
         self.sel = selectors.DefaultSelector()
-        # number of active connections
-        self.activecount = 0
-        # mapping of connections to subconnections
-        self.conns = dict()
+        # number of active connections, which may be shared with other
+        # worker processes serving the same port
+        self.clients = clients if clients is not None else ClientTracker()
+        # all open connections and their subconnections
+        self.conns = ConnRegistry()
+        # pending data port accept deadlines, a heap of
+        # (deadline, sequence no., listening socket, its metadata)
+        self.deadlines = []
+        self.deadline_seq = 0
         # the encoding to use for protocol commands
         self.encoding = encoding
+        # receive buffers shared by all transfers
+        self.bufpool = BufferPool()
+        # data ports leased out to transfers
+        self.ports = DataPortPool(ipaddr, dataports)
+        # threads running blocking filesystem work
+        self.fs = FsExecutor(fsworkers)
+        # threads running whole transfer bodies, if data-plane mode is on
+        self.dataplane = None
+        if datathreads > 0:
+            self.dataplane = FsExecutor(datathreads, "iotftp-data")
+        # most data connections a transfer can be split across
+        self.maxstreams = maxstreams
+        # the content store uploads are deduplicated against, if any
+        self.store = store
+        # listings of the directories listed lately, shared by every client
+        self.listings = ListingCache()
+        # the index of the files under cwd that SYNC answers from, if any
+        self.index = index
+        # largest file sent inline with a GET reply or a PUT command
+        self.inlinesize = inlinesize
+        # largest transfer multiplexed onto the main connection of a client
+        self.muxsize = muxsize
+        # executors by the socket they wake the loop up on
+        self.executors = {
+            ex.wakesock: ex for ex in (self.fs, self.dataplane) if ex is not None
+        }
         # track whether the server should be running
         self.running = False
         # the listening socket
         self.listensock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuseport:
+            # let other worker processes listen on the same port
+            self.listensock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
         IoTFTPServer.host = ipaddr
 
@@ -51,12 +106,18 @@ class IoTFTPServer:
         self.listensock.setblocking(False)
         self.listensock.listen()
         self.sel.register(self.listensock, selectors.EVENT_READ, data=None)
+        for wakesock in self.executors:
+            self.sel.register(wakesock, selectors.EVENT_READ, data=None)
+        self.ports.open()
     
     def stop(self):
         if self.running:
             self.running = False
         
         self.listensock.close()
+        self.ports.close()
+        for ex in self.executors.values():
+            ex.close()
         self.sel.close()
     
     def run(self):
@@ -64,29 +125,41 @@ class IoTFTPServer:
         self.running = True
         while self.running:
             logger.debug("**************** Event Loop Start ****************")
-            events = self.sel.select(timeout=None)
+            events = self.sel.select(timeout=self.next_timeout())
             for k, m in events:
-                if k.data is None:
+                if k.fileobj in self.executors:
+                    self.resume(self.executors[k.fileobj])
+                elif k.data is None:
                     try:
                         self.accept(k)
                     except ConnectionResetError:
-                        logger.debug(f"[!] Connection reset on new connection")
+                        logger.debug("[!] Connection reset on new connection")
                         continue
                 else:
+                    mainconn = self.conns.mainconn_of(k.fileobj)
                     try:
                         self.service_conn(k, m)
                     except ConnectionResetError:
-                        logger.debug(f"[{k.data.addr}] Connection reset by peer")
+                        logger.debug("[%s] Connection reset by peer", k.data.addr)
                         self.close_all(k.fileobj, k.data)
                     except ConnClosedErr:
-                        logger.debug(f"[{k.data.addr}] Connection closed by peer")
+                        logger.debug("[%s] Connection closed by peer", k.data.addr)
                         self.close_all(k.fileobj, k.data)
                     except BrokenPipeError:
-                        logger.debug(f"[{k.data.addr}] Connection closed on write")
+                        logger.debug("[%s] Connection closed on write", k.data.addr)
                         self.close_all(k.fileobj, k.data)
                     except TimeoutError:
-                        logger.debug(f"[{k.data.addr}] Connection timed out, closing")
+                        logger.debug("[%s] Connection timed out, closing", k.data.addr)
                         self.close_all(k.fileobj, k.data)
+                    except Exception:
+                        # a bug serving one client must not take the others down
+                        logger.exception("[%s] Error serving client, closing", k.data.addr)
+                        self.close_all(k.fileobj, k.data)
+                    else:
+                        # the command state may have changed, so update
+                        # what every connection of the client waits on
+                        self.refresh(mainconn)
+            self.expire_deadlines()
             logger.debug("**************** Event Loop End   ****************")
         self.stop()
             
@@ -94,59 +167,84 @@ class IoTFTPServer:
         """
         Accepts a main connection and registers it with the selector pool.
         """
+        if tracer.on:
+            start = tracer.clock()
         conn, addr = key.fileobj.accept()
-        logger.debug(f"[*] Got connection from {addr}")
-        self.activecount += 1
+        logger.debug("[*] Got connection from %s", addr)
+        self.clients.connect()
 
         # send the welcome message
         self.welcome(conn)
 
         # set the socket to nonblocking
         conn.setblocking(False)
+        # the client may go on to frame its commands
+        conn = ControlConn(conn)
 
-        self.conns[conn] = []
-
-        # initialize connection metadata and register it
+        # initialize connection metadata and register it,
+        # waiting for the client to send a command
         dat = ConnData(
             ConnType.COMMAND, 
             addr, ConnState.NON, None
         )
-        self.sel.register(conn, RWMASK, data=dat)
+        # every connection starts out in the server's directory
+        dat.cwd = self.cwd
+        self.conns.add(conn, dat)
+        self.sel.register(conn, selectors.EVENT_READ, data=dat)
+        if tracer.on:
+            tracer.label(conn, addr)
+            tracer.record(conn, "accept", start)
+
+    def resume(self, executor):
+        """
+        Wakes up the connections whose jobs on executor have completed.
+        """
+        for conn in executor.completed():
+            self.refresh(self.conns.mainconn_of(conn))
 
     def welcome(self, conn):
         """
         Sends the welcome message and relevant information.
         """
-        start_fn("welcome")
         delim = IoTFTPServer.delimiter
 
         send = [
             IoTFTPServer.startmsg,
-            bytes(VERSION, self.encoding),
+            bytes(",".join((VERSION, FRAMED_VERSION)), self.encoding),
             bytes(self.cwd, self.encoding),
             bytes(self.user, self.encoding),
             bytes(str(self.euid), self.encoding),
+            bytes(" ".join(format_opts(server_features(self.maxstreams, self.store, self.index, self.inlinesize))), self.encoding),
         ]
 
         conn.send(delim.join(send))
-        end_fn("welcome")
 
     def close(self, conn):
         """
         Closes a given connection and all its subconnections.
         """
-        logger.debug(f"[*] Closing connection {conn}")
+        logger.debug("[*] Closing connection %s", conn)
+
+        # let the handler of any running command release its resources
+        data = self.conns.data_of(conn)
+        if data.handler is not None:
+            data.handler.close()
 
         # unregister and close all subconnections
-        for subconn in self.conns.pop(conn, []):
-            self.sel.unregister(subconn)
-            subconn.close()
+        for subconn in self.conns.remove(conn):
+            self.unwatch(subconn)
+            self.close_subconn(subconn)
         
-        self.sel.unregister(conn)
+        self.unwatch(conn)
         conn.close()
+        if tracer.on:
+            tracer.forget(conn)
 
-        # decrement number of active connections
-        self.activecount -= 1
+        # decrement number of active connections, and exit
+        # if a client asked us to once everyone has left
+        if self.clients.disconnect() == 0 and self.clients.close_requested():
+            logger.debug("[*] Last client left, exiting")
+            self.running = False
 
     def close_all(self, conn, data):
         """
@@ -154,136 +252,385 @@ class IoTFTPServer:
         Else, just runs close().
         """
 
-        if data.is_subconn():
-            mainconn = self.lookup_conn(conn)
-        else:
-            mainconn = conn
-        
-        self.close(mainconn)
+        self.close(self.conns.mainconn_of(conn))
 
     def add_subconn(self, mainconn, subconn, data):
-        # store the subconnection in the conns dict
-        logger.debug(f"Associating subconn {subconn} with mainconn {mainconn}")
-        self.conns[mainconn].append(subconn)
-        self.sel.register(subconn, RWMASK, ConnData(
+        subdata = ConnData(
             ConnType.TRANSFER,
             data.addr,
             None,
             data.handler,
-        ))
+        )
+        self.attach_subconn(mainconn, subconn, subdata)
+        return subdata
+
+    def attach_subconn(self, mainconn, subconn, subdata):
+        # store the subconnection in the registry
+        logger.debug("Associating subconn %s with mainconn %s", subconn, mainconn)
+        self.conns.attach(mainconn, subconn, subdata)
+        self.watch(subconn, subdata)
 
     def del_subconn(self, subconn):
-        logger.debug(f"Deleting subconn {subconn}")
+        logger.debug("Deleting subconn %s", subconn)
         
-        mainconn = self.lookup_conn(subconn)
-        self.conns[mainconn].remove(subconn)
-        self.sel.unregister(subconn)
-        subconn.close()
+        self.conns.detach(subconn)
+        self.unwatch(subconn)
+        self.close_subconn(subconn)
+
+    def close_subconn(self, subconn):
+        """
+        Closes a subconnection, returning it to the pool
+        if it is a pooled data port.
+        """
+        if self.ports.owns(subconn):
+            self.ports.release(subconn)
+        else:
+            # wake up any data-plane thread blocked on it first
+            shutdown(subconn)
+            subconn.close()
+
+    def drop_subconns(self, mainconn):
+        """
+        Unregisters and closes all subconnections of a main connection,
+        keeping the main connection open.
+        """
+        for subconn in self.conns.subconns_of(mainconn):
+            self.del_subconn(subconn)
+
+    def interest(self, data):
+        """
+        Returns the selector events a connection is waiting on
+        in its current state.
+        """
+        if data.is_subconn():
+            return data.handler.interest(data)
+
+        if data.state in (ConnState.NON, ConnState.ACK):
+            # waiting for a command or an acknowledgement
+            return selectors.EVENT_READ
+        elif data.state.is_err() or data.state == ConnState.BYE:
+            # a response is ready to be sent
+            return selectors.EVENT_WRITE
+        elif data.handler is not None:
+            return data.handler.interest(data)
+        return selectors.EVENT_READ
+
+    def refresh(self, mainconn):
+        """
+        Updates the selector registrations of a main connection and
+        its subconnections to match what each is waiting on.
+        """
+        if mainconn not in self.conns:
+            # connection was closed while being serviced
+            return
+
+        for conn in self.conns.group(mainconn):
+            self.watch(conn, self.conns.data_of(conn))
+
+    def watch(self, conn, data):
+        """
+        Registers, modifies or unregisters a connection with the selector
+        so that it only wakes up the loop for the events it is waiting on.
+        """
+        events = self.interest(data)
+        if not data.is_subconn() and conn.pending():
+            # replies backed up behind a slow client
+            events |= selectors.EVENT_WRITE
+        if self.buffered(conn, data):
+            # the socket will not become readable for what was already read
+            # off it, so wake up as soon as it is writable instead
+            events |= selectors.EVENT_WRITE
+        try:
+            key = self.sel.get_key(conn)
+        except KeyError:
+            if events:
+                self.sel.register(conn, events, data)
+            return
+
+        if not events:
+            self.sel.unregister(conn)
+        elif events != key.events:
+            self.sel.modify(conn, events, data)
+
+    def buffered(self, conn, data):
+        """
+        Returns whether a framed main connection is waiting to read a
+        message or data that has already been read off its socket.
+        """
+        return not data.is_subconn() and data.state != ConnState.NON and \
+            self.interest(data) & selectors.EVENT_READ and conn.buffered()
+
+    def unwatch(self, conn):
+        """
+        Unregisters a connection from the selector, if it is registered.
+        """
+        try:
+            self.sel.unregister(conn)
+        except KeyError:
+            pass
+
+    def add_deadline(self, conn, data, timeout):
+        """
+        Closes the client owning conn if conn is still open after timeout
+        seconds. Used for data ports waiting for the client to connect.
+        """
+        self.deadline_seq += 1
+        heapq.heappush(self.deadlines, (
+            time.monotonic() + timeout, self.deadline_seq, conn, data
+        ))
+
+    def next_timeout(self):
+        """
+        Returns how long the selector can wait before a deadline expires.
+        """
+        if not self.deadlines:
+            return None
+        return max(0, self.deadlines[0][0] - time.monotonic())
+
+    def expire_deadlines(self):
+        """
+        Closes the clients of any data ports whose deadlines have passed.
+        """
+        now = time.monotonic()
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, _, conn, data = heapq.heappop(self.deadlines)
+            # the port may since have been accepted on or closed
+            if self.conns.data.get(conn) is not data:
+                continue
+            logger.debug("[%s] Data port not connected to in time, closing", data.addr)
+            self.close_all(conn, data)
+
+    def next_command(self, conn, data):
+        """
+        Evaluates the next command, timing how long it takes to parse and
+        starting to time the whole command if tracing is on.
+        """
+        if not tracer.on:
+            self.evalcmd(conn, data)
+            return
+        start = tracer.clock()
+        self.evalcmd(conn, data)
+        if data.state != ConnState.NON:
+            tracer.label(conn, data.addr, data.cmd[0])
+            tracer.record(conn, "parse", start)
+            tracer.begin(conn, "command", start)
 
     def evalcmd(self, conn, data):
         """
         Evaluates a command sent by a client and prepares the connection
         to be handled by its respective handler.
         """
-        start_fn("evalcmd")
         delim = IoTFTPServer.delimiter
         # assume conn can be read from
-        cmd = conn.recv(512)
+        cmd = conn.read_command()
+        if cmd is None:
+            # the rest of a framed command is still to come
+            return
         if not cmd:
             raise ConnClosedErr()
         
+        # a PUT may carry the file it uploads inline, after an empty field
+        cmd, body = split_inline(cmd, delim)
         cmd = cmd.split(delim)
         for i in range(len(cmd)):
             cmd[i] = cmd[i].decode(self.encoding)
         data.cmd = cmd
 
         command = cmd[0]
+        if body is not None and command != "PUT":
+            logger.debug("Error: %s cannot carry a file inline", command)
+            data.state = ConnState.E306
+            return
 
         match command:
             case "GET":
                 logger.debug("Got GET command")
-                if len(cmd) != 2:
-                    logger.debug("Error: did not receive exactly 2 arguments")
+                try:
+                    if len(cmd) < 2 or not cmd[1]:
+                        raise ValueError("no path")
+                    opts = parse_opts(cmd[2:])
+                except ValueError as e:
+                    logger.debug("Error: bad arguments: %s", e)
                     data.state = ConnState.E306
-
-                    end_fn("evalcmd")
                     return
 
-                args = cmd[1]
+                args = resolve(data.cwd, cmd[1])
                 data.state = ConnState.GET
-                data.handler = GetCmdHandler(args)
+                data.handler = GetCmdHandler(args, opts)
             case "PUT":
                 logger.debug("Got PUT command")
-                if len(cmd) != 3:
-                    logger.debug("Error: received not exactly 3 arguments")
+                try:
+                    if len(cmd) < 3 or not cmd[1]:
+                        raise ValueError("no path or size")
+                    opts = parse_opts(cmd[3:])
+                except ValueError as e:
+                    logger.debug("Error: bad arguments: %s", e)
                     data.state = ConnState.E306
-
-                    end_fn("evalcmd")
                     return
                 
-                args = cmd[1:]
+                args = [ resolve(data.cwd, cmd[1]), cmd[2] ]
                 data.state = ConnState.PUT
-                data.handler = PutCmdHandler(args)
+                data.handler = PutCmdHandler(args, opts, body)
+            case "DPUT":
+                logger.debug("Got DPUT command")
+                try:
+                    if len(cmd) < 3 or not cmd[1]:
+                        raise ValueError("no path or size")
+                    opts = parse_opts(cmd[3:])
+                except ValueError as e:
+                    logger.debug("Error: bad arguments: %s", e)
+                    data.state = ConnState.E306
+                    return
+
+                args = [ resolve(data.cwd, cmd[1]), cmd[2] ]
+                data.state = ConnState.DPUT
+                data.handler = DPutCmdHandler(args, opts)
             case "DEL":
                 logger.debug("Got DEL command")
                 if len(cmd) != 2:
                     logger.debug("Error: received not exactly 2 arguments")
                     data.state = ConnState.E306
-
-                    end_fn("evalcmd")
                     return
-                
-                args = cmd[1]
+                if not cmd[1]:
+                    # an empty path would resolve to the working directory
+                    logger.debug("Error: received an empty path")
+                    data.state = ConnState.E302
+                    return
+
+                args = resolve(data.cwd, cmd[1])
                 data.state = ConnState.DEL
                 data.handler = DelCmdHandler(args)
+            case "SIZE":
+                logger.debug("Got SIZE command")
+                if len(cmd) != 2 or not cmd[1]:
+                    logger.debug("Error: received not exactly 2 arguments")
+                    data.state = ConnState.E306
+                    return
+
+                args = resolve(data.cwd, cmd[1])
+                data.state = ConnState.SIZE
+                data.handler = SizeCmdHandler(args)
+            case "MGET":
+                logger.debug("Got MGET command")
+                if len(cmd) < 2:
+                    logger.debug("Error: received no paths")
+                    data.state = ConnState.E306
+                    return
+
+                args = cmd[1:]
+                data.state = ConnState.MGET
+                data.handler = MGetCmdHandler(args, data.cwd)
+            case "MPUT":
+                logger.debug("Got MPUT command")
+                if len(cmd) != 2:
+                    logger.debug("Error: received not exactly 2 arguments")
+                    data.state = ConnState.E306
+                    return
+
+                args = cmd[1]
+                data.state = ConnState.MPUT
+                data.handler = MPutCmdHandler(args, data.cwd)
+            case "TGET":
+                logger.debug("Got TGET command")
+                if len(cmd) != 2:
+                    logger.debug("Error: did not receive exactly 2 arguments")
+                    data.state = ConnState.E306
+                    return
+
+                args = resolve(data.cwd, cmd[1])
+                data.state = ConnState.TGET
+                data.handler = TGetCmdHandler(args)
             case "PWD":
                 logger.debug("Got PWD Command")
-                # data.state = ConnState.PWD
-                data.state = ConnState.E305
+                data.state = ConnState.PWD
+                data.handler = PwdCmdHandler()
             case "LSD":
                 logger.debug("Got LSD command")
-                # data.state = ConnState.LSD
-                data.state = ConnState.E305
+                if len(cmd) > 2:
+                    logger.debug("Error: received more than 2 arguments")
+                    data.state = ConnState.E306
+                    return
+
+                # the working directory, unless given another
+                args = resolve(data.cwd, cmd[1]) if len(cmd) == 2 else data.cwd
+                data.state = ConnState.LSD
+                data.handler = LsdCmdHandler(args)
             case "CWD":
                 logger.debug("Got CWD command")
-                # data.state = ConnState.CWD
-                data.state = ConnState.E305
+                if len(cmd) != 2:
+                    logger.debug("Error: received not exactly 2 arguments")
+                    data.state = ConnState.E306
+                    return
+
+                args = resolve(data.cwd, cmd[1])
+                data.state = ConnState.CWD
+                data.handler = CwdCmdHandler(args)
+            case "SYNC":
+                logger.debug("Got SYNC command")
+                if self.index is None:
+                    logger.debug("Error: no file index kept")
+                    data.state = ConnState.E305
+                    return
+
+                try:
+                    if len(cmd) < 2 or not cmd[1]:
+                        raise ValueError("no path")
+                    opts = parse_opts(cmd[2:])
+                    since = parse_token(opts["SINCE"]) if "SINCE" in opts else None
+                except ValueError as e:
+                    logger.debug("Error: bad arguments: %s", e)
+                    data.state = ConnState.E306
+                    return
+
+                if opts.get("H", DIGESTS[0]) not in DIGESTS:
+                    logger.debug("Error: unsupported digest %s", opts['H'])
+                    data.state = ConnState.E305
+                    return
+
+                args = resolve(data.cwd, cmd[1])
+                data.state = ConnState.SYNC
+                data.handler = SyncCmdHandler(args, since, opts.get("H"))
             case "BYE":
                 logger.debug("Got BYE command")
                 data.state = ConnState.BYE
             case _:
-                logger.debug(f"Got {command}")
-        end_fn("evalcmd")
+                logger.debug("Got %s", command)
     
     def service_conn(self, key, mask):
         """
         Handles a connection ready for reading or writing.
         """
-        start_fn("service_conn")
         conn = key.fileobj
         data = key.data
 
-        logger.debug(f"Servicing connection {data.addr}")
+        logger.debug("Servicing connection %s", data.addr)
 
         logger.debug(data.state)
 
         if conn.fileno() < 0:
             return
 
-        if mask & selectors.EVENT_READ:
+        readable = mask & selectors.EVENT_READ or self.buffered(conn, data)
+        if readable and (
+            data.is_subconn() or conn.poll(data.state == ConnState.NON)
+        ):
             logger.debug("open for reading")
             if data.state == ConnState.NON:
                 # eval the command that the connection wants
-                self.evalcmd(conn, data)
+                self.next_command(conn, data)
             elif data.state == ConnState.ACK:
                 # if an error has occurred, read in acknowledgement
                 logger.debug("reading in acknowledgement")
-                dat = conn.recv(8)
+                dat = conn.recv(len(ACKNOW))
                 if not dat:
                     raise ConnClosedErr()
                 
                 if dat == ACKNOW:
                     logger.debug("ack received, resetting connection")
+                    if tracer.on:
+                        tracer.abandon(conn)
+                    if data.handler is not None:
+                        data.handler.close()
                     data.reset()
                 else:
                     pass #! this is an error condition
@@ -298,49 +645,47 @@ class IoTFTPServer:
         if conn.fileno() < 0:
             return
 
-        if mask & selectors.EVENT_WRITE:
+        if mask & selectors.EVENT_WRITE and not data.is_subconn():
+            conn.flush()
+
+        if mask & selectors.EVENT_WRITE and (
+            data.is_subconn() or self.interest(data) & selectors.EVENT_WRITE
+        ):
             logger.debug("open for writing")
 
             # if state is err, implies that the connection is a main conn,
             # since state for subconn is always None
             if not data.is_subconn() and data.state.is_err():
-                logger.debug(f"[*] Sending error message for error {data.state}")
+                logger.debug("[*] Sending error message for error %s", data.state)
                 conn.send(data.state.value.value)
                 data.state = ConnState.ACK
             elif data.state == ConnState.BYE:
                 logger.debug("Handling BYE command")
                 conn.send(RES_OK)
-                
-                self.running = False
+                data.reset()
+                if tracer.on:
+                    tracer.finish(conn)
+
+                # only exit once this is the last client connected
+                self.clients.request_close()
+                if self.clients.count() <= 1:
+                    self.running = False
             elif data.handler is not None:
                 if data.is_subconn():
                     ty, res = data.handler.handle_subconn(conn, self.params(), data, RW.WRITE)
                 else:
                     ty, res = data.handler.handle(conn, self.params(), data, RW.WRITE)
                 self.process_handler_result(ty, res, conn, data)
-        else:
-            logger.debug("Unknown event mask")
-            return
-        end_fn("service_conn")
-
-    def lookup_conn(self, subconn):
-        """
-        Looks up the main connection associated with a subconnection.
-        """
-        start_fn("lookup_conn")
 
-        for k in self.conns:
-            if subconn in self.conns[k]:
-                logger.debug(f"Got main conn {k}")
-                return k
-        end_fn("lookup_conn")
+        # evaluate any commands a framing client sent without waiting
+        while not data.is_subconn() and conn.fileno() >= 0 and \
+                data.state == ConnState.NON and conn.has_command():
+            self.next_command(conn, data)
 
     def process_handler_result(self, restype, res, conn, data):
         """
         Processes the handler result accordingly.
         """
-        start_fn("process_handler")
-
         if restype is None:
             logger.error("[ERR] Received invalid handler result")
             data.state = ConnState.E308
@@ -350,13 +695,16 @@ class IoTFTPServer:
             logger.debug("[*] Restype is error, handling")
             if data.is_subconn():
                 # get the data associated with the main conn
-                c = self.lookup_conn(conn)
-                dat = self.sel.get_key(c).data
+                c = self.conns.mainconn_of(conn)
+                dat = self.conns.data_of(c)
                 dat.state = ConnState.from_handler_result(restype)
             # set state to error and return
             # sending the error will be handled by service_conn
             else:
+                c = conn
                 data.state = ConnState.from_handler_result(restype)
+            # the transfer is abandoned, so its subconns are no longer needed
+            self.drop_subconns(c)
         else:
             match restype:
                 case HandlerResult.OK:
@@ -364,21 +712,35 @@ class IoTFTPServer:
                     logger.debug("Received OK, doing nothing")
                 case HandlerResult.NEWCONN:
                     logger.debug("Received NEWCONN, registering new subconn")
-                    self.add_subconn(conn, res, data)
+                    subdata = self.add_subconn(conn, res, data)
+                    # the client only has so long to connect to the new port
+                    self.add_deadline(res, subdata, DATA_ACCEPT_TIMEOUT)
+                    if tracer.on:
+                        tracer.begin(conn, "connect")
                 case HandlerResult.REPLACE:
                     logger.debug("Received REPLACE, replacing old subconn")
-                    if data.is_subconn():
-                        mainconn = self.lookup_conn(conn)
-                    else:
-                        mainconn = conn
+                    mainconn = self.conns.mainconn_of(conn)
                     self.del_subconn(res[0])
-                    self.add_subconn(mainconn, res[1][0], res[1][1])
+                    self.attach_subconn(mainconn, res[1][0], res[1][1])
+                    if tracer.on:
+                        # every data connection has been made
+                        tracer.switch(mainconn, "connect", "transfer")
+                case HandlerResult.ATTACH:
+                    logger.debug("Received ATTACH, adding another subconn")
+                    mainconn = self.conns.mainconn_of(conn)
+                    self.attach_subconn(mainconn, res[0], res[1])
                 case HandlerResult.DONE:
-                    logger.debug("Received DONE, closing subconn")
                     if data.is_subconn():
+                        logger.debug("Received DONE, closing subconn")
                         self.del_subconn(conn)
-
-        end_fn("process_handler")
+                    else:
+                        # command complete, ready for the next one
+                        logger.debug("Received DONE, resetting connection")
+                        self.drop_subconns(conn)
+                        data.handler.close()
+                        data.reset()
+                        if tracer.on:
+                            tracer.finish(conn)
         return
 
     def respond(self, conn, response):
@@ -398,7 +760,17 @@ class IoTFTPServer:
             self.cwd,
             self.user,
             self.euid,
-            self.activecount,
+            self.clients.count(),
             IoTFTPServer.delimiter,
-            self.encoding
+            self.encoding,
+            self.bufpool,
+            self.ports,
+            self.fs,
+            self.dataplane,
+            self.maxstreams,
+            self.store,
+            self.listings,
+            self.index,
+            self.inlinesize,
+            self.muxsize,
         )
\ No newline at end of file
@@ -0,0 +1,335 @@
+import os
+import errno
+import fcntl
+import string
+import logging
+import tempfile
+import threading
+import collections
+import concurrent.futures
+
+from iotftp.digest import DEF_DIGEST, new_hasher
+
+logger = logging.getLogger()
+
+# most bytes of objects a content store keeps by default
+DEF_STORE_SIZE = 1 << 30
+# ioctl making a file share the extents of another, on filesystems with
+# copy-on-write support (Linux FICLONE)
+FICLONE = 0x40049409
+# bytes read at a time when hashing or copying an object
+STORE_BLOCKSIZE = 1 << 20
+
+# errors from a clone or copy_file_range that mean it cannot be used for
+# this pair of files, and an ordinary copy should be made instead
+CLONE_UNSUPPORTED = (
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.ENOTTY,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+)
+
+class ContentStore:
+    """
+    Keeps a copy of uploaded files under the digest of their contents, so
+    that a file uploaded again, to any path, can be made from the copy
+    instead of being sent.
+
+    Each object is stored at root/ab/abcd..., named by its digest. An index
+    of the objects in order of use is kept in memory, and the least recently
+    used are evicted once they take up more than maxsize bytes. The
+    modification time of an object is updated when it is used, so the order
+    survives a restart.
+
+    Worker processes sharing a store each have their own index, picking up
+    the objects the others add as they are asked for. An object may also be
+    evicted from under one of them; that is only ever a miss.
+    """
+    def __init__(self, root, maxsize=DEF_STORE_SIZE, algorithm=DEF_DIGEST, hardlink=False):
+        # the directory objects are kept in
+        self.root = os.path.abspath(root)
+        # most bytes of objects to keep
+        self.maxsize = maxsize
+        # the digest algorithm objects are named by
+        self.algorithm = algorithm
+        self.digestlen = new_hasher(algorithm).digest_size * 2
+        # whether to hard link files to their objects rather than copy them,
+        # which leaves the files sharing the read-only inode of the object
+        self.hardlink = hardlink
+        # sizes of the objects by digest, least recently used first,
+        # and their total
+        self.index = collections.OrderedDict()
+        self.size = 0
+        # the index is used from every filesystem thread
+        self.lock = threading.Lock()
+        # futures done once the objects being added under each digest are
+        # in, so an upload of the same contents meanwhile can wait for them
+        # rather than miss
+        self.adding = {}
+
+        os.makedirs(self.root, exist_ok=True)
+        self.load()
+
+    def load(self):
+        """
+        Builds the index from the objects already in the store.
+        """
+        found = []
+        for entry in os.scandir(self.root):
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            for obj in os.scandir(entry.path):
+                if obj.name.startswith("."):
+                    # left over from an interrupted add
+                    remove(obj.path)
+                elif obj.is_file(follow_symlinks=False):
+                    st = obj.stat(follow_symlinks=False)
+                    found.append((st.st_mtime, obj.name, st.st_size))
+
+        for _, digest, size in sorted(found):
+            self.index[digest] = size
+            self.size += size
+        for digest in self.trim():
+            remove(self.path(digest))
+        logger.debug("Content store at %s has %s objects", self.root, len(self.index))
+
+    def parse_offer(self, value):
+        """
+        Parses the value of a CAS option, of the form algorithm:digest,
+        into the digest. Raises KeyError if the algorithm is not the one
+        the store uses, and ValueError if the digest is malformed.
+        """
+        name, sep, digest = value.partition(":")
+        if not sep:
+            raise ValueError(f"invalid content digest {value!r}")
+        if name != self.algorithm:
+            raise KeyError(name)
+        if len(digest) != self.digestlen or not set(digest) <= set(string.hexdigits[:16]):
+            raise ValueError(f"invalid content digest {value!r}")
+        return digest
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def fetch(self, digest, path, file, size):
+        """
+        Fills the newly created file, open at path, with the object stored
+        under digest, if the store has it, or replaces it with a hard link
+        to the object. Returns whether it did.
+        Runs on the filesystem executor, so never waits for an add in
+        progress, which may be queued behind it; see pending().
+        """
+        with self.lock:
+            known = digest in self.index
+            if known:
+                self.index.move_to_end(digest)
+
+        try:
+            src = open(self.path(digest), "rb", buffering=0)
+        except FileNotFoundError:
+            # evicted, possibly by another worker process
+            self.forget(digest)
+            return False
+
+        with src:
+            stored = os.fstat(src.fileno()).st_size
+            if not known:
+                # added by another worker process
+                self.adopt(digest, stored)
+            if stored != size:
+                return False
+            try:
+                # record the use, for the order of eviction after a restart
+                os.utime(src.fileno())
+            except OSError:
+                pass
+
+            if self.hardlink:
+                try:
+                    link_over(self.path(digest), path)
+                    return True
+                except OSError as e:
+                    # on another filesystem, or out of links
+                    logger.debug("Cannot link %s to the store: %s", path, e)
+            clone(src.fileno(), file.fileno(), size)
+        return True
+
+    def expect(self, digest):
+        """
+        Marks an object as about to be added under digest, until add is
+        done. Called before the upload is acknowledged, with add then
+        submitted to the executor, so a client putting the same contents
+        again straight after finds them.
+        """
+        with self.lock:
+            if digest not in self.index:
+                self.adding.setdefault(digest, concurrent.futures.Future())
+
+    def pending(self, digest):
+        """
+        Returns a future done once the object being added under digest is
+        in, or None if it is not being added. Waited on by the event loop
+        before fetching, never on the executor the add runs on.
+        """
+        with self.lock:
+            return self.adding.get(digest)
+
+    def add(self, digest, path):
+        """
+        Adds a copy of the file at path to the store under digest. The copy
+        is hashed before it is added, so a client cannot plant contents under
+        the digest of other contents.
+        Runs on the filesystem executor, once the upload has completed, so
+        a failure only means the file is not stored.
+        """
+        try:
+            self._add(digest, path)
+        except OSError as e:
+            logger.warning(f"Could not store {path}: {e}")
+        finally:
+            with self.lock:
+                adding = self.adding.pop(digest, None)
+            if adding is not None:
+                adding.set_result(None)
+
+    def _add(self, digest, path):
+        with self.lock:
+            if digest in self.index:
+                return
+
+        obj = self.path(digest)
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(obj), prefix=".", suffix=".tmp")
+        try:
+            with open(path, "rb", buffering=0) as src:
+                size = os.fstat(src.fileno()).st_size
+                if size > self.maxsize:
+                    remove(tmppath)
+                    return
+                clone(src.fileno(), fd, size)
+
+            hasher = new_hasher(self.algorithm)
+            offset = 0
+            while (b := os.pread(fd, STORE_BLOCKSIZE, offset)):
+                hasher.update(b)
+                offset += len(b)
+            if hasher.hexdigest() != digest:
+                logger.warning(f"Not storing {path}: contents do not match {digest}")
+                remove(tmppath)
+                return
+
+            # objects are never changed once stored
+            os.fchmod(fd, 0o444)
+            os.replace(tmppath, obj)
+        except Exception:
+            remove(tmppath)
+            raise
+        finally:
+            os.close(fd)
+
+        self.adopt(digest, size)
+
+    def adopt(self, digest, size):
+        """
+        Adds an object already in place to the index, as the most recently
+        used, evicting others to make room for it.
+        """
+        with self.lock:
+            if digest not in self.index:
+                self.index[digest] = size
+                self.size += size
+            evicted = self.trim()
+        for digest in evicted:
+            remove(self.path(digest))
+
+    def forget(self, digest):
+        with self.lock:
+            size = self.index.pop(digest, None)
+            if size is not None:
+                self.size -= size
+
+    def trim(self):
+        """
+        Drops the least recently used objects from the index until the rest
+        fit in maxsize, and returns their digests. Called with the lock held.
+        """
+        evicted = []
+        while self.size > self.maxsize and self.index:
+            digest, size = self.index.popitem(last=False)
+            self.size -= size
+            evicted.append(digest)
+        return evicted
+
+def clone(src, dst, size):
+    """
+    Makes the file open at dst a copy of the first size bytes of the file
+    open at src, sharing its extents if the filesystem supports it.
+    """
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+        return
+    except OSError as e:
+        if e.errno not in CLONE_UNSUPPORTED:
+            raise
+
+    offset = 0
+    use_copy_range = hasattr(os, "copy_file_range")
+    while offset < size:
+        if use_copy_range:
+            try:
+                n = os.copy_file_range(src, dst, size - offset, offset, offset)
+            except OSError as e:
+                if e.errno not in CLONE_UNSUPPORTED:
+                    raise
+                use_copy_range = False
+                continue
+        else:
+            b = os.pread(src, min(STORE_BLOCKSIZE, size - offset), offset)
+            n = os.pwrite(dst, b, offset) if b else 0
+        if not n:
+            raise OSError("file shrank while being copied")
+        offset += n
+
+def link_over(obj, path):
+    """
+    Replaces the file at path with a hard link to obj.
+    """
+    tmppath = os.path.join(
+        os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}.link"
+    )
+    os.link(obj, tmppath)
+    try:
+        os.replace(tmppath, path)
+    except Exception:
+        remove(tmppath)
+        raise
+
+def copy_out(path, size):
+    """
+    Replaces the file at path, which shares its inode with other files, as
+    one linked to a store object does, with a copy of its first size bytes
+    that is its own, so it can be written to without changing the others.
+    """
+    tmppath = os.path.join(
+        os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}.copy"
+    )
+    with open(path, "rb", buffering=0) as src:
+        fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            clone(src.fileno(), fd, size)
+            # a clone shares all of the extents, whatever the size
+            os.ftruncate(fd, size)
+            os.replace(tmppath, path)
+        except Exception:
+            remove(tmppath)
+            raise
+        finally:
+            os.close(fd)
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import collections
+
+# spans kept while tracing, by default, before the oldest are dropped
+DEF_TRACE_SPANS = 1 << 16
+
+# a timed phase of serving a client, with its start and duration in
+# nanoseconds on the perf counter, and the client and command it was for
+Span = collections.namedtuple("Span", "start duration phase addr command")
+
+class Tracer:
+    """
+    Records how long each phase of serving a command takes: accepting the
+    connection, parsing the command, waiting for the data connection, the
+    transfer, and the final acknowledgement, along with the whole command.
+
+    Every probe is guarded by the on attribute where it is placed,
+
+        if tracer.on:
+            tracer.begin(conn, "transfer")
+
+    so while tracing is off, as it is unless turned on at startup, a probe
+    costs a single attribute check and nothing is formatted or stored.
+
+    Phases are tracked by the key of the connection they belong to, which
+    is whatever identifies it for as long as it is open. Finished phases go
+    into a ring buffer, which drops the oldest once full, until dumped.
+    Probes must all run on the thread of the event loop.
+    """
+    def __init__(self):
+        # whether probes record anything
+        self.on = False
+        # the phases recorded, oldest first
+        self.spans = collections.deque(maxlen=DEF_TRACE_SPANS)
+        # the starts of the phases in progress, by key and then phase
+        self.started = {}
+        # the client address and command of each key
+        self.labels = {}
+
+    def enable(self, size=DEF_TRACE_SPANS):
+        self.spans = collections.deque(self.spans, maxlen=size)
+        self.on = True
+
+    def disable(self):
+        self.on = False
+        self.started.clear()
+        self.labels.clear()
+
+    def clock(self):
+        return time.perf_counter_ns()
+
+    def label(self, key, addr, command=None):
+        """
+        Sets the client and command the spans of key are recorded for.
+        """
+        self.labels[key] = (addr, command)
+
+    def record(self, key, phase, start, end=None):
+        """
+        Records a phase of key that started at start and ends now, or at end.
+        """
+        if end is None:
+            end = time.perf_counter_ns()
+        addr, command = self.labels.get(key, (None, None))
+        self.spans.append(Span(start, end - start, phase, addr, command))
+
+    def begin(self, key, phase, start=None):
+        """
+        Starts a phase of key, now or at start.
+        """
+        if start is None:
+            start = time.perf_counter_ns()
+        self.started.setdefault(key, {})[phase] = start
+
+    def end(self, key, phase, end=None):
+        """
+        Ends a phase of key, recording it if it was started.
+        """
+        start = self.started.get(key, {}).pop(phase, None)
+        if start is not None:
+            self.record(key, phase, start, end)
+
+    def switch(self, key, old, new):
+        """
+        Ends one phase of key and starts the next at the same instant.
+        """
+        now = time.perf_counter_ns()
+        self.end(key, old, now)
+        self.begin(key, new, now)
+
+    def finish(self, key):
+        """
+        Ends every phase of key still in progress, once its command is done.
+        """
+        now = time.perf_counter_ns()
+        for phase, start in self.started.pop(key, {}).items():
+            self.record(key, phase, start, now)
+
+    def abandon(self, key):
+        """
+        Drops the phases of key in progress, once its command has failed.
+        """
+        self.started.pop(key, None)
+
+    def forget(self, key):
+        """
+        Drops everything kept about key, once its connection is closed.
+        """
+        self.started.pop(key, None)
+        self.labels.pop(key, None)
+
+    def dump(self, f):
+        """
+        Writes the spans recorded so far to f as JSON lines, oldest first,
+        and empties the buffer.
+        """
+        pid = os.getpid()
+        while self.spans:
+            span = self.spans.popleft()
+            addr = f"{span.addr[0]}:{span.addr[1]}" if span.addr else None
+            f.write(json.dumps({
+                "pid": pid,
+                "start_ns": span.start,
+                "duration_us": span.duration / 1000,
+                "phase": span.phase,
+                "addr": addr,
+                "command": span.command,
+            }) + "\n")
+        f.flush()
+
+# the tracer every probe records to
+tracer = Tracer()
@@ -0,0 +1,831 @@
+import os
+import errno
+import logging
+
+from iotftp.utils import *
+from iotftp.compress import COMPRESS_BLOCKSIZE, CorruptStream
+from iotftp.digest import new_hasher
+
+logger = logging.getLogger()
+
+# whether the platform provides os.sendfile at all
+HAS_SENDFILE = hasattr(os, "sendfile")
+
+# errors from os.sendfile that mean it cannot be used for this
+# file/socket pair, and the read/send loop should be used instead
+SENDFILE_UNSUPPORTED = (
+    errno.EINVAL,
+    errno.ENOSYS,
+    errno.ENOTSOCK,
+    errno.EOPNOTSUPP,
+)
+
+class FileSender:
+    """
+    Sends a file over a nonblocking socket, picking up where it left off
+    each time the socket becomes writable.
+
+    Uses os.sendfile where available so the file contents never pass
+    through Python, and falls back to a read/send loop otherwise. Without
+    sendfile, the read/send loop is always used, so conn can be anything
+    with a socket's send().
+    """
+    def __init__(self, file, totalsize, offset=0, hasher=None, sendfile=True,
+                 blocksize=None):
+        # the file being sent
+        self.file = file
+        # total size of the file
+        self.totalsize = totalsize
+        # offset of the next byte to send
+        self.offset = offset
+        # the hash object updated with the bytes sent, if any
+        self.hasher = hasher
+        # whether to attempt sendfile, which keeps the bytes out of
+        # Python and so out of reach of the hasher
+        self.use_sendfile = sendfile and HAS_SENDFILE and hasher is None
+        # block size for the fallback read/send loop
+        self.blocksize = blocksize or get_blocksize(totalsize)
+
+    def send(self, conn):
+        """
+        Sends as much of the file as the socket will take without blocking.
+
+        Returns the number of bytes sent.
+        """
+        if self.use_sendfile:
+            try:
+                return self._sendfile(conn)
+            except BlockingIOError:
+                return 0
+            except OSError as e:
+                if e.errno not in SENDFILE_UNSUPPORTED:
+                    raise
+                logger.debug("sendfile unavailable (%s), falling back to read/send", e)
+                self.use_sendfile = False
+
+        try:
+            return self._readsend(conn)
+        except BlockingIOError:
+            return 0
+
+    def send_all(self, conn):
+        """
+        Sends the rest of the file over a blocking socket.
+        Runs on a data-plane thread.
+        """
+        if self.hasher is not None:
+            while not self.done():
+                b = os.pread(
+                    self.file.fileno(),
+                    min(self.blocksize, self.totalsize - self.offset),
+                    self.offset,
+                )
+                if not b:
+                    break
+                self.hasher.update(b)
+                conn.sendall(b)
+                self.offset += len(b)
+        else:
+            count = self.totalsize - self.offset
+            if count > 0:
+                self.offset += conn.sendfile(self.file, self.offset, count)
+        if not self.done():
+            logger.debug("sendfile hit EOF early, file truncated?")
+            self.totalsize = self.offset
+
+    def _sendfile(self, conn):
+        count = min(SENDFILE_BLOCKSIZE, self.totalsize - self.offset)
+        sent = os.sendfile(conn.fileno(), self.file.fileno(), self.offset, count)
+        if sent == 0:
+            # file was truncated underneath us, nothing more to send
+            logger.debug("sendfile hit EOF early, file truncated?")
+            self.totalsize = self.offset
+        self.offset += sent
+        return sent
+
+    def _readsend(self, conn):
+        # positional reads, as the ranges of a split transfer share the
+        # file position
+        b = os.pread(
+            self.file.fileno(), min(self.blocksize, self.totalsize - self.offset), self.offset
+        )
+        if not b:
+            self.totalsize = self.offset
+            return 0
+        sent = conn.send(b)
+        if self.hasher is not None:
+            # the rest is read again on the next send
+            with memoryview(b) as view:
+                self.hasher.update(view[:sent])
+        self.offset += sent
+        return sent
+
+    def ready(self):
+        return True
+
+    def done(self):
+        return self.offset >= self.totalsize
+
+    def close(self):
+        self.file.close()
+
+class CompressedSender:
+    """
+    Sends a file through a streaming compressor over a nonblocking socket,
+    until the compressed stream ends.
+
+    By default blocks are read and compressed inline. Once offload() is
+    called, they are instead read and compressed on an FsExecutor, with the
+    next block prepared while the current one is being sent.
+    """
+    def __init__(self, file, totalsize, encoder, offset=0, hasher=None):
+        # the file being sent
+        self.file = file
+        # total size of the file
+        self.totalsize = totalsize
+        # the compressor the file is streamed through
+        self.encoder = encoder
+        # the hash object updated with the file as it is read, if any
+        self.hasher = hasher
+        # offset of the next byte to read from the file
+        self.offset = offset
+        # whether the compressor has been flushed
+        self.flushed = False
+        # compressed data not yet sent
+        self.out = memoryview(b"")
+        # number of compressed bytes sent
+        self.sent = 0
+        # the executor to compress on, the connection to wake up
+        # when a block is ready, and the block in progress
+        self.fs = None
+        self.wakeconn = None
+        self.pending = None
+
+    def offload(self, fs, conn):
+        """
+        Compresses blocks on fs from now on, waking conn up as each is ready.
+        """
+        self.fs = fs
+        self.wakeconn = conn
+        self.pending = fs.submit(conn, self.produce)
+
+    def produce(self):
+        """
+        Reads and compresses blocks until the compressor has output, and
+        returns it. Returns an empty bytes once the stream has ended.
+        """
+        while not self.flushed:
+            b = b""
+            if self.offset < self.totalsize:
+                b = os.pread(
+                    self.file.fileno(),
+                    min(COMPRESS_BLOCKSIZE, self.totalsize - self.offset),
+                    self.offset,
+                )
+            if b:
+                self.offset += len(b)
+                if self.hasher is not None:
+                    self.hasher.update(b)
+                out = self.encoder.compress(b)
+            else:
+                # end of the file, or the file was truncated underneath us
+                out = self.encoder.flush()
+                self.flushed = True
+            if out:
+                return out
+        return b""
+
+    def send(self, conn):
+        """
+        Sends as much of the compressed stream as the socket will take
+        without blocking.
+
+        Returns the number of bytes sent.
+        """
+        if not self.out:
+            if self.fs is None:
+                self.out = memoryview(self.produce())
+            elif self.pending is None or not self.pending.done():
+                return 0
+            else:
+                try:
+                    self.out = memoryview(self.pending.result())
+                finally:
+                    self.pending = None
+                if not self.flushed:
+                    # compress the next block while this one is sent
+                    self.pending = self.fs.submit(self.wakeconn, self.produce)
+
+        try:
+            n = conn.send(self.out)
+        except BlockingIOError:
+            return 0
+        self.out = self.out[n:]
+        self.sent += n
+        return n
+
+    def send_all(self, conn):
+        """
+        Sends the rest of the compressed stream over a blocking socket.
+        Runs on a data-plane thread.
+        """
+        while (out := self.produce()):
+            conn.sendall(out)
+            self.sent += len(out)
+
+    def ready(self):
+        """
+        Whether there is compressed data to send without waiting on a block.
+        """
+        return bool(self.out) or self.pending is None or self.pending.done()
+
+    def done(self):
+        return self.flushed and not self.out and self.pending is None
+
+    def close(self):
+        if self.pending is not None:
+            # the file must not be closed under a block in progress
+            self.pending.add_done_callback(lambda _: self.file.close())
+        else:
+            self.file.close()
+
+class BufferPool:
+    """
+    A pool of preallocated receive buffers shared between transfers,
+    so that receiving does not allocate a new bytes object per read.
+    """
+    def __init__(self, bufsize=RECV_BUFSIZE, maxfree=BUFPOOL_MAXFREE):
+        # size of each buffer in the pool
+        self.bufsize = bufsize
+        # maximum number of idle buffers kept around
+        self.maxfree = maxfree
+        # buffers not currently in use by a transfer
+        self.free = []
+
+    def acquire(self):
+        """
+        Takes a buffer from the pool, allocating one if none are free.
+        """
+        if self.free:
+            return self.free.pop()
+        return bytearray(self.bufsize)
+
+    def release(self, buf):
+        """
+        Returns a buffer to the pool.
+        """
+        if len(self.free) < self.maxfree:
+            self.free.append(buf)
+
+class FileReceiver:
+    """
+    Receives a file from a nonblocking socket with recv_into, filling
+    a pooled buffer and flushing it to the file only once it is full.
+
+    By default flushes are written out inline, and each transfer holds at
+    most one buffer from the pool. Once offload() is called, full buffers
+    are instead written out on an FsExecutor while receiving carries on
+    into a fresh buffer, with at most MAX_INFLIGHT_FLUSHES in flight.
+
+    Given a decoder, the data received is a compressed stream that runs
+    until the sender closes its side of the connection, and is decompressed
+    as it is flushed. Flushes are then written out one at a time, in order.
+
+    Given an offset, the file already holds everything before it, and only
+    the rest is received. If the transfer is cut short, the file is truncated
+    on close to the data written out so far, so it can be resumed from there,
+    unless truncate is False.
+    """
+    def __init__(self, file, totalsize, pool, decoder=None, offset=0, truncate=True,
+                 hasher=None):
+        # the file being written to
+        self.file = file
+        # total number of bytes expected
+        self.totalsize = totalsize
+        # the pool the receive buffer is taken from
+        self.pool = pool
+        # the current receive buffer, taken on first receive
+        self.buf = None
+        self.view = None
+        # number of bytes in the buffer not yet flushed
+        self.filled = 0
+        # number of bytes received, counting from the start of the file
+        self.received = offset
+        # offset in the file the next flush is written to
+        self.written = offset
+        # end of the data known to be written out, with no gaps before it
+        self.stored = offset
+        # whether to truncate an incomplete file to stored on close
+        self.truncate = truncate
+        # the executor to write out flushes on, and the connection
+        # to wake up when they complete
+        self.fs = None
+        self.wakeconn = None
+        # flushes in progress on the executor, oldest first
+        self.flushes = []
+        # the first error raised by an offloaded flush
+        self.error = None
+        # the decompressor for a compressed stream, whether the sender
+        # has ended the stream, and the number of bytes decompressed
+        self.decoder = decoder
+        self.eof = False
+        self.decoded = offset
+        # the hash object updated with the file as it is written, if any
+        self.hasher = hasher
+
+    def offload(self, fs, conn):
+        """
+        Writes out flushes on fs from now on, waking conn up as each completes.
+        """
+        self.fs = fs
+        self.wakeconn = conn
+
+    def preallocate(self):
+        """
+        Reserves space for the whole file up front, so the filesystem
+        does not have to extend it on every flush.
+        """
+        preallocate(self.file.fileno(), self.totalsize)
+
+    def recv(self, conn):
+        """
+        Receives as much as the socket has available without blocking.
+
+        Returns the number of bytes received.
+        """
+        try:
+            n = conn.recv_into(self.window())
+        except BlockingIOError:
+            return 0
+        if not n:
+            self.end()
+            return 0
+
+        self.commit(n)
+        return n
+
+    def recv_all(self, conn):
+        """
+        Receives the rest of the file from a blocking socket.
+        Runs on a data-plane thread.
+        """
+        while not self.done():
+            n = conn.recv_into(self.window())
+            if not n:
+                self.end()
+                continue
+            self.commit(n)
+
+    def feed(self, data):
+        """
+        Takes bytes that were already read off the socket, as many as
+        the file still needs. Returns the number of bytes taken.
+        """
+        taken = 0
+        with memoryview(data) as view:
+            while taken < len(view) and not self.done():
+                win = self.window()
+                n = min(len(win), len(view) - taken)
+                win[:n] = view[taken:taken + n]
+                self.commit(n)
+                taken += n
+        return taken
+
+    def window(self):
+        """
+        Returns the part of the buffer the next receive should go into.
+        """
+        if self.buf is None:
+            self.buf = self.pool.acquire()
+            self.view = memoryview(self.buf)
+
+        want = len(self.buf) - self.filled
+        if self.decoder is None:
+            want = min(want, self.totalsize - self.received)
+        return self.view[self.filled:self.filled + want]
+
+    def commit(self, n):
+        """
+        Records n bytes as received into the window, flushing
+        the buffer if it is full or the file is complete.
+        """
+        self.filled += n
+        self.received += n
+
+        if self.filled == len(self.buf) or self.done():
+            self.flush()
+
+    def end(self):
+        """
+        Records the sender closing its side of the connection, which only
+        ends a compressed stream. Raises ConnClosedErr otherwise.
+        """
+        if self.decoder is None:
+            raise ConnClosedErr()
+        self.eof = True
+        self.flush()
+
+    def flush(self):
+        """
+        Writes out everything in the buffer.
+        """
+        if not self.filled:
+            return
+
+        if self.hasher is not None and self.decoder is None:
+            # hashed here, in order, as offloaded flushes may be written
+            # out in any order
+            self.hasher.update(self.view[:self.filled])
+
+        if self.fs is None:
+            self.stored = self._store(self.view[:self.filled], self.written)
+        else:
+            # hand the whole buffer over, and receive into a new one
+            self.view.release()
+            self.flushes.append(self.fs.submit(
+                self.wakeconn, self._write, self.buf, self.filled, self.written
+            ))
+            self.buf = self.view = None
+
+        self.written += self.filled
+        self.filled = 0
+
+    def _write(self, buf, n, offset):
+        # runs on the executor
+        with memoryview(buf) as view:
+            end = self._store(view[:n], offset)
+        return buf, end
+
+    def _store(self, data, offset):
+        # writes data out at offset, returning the offset just after it
+        if self.decoder is not None:
+            # compressed streams are flushed in order, so the decompressed
+            # data always goes right after what came before
+            data = self.decoder.decompress(data)
+            if self.hasher is not None:
+                self.hasher.update(data)
+            offset = self.decoded
+            self.decoded += len(data)
+            if self.decoded > self.totalsize:
+                raise CorruptStream("compressed stream longer than declared")
+        write_at(self.file.fileno(), data, offset)
+        return offset + len(data)
+
+    def reap(self):
+        """
+        Returns the buffers of completed flushes to the pool.
+        """
+        while self.flushes and self.flushes[0].done():
+            fut = self.flushes.pop(0)
+            if fut.exception() is not None:
+                self.error = self.error or fut.exception()
+                continue
+            buf, end = fut.result()
+            if self.error is None:
+                self.stored = end
+            self.pool.release(buf)
+
+    def ready(self):
+        """
+        Whether there is room to receive more without waiting on flushes.
+        """
+        self.reap()
+        limit = MAX_INFLIGHT_FLUSHES if self.decoder is None else 1
+        return len(self.flushes) < limit
+
+    def done(self):
+        """
+        Whether every byte has been received.
+        """
+        if self.decoder is not None:
+            return self.eof
+        return self.received >= self.totalsize
+
+    def finished(self):
+        """
+        Whether every byte has been received and written out.
+        """
+        self.reap()
+        return self.done() and not self.filled and not self.flushes
+
+    def verify(self):
+        """
+        Raises CorruptStream if a finished compressed stream did not
+        decompress to exactly the declared size.
+        """
+        if self.decoder is None:
+            return
+        if not self.decoder.eof:
+            raise CorruptStream("compressed stream ended early")
+        if self.decoded != self.totalsize:
+            raise CorruptStream(
+                f"compressed stream decoded to {self.decoded} bytes, expected {self.totalsize}"
+            )
+
+    def close(self):
+        """
+        Flushes any received data, waits for flushes in progress, returns
+        the buffers to the pool and closes the file, truncating an incomplete
+        file to the data written out. Safe to call more than once.
+        """
+        if self.buf is not None:
+            fs, self.fs = self.fs, None
+            try:
+                self.flush()
+            except OSError as e:
+                logger.debug("Could not flush received data: %s", e)
+            self.fs = fs
+            self.view.release()
+            self.pool.release(self.buf)
+            self.buf = self.view = None
+
+        for fut in self.flushes:
+            # the file must not be closed under a flush in progress
+            fut.exception()
+        self.reap()
+
+        if self.truncate and not self.file.closed and self.stored < self.totalsize:
+            # drop the preallocated space past the last good byte
+            try:
+                os.ftruncate(self.file.fileno(), self.stored)
+            except OSError as e:
+                logger.debug("Could not truncate incomplete file: %s", e)
+        self.file.close()
+
+class RangeSender:
+    """
+    Sends one range of a file over its own data connection, for a transfer
+    split across several. The range is preceded by a header giving its
+    offset and length.
+    """
+    def __init__(self, file, offset, length, delim, encoding, hasher=None):
+        # the header not yet sent
+        self.header = memoryview(pack_range(offset, length, delim, encoding))
+        # the hash object updated with the range as it is sent, if any
+        self.hasher = hasher
+        # the transfer engine sending the range
+        self.sender = FileSender(file, offset + length, offset, hasher)
+        # the data-plane job sending the range, if any
+        self.pending = None
+
+    def send(self, conn):
+        """
+        Sends as much of the header and range as the socket will take
+        without blocking. Returns the number of bytes sent.
+        """
+        sent = 0
+        if self.header:
+            try:
+                sent = conn.send(self.header)
+            except BlockingIOError:
+                return 0
+            self.header = self.header[sent:]
+            if self.header:
+                return sent
+        return sent + self.sender.send(conn)
+
+    def send_all(self, conn):
+        """
+        Sends the rest of the header and range over a blocking socket.
+        Runs on a data-plane thread.
+        """
+        conn.sendall(self.header)
+        self.header = self.header[len(self.header):]
+        self.sender.send_all(conn)
+
+    def ready(self):
+        return self.pending is None or self.pending.done()
+
+    def done(self):
+        return not self.header and self.sender.done()
+
+    def close(self):
+        if self.pending is not None:
+            # the file must not be closed under a data-plane thread
+            self.pending.add_done_callback(lambda _: self.sender.close())
+        else:
+            self.sender.close()
+
+class RangeReceiver:
+    """
+    Receives one range of a file over its own data connection, for a
+    transfer split across several. The range is read from the header
+    preceding it, and must be one of those the transfer still expects.
+    """
+    def __init__(self, file, pool, expected, delim, digest=None):
+        # the file being written to, closed along with the receiver
+        self.file = file
+        # the pool receive buffers are taken from
+        self.pool = pool
+        # the ranges of the transfer not yet claimed by a connection,
+        # mapped to their index, shared with the other receivers
+        self.expected = expected
+        self.delim = delim
+        # the part of the header read so far
+        self.inbuf = bytearray()
+        # the index of the range claimed, once the header is read
+        self.index = None
+        # the digest algorithm to hash the range with, if any, and
+        # the hash object, once the range has started
+        self.digest = digest
+        self.hasher = None
+        # the transfer engine receiving the range, once the header is read
+        self.receiver = None
+        # the executor to write out flushes on, and the connection
+        # to wake up when they complete
+        self.fs = None
+        self.wakeconn = None
+        # the data-plane job receiving the range, if any
+        self.pending = None
+
+    def offload(self, fs, conn):
+        """
+        Writes out flushes on fs, waking conn up as each completes.
+        """
+        self.fs = fs
+        self.wakeconn = conn
+
+    def recv(self, conn):
+        """
+        Receives as much as the socket has available without blocking.
+        Raises ValueError if the header is malformed or not expected.
+
+        Returns the number of bytes received.
+        """
+        if self.receiver is not None:
+            return self.receiver.recv(conn)
+
+        try:
+            b = conn.recv(MAX_RANGE_HEADER)
+        except BlockingIOError:
+            return 0
+        if not b:
+            raise ConnClosedErr()
+        self.feed_header(b)
+        return len(b)
+
+    def recv_all(self, conn):
+        """
+        Receives the header and the whole range from a blocking socket.
+        Runs on a data-plane thread.
+        """
+        while self.receiver is None:
+            b = conn.recv(MAX_RANGE_HEADER)
+            if not b:
+                raise ConnClosedErr()
+            self.feed_header(b)
+        self.receiver.recv_all(conn)
+
+    def feed_header(self, data):
+        """
+        Takes bytes read off the socket before the range has been claimed.
+        """
+        self.inbuf += data
+        self.start()
+
+    def start(self):
+        """
+        Claims the range once its whole header has been read, and hands
+        anything read past the header to the receiver.
+        """
+        header = take_header(self.inbuf, self.delim)
+        if header is None:
+            if len(self.inbuf) >= MAX_RANGE_HEADER:
+                raise ValueError("range header too long")
+            return
+
+        offset, length = parse_range(header, self.delim)
+        self.index = self.expected.pop((offset, length), None)
+        if self.index is None:
+            raise ValueError(f"unexpected range {offset}+{length}")
+
+        if self.digest is not None:
+            self.hasher = new_hasher(self.digest)
+        self.receiver = FileReceiver(
+            self.file, offset + length, self.pool, offset=offset, truncate=False,
+            hasher=self.hasher,
+        )
+        if self.fs is not None:
+            self.receiver.offload(self.fs, self.wakeconn)
+        if self.receiver.feed(self.inbuf) != len(self.inbuf):
+            raise ValueError("more data than the range holds")
+        self.inbuf = None
+
+    def ready(self):
+        if self.pending is not None:
+            return self.pending.done()
+        return self.receiver is None or self.receiver.ready()
+
+    def done(self):
+        return self.receiver is not None and self.receiver.done()
+
+    def finished(self):
+        return self.receiver is not None and self.receiver.finished()
+
+    def error(self):
+        return self.receiver.error if self.receiver is not None else None
+
+    def stored(self):
+        """
+        Returns the index of the range and the end of the data written out
+        in it, or None if no range has been claimed.
+        """
+        if self.receiver is None:
+            return None
+        return self.index, self.receiver.stored
+
+    def close(self):
+        if self.receiver is not None:
+            self.receiver.close()
+        else:
+            self.file.close()
+
+def split_ranges(start, end, count):
+    """
+    Splits the bytes from start to end into at most count contiguous ranges
+    of at least MIN_RANGE_SIZE bytes, returned in order as (offset, length).
+    There is always at least one range, which may be empty.
+    """
+    count = max(1, min(count, (end - start) // MIN_RANGE_SIZE))
+    step, extra = divmod(end - start, count)
+
+    ranges, offset = [], start
+    for i in range(count):
+        length = step + (1 if i < extra else 0)
+        ranges.append((offset, length))
+        offset += length
+    return ranges
+
+def received_prefix(ranges, stored):
+    """
+    Returns the end of the data written out with no gaps from the start of
+    ranges, given the end of the data written out in each range by index.
+    """
+    for i, (offset, length) in enumerate(ranges):
+        end = stored.get(i, offset)
+        if end < offset + length:
+            return end
+    return ranges[-1][0] + ranges[-1][1]
+
+def pack_range(offset, length, delim, encoding):
+    """
+    Builds the header sent before each range of a split transfer.
+    """
+    return delim.join([
+        bytes(str(offset), encoding),
+        bytes(str(length), encoding),
+    ]) + delim
+
+def parse_range(header, delim):
+    """
+    Parses the offset and length out of the header of a range.
+    Raises ValueError if it is malformed.
+    """
+    offset, length = (int(field) for field in header.split(delim))
+    if offset < 0 or length < 0:
+        raise ValueError("invalid range")
+    return offset, length
+
+def reopen(file, mode):
+    """
+    Opens another file object on the same open file, so each range of a
+    split transfer can be closed on its own. The file position is shared,
+    so ranges are only ever read and written at explicit offsets.
+    """
+    return os.fdopen(os.dup(file.fileno()), mode, buffering=0)
+
+def take_header(buf, delim):
+    """
+    Removes a header of two fields, each followed by delim, from buf and
+    returns it, or returns None if buf does not hold a whole header yet.
+    """
+    first = buf.find(delim)
+    if first < 0:
+        return None
+    end = buf.find(delim, first + len(delim))
+    if end < 0:
+        return None
+    header = bytes(buf[:end])
+    del buf[:end + len(delim)]
+    return header
+
+def preallocate(fd, size):
+    """
+    Reserves size bytes for the file open at fd.
+    """
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # not supported by the platform or the filesystem
+        os.ftruncate(fd, size)
+
+def write_at(fd, data, offset):
+    """
+    Writes all of data to fd at offset.
+    """
+    while data:
+        n = os.pwrite(fd, data, offset)
+        data = data[n:]
+        offset += n
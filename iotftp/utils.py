@@ -1,9 +1,14 @@
+import os
+import pwd
 import selectors
 import logging
+from socket import SHUT_RDWR
 from enum import Enum
 import netifaces as ni
 
 from iotftp.cmds import BaseCommandHandler
+from iotftp.compress import CODECS
+from iotftp.digest import DIGESTS
 
 RWMASK = selectors.EVENT_READ | selectors.EVENT_WRITE
 
@@ -14,17 +19,204 @@ RES_OK   = b"200 AIGT"
 
 DEF_BLOCKSIZE = 1024
 
+# maximum number of bytes handed to a single sendfile call
+SENDFILE_BLOCKSIZE = 1 << 20
+
+# size of the pooled buffers used to receive files
+RECV_BUFSIZE = 1 << 18
+# maximum number of idle receive buffers kept by a pool
+BUFPOOL_MAXFREE = 64
+# maximum number of buffers a transfer can have being written out at once
+MAX_INFLIGHT_FLUSHES = 2
+
+# number of threads running blocking filesystem work
+DEF_FS_WORKERS = 4
+# seconds a data-plane thread waits on a stalled data connection
+DATA_TIMEOUT = 120
+
 DELIMITER = b"\n"
 
+# longest command accepted from a client
+MAX_COMMAND = 512
+# longest per-file header accepted in a multi-file transfer
+MAX_HEADER = 8192
+# longest range header accepted on a data connection of a split transfer
+MAX_RANGE_HEADER = 64
+# longest final reply read by the client, which may carry digests
+MAX_REPLY = 4096
+
+# number of data ports the server keeps bound and listening
+DEF_DATAPORTS = 16
+
+# seconds a client has to connect to a data port before the transfer is dropped
+DATA_ACCEPT_TIMEOUT = 10
+# times a client tries the data port of an older server, which only starts
+# listening once the port is acknowledged, and seconds between the tries
+DATA_CONNECT_TRIES = 5
+DATA_CONNECT_WAIT = 0.5
+
+# most data connections a single transfer can be split across
+DEF_MAX_STREAMS = 8
+# smallest byte range worth giving its own data connection
+MIN_RANGE_SIZE = 1 << 20
+# version of the block signatures and ops of a delta upload
+DELTA_VERSION = 1
+# version of the lines SYNC sends for the files changed
+SYNC_VERSION = 1
+
 VERSION = "0.1.0"
+# version of the framed protocol, offered in the welcome alongside VERSION
+FRAMED_VERSION = "2"
+# most bytes of a transfer multiplexed onto a framed main connection that
+# can be sent ahead of the receiver granting more credit
+MUX_WINDOW = 1 << 20
+# largest data frame of a multiplexed transfer
+MUX_CHUNK = 1 << 16
+# largest transfer the server multiplexes onto the main connection, by
+# default; bigger ones get a data connection of their own, as the cost of
+# making it is small next to theirs, and a multiplexed transfer holds up
+# the commands pipelined behind it
+DEF_MUX_SIZE = 1 << 18
+# largest file sent inline with a GET reply or a PUT command, by default,
+# instead of over a data connection
+DEF_INLINE_SIZE = 1 << 16
 
 logger = logging.getLogger()
 
-def start_fn(name):
-    logger.debug(f"========START {name}========")
+def shutdown(conn):
+    """
+    Shuts a connection down in both directions, waking up any thread
+    blocked on it. The connection still has to be closed.
+    """
+    try:
+        conn.shutdown(SHUT_RDWR)
+    except OSError:
+        # already closed or never connected
+        pass
+
+def login_name():
+    """
+    Returns the name of the user serving, which os.getlogin() cannot tell
+    when the server runs without a controlling terminal, as under a
+    service manager.
+    """
+    try:
+        return os.getlogin()
+    except OSError:
+        return pwd.getpwuid(os.geteuid()).pw_name
+
+def parse_opts(fields):
+    """
+    Parses the KEY=VALUE options following the arguments of a command
+    or reply into a dict. Raises ValueError if a field is not an option.
+    """
+    opts = {}
+    for field in fields:
+        key, sep, value = field.partition("=")
+        if not sep or not key:
+            raise ValueError(f"invalid option {field!r}")
+        opts[key] = value
+    return opts
+
+def parse_offset(opts):
+    """
+    Returns the offset a transfer resumes from, given in its OFF option,
+    or None if it is not being resumed. Raises ValueError if it is invalid.
+    """
+    if "OFF" not in opts:
+        return None
+    offset = int(opts["OFF"])
+    if offset < 0:
+        raise ValueError(f"negative offset {offset}")
+    return offset
+
+def parse_streams(opts):
+    """
+    Returns the number of data connections asked for in a transfer's
+    STREAMS option, 1 if not given. Raises ValueError if it is invalid.
+    """
+    streams = int(opts.get("STREAMS", 1))
+    if streams < 1:
+        raise ValueError(f"invalid stream count {streams}")
+    return streams
 
-def end_fn(name):
-    logger.debug(f"======== END  {name}========")
+def parse_mux(opts):
+    """
+    Returns the window asked for in a transfer's MUX option, capped at
+    MUX_WINDOW, or None if it is not to be multiplexed onto the main
+    connection. Raises ValueError if it is invalid.
+    """
+    if "MUX" not in opts:
+        return None
+    window = int(opts["MUX"])
+    if window < 1:
+        raise ValueError(f"invalid window {window}")
+    return min(window, MUX_WINDOW)
+
+def parse_inline(opts):
+    """
+    Returns the largest file the client takes inline, given in a GET's
+    INLINE option, or None if it does not take files inline. Raises
+    ValueError if it is invalid.
+    """
+    if "INLINE" not in opts:
+        return None
+    size = int(opts["INLINE"])
+    if size < 0:
+        raise ValueError(f"invalid inline size {size}")
+    return size
+
+def pack_inline(fields, body, delim):
+    """
+    Joins the fields of a command or reply and the file it carries
+    inline, which follows them after an empty field.
+    """
+    return delim.join(fields + [b""]) + delim + body
+
+def split_inline(msg, delim):
+    """
+    Splits a command or reply into its fields and the file it carries
+    inline, None if it carries none.
+    """
+    fields, sep, body = msg.partition(delim + delim)
+    return fields, body if sep else None
+
+def resolve(cwd, path):
+    """
+    Returns path made absolute against a connection's working directory.
+    """
+    return os.path.normpath(os.path.join(cwd, path))
+
+def format_opts(opts):
+    return [f"{key}={value}" for key, value in opts.items()]
+
+def server_features(maxstreams, store=None, index=None, inlinesize=0):
+    """
+    Returns the optional features the server supports, as advertised
+    in its welcome message.
+    """
+    features = {
+        # compression codecs, most preferred first
+        "Z": ",".join(CODECS),
+        # digest algorithms, most preferred first
+        "H": ",".join(DIGESTS),
+        # most data connections a transfer can be split across
+        "STREAMS": str(maxstreams),
+        # version of the delta format DPUT uses
+        "DELTA": str(DELTA_VERSION),
+        # largest window of a transfer multiplexed onto a framed main connection
+        "MUX": str(MUX_WINDOW),
+    }
+    if store is not None:
+        # the digest algorithm uploads can be offered by
+        features["CAS"] = store.algorithm
+    if index is not None:
+        # version of the changes SYNC sends
+        features["SYNC"] = str(SYNC_VERSION)
+    if inlinesize > 0:
+        # largest file sent inline with a GET reply or a PUT command
+        features["INLINE"] = str(inlinesize)
+    return features
 
 def get_blocksize(size):
     if size < 4096:
@@ -83,6 +275,18 @@ class ConnState(Enum):
     CWD = 6
     # running a bye command
     BYE = 7
+    # running an mget command
+    MGET = 8
+    # running an mput command
+    MPUT = 9
+    # running a tget command
+    TGET = 10
+    # running a size command
+    SIZE = 11
+    # running a dput command
+    DPUT = 13
+    # running a sync command
+    SYNC = 14
     # error running command, response to be sent
     E301 = CommandError.ERR_PERM
     E302 = CommandError.ERR_NONE
@@ -151,6 +355,12 @@ class ConnData:
         self.cmd = []
         # the handler for the command being run (if any)
         self.handler = handler
+        # for a data connection carrying one range of a transfer split
+        # across several, the state of that range
+        self.stream = None
+        # for a command connection, the working directory the paths
+        # in its commands are relative to, kept across commands
+        self.cwd = None
 
     def reset(self):
         self.state = ConnState.NON
@@ -160,12 +370,38 @@ class ConnData:
     def is_subconn(self):
         return self.type == ConnType.TRANSFER
 
+class ClientTracker:
+    """
+    Counts the clients connected to a server, and tracks whether
+    a client has asked the server to exit.
+    """
+    def __init__(self):
+        self.active = 0
+        self.closing = False
+
+    def connect(self):
+        self.active += 1
+        return self.active
+
+    def disconnect(self):
+        self.active -= 1
+        return self.active
+
+    def count(self):
+        return self.active
+
+    def request_close(self):
+        self.closing = True
+
+    def close_requested(self):
+        return self.closing
+
 class ServerParams:
     """
     Various params about the server.
     """
 
-    def __init__(self, host, port, cwd, user, euid, active, delim, encoding):
+    def __init__(self, host, port, cwd, user, euid, active, delim, encoding, bufpool, ports, fs, dataplane, maxstreams, store, listings, index, inlinesize, muxsize):
         self.host = host
         self.port = port
         self.cwd = cwd
@@ -174,6 +410,26 @@ class ServerParams:
         self.active = active
         self.delim = delim
         self.encoding = encoding
+        # the pool of buffers to receive file data into
+        self.bufpool = bufpool
+        # the pool of data ports to lease for transfers
+        self.ports = ports
+        # the executor to run blocking filesystem work on
+        self.fs = fs
+        # the executor to run transfer bodies on, if data-plane mode is on
+        self.dataplane = dataplane
+        # most data connections a transfer can be split across
+        self.maxstreams = maxstreams
+        # the content store uploads are deduplicated against, if any
+        self.store = store
+        # the cache of directory listings
+        self.listings = listings
+        # the index of the files under cwd that SYNC answers from, if any
+        self.index = index
+        # largest file sent inline with a GET reply or a PUT command, 0 if none are
+        self.inlinesize = inlinesize
+        # largest transfer multiplexed onto the main connection
+        self.muxsize = muxsize
 
 
 class RW(Enum):
@@ -189,6 +445,9 @@ class HandlerResult(Enum):
     NEWCONN = 2
     # received new connection to receive/send data, replace existing conn
     REPLACE = 3
+    # received another connection to receive/send data alongside the
+    # existing ones, add it to the pool
+    ATTACH = 4
     # error in handling, send error and close connection
     E301 = CommandError.ERR_PERM
     E302 = CommandError.ERR_NONE
@@ -0,0 +1,114 @@
+import os
+import signal
+import logging
+import multiprocessing
+
+logger = logging.getLogger()
+
+class SharedClientTracker:
+    """
+    A ClientTracker shared between worker processes, so the client count
+    and BYE requests cover the whole server rather than a single worker.
+
+    Must be created before the workers are forked.
+    """
+    def __init__(self):
+        self.active = multiprocessing.Value("i", 0)
+        self.closing = multiprocessing.Event()
+
+    def connect(self):
+        with self.active.get_lock():
+            self.active.value += 1
+            return self.active.value
+
+    def disconnect(self):
+        with self.active.get_lock():
+            self.active.value -= 1
+            return self.active.value
+
+    def count(self):
+        return self.active.value
+
+    def request_close(self):
+        self.closing.set()
+
+    def close_requested(self):
+        return self.closing.is_set()
+
+class WorkerPool:
+    """
+    Runs a server as several forked worker processes, each running its own
+    event loop on a SO_REUSEPORT listener bound to the same port.
+
+    factory is called in each worker with the shared client tracker, and
+    must return a server created with reuseport=True.
+
+    The whole pool exits as soon as any worker does, which is normally the
+    worker that saw the last client leave after a BYE.
+    """
+    def __init__(self, factory, count):
+        # creates the server run by each worker
+        self.factory = factory
+        # number of workers to run
+        self.count = count
+        # client count and BYE state shared by all workers
+        self.clients = SharedClientTracker()
+        # process ids of the running workers
+        self.pids = set()
+
+    def start(self):
+        for _ in range(self.count):
+            self.spawn()
+        logger.debug("[*] Started %s workers", self.count)
+
+    def run(self):
+        """
+        Waits for a worker to exit, then stops the rest.
+        """
+        while self.pids:
+            pid, status = os.wait()
+            if pid not in self.pids:
+                continue
+            self.pids.discard(pid)
+
+            if not self.clients.close_requested():
+                logger.warning(f"[!] Worker {pid} exited unexpectedly ({status})")
+            break
+        self.stop()
+
+    def stop(self):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self.pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.pids.clear()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            # in the worker, never return into the caller's code
+            code = 1
+            try:
+                self.work()
+                code = 0
+            except KeyboardInterrupt:
+                code = 0
+            except Exception as e:
+                logger.error(f"[ERR] Worker failed: {e!r}")
+            finally:
+                os._exit(code)
+        self.pids.add(pid)
+
+    def work(self):
+        server = self.factory(self.clients)
+        server.start()
+        try:
+            server.run()
+        finally:
+            server.stop()
@@ -1,23 +1,118 @@
+import os
 import sys
+import signal
 import logging
+import argparse
 
-from iotftp import IoTFTPServer, InvalidIPException
+from iotftp import (
+    IoTFTPServer, IoTFTPAsyncServer, WorkerPool, ContentStore, FileIndex,
+    InvalidIPException, DEF_DATAPORTS, DEF_FS_WORKERS, DEF_MAX_STREAMS, DEF_STORE_SIZE,
+    DEF_INLINE_SIZE, DEF_MUX_SIZE, tracer, validate_ip,
+)
+
+ENGINES = {
+    "selectors": IoTFTPServer,
+    "asyncio": IoTFTPAsyncServer,
+}
 
 logger = logging.getLogger()
 logger.setLevel(logging.WARN)
 handler = logging.StreamHandler()
 logger.addHandler(handler)
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="IoTFTP server")
+    parser.add_argument("ipaddr", help="address to listen on")
+    parser.add_argument("port", type=int, help="port to listen on")
+    parser.add_argument("-v", "--verbose", action="store_true",
+        help="enable debug logging")
+    parser.add_argument("--dataports", type=int, default=DEF_DATAPORTS,
+        help="number of data ports to keep bound for transfers")
+    parser.add_argument("--fs-threads", type=int, default=DEF_FS_WORKERS,
+        help="number of threads running blocking filesystem work")
+    parser.add_argument("--data-threads", type=int, default=0,
+        help="run transfer bodies on this many dedicated threads (default: off)")
+    parser.add_argument("--max-streams", type=int, default=DEF_MAX_STREAMS,
+        help="most data connections a single transfer can be split across")
+    parser.add_argument("--inline-size", type=int, default=DEF_INLINE_SIZE,
+        help="largest file sent inline with a GET reply or a PUT command, 0 to turn off")
+    parser.add_argument("--mux-size", type=int, default=DEF_MUX_SIZE,
+        help="largest GET or PUT sent on the main connection of a framed session rather than a data connection")
+    parser.add_argument("--store", metavar="DIR",
+        help="keep uploaded files in a content store here, so repeated uploads are not sent (default: off)")
+    parser.add_argument("--store-size", type=int, default=DEF_STORE_SIZE,
+        help="most bytes the content store keeps before evicting the least recently used")
+    parser.add_argument("--store-hardlink", action="store_true",
+        help="hard link files to the content store instead of copying them")
+    parser.add_argument("--index", metavar="FILE",
+        help="keep an index of the files served in FILE, so clients can sync only what changed (default: off)")
+    parser.add_argument("--trace", type=int, default=0, metavar="SPANS",
+        help="time every phase of each command, keeping the last SPANS to dump on SIGUSR1 and at exit (default: off)")
+    parser.add_argument("--trace-file", metavar="FILE",
+        help="append the phases dumped to FILE as JSON lines (default: stderr)")
+    parser.add_argument("--engine", choices=ENGINES, default="selectors",
+        help="the server implementation to run")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+        help="number of worker processes sharing the port (default: CPU count)")
+    return parser.parse_args()
+
+def make_store(args):
+    if args.store is None:
+        return None
+    return ContentStore(args.store, args.store_size, hardlink=args.store_hardlink)
+
+def make_index(args):
+    if args.index is None:
+        return None
+    return FileIndex(os.getcwd(), args.index)
+
+def dump_trace(args):
+    if args.trace_file is None:
+        tracer.dump(sys.stderr)
+        return
+    with open(args.trace_file, "a") as f:
+        tracer.dump(f)
+
+def make_server(args):
+    engine = ENGINES[args.engine]
+
+    if args.workers <= 1:
+        return engine(
+            args.ipaddr, args.port, 'ascii', dataports=args.dataports,
+            fsworkers=args.fs_threads, datathreads=args.data_threads,
+            maxstreams=args.max_streams, store=make_store(args),
+            index=make_index(args), inlinesize=args.inline_size,
+            muxsize=args.mux_size,
+        )
+
+    if not validate_ip(args.ipaddr):
+        raise InvalidIPException()
+
+    def factory(clients):
+        return engine(
+            args.ipaddr, args.port, 'ascii', dataports=args.dataports,
+            reuseport=True, clients=clients, fsworkers=args.fs_threads,
+            datathreads=args.data_threads, maxstreams=args.max_streams,
+            store=make_store(args), index=make_index(args),
+            inlinesize=args.inline_size, muxsize=args.mux_size,
+        )
+    return WorkerPool(factory, args.workers)
+
 def main():
-    ipaddr, port = sys.argv[1], int(sys.argv[2])
+    args = parse_args()
 
-    if len(sys.argv) > 3 and sys.argv[3] == "-v":
+    if args.verbose:
         logger.setLevel(logging.DEBUG)
-    
+    if args.trace > 0:
+        # set before the workers are forked, so each dumps its own
+        tracer.enable(args.trace)
+        signal.signal(signal.SIGUSR1, lambda *_: dump_trace(args))
+
     try:
-        server = IoTFTPServer(ipaddr, port, 'ascii')
+        server = make_server(args)
     except InvalidIPException:
         print("[ERROR] Invalid ip given.")
+        sys.exit(1)
     server.start()
     try:
         server.run()
@@ -25,6 +120,8 @@ def main():
         print("Received Ctrl-C, closing")
     finally:
         server.stop()
+        if tracer.on:
+            dump_trace(args)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
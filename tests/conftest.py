@@ -0,0 +1,173 @@
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import subprocess
+
+import pytest
+
+# the tests run from a checkout, against the library in it
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import iotftp
+
+ENGINES = ["selectors", "asyncio"]
+
+class Server:
+    """
+    Runs server.py on loopback in a process of its own, serving root.
+    """
+    def __init__(self, root, engine, *args):
+        self.root = root
+        self.engine = engine
+        self.args = args
+        self.port = None
+        self.proc = None
+
+    def start(self):
+        self.port = free_port()
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "server.py"),
+             "127.0.0.1", str(self.port), "--engine", self.engine,
+             "--workers", "1", *self.args],
+            cwd=self.root,
+        )
+        self.wait_listening()
+        return self
+
+    def stop(self):
+        # as Ctrl-C would, so worker processes are stopped too
+        if self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGINT)
+        try:
+            self.proc.wait(10)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def wait_listening(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"server exited with {self.proc.returncode}")
+            if self.port in listening_ports():
+                return
+            time.sleep(0.05)
+        raise TimeoutError("server did not start listening")
+
+    def client(self, **kwargs):
+        return iotftp.IoTFTPClient("127.0.0.1", self.port, "ascii", **kwargs)
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def listening_ports():
+    ports = set()
+    for path in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            f = open(path)
+        except FileNotFoundError:
+            continue
+        with f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                # listening sockets are in state 0A
+                if fields[3] == "0A":
+                    ports.add(int(fields[1].rpartition(":")[2], 16))
+    return ports
+
+def write_file(path, size, seed=0):
+    """
+    Writes size bytes of a repeatable pattern to path, returning them.
+    """
+    block = bytes((i * 31 + seed) % 251 for i in range(251))
+    data = (block * (size // len(block) + 1))[:size]
+    with open(path, "wb") as f:
+        f.write(data)
+    return data
+
+def command(session, *fields):
+    """
+    Sends a raw command on a session, returning the reply. An error reply
+    is acknowledged, so the session can go on.
+    """
+    def run(conn):
+        conn.send(b"\n".join(field.encode() for field in fields))
+        reply = conn.recv(512)
+        if reply[:1] == b"3":
+            conn.send(iotftp.ACKNOW)
+        return reply
+    return session.run(run)
+
+def open_fds(pid):
+    return len(os.listdir(f"/proc/{pid}/fd"))
+
+def wait_fds(pid, count, timeout=5):
+    """
+    Waits for a process to have count fds open, returning how many it has.
+    """
+    deadline = time.monotonic() + timeout
+    while (n := open_fds(pid)) != count and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return n
+
+def read_spans(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+@pytest.fixture(params=ENGINES)
+def engine(request):
+    return request.param
+
+@pytest.fixture
+def srvroot(tmp_path):
+    root = tmp_path / "srv"
+    root.mkdir()
+    return str(root)
+
+@pytest.fixture
+def cliroot(tmp_path, monkeypatch):
+    # the client reads and writes files in its working directory
+    root = tmp_path / "cli"
+    root.mkdir()
+    monkeypatch.chdir(root)
+    return str(root)
+
+@pytest.fixture
+def serve(engine, srvroot):
+    """
+    Starts servers on the engine under test, with any options given,
+    stopping them all at the end of the test.
+
+        srv = serve("--inline-size", "0")
+    """
+    servers = []
+
+    def start(*args):
+        srv = Server(srvroot, engine, *args).start()
+        servers.append(srv)
+        return srv
+
+    yield start
+    for srv in servers:
+        srv.stop()
+
+@pytest.fixture
+def server(serve):
+    return serve()
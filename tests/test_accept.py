@@ -0,0 +1,57 @@
+import time
+import socket
+
+from iotftp.utils import ACKNOW, DATA_ACCEPT_TIMEOUT, DELIMITER
+from conftest import open_fds, read_file, wait_fds, write_file
+
+def stall(srv, command):
+    """
+    Starts a GET or PUT on a raw connection, and acknowledges the data port
+    without ever connecting to it. Returns the connection.
+    """
+    s = socket.create_connection(("127.0.0.1", srv.port))
+    s.recv(512)
+    s.sendall(DELIMITER.join(command))
+    assert s.recv(512).split(DELIMITER)[0] == b"200 AIGT"
+    s.sendall(ACKNOW)
+    return s
+
+def closed(s):
+    try:
+        while s.recv(512):
+            pass
+    except ConnectionResetError:
+        pass
+    return True
+
+def test_unconnected_data_port_dropped(server, cliroot):
+    write_file(server.path("big"), 1 << 20)
+    write_file("up", 1 << 20, seed=1)
+    baseline = open_fds(server.proc.pid)
+
+    start = time.monotonic()
+    stalled = [
+        stall(server, [b"GET", b"big"]),
+        stall(server, [b"PUT", b"stalled", bytes(str(1 << 20), "ascii")]),
+    ]
+    try:
+        # other clients are served meanwhile, without waiting on the port
+        with server.client(mux=False, inline=0).session() as s:
+            s.get("big")
+            s.put("up")
+        assert time.monotonic() - start < DATA_ACCEPT_TIMEOUT / 2
+        assert read_file("big") == read_file(server.path("big"))
+        assert read_file(server.path("up")) == read_file("up")
+
+        # and the stalled clients are dropped once their ports time out
+        for s in stalled:
+            s.settimeout(DATA_ACCEPT_TIMEOUT + 5)
+            assert closed(s)
+        assert time.monotonic() - start >= DATA_ACCEPT_TIMEOUT - 1
+    finally:
+        for s in stalled:
+            s.close()
+
+    assert wait_fds(server.proc.pid, baseline) == baseline
+    with server.client().session() as s:
+        assert s.size("big") == 1 << 20
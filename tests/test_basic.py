@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+import iotftp
+from conftest import read_file, write_file
+
+SIZES = [0, 1, 1000, (1 << 20) + 3]
+
+@pytest.mark.parametrize("size", SIZES)
+def test_get(server, cliroot, size):
+    data = write_file(server.path("f"), size)
+    server.client(mux=False, inline=0).get("f")
+    assert read_file("f") == data
+
+@pytest.mark.parametrize("size", SIZES)
+def test_put(server, cliroot, size):
+    data = write_file("f", size)
+    server.client(mux=False, inline=0).put("f")
+    assert read_file(server.path("f")) == data
+
+def test_plaintext_session(server, cliroot):
+    data = write_file(server.path("a"), 5000)
+    write_file("b", 3000)
+    with server.client(framing=False).session() as s:
+        s.get("a")
+        s.put("b")
+        assert s.size("b") == 3000
+        s.delete("b")
+        assert s.size("b") is None
+    assert read_file("a") == data
+    assert not os.path.exists(server.path("b"))
+
+def test_errors(server, cliroot):
+    write_file(server.path("f"), 10)
+    write_file("f", 10)
+    os.mkdir(server.path("d"))
+    with server.client().session() as s:
+        with pytest.raises(iotftp.ServerError, match="302"):
+            s.get("missing")
+        with pytest.raises(iotftp.ServerError, match="307"):
+            s.put("f")
+        with pytest.raises(iotftp.ServerError, match="309"):
+            s.size("d")
+        # the session carries on after errors
+        assert s.size("f") == 10
+
+def test_bye_stops_server(server, cliroot):
+    server.client().bye()
+    server.proc.wait(10)
+    assert not server.alive()
+
+@pytest.mark.parametrize("threads", ["1", "4"])
+def test_fs_threads(serve, cliroot, threads):
+    srv = serve("--fs-threads", threads)
+    names = [f"f{i}" for i in range(20)]
+    for i, name in enumerate(names):
+        write_file(srv.path(name), 100 * i, seed=i)
+    with srv.client().session() as s:
+        for name in names:
+            s.get(name)
+    for i, name in enumerate(names):
+        assert read_file(name) == read_file(srv.path(name))
@@ -0,0 +1,38 @@
+import os
+
+import pytest
+
+import iotftp
+from iotftp.compress import CODECS
+from conftest import command, read_file
+
+def text(size):
+    line = b"2026-10-18 12:00:00 sensor=7 reading=0.125 status=ok\n"
+    return (line * (size // len(line) + 1))[:size]
+
+@pytest.mark.parametrize("spec", [*CODECS, "zlib:1", "zlib:9"])
+@pytest.mark.parametrize("data", [text(300000), os.urandom(200000), b""], ids=["text", "random", "empty"])
+def test_get_put_compressed(server, cliroot, spec, data):
+    with open(server.path("a"), "wb") as f:
+        f.write(data)
+    with open("b", "wb") as f:
+        f.write(data)
+    with server.client(compress=spec, mux=False, inline=0).session() as s:
+        s.get("a")
+        s.put("b")
+    assert read_file("a") == data
+    assert read_file(server.path("b")) == data
+
+def test_client_rejects_bad_spec():
+    with pytest.raises(KeyError):
+        iotftp.IoTFTPClient("127.0.0.1", 1, "ascii", compress="nope")
+    with pytest.raises(ValueError):
+        iotftp.IoTFTPClient("127.0.0.1", 1, "ascii", compress="zlib:12")
+
+def test_server_rejects_bad_spec(server, cliroot):
+    with open(server.path("a"), "wb") as f:
+        f.write(text(1000))
+    with server.client().session() as s:
+        assert command(s, "GET", "a", "Z=nope") == b"305 UNSP"
+        assert command(s, "GET", "a", "Z=zlib:12") == b"306 ARGS"
+        assert s.size("a") == 1000
@@ -0,0 +1,54 @@
+import os
+import socket
+
+from iotftp.utils import ACKNOW, DELIMITER
+from conftest import open_fds, read_file, wait_fds, write_file
+
+def abort(srv, command, stage):
+    """
+    Starts a GET or PUT on a raw connection and drops the client at stage:
+    once the data port is sent, or partway through the transfer.
+    """
+    with socket.create_connection(("127.0.0.1", srv.port)) as s:
+        s.recv(512)
+        s.sendall(DELIMITER.join(command))
+        reply = s.recv(512).split(DELIMITER)
+        assert reply[0] == b"200 AIGT"
+        if stage == "port":
+            return
+        s.sendall(ACKNOW)
+        with socket.create_connection(("127.0.0.1", int(reply[1]))) as d:
+            if command[0] == b"GET":
+                d.recv(1000)
+            else:
+                d.sendall(b"x" * 1000)
+
+def test_conns_released(server, cliroot, capfd):
+    write_file(server.path("big"), 3 << 20)
+    write_file("up", 3 << 20, seed=1)
+    baseline = open_fds(server.proc.pid)
+
+    # whole transfers, over one data connection and split across several,
+    # replacing the data port with the connection made to it and attaching
+    # one connection per range
+    for streams in (1, 3):
+        with server.client(streams=streams, mux=False, inline=0).session() as s:
+            s.get("big")
+            s.put("up")
+        os.remove("big")
+        os.remove(server.path("up"))
+
+    # clients dropped at every point of a transfer, with their data ports
+    # or connections still open
+    for stage in ("port", "data"):
+        abort(server, [b"GET", b"big"], stage)
+        abort(server, [b"PUT", bytes(f"up{stage}", "ascii"), bytes(str(3 << 20), "ascii")], stage)
+
+    assert wait_fds(server.proc.pid, baseline) == baseline
+    # the server carried on, with nothing going wrong on the way
+    with server.client(mux=False, inline=0).session() as s:
+        s.get("big")
+    assert read_file("big") == read_file(server.path("big"))
+    assert server.alive()
+    err = capfd.readouterr().err
+    assert "Traceback" not in err and "Error" not in err
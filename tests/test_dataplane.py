@@ -0,0 +1,14 @@
+import pytest
+
+from conftest import read_file, write_file
+
+@pytest.mark.parametrize("streams", [1, 3])
+def test_transfers_on_data_threads(serve, cliroot, streams):
+    srv = serve("--data-threads", "2")
+    got = write_file(srv.path("a"), (2 << 20) + 5)
+    put = write_file("b", (1 << 20) + 7, seed=1)
+    with srv.client(mux=False, inline=0, streams=streams).session() as s:
+        s.get("a")
+        s.put("b")
+    assert read_file("a") == got
+    assert read_file(srv.path("b")) == put
@@ -0,0 +1,28 @@
+import os
+
+import pytest
+
+import iotftp
+from conftest import write_file
+
+def test_delete(server, cliroot):
+    write_file(server.path("f"), 10)
+    server.client().delete("f")
+    assert not os.path.exists(server.path("f"))
+
+def test_delete_missing(server, cliroot):
+    with pytest.raises(iotftp.ServerError, match="302"):
+        server.client().delete("nothing")
+
+def test_delete_directory(server, cliroot):
+    os.mkdir(server.path("d"))
+    write_file(server.path("f"), 10)
+    with server.client().session() as s, server.client().session() as other:
+        other.pwd()
+        with pytest.raises(iotftp.ServerError, match="309"):
+            s.delete("d")
+        # neither the session nor the server's other clients are affected
+        assert s.size("f") == 10
+        assert other.size("f") == 10
+    assert os.path.isdir(server.path("d"))
+    assert server.alive()
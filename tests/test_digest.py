@@ -0,0 +1,38 @@
+import hashlib
+
+import pytest
+
+import iotftp
+from iotftp.digest import DIGESTS
+from conftest import command, read_file, write_file
+
+WAYS = {
+    "data conn": dict(mux=False, inline=0),
+    "split": dict(mux=False, inline=0, streams=3),
+    "mux": dict(inline=0),
+    "inline": dict(),
+    "compressed": dict(mux=False, inline=0, compress="zlib"),
+}
+
+@pytest.mark.parametrize("algorithm", [*DIGESTS, None])
+@pytest.mark.parametrize("way", WAYS)
+def test_verified_transfers(server, cliroot, algorithm, way):
+    size = 5000 if way == "inline" else 600000
+    got = write_file(server.path("a"), size)
+    put = write_file("b", size, seed=1)
+    with server.client(digest=algorithm, **WAYS[way]).session() as s:
+        s.get("a")
+        s.put("b")
+    assert read_file("a") == got
+    assert read_file(server.path("b")) == put
+
+def test_digest_reply(server, cliroot):
+    with server.client().session() as s:
+        reply = command(s, "PUT", "f", "3", "H=sha256", "", "abc")
+        assert reply == b"200 AIGT\nH=sha256:" + hashlib.sha256(b"abc").hexdigest().encode()
+        assert command(s, "GET", "f", "H=md4") == b"305 UNSP"
+    assert read_file(server.path("f")) == b"abc"
+
+def test_client_rejects_unknown_algorithm():
+    with pytest.raises(KeyError):
+        iotftp.IoTFTPClient("127.0.0.1", 1, "ascii", digest="md4")
@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+from conftest import read_file, write_file
+
+def edits(base):
+    yield "same", base
+    yield "appended", base + b"tail" * 1000
+    yield "truncated", base[:len(base) // 3]
+    yield "inserted", base[:1000] + b"new bytes" + base[1000:]
+    yield "removed", base[:5000] + base[9000:]
+    yield "replaced", base[:200000] + os.urandom(3000) + base[203000:]
+    yield "empty", b""
+
+BASE = bytes((i * 7919) % 256 for i in range(300000))
+
+@pytest.mark.parametrize("edit", [name for name, _ in edits(BASE)])
+def test_dput(server, cliroot, edit):
+    new = dict(edits(BASE))[edit]
+    with open(server.path("f"), "wb") as f:
+        f.write(BASE)
+    os.chmod(server.path("f"), 0o640)
+    with open("f", "wb") as f:
+        f.write(new)
+    server.client().dput("f")
+    assert read_file(server.path("f")) == new
+    assert os.stat(server.path("f")).st_mode & 0o777 == 0o640
+
+def test_dput_without_base(server, cliroot):
+    data = write_file("f", 70000)
+    server.client().dput("f")
+    assert read_file(server.path("f")) == data
+
+def test_dput_empty_base(server, cliroot):
+    open(server.path("f"), "wb").close()
+    data = write_file("f", 70000)
+    with server.client().session() as s:
+        s.dput("f")
+        assert s.size("f") == 70000
+    assert read_file(server.path("f")) == data
@@ -0,0 +1,110 @@
+import socket
+
+import pytest
+
+from iotftp.framing import (
+    ControlConn, FrameParser, FRAME, FRAME_BACKLOG, FRAME_START, pack_frame,
+)
+from iotftp.utils import ConnClosedErr
+
+@pytest.fixture
+def pair():
+    server, client = socket.socketpair()
+    server.setblocking(False)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    conn = ControlConn(server)
+    client.sendall(pack_frame(1, b"PWD"))
+    conn.detect()
+    assert conn.framed
+    yield conn, client
+    server.close()
+    client.close()
+
+def test_parser_splits_frames():
+    parser = FrameParser()
+    stream = pack_frame(1, b"GET\nf") + pack_frame(2, b"") + pack_frame(2, b"SIZE\nf")
+    for i in range(len(stream)):
+        parser.feed(stream[i:i + 1])
+    assert parser.next_command() == (1, b"GET\nf")
+    assert parser.next_command() == (2, b"SIZE\nf")
+    assert parser.next_command() is None
+
+def test_parser_rejects_bad_frames():
+    with pytest.raises(ConnClosedErr):
+        FrameParser().feed(FRAME.pack(9, 1, 0))
+    with pytest.raises(ConnClosedErr):
+        FrameParser().feed(FRAME.pack(FRAME_START, 1, (1 << 20) + 1))
+
+def test_chunks_block_when_backed_up(pair):
+    conn, client = pair
+    chunk = b"x" * 4096
+    with pytest.raises(BlockingIOError):
+        for _ in range(1000):
+            conn.send_chunk(chunk)
+    assert len(conn.outbuf) >= FRAME_BACKLOG
+    # commands are held back until the client reads
+    client.sendall(pack_frame(2, b"PWD"))
+    conn.fill()
+    assert not conn.has_command()
+
+def test_replies_queue_when_backed_up(pair):
+    conn, client = pair
+    conn.read_command()
+    with pytest.raises(BlockingIOError):
+        for _ in range(1000):
+            conn.send_chunk(b"x" * 4096)
+
+    # a reply never blocks, and goes out once the client reads the rest
+    assert conn.send(b"200 AIGT") == 8
+    parser = FrameParser()
+    while conn.pending():
+        parser.feed(client.recv(1 << 16))
+        conn.flush()
+    client.setblocking(False)
+    try:
+        while (b := client.recv(1 << 16)):
+            parser.feed(b)
+    except BlockingIOError:
+        pass
+    payloads = b"".join(payload for _, payload in parser.frames)
+    assert payloads.endswith(b"200 AIGT")
+
+@pytest.mark.parametrize("framing", [False, True])
+def test_pipelined_sizes(server, cliroot, framing):
+    for i in range(200):
+        with open(server.path(f"f{i}"), "wb") as f:
+            f.write(b"x" * i)
+    names = [f"f{i}" for i in range(200)] + ["missing"]
+    with server.client(framing=framing).session() as s:
+        assert s.framed() == framing
+        assert s.sizes(*names) == list(range(200)) + [None]
+        # the session is still in step after an error among the replies
+        assert s.size("f7") == 7
+
+def test_long_listing_framed(server, cliroot):
+    names = {f"{i:05}-{'n' * 60}" for i in range(5000)}
+    for name in names:
+        open(server.path(name), "w").close()
+    with server.client().session() as s:
+        entries = s.lsd()
+        assert {entry[3] for entry in entries} == names
+        assert s.size(min(names)) == 0
+
+def test_long_framed_command(server, cliroot):
+    names = [f"{i:03}-{'x' * 40}" for i in range(60)]
+    for name in names:
+        open(server.path(name), "wb").close()
+    with server.client().session() as s:
+        assert s.framed()
+        results = s.mget(*names)
+    assert [name for name, err in results if err is None] == names
+
+def test_bad_frame_closes_only_its_connection(server, cliroot):
+    with server.client().session() as other:
+        other.pwd()
+        with socket.create_connection(("127.0.0.1", server.port)) as sock:
+            sock.recv(512)
+            sock.sendall(FRAME.pack(FRAME_START, 1, (1 << 20) + 1))
+            sock.settimeout(10)
+            assert sock.recv(512) == b""
+        assert other.pwd() == server.root
@@ -0,0 +1,42 @@
+import os
+import time
+
+from conftest import write_file
+
+def cpu_ticks(pid):
+    """
+    Returns the clock ticks of CPU time a process has used so far.
+    """
+    with open(f"/proc/{pid}/stat") as f:
+        # the fields after the command name, which may hold spaces
+        fields = f.read().rpartition(")")[2].split()
+    return int(fields[11]) + int(fields[12])
+
+def test_idle_server_sleeps(server, cliroot):
+    write_file(server.path("f"), 1 << 20)
+    write_file(server.path("g"), 100 << 10)
+    sessions = [server.client().session() for _ in range(4)]
+    sessions.append(server.client(framing=False).session())
+    for s in sessions:
+        s.open()
+        s.pwd()
+    # leave a few sessions idle after transfers of either kind
+    sessions[0].get("f")
+    os.rename("f", "f0")
+    sessions[1].get("g")
+    os.rename("g", "g1")
+    sessions[4].get("f")
+    time.sleep(0.5)
+
+    try:
+        before = cpu_ticks(server.proc.pid)
+        time.sleep(2)
+        # a loop woken up for writable sockets it has nothing to send on
+        # spins, using up hundreds of ticks
+        assert cpu_ticks(server.proc.pid) - before <= 1
+    finally:
+        for s in sessions:
+            s.close()
+    # and still answers
+    with server.client().session() as s:
+        s.pwd()
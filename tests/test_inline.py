@@ -0,0 +1,49 @@
+import pytest
+
+from conftest import command, read_file, write_file
+
+@pytest.mark.parametrize("size", [0, 1, 1000, 1 << 16])
+@pytest.mark.parametrize("framing", [False, True])
+def test_inline_round_trip(server, cliroot, size, framing):
+    got = write_file(server.path("a"), size)
+    put = write_file("b", size, seed=1)
+    with server.client(framing=framing).session() as s:
+        s.get("a")
+        s.put("b")
+    assert read_file("a") == got
+    assert read_file(server.path("b")) == put
+
+def test_inline_get_reply(server, cliroot):
+    data = write_file(server.path("f"), 10)
+    with server.client().session() as s:
+        assert command(s, "GET", "f", "INLINE=100") == b"200 AIGT\nINLINE=10\n\n" + data
+        assert command(s, "GET", "f", "OFF=4", "INLINE=100") == b"200 AIGT\nINLINE=6\n\n" + data[4:]
+        # too big for what was asked, so a data connection is offered instead
+        reply = command(s, "GET", "f", "INLINE=5")
+        assert reply.startswith(b"200 AIGT\n") and b"INLINE" not in reply
+
+def test_inline_size_option(serve, cliroot):
+    srv = serve("--inline-size", "100")
+    data = write_file(srv.path("f"), 200)
+    with srv.client().session() as s:
+        assert s.welcome[4]["INLINE"] == "100"
+        reply = command(s, "GET", "f", "INLINE=1000")
+        assert b"INLINE" not in reply
+    srv.stop()
+
+    srv = serve("--inline-size", "0")
+    with srv.client().session() as s:
+        assert "INLINE" not in s.welcome[4]
+        s.get("f")
+        write_file("g", 10)
+        s.put("g")
+    assert read_file("f") == data
+
+def test_inline_put_errors(serve, cliroot):
+    srv = serve("--inline-size", "100")
+    with srv.client().session() as s:
+        assert command(s, "PUT", "f", "200", "", "x" * 200) == b"305 UNSP"
+        assert command(s, "PUT", "f", "5", "", "abc") == b"306 ARGS"
+        assert command(s, "SIZE", "f", "", "abc") == b"306 ARGS"
+        assert command(s, "PUT", "f", "3", "", "abc") == b"200 AIGT"
+    assert read_file(srv.path("f")) == b"abc"
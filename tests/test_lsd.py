@@ -0,0 +1,103 @@
+import os
+import time
+import threading
+
+import pytest
+
+import iotftp
+from iotftp.cmds import lsd
+from iotftp.cmds.lsd import ListingCache
+from conftest import write_file
+
+def test_concurrent_misses_share_a_scan(tmp_path, monkeypatch):
+    for i in range(100):
+        (tmp_path / f"f{i}").write_bytes(b"x" * i)
+    scans = []
+
+    def slow_scan(path):
+        scans.append(path)
+        time.sleep(0.2)
+        return scan_dir(path)
+
+    scan_dir = lsd.scan_dir
+    monkeypatch.setattr(lsd, "scan_dir", slow_scan)
+    cache = ListingCache()
+    listings = []
+    threads = [
+        threading.Thread(target=lambda: listings.append(cache.list(str(tmp_path))))
+        for _ in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(scans) == 1
+    assert len(listings) == 8
+    assert all(listing is listings[0] for listing in listings)
+    assert len(listings[0].lines) == 100
+    assert not cache.scans
+
+def test_failed_scan_is_not_kept(tmp_path, monkeypatch):
+    def failing_scan(path):
+        raise PermissionError(path)
+
+    monkeypatch.setattr(lsd, "scan_dir", failing_scan)
+    cache = ListingCache()
+    with pytest.raises(PermissionError):
+        cache.list(str(tmp_path))
+    assert not cache.scans
+
+def test_cached_until_changed(tmp_path):
+    (tmp_path / "a").write_bytes(b"")
+    # old enough to have settled
+    os.utime(tmp_path, ns=(0, 0))
+    cache = ListingCache()
+    first = cache.list(str(tmp_path))
+    assert cache.list(str(tmp_path)) is first
+
+    (tmp_path / "b").write_bytes(b"")
+    listing = cache.list(str(tmp_path))
+    assert listing is not first
+    assert [line.split(b" ")[3] for line in listing.lines] == [b"a\n", b"b\n"]
+
+def test_pwd_cwd_lsd(server, cliroot):
+    os.makedirs(server.path("d", "e"))
+    write_file(server.path("d", "f"), 123)
+    os.symlink("f", server.path("d", "l"))
+    with server.client().session() as s:
+        assert s.pwd() == server.root
+        s.cwd("d")
+        assert s.pwd() == server.path("d")
+        entries = {name: (kind, size) for kind, size, _, name in s.lsd()}
+        assert entries == {"e": ("d", entries["e"][1]), "f": ("f", 123), "l": ("l", 1)}
+        # paths of later commands are relative to the new directory
+        assert s.size("f") == 123
+        s.cwd("..")
+        assert s.pwd() == server.root
+        assert [entry[3] for entry in s.lsd("d")] == ["e", "f", "l"]
+
+    # each session has a directory of its own
+    with server.client().session() as s:
+        assert s.pwd() == server.root
+
+def test_lsd_sees_changes(server, cliroot):
+    with server.client().session() as s:
+        assert s.lsd() == []
+        write_file(server.path("a"), 5)
+        assert [entry[3] for entry in s.lsd()] == ["a"]
+        os.remove(server.path("a"))
+        assert s.lsd() == []
+
+def test_cwd_lsd_errors(server, cliroot):
+    write_file(server.path("f"), 10)
+    with server.client().session() as s:
+        with pytest.raises(iotftp.ServerError, match="302"):
+            s.cwd("missing")
+        with pytest.raises(iotftp.ServerError, match="303"):
+            s.cwd("f")
+        with pytest.raises(iotftp.ServerError, match="302"):
+            s.lsd("missing")
+        with pytest.raises(iotftp.ServerError, match="303"):
+            s.lsd("f")
+        assert s.pwd() == server.root
@@ -0,0 +1,43 @@
+import os
+
+import iotftp
+from conftest import read_file, write_file
+
+def test_mget(server, cliroot):
+    os.mkdir(server.path("d"))
+    for name in ("a.log", "b.log", "c.txt", "d/e.log"):
+        write_file(server.path(name), 3000 + len(name), seed=len(name))
+    os.mkdir("d")
+    with server.client().session() as s:
+        results = dict(s.mget("*.log", "d/*.log", "missing"))
+
+    assert set(results) == {"a.log", "b.log", "d/e.log", "missing"}
+    assert [name for name, err in results.items() if err is not None] == ["missing"]
+    assert "302" in str(results["missing"])
+    for name in ("a.log", "b.log", "d/e.log"):
+        assert read_file(name) == read_file(server.path(name))
+    assert not os.path.exists("c.txt")
+
+def test_mget_keeps_local_files(server, cliroot):
+    write_file(server.path("a"), 100)
+    local = write_file("a", 50, seed=1)
+    results = server.client().mget("a")
+    assert results[0][0] == "a"
+    assert read_file("a") == local
+
+def test_mput(server, cliroot):
+    names = [f"f{i}" for i in range(5)]
+    for i, name in enumerate(names):
+        write_file(name, 1000 * i, seed=i)
+    write_file(server.path("f2"), 10)
+    with server.client().session() as s:
+        results = dict(s.mput(*names, "missing"))
+        # the session is still in step
+        assert s.size("f4") == 4000
+
+    assert isinstance(results["missing"], FileNotFoundError)
+    assert isinstance(results["f2"], iotftp.ServerError) and "307" in str(results["f2"])
+    for name in ("f0", "f1", "f3", "f4"):
+        assert results[name] is None
+        assert read_file(server.path(name)) == read_file(name)
+    assert os.path.getsize(server.path("f2")) == 10
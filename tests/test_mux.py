@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from conftest import command, read_file, read_spans, write_file
+
+@pytest.mark.parametrize("size", [0, 100 << 10, (128 << 10) + 1, 1 << 20])
+def test_mux_round_trip(serve, cliroot, size):
+    srv = serve("--mux-size", str(128 << 10))
+    data = write_file(srv.path("f"), size)
+    with srv.client(inline=0).session() as s:
+        s.get("f")
+        assert read_file("f") == data
+        os.rename("f", "g")
+        s.put("g")
+    assert read_file(srv.path("g")) == data
+
+def test_mux_size(serve, cliroot, tmp_path):
+    trace = str(tmp_path / "trace")
+    srv = serve("--mux-size", str(128 << 10), "--trace", "1000", "--trace-file", trace)
+    write_file(srv.path("small"), 128 << 10)
+    write_file(srv.path("big"), (128 << 10) + 1)
+    with srv.client(inline=0).session() as s:
+        s.get("small")
+        s.get("big")
+        os.remove(srv.path("small"))
+        os.remove(srv.path("big"))
+        s.put("small")
+        s.put("big")
+    srv.stop()
+
+    # only the transfers over the limit wait for a data connection
+    connects = [span for span in read_spans(trace) if span["phase"] == "connect"]
+    assert sorted(span["command"] for span in connects) == ["GET", "PUT"]
+
+def test_mux_off_unframed(server, cliroot):
+    data = write_file(server.path("f"), 100 << 10)
+    with server.client(framing=False, inline=0).session() as s:
+        s.get("f")
+    assert read_file("f") == data
+
+def test_mux_unframed_refused(server, cliroot):
+    write_file(server.path("f"), 100)
+    with server.client(framing=False).session() as s:
+        assert command(s, "GET", "f", "MUX=65536") == b"305 UNSP"
+        assert s.size("f") == 100
+
+@pytest.mark.parametrize("window", [1, 4096, 1 << 30])
+def test_mux_window(server, cliroot, window):
+    write_file(server.path("f"), 200 << 10)
+    with server.client(inline=0).session() as s:
+        reply = command(s, "GET", "f", f"MUX={window}")
+        assert reply.startswith(b"200 AIGT\nMUX=")
+        # capped at the window the server advertised
+        assert int(reply.split(b"\n")[1][4:]) == min(window, 1 << 20)
@@ -0,0 +1,17 @@
+import os
+
+from conftest import command, write_file
+
+def test_empty_path_arguments(server, cliroot):
+    write_file(server.path("f"), 10)
+    with server.client().session() as s:
+        assert command(s, "DEL", "") == b"302 NONE"
+        assert command(s, "GET", "") == b"306 ARGS"
+        assert command(s, "SIZE", "") == b"306 ARGS"
+        assert command(s, "DEL") == b"306 ARGS"
+        assert command(s, "GET") == b"306 ARGS"
+        assert command(s, "SIZE") == b"306 ARGS"
+        # the session, and the server, carry on
+        assert s.size("f") == 10
+    assert server.alive()
+    assert os.path.isdir(server.root)
@@ -0,0 +1,62 @@
+import socket
+import threading
+
+import pytest
+
+from iotftp.ports import DataPortPool
+from conftest import read_file, write_file
+
+def test_pool_leases_and_releases():
+    pool = DataPortPool("127.0.0.1", 2)
+    pool.open()
+    try:
+        a, b = pool.lease(), pool.lease()
+        assert pool.owns(a) and pool.owns(b)
+        # past the pool, a one-off port is bound
+        c = pool.lease()
+        assert not pool.owns(c)
+        pool.release(c)
+        assert c.fileno() == -1
+        pool.release(a)
+        assert pool.lease() is a
+    finally:
+        pool.close()
+
+def test_pool_drains_stale_connections():
+    pool = DataPortPool("127.0.0.1", 1)
+    pool.open()
+    try:
+        sock = pool.lease()
+        stale = socket.create_connection(sock.getsockname())
+        pool.release(sock)
+        assert pool.lease() is sock
+        with pytest.raises(BlockingIOError):
+            sock.accept()
+        stale.close()
+    finally:
+        pool.close()
+
+@pytest.mark.parametrize("dataports", [0, 1, 4])
+def test_concurrent_transfers(serve, cliroot, dataports):
+    srv = serve("--dataports", str(dataports))
+    files = {f"f{i}": write_file(srv.path(f"f{i}"), (256 << 10) + i, seed=i)
+             for i in range(12)}
+    errors = []
+
+    def get(names):
+        try:
+            with srv.client(mux=False, inline=0).session() as s:
+                for name in names:
+                    s.get(name)
+        except Exception as e:
+            errors.append(e)
+
+    names = list(files)
+    threads = [threading.Thread(target=get, args=(names[i::4],)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert not errors
+    for name, data in files.items():
+        assert read_file(name) == data
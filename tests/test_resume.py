@@ -0,0 +1,46 @@
+import pytest
+
+import iotftp
+from conftest import read_file, write_file
+
+WAYS = {
+    "data conn": dict(mux=False, inline=0),
+    "mux": dict(inline=0),
+    "inline": dict(),
+}
+
+@pytest.mark.parametrize("way", WAYS)
+@pytest.mark.parametrize("size,kept", [(1 << 20, 300000), (100000, 99000), (5000, 5000)])
+def test_get_resume(server, cliroot, way, size, kept):
+    data = write_file(server.path("f"), size)
+    with open("f", "wb") as f:
+        f.write(data[:kept])
+    with server.client(**WAYS[way]).session() as s:
+        with pytest.raises(FileExistsError):
+            s.get("f")
+        s.get("f", resume=True)
+    assert read_file("f") == data
+
+@pytest.mark.parametrize("way", WAYS)
+@pytest.mark.parametrize("size,kept", [(1 << 20, 300000), (100000, 99000), (5000, 0)])
+def test_put_resume(server, cliroot, way, size, kept):
+    data = write_file("f", size)
+    with open(server.path("f"), "wb") as f:
+        f.write(data[:kept])
+    with server.client(**WAYS[way]).session() as s:
+        s.put("f", resume=True)
+    assert read_file(server.path("f")) == data
+
+def test_get_resume_past_end(server, cliroot):
+    write_file(server.path("f"), 100)
+    write_file("f", 200)
+    with server.client().session() as s:
+        with pytest.raises(iotftp.ServerError, match="306"):
+            s.get("f", resume=True)
+        assert s.size("f") == 100
+
+def test_put_resume_nothing_to_resume(server, cliroot):
+    data = write_file("f", 3000)
+    # with no partial copy, the whole file is sent
+    server.client().put("f", resume=True)
+    assert read_file(server.path("f")) == data
@@ -0,0 +1,55 @@
+import threading
+
+import pytest
+
+import iotftp
+from conftest import read_file, write_file
+
+def test_session_runs_many_commands(server, cliroot):
+    for i in range(10):
+        write_file(server.path(f"f{i}"), i * 100, seed=i)
+    with server.client().session() as s:
+        for i in range(10):
+            s.get(f"f{i}")
+            assert s.size(f"f{i}") == i * 100
+    for i in range(10):
+        assert read_file(f"f{i}") == read_file(server.path(f"f{i}"))
+
+def test_closed_session_refuses_commands(server, cliroot):
+    s = server.client().session()
+    with s:
+        s.pwd()
+    with pytest.raises(ConnectionError):
+        s.pwd()
+
+def test_pool_reuses_sessions(server, cliroot):
+    for i in range(16):
+        write_file(server.path(f"f{i}"), 500, seed=i)
+    opened = []
+    errors = []
+    with server.client().pool(4) as pool:
+        def get(i):
+            try:
+                with pool.session() as s:
+                    opened.append(s)
+                    s.get(f"f{i}")
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=get, args=(i,)) for i in range(16)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(pool.idle) <= 4
+
+    assert not errors
+    assert len(set(map(id, opened))) <= 4
+    for i in range(16):
+        assert read_file(f"f{i}") == read_file(server.path(f"f{i}"))
+
+def test_pool_keeps_session_after_server_error(server, cliroot):
+    with server.client().pool(1) as pool:
+        with pytest.raises(iotftp.ServerError):
+            pool.get("missing")
+        assert pool.size("missing") is None
+        assert len(pool.idle) == 1
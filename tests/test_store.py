@@ -0,0 +1,130 @@
+import os
+import shutil
+import threading
+
+import pytest
+
+from conftest import read_file, write_file
+
+@pytest.fixture
+def store_server(serve, tmp_path):
+    return serve("--store", str(tmp_path / "store"))
+
+@pytest.mark.parametrize("mux", [False, True])
+def test_put_again_hits(store_server, cliroot, mux):
+    data = write_file("a", 200 << 10)
+    client = store_server.client(mux=mux)
+    with client.session() as s:
+        assert s.put("a") is False
+        # straight after, while the first copy may still be being stored
+        shutil.copy("a", "b")
+        assert s.put("b") is True
+    assert read_file(store_server.path("b")) == data
+
+def test_put_changed_misses(store_server, cliroot):
+    write_file("a", 100 << 10)
+    client = store_server.client()
+    assert client.put("a") is False
+    data = write_file("b", 100 << 10, seed=1)
+    assert client.put("b") is False
+    assert read_file(store_server.path("b")) == data
+
+def test_put_inline_not_offered(store_server, cliroot):
+    write_file("a", 1000)
+    client = store_server.client()
+    assert client.put("a") is None
+    shutil.copy("a", "b")
+    assert client.put("b") is None
+
+def test_put_without_store(server, cliroot):
+    write_file("a", 100 << 10)
+    assert server.client().put("a") is None
+
+def test_hardlinked_store(serve, cliroot, tmp_path):
+    srv = serve("--store", str(tmp_path / "store"), "--store-hardlink")
+    data = write_file("a", 100 << 10)
+    with srv.client().session() as s:
+        assert s.put("a") is False
+        shutil.copy("a", "b")
+        assert s.put("b") is True
+    assert read_file(srv.path("b")) == data
+    assert os.stat(srv.path("b")).st_nlink == 2
+
+@pytest.mark.parametrize("mux", [False, True])
+def test_resume_hardlinked(serve, cliroot, tmp_path, mux):
+    store = tmp_path / "store"
+    srv = serve("--store", str(store), "--store-hardlink")
+    data = write_file("a", 100 << 10)
+    with srv.client(mux=mux, inline=0).session() as s:
+        assert s.put("a") is False
+        shutil.copy("a", "b")
+        assert s.put("b") is True
+        assert os.stat(srv.path("b")).st_nlink == 2
+        with open("b", "ab") as f:
+            f.write(b"x" * 5000)
+        s.put("b", resume=True)
+    assert read_file(srv.path("b")) == data + b"x" * 5000
+    assert os.stat(srv.path("b")).st_nlink == 1
+    # the object is unchanged, and still hit
+    objs = [path for path in store.rglob("*") if path.is_file()]
+    assert [read_file(path) for path in objs] == [data]
+    with srv.client().session() as s:
+        shutil.copy("a", "c")
+        assert s.put("c") is True
+    assert read_file(srv.path("c")) == data
+
+def test_store_evicts(serve, cliroot, tmp_path):
+    srv = serve("--store", str(tmp_path / "store"), "--store-size", str(150 << 10))
+    write_file("a", 100 << 10)
+    write_file("b", 100 << 10, seed=1)
+    with srv.client().session() as s:
+        assert s.put("a") is False
+        assert s.put("b") is False
+        # waits for b to be stored
+        shutil.copy("b", "b2")
+        assert s.put("b2") is True
+        # a was evicted to make room for b
+        shutil.copy("a", "c")
+        assert s.put("c") is False
+        shutil.copy("c", "d")
+        assert s.put("d") is True
+
+def test_store_survives_restart(serve, cliroot, tmp_path):
+    store = str(tmp_path / "store")
+    srv = serve("--store", store)
+    write_file("a", 100 << 10)
+    assert srv.client().put("a") is False
+    srv.stop()
+
+    srv = serve("--store", store)
+    shutil.copy("a", "b")
+    assert srv.client().put("b") is True
+
+def test_concurrent_puts_of_same_contents(serve, cliroot, tmp_path):
+    # with one filesystem thread, an upload waiting on the executor for the
+    # same contents to be added would stop the add from ever running
+    srv = serve("--store", str(tmp_path / "store"), "--fs-threads", "1")
+    errors = []
+
+    def put(name):
+        try:
+            srv.client(mux=False).put(name)
+        except Exception as e:
+            errors.append(e)
+
+    for round in range(6):
+        names = []
+        for i in range(12):
+            name = f"r{round}f{i}"
+            # half the files have the same contents
+            write_file(name, 100 << 10, seed=round if i % 2 else 100 + i)
+            names.append(name)
+        threads = [threading.Thread(target=put, args=(name,)) for name in names]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(20)
+        assert not any(t.is_alive() for t in threads)
+        assert not errors
+        for name in names:
+            assert read_file(srv.path(name)) == read_file(name)
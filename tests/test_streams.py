@@ -0,0 +1,32 @@
+import pytest
+
+from conftest import read_file, write_file
+
+@pytest.mark.parametrize("streams", [2, 4, 8])
+@pytest.mark.parametrize("size", [1, 7, (3 << 20) + 1])
+def test_split_transfers(server, cliroot, streams, size):
+    got = write_file(server.path("a"), size)
+    put = write_file("b", size, seed=1)
+    with server.client(streams=streams, mux=False, inline=0).session() as s:
+        s.get("a")
+        s.put("b")
+    assert read_file("a") == got
+    assert read_file(server.path("b")) == put
+
+def test_max_streams(serve, cliroot):
+    srv = serve("--max-streams", "2")
+    got = write_file(srv.path("a"), 1 << 20)
+    put = write_file("b", 1 << 20, seed=1)
+    with srv.client(streams=8, mux=False, inline=0).session() as s:
+        s.get("a")
+        s.put("b")
+    assert read_file("a") == got
+    assert read_file(srv.path("b")) == put
+
+def test_split_resume(server, cliroot):
+    data = write_file(server.path("f"), 2 << 20)
+    with open("f", "wb") as f:
+        f.write(data[:700001])
+    with server.client(streams=4, mux=False, inline=0).session() as s:
+        s.get("f", resume=True)
+    assert read_file("f") == data
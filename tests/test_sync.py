@@ -0,0 +1,87 @@
+import os
+import hashlib
+
+import pytest
+
+import iotftp
+from conftest import read_file, write_file
+
+@pytest.fixture
+def index_server(serve, tmp_path):
+    return serve("--index", str(tmp_path / "index"))
+
+def names(entries):
+    return {entry[4]: entry[0] for entry in entries}
+
+def test_sync_changes(index_server, cliroot):
+    srv = index_server
+    os.mkdir(srv.path("d"))
+    write_file(srv.path("a"), 10)
+    write_file(srv.path("d", "b"), 20)
+    with srv.client().session() as s:
+        token, full, entries = s.sync()
+        assert full
+        assert names(entries) == {"a": "f", "d/b": "f"}
+
+        token, full, entries = s.sync(token=token)
+        assert not full
+        assert entries == []
+
+        write_file(srv.path("a"), 11)
+        write_file(srv.path("d", "c"), 30)
+        os.remove(srv.path("d", "b"))
+        token, full, entries = s.sync(token=token)
+        assert not full
+        assert names(entries) == {"a": "f", "d/b": "x", "d/c": "f"}
+
+        # paths are relative to the directory synced
+        _, _, entries = s.sync("d")
+        assert names(entries) == {"c": "f"}
+
+def test_sync_digests(index_server, cliroot):
+    data = write_file(index_server.path("a"), 1000)
+    _, _, entries = index_server.client().sync(digest="sha256")
+    assert entries[0][3] == "sha256:" + hashlib.sha256(data).hexdigest()
+
+def test_sync_token_survives_restart(serve, cliroot, tmp_path):
+    index = str(tmp_path / "index")
+    srv = serve("--index", index)
+    write_file(srv.path("a"), 10)
+    token, _, _ = srv.client().sync()
+    srv.stop()
+
+    srv = serve("--index", index)
+    write_file(srv.path("b"), 10)
+    _, full, entries = srv.client().sync(token=token)
+    assert not full
+    assert names(entries) == {"b": "f"}
+
+def test_pull(index_server, cliroot):
+    srv = index_server
+    os.mkdir(srv.path("d"))
+    write_file(srv.path("a"), 100000)
+    write_file(srv.path("d", "b"), 20)
+    os.mkdir("copy")
+    with srv.client().session() as s:
+        token, results = s.pull(dest="copy")
+        assert all(err is None for _, err in results)
+        assert read_file("copy/a") == read_file(srv.path("a"))
+        assert read_file("copy/d/b") == read_file(srv.path("d", "b"))
+
+        write_file(srv.path("a"), 5, seed=3)
+        os.remove(srv.path("d", "b"))
+        token, results = s.pull(dest="copy", token=token, delete=True)
+        assert [name for name, _ in results] == ["a"]
+        assert read_file("copy/a") == read_file(srv.path("a"))
+        assert not os.path.exists("copy/d/b")
+
+def test_sync_errors(index_server, server, cliroot):
+    with server.client().session() as s:
+        with pytest.raises(iotftp.ServerError, match="305"):
+            s.sync()
+    with index_server.client().session() as s:
+        with pytest.raises(iotftp.ServerError, match="306"):
+            s.sync(token="nonsense")
+        with pytest.raises(iotftp.ServerError, match="302"):
+            s.sync("..")
+        assert s.sync()[1]
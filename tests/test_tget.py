@@ -0,0 +1,134 @@
+import io
+import os
+import socket
+import tarfile
+
+import pytest
+
+import iotftp
+from iotftp import client as client_module
+from iotftp.utils import DELIMITER, RES_OK
+from conftest import read_file, write_file
+
+def make_tree(root):
+    os.makedirs(os.path.join(root, "t", "sub", "deeper"))
+    os.makedirs(os.path.join(root, "t", "empty"))
+    files = {
+        "t/a": 0,
+        "t/b": 70000,
+        "t/sub/c": 1 << 20,
+        "t/sub/deeper/d": 513,
+    }
+    for name, size in files.items():
+        write_file(os.path.join(root, name), size, seed=size % 7)
+    os.symlink("b", os.path.join(root, "t", "link"))
+    return files
+
+@pytest.fixture(params=[True, False], ids=["filter", "fallback"])
+def data_filter(request, monkeypatch):
+    if request.param and not client_module.HAS_DATA_FILTER:
+        pytest.skip("tarfile has no data filter")
+    monkeypatch.setattr(client_module, "HAS_DATA_FILTER", request.param)
+
+def test_tget(server, cliroot, data_filter):
+    files = make_tree(server.root)
+    server.client().tget("t")
+
+    for name in files:
+        assert read_file(name) == read_file(server.path(name))
+    assert os.path.isdir("t/empty")
+    assert os.readlink("t/link") == "b"
+
+def test_tget_into_dest(server, cliroot):
+    files = make_tree(server.root)
+    os.mkdir("out")
+    with server.client().session() as s:
+        s.tget("t/sub", "out")
+    assert read_file("out/sub/c") == read_file(server.path("t/sub/c"))
+    assert not os.path.exists("out/t")
+
+def test_tget_errors(server, cliroot):
+    write_file(server.path("f"), 10)
+    with server.client().session() as s:
+        with pytest.raises(iotftp.ServerError, match="302"):
+            s.tget("missing")
+        with pytest.raises(iotftp.ServerError, match="303"):
+            s.tget("f")
+        assert s.size("f") == 10
+
+class StubConn:
+    """
+    Stands in for the connection to a server replying to TGET with a data
+    port, and then with success.
+    """
+    def __init__(self):
+        self.replies = [DELIMITER.join([RES_OK, b"1"]), RES_OK]
+
+    def send(self, b):
+        pass
+
+    def recv(self, n):
+        return self.replies.pop(0)
+
+def hostile_tree():
+    """
+    Returns a tar stream of members that must not be extracted, along
+    with some that must.
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        def add(name, kind=tarfile.REGTYPE, linkname="", data=b"x", mode=0o644):
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            info.linkname = linkname
+            info.mode = mode
+            if kind == tarfile.REGTYPE:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            else:
+                tar.addfile(info)
+        add("t", tarfile.DIRTYPE, mode=0o755)
+        add("t/ok", data=b"fine", mode=0o4777)
+        add("t/../escaped")
+        add("/tmp/absolute")
+        add("t/up", tarfile.SYMTYPE, "..")
+        add("t/up/escaped")
+        add("t/out", tarfile.SYMTYPE, "../../outside")
+        add("t/abs", tarfile.SYMTYPE, "/etc")
+        add("t/sub", tarfile.DIRTYPE, mode=0o755)
+        add("t/sub/back", tarfile.SYMTYPE, "..")
+        add("t/sub/through", tarfile.SYMTYPE, "back/../..")
+        add("t/sub/sibling", tarfile.SYMTYPE, "../ok")
+        add("t/ok2", tarfile.LNKTYPE, "t/ok")
+        add("t/fifo", tarfile.FIFOTYPE)
+        add("t/dev", tarfile.CHRTYPE)
+    return buf.getvalue()
+
+def test_tget_hostile_tree(tmp_path, monkeypatch, data_filter):
+    dest = tmp_path / "a" / "dest"
+    dest.mkdir(parents=True)
+    stream = hostile_tree()
+
+    def dial(self, port):
+        ours, theirs = socket.socketpair()
+        theirs.sendall(stream)
+        theirs.close()
+        return ours
+
+    monkeypatch.setattr(iotftp.ClientSession, "dial", dial)
+    session = iotftp.IoTFTPClient("127.0.0.1", 1, "ascii").session()
+    session.conn, session.welcome = StubConn(), None
+    session.tget("t", str(dest))
+
+    assert read_file(dest / "t" / "ok") == b"fine"
+    assert not os.stat(dest / "t" / "ok").st_mode & 0o7000
+    assert os.readlink(dest / "t" / "sub" / "sibling") == "../ok"
+    assert not (tmp_path / "a" / "escaped").exists()
+    assert not os.path.lexists(tmp_path / "tmp" / "absolute")
+    assert not os.path.lexists(dest / "t" / "out")
+    assert not os.path.lexists(dest / "t" / "abs")
+    assert not os.path.lexists(dest / "t" / "sub" / "through")
+    assert not os.path.lexists(dest / "t" / "fifo")
+    assert not os.path.lexists(dest / "t" / "dev")
+    # nothing written through a link to above dest
+    assert sorted(os.listdir(tmp_path / "a")) == ["dest"]
@@ -0,0 +1,78 @@
+import io
+import os
+import json
+import time
+import signal
+
+from iotftp.trace import Tracer
+from conftest import read_spans, write_file
+
+def test_tracer_phases():
+    tracer = Tracer()
+    tracer.enable(size=3)
+    tracer.label("k", ("127.0.0.1", 5), "GET")
+    tracer.begin("k", "command")
+    tracer.begin("k", "connect")
+    tracer.switch("k", "connect", "transfer")
+    tracer.finish("k")
+    tracer.begin("k", "ack")
+    tracer.abandon("k")
+    tracer.end("k", "ack")
+    tracer.forget("k")
+
+    f = io.StringIO()
+    tracer.dump(f)
+    spans = [json.loads(line) for line in f.getvalue().splitlines()]
+    assert sorted(span["phase"] for span in spans) == ["command", "connect", "transfer"]
+    assert all(span["addr"] == "127.0.0.1:5" and span["command"] == "GET" for span in spans)
+    assert all(span["duration_us"] >= 0 for span in spans)
+    assert not tracer.spans and not tracer.started and not tracer.labels
+
+def test_tracer_keeps_the_latest():
+    tracer = Tracer()
+    tracer.enable(size=2)
+    for phase in ("a", "b", "c"):
+        tracer.record("k", phase, tracer.clock())
+    assert [span.phase for span in tracer.spans] == ["b", "c"]
+
+def test_server_traces_phases(serve, cliroot, tmp_path):
+    trace = str(tmp_path / "trace")
+    srv = serve("--trace", "1000", "--trace-file", trace)
+    write_file(srv.path("f"), 1 << 20)
+    with srv.client(inline=0, mux=False).session() as s:
+        s.get("f")
+        s.size("f")
+        # the spans of a command are recorded once its reply is sent, so
+        # make sure the server is done with the last one checked
+        s.pwd()
+    srv.stop()
+
+    spans = read_spans(trace)
+    phases = {(span["command"], span["phase"]) for span in spans}
+    assert {
+        (None, "accept"),
+        ("GET", "parse"), ("GET", "command"), ("GET", "connect"),
+        ("GET", "transfer"), ("GET", "ack"),
+        ("SIZE", "parse"), ("SIZE", "command"),
+    } <= phases
+    assert all(span["pid"] == srv.proc.pid for span in spans)
+
+def test_dump_on_signal(serve, cliroot, tmp_path):
+    trace = str(tmp_path / "trace")
+    srv = serve("--trace", "1000", "--trace-file", trace)
+    with srv.client().session() as s:
+        s.pwd()
+        s.size("missing")
+    srv.proc.send_signal(signal.SIGUSR1)
+    deadline = time.monotonic() + 10
+    while not os.path.exists(trace) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert any(span["command"] == "PWD" for span in read_spans(trace))
+
+def test_no_trace_by_default(serve, cliroot, tmp_path):
+    trace = str(tmp_path / "trace")
+    srv = serve("--trace-file", trace)
+    with srv.client().session() as s:
+        s.pwd()
+    srv.stop()
+    assert not os.path.exists(trace)
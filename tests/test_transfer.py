@@ -0,0 +1,123 @@
+import os
+import errno
+import socket
+
+import pytest
+
+from iotftp import transfer
+from iotftp.transfer import BufferPool, FileReceiver, FileSender
+from iotftp.utils import ConnClosedErr
+from iotftp.digest import DEF_DIGEST, new_hasher
+
+from conftest import read_file, write_file
+
+def send_through(sender, size):
+    """
+    Drives sender over a nonblocking socketpair, returning what arrived.
+    """
+    a, b = socket.socketpair()
+    with a, b:
+        a.setblocking(False)
+        got = bytearray()
+        while not sender.done():
+            sender.send(a)
+            while True:
+                try:
+                    chunk = b.recv(1 << 16, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    break
+                got += chunk
+        a.close()
+        while len(got) < size:
+            chunk = b.recv(1 << 16)
+            if not chunk:
+                break
+            got += chunk
+    return bytes(got)
+
+@pytest.mark.parametrize("sendfile", [True, False])
+def test_sender(tmp_path, sendfile):
+    data = write_file(tmp_path / "a", (1 << 20) + 3)
+    with open(tmp_path / "a", "rb") as f:
+        sender = FileSender(f, len(data), sendfile=sendfile)
+        assert sender.use_sendfile == (sendfile and transfer.HAS_SENDFILE)
+        assert send_through(sender, len(data)) == data
+
+def test_sender_without_sendfile(tmp_path, monkeypatch):
+    monkeypatch.setattr(transfer, "HAS_SENDFILE", False)
+    data = write_file(tmp_path / "a", 100003)
+    with open(tmp_path / "a", "rb") as f:
+        sender = FileSender(f, len(data), offset=3)
+        assert not sender.use_sendfile
+        assert send_through(sender, len(data) - 3) == data[3:]
+
+def test_sender_falls_back(tmp_path, monkeypatch):
+    def unsupported(*args):
+        raise OSError(errno.EINVAL, "sendfile unsupported")
+    monkeypatch.setattr(os, "sendfile", unsupported, raising=False)
+    monkeypatch.setattr(transfer, "HAS_SENDFILE", True)
+    data = write_file(tmp_path / "a", 100003)
+    with open(tmp_path / "a", "rb") as f:
+        sender = FileSender(f, len(data))
+        assert send_through(sender, len(data)) == data
+        assert not sender.use_sendfile
+
+def test_sender_hashes(tmp_path):
+    data = write_file(tmp_path / "a", 100003)
+    hasher = new_hasher(DEF_DIGEST)
+    with open(tmp_path / "a", "rb") as f:
+        sender = FileSender(f, len(data), hasher=hasher)
+        # the hasher has to see the bytes, so sendfile is not used
+        assert not sender.use_sendfile
+        assert send_through(sender, len(data)) == data
+    expected = new_hasher(DEF_DIGEST)
+    expected.update(data)
+    assert hasher.digest() == expected.digest()
+
+def receive_through(receiver, data):
+    """
+    Sends data to receiver over a socketpair, then closes the sending side.
+    """
+    a, b = socket.socketpair()
+    with a, b:
+        b.setblocking(False)
+        sent = 0
+        while not receiver.done():
+            if sent < len(data):
+                sent += a.send(data[sent:sent + (1 << 14)])
+            elif a.fileno() != -1:
+                a.close()
+            receiver.recv(b)
+
+def test_receiver(tmp_path):
+    data = write_file(tmp_path / "a", (1 << 20) + 3)
+    pool = BufferPool(bufsize=1 << 14)
+    receiver = FileReceiver(open(tmp_path / "b", "wb"), len(data), pool)
+    receive_through(receiver, data)
+    assert receiver.finished()
+    receiver.close()
+    assert read_file(tmp_path / "b") == data
+    # the one buffer the transfer used went back to the pool
+    assert len(pool.free) == 1
+
+def test_receiver_reuses_buffers(tmp_path):
+    pool = BufferPool(bufsize=1 << 14)
+    bufs = set()
+    for i in range(3):
+        data = write_file(tmp_path / "a", 100003, seed=i)
+        receiver = FileReceiver(open(tmp_path / f"b{i}", "wb"), len(data), pool)
+        receive_through(receiver, data)
+        bufs.add(id(receiver.buf))
+        receiver.close()
+        assert read_file(tmp_path / f"b{i}") == data
+    assert len(bufs) == 1
+
+def test_receiver_truncates_short_transfer(tmp_path):
+    data = write_file(tmp_path / "a", 100003)
+    pool = BufferPool(bufsize=1 << 14)
+    receiver = FileReceiver(open(tmp_path / "b", "wb"), len(data) + 10, pool)
+    receiver.preallocate()
+    with pytest.raises(ConnClosedErr):
+        receive_through(receiver, data)
+    receiver.close()
+    assert read_file(tmp_path / "b") == data
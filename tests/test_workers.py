@@ -0,0 +1,32 @@
+import threading
+
+from conftest import read_file, write_file
+
+def test_workers_share_the_port(serve, cliroot):
+    srv = serve("--workers", "3")
+    names = [f"f{i}" for i in range(24)]
+    for i, name in enumerate(names):
+        write_file(srv.path(name), 1000 + i, seed=i)
+
+    errors = []
+    with srv.client().pool(8) as pool:
+        def get(name):
+            try:
+                pool.get(name)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=get, args=(name,)) for name in names]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    assert not errors
+    for name in names:
+        assert read_file(name) == read_file(srv.path(name))
+
+def test_bye_stops_every_worker(serve, cliroot):
+    srv = serve("--workers", "2")
+    srv.client().bye()
+    srv.proc.wait(10)
+    assert not srv.alive()